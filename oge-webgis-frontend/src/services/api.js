@@ -232,8 +232,8 @@ export const mcpService = {
     return await mcpApi.post('/water_extraction', params)
   },
 
-  // 获取任务状态
-  async getTaskStatus(taskId) {
+  // 获取任务状态；wait>0 时为长轮询，服务端在状态版本超过 sinceVersion 或超时后返回
+  async getTaskStatus(taskId, { wait = 0, sinceVersion = null } = {}) {
     if (OFFLINE_MODE) {
       return new Promise(resolve => {
         setTimeout(() => {
@@ -242,17 +242,24 @@ export const mcpService = {
         }, 300)
       })
     }
-    return await mcpApi.get(`/task_status/${taskId}`)
+    const params = { wait }
+    if (sinceVersion !== null) params.since_version = sinceVersion
+    const response = await mcpApi.get(`/task_status/${taskId}`, {
+      params,
+      timeout: (wait + 30) * 1000
+    })
+    return response.data
   },
 
-  // 获取任务历史
-  async getTaskHistory() {
+  // 获取任务历史，可按 user_id、status、since、limit 筛选
+  async getTaskHistory(params = {}) {
     if (OFFLINE_MODE) {
       return new Promise(resolve => {
         setTimeout(() => resolve(mockData.taskHistory), 500)
       })
     }
-    return await mcpApi.get('/task_history')
+    const response = await mcpApi.get('/task_history', { params })
+    return response.data
   }
 }
 
@@ -500,6 +507,25 @@ export const mapService = {
       })
     }
     return await mcpApi.post('/geo-stats', { bounds })
+  },
+
+  // 获取栅格结果信息（范围、金字塔、值域）
+  async getRasterInfo(userId, filename) {
+    if (OFFLINE_MODE) {
+      return new Promise((resolve, reject) => {
+        setTimeout(() => {
+          reject(new Error('栅格瓦片服务需要内网环境'))
+        }, 400)
+      })
+    }
+    return await mcpApi.get(`/raster/${userId}/${encodeURIComponent(filename)}/info`)
+  },
+
+  // 栅格结果XYZ瓦片地址模板，供地图图层直接使用
+  getRasterTileUrl(userId, filename, params = {}) {
+    const query = new URLSearchParams(params).toString()
+    const base = mcpApi.defaults.baseURL
+    return `${base}/raster/${userId}/${encodeURIComponent(filename)}/tiles/{z}/{x}/{y}.png${query ? `?${query}` : ''}`
   }
 }
 
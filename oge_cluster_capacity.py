@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+集群容量监控
+服务端原先不了解集群负载：集群已满时新任务照样提交，只能在Spark/YARN里排队。这里在后台定时采样
+Spark Master（SPARK_MASTER_UI 的 /json/）和 YARN ResourceManager（HADOOP_UI 的 /ws/v1/cluster/metrics）：
+
+- 每个DAG集群对应一组采样来源（spark / yarn），每次采样得到空闲核数、空闲内存和排队的应用数，
+  多个来源时取最紧张的一个，写入按集群的环形缓冲（保留最近 CAPACITY_RING_SIZE 次采样）；
+- 空闲核数、空闲内存低于阈值或排队应用过多，且连续 CAPACITY_SATURATION_SAMPLES 次如此，判为饱和；
+  采样失败或数据过期时视为未知，不影响提交；
+- 提交时饱和的集群排在后面（DagClusterRouter），所有集群都饱和时提交前等待，最多 CAPACITY_MAX_DELAY 秒。
+
+设置 OGE_CAPACITY_FIXTURES 时从该目录读取录制的响应（spark_master.json、yarn_metrics.json）代替HTTP请求，
+文件内容为JSON列表时按顺序回放（停在最后一个），用于离线验证阈值与路由。
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+import httpx
+
+from oge_metrics import MetricsText
+from oge_run_history import parse_window
+from yaogan_environment_config import SPARK_MASTER_UI, HADOOP_UI
+
+logger = logging.getLogger("shandong_mcp")
+
+# ============ 配置部分 ============
+
+CAPACITY_MONITOR_ENABLED = os.getenv("OGE_CAPACITY_MONITOR", "1") == "1"
+CAPACITY_SAMPLE_INTERVAL = float(os.getenv("OGE_CAPACITY_INTERVAL", "15"))
+CAPACITY_RING_SIZE = 240                 # 15秒一次时约保留1小时
+CAPACITY_REQUEST_TIMEOUT = 5
+CAPACITY_STALE_AFTER = 3                 # 超过3个采样间隔没有新数据视为未知
+CAPACITY_FIXTURE_DIR = os.getenv("OGE_CAPACITY_FIXTURES")
+# 各DAG集群的采样来源：{"DAG集群地址": {"spark": "Spark Master地址", "yarn": "ResourceManager地址"}}
+CAPACITY_SOURCES = os.getenv("OGE_CAPACITY_SOURCES")
+
+MIN_FREE_CORES = 2                       # 空闲核数低于此值判为饱和
+MIN_FREE_MEMORY_MB = 4096                # 空闲内存低于此值判为饱和
+MAX_QUEUED_APPS = 3                      # 排队应用达到此值判为饱和
+CAPACITY_SATURATION_SAMPLES = 2          # 连续几次满足才判为饱和，避免抖动
+CAPACITY_MAX_DELAY = float(os.getenv("OGE_CAPACITY_MAX_DELAY", "300"))   # 全部集群饱和时提交前最多等待的秒数
+
+SOURCE_PATHS = {"spark": "/json/", "yarn": "/ws/v1/cluster/metrics"}
+FIXTURE_FILES = {"spark": "spark_master.json", "yarn": "yarn_metrics.json"}
+
+
+def parse_spark_master(doc: dict) -> Dict[str, Any]:
+    """Spark Master /json/ 响应 -> 容量（只统计 ALIVE 的worker，内存单位MB）"""
+    workers = [w for w in doc.get("workers") or [] if w.get("state", "ALIVE") == "ALIVE"]
+    if workers:
+        total_cores = sum(int(w.get("cores") or 0) for w in workers)
+        used_cores = sum(int(w.get("coresused") or 0) for w in workers)
+        total_memory = sum(int(w.get("memory") or 0) for w in workers)
+        used_memory = sum(int(w.get("memoryused") or 0) for w in workers)
+    else:
+        total_cores, used_cores = int(doc.get("cores") or 0), int(doc.get("coresused") or 0)
+        total_memory, used_memory = int(doc.get("memory") or 0), int(doc.get("memoryused") or 0)
+    apps = doc.get("activeapps") or []
+    return {
+        "total_cores": total_cores,
+        "free_cores": max(0, total_cores - used_cores),
+        "total_memory_mb": total_memory,
+        "free_memory_mb": max(0, total_memory - used_memory),
+        "running_apps": sum(1 for a in apps if a.get("state") == "RUNNING"),
+        "queued_apps": sum(1 for a in apps if a.get("state") == "WAITING"),
+        "nodes": len(workers) if workers else int(doc.get("aliveworkers") or 0)
+    }
+
+
+def parse_yarn_metrics(doc: dict) -> Dict[str, Any]:
+    """YARN /ws/v1/cluster/metrics 响应 -> 容量"""
+    m = doc.get("clusterMetrics") or {}
+    return {
+        "total_cores": int(m.get("totalVirtualCores") or 0),
+        "free_cores": int(m.get("availableVirtualCores") or 0),
+        "total_memory_mb": int(m.get("totalMB") or 0),
+        "free_memory_mb": int(m.get("availableMB") or 0),
+        "running_apps": int(m.get("appsRunning") or 0),
+        "queued_apps": int(m.get("appsPending") or 0),
+        "nodes": int(m.get("activeNodes") or 0)
+    }
+
+
+PARSERS = {"spark": parse_spark_master, "yarn": parse_yarn_metrics}
+
+
+def is_saturated(capacity: Dict[str, Any]) -> bool:
+    """单次采样是否满足饱和条件"""
+    return (capacity["free_cores"] < MIN_FREE_CORES
+            or capacity["free_memory_mb"] < MIN_FREE_MEMORY_MB
+            or capacity["queued_apps"] >= MAX_QUEUED_APPS)
+
+
+def capacity_sources(dag_urls: Iterable[str]) -> Dict[str, Dict[str, str]]:
+    """各DAG集群的采样来源；未配置 OGE_CAPACITY_SOURCES 时第一个DAG集群使用环境配置中的Spark与YARN地址"""
+    if CAPACITY_SOURCES:
+        return {url.rstrip("/"): sources for url, sources in json.loads(CAPACITY_SOURCES).items()}
+    dag_urls = [url.rstrip("/") for url in dag_urls]
+    return {dag_urls[0]: {"spark": SPARK_MASTER_UI, "yarn": HADOOP_UI}} if dag_urls else {}
+
+
+class CapacityMonitor:
+    """后台采样集群容量，只在事件循环线程中使用"""
+
+    def __init__(self, clusters: Dict[str, Dict[str, str]], interval: float = CAPACITY_SAMPLE_INTERVAL,
+                 ring_size: int = CAPACITY_RING_SIZE, fixture_dir: Optional[str] = CAPACITY_FIXTURE_DIR,
+                 enabled: bool = CAPACITY_MONITOR_ENABLED):
+        self.clusters = {name: {kind: url.rstrip("/") for kind, url in sources.items() if kind in PARSERS}
+                         for name, sources in clusters.items()}
+        self.interval = interval
+        self.fixture_dir = Path(fixture_dir) if fixture_dir else None
+        self.enabled = enabled and bool(self.clusters)
+        self._samples: Dict[str, Deque[dict]] = {name: deque(maxlen=ring_size) for name in self.clusters}
+        self._fixture_positions: Dict[str, int] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"samples": 0, "errors": {}, "delayed_submissions": 0, "delay_seconds": 0.0}
+
+    # ---------- 采样 ----------
+
+    def _read_fixture(self, kind: str) -> dict:
+        path = self.fixture_dir / FIXTURE_FILES[kind]
+        doc = json.loads(path.read_text(encoding="utf-8"))
+        if isinstance(doc, list):
+            position = self._fixture_positions.get(kind, 0)
+            self._fixture_positions[kind] = position + 1
+            return doc[min(position, len(doc) - 1)]
+        return doc
+
+    async def _fetch(self, kind: str, base_url: str) -> dict:
+        if self.fixture_dir is not None:
+            return self._read_fixture(kind)
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=CAPACITY_REQUEST_TIMEOUT)
+        response = await self._client.get(f"{base_url}{SOURCE_PATHS[kind]}", headers={"Accept": "application/json"})
+        response.raise_for_status()
+        return response.json()
+
+    async def _sample_source(self, cluster: str, kind: str, base_url: str) -> Optional[dict]:
+        try:
+            return PARSERS[kind](await self._fetch(kind, base_url))
+        except Exception as e:
+            key = f"{cluster}|{kind}"
+            self.stats["errors"][key] = self.stats["errors"].get(key, 0) + 1
+            logger.debug(f"集群容量采样失败 {kind} {base_url}: {e}")
+            return None
+
+    async def sample_cluster(self, cluster: str) -> dict:
+        """采样一个集群的全部来源，写入环形缓冲并返回本次采样"""
+        kinds = list(self.clusters[cluster])
+        results = await asyncio.gather(*[
+            self._sample_source(cluster, kind, self.clusters[cluster][kind]) for kind in kinds
+        ])
+        sources = {kind: result for kind, result in zip(kinds, results)}
+        reachable = [c for c in sources.values() if c is not None]
+        sample = {"at": time.time(), "sources": sources, "free_cores": None, "free_memory_mb": None,
+                  "queued_apps": None, "saturated": None}
+        if reachable:
+            # 多个来源（Standalone与YARN）时取最紧张的一个
+            sample.update({
+                "free_cores": min(c["free_cores"] for c in reachable),
+                "free_memory_mb": min(c["free_memory_mb"] for c in reachable),
+                "queued_apps": max(c["queued_apps"] for c in reachable),
+                "saturated": any(is_saturated(c) for c in reachable)
+            })
+        self._samples[cluster].append(sample)
+        self.stats["samples"] += 1
+        return sample
+
+    async def sample_once(self) -> Dict[str, dict]:
+        samples = await asyncio.gather(*[self.sample_cluster(name) for name in self.clusters])
+        return dict(zip(self.clusters, samples))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sample_once()
+            except Exception as e:
+                logger.warning(f"集群容量采样出错: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """启动后台采样（同一事件循环中只启动一次）"""
+        if not self.enabled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._worker is not None and not self._worker.done() and self._worker.get_loop() is loop:
+            return
+        # 后台采样不继承调用方的截止时间
+        self._worker = loop.create_task(self._run(), context=contextvars.Context())
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # ---------- 查询 ----------
+
+    def latest(self, cluster: str) -> Optional[dict]:
+        """最近一次有效采样，过期时返回None"""
+        samples = self._samples.get(cluster.rstrip("/"))
+        if not samples:
+            return None
+        sample = samples[-1]
+        if sample["saturated"] is None or time.time() - sample["at"] > self.interval * CAPACITY_STALE_AFTER:
+            return None
+        return sample
+
+    def saturated(self, cluster: str) -> bool:
+        """最近 CAPACITY_SATURATION_SAMPLES 次采样都饱和时为True；没有监控或数据未知时为False"""
+        if self.latest(cluster) is None:
+            return False
+        recent = list(self._samples[cluster.rstrip("/")])[-CAPACITY_SATURATION_SAMPLES:]
+        return len(recent) >= CAPACITY_SATURATION_SAMPLES and all(s["saturated"] for s in recent)
+
+    def all_saturated(self, clusters: Iterable[str]) -> bool:
+        clusters = list(clusters)
+        return bool(clusters) and all(self.saturated(c) for c in clusters)
+
+    async def wait_for_capacity(self, clusters: Iterable[str], max_delay: float = CAPACITY_MAX_DELAY) -> float:
+        """所有集群都饱和时等待，直到有集群空闲或超过 max_delay，返回等待的秒数"""
+        clusters = list(clusters)
+        if not self.enabled or not self.all_saturated(clusters):
+            return 0.0
+        start = time.monotonic()
+        logger.info(f"所有DAG集群均已饱和，提交前等待空闲（最多{max_delay:.0f}秒）")
+        while self.all_saturated(clusters) and time.monotonic() - start < max_delay:
+            await asyncio.sleep(min(self.interval, max(0.0, max_delay - (time.monotonic() - start))))
+        waited = time.monotonic() - start
+        self.stats["delayed_submissions"] += 1
+        self.stats["delay_seconds"] += waited
+        return waited
+
+    def history(self, cluster: str, window: Any = "15m") -> List[dict]:
+        since = time.time() - parse_window(window)
+        return [s for s in self._samples.get(cluster.rstrip("/"), ()) if s["at"] >= since]
+
+    def snapshot(self, window: Any = "15m", cluster: Optional[str] = None) -> dict:
+        clusters = {}
+        for name in self.clusters:
+            if cluster and name != cluster.rstrip("/"):
+                continue
+            samples = [s for s in self.history(name, window) if s["saturated"] is not None]
+            clusters[name] = {
+                "sources": self.clusters[name],
+                "latest": self.latest(name),
+                "saturated": self.saturated(name),
+                "window": {
+                    "samples": len(samples),
+                    "min_free_cores": min((s["free_cores"] for s in samples), default=None),
+                    "min_free_memory_mb": min((s["free_memory_mb"] for s in samples), default=None),
+                    "max_queued_apps": max((s["queued_apps"] for s in samples), default=None),
+                    "saturated_fraction": round(sum(1 for s in samples if s["saturated"]) / len(samples), 3)
+                    if samples else None
+                }
+            }
+        return {
+            "enabled": self.enabled,
+            "interval": self.interval,
+            "fixture_dir": str(self.fixture_dir) if self.fixture_dir else None,
+            "clusters": clusters,
+            **self.stats
+        }
+
+    def write_metrics(self, metrics: MetricsText) -> None:
+        for name in self.clusters:
+            metrics.add("oge_cluster_saturated", self.saturated(name), {"cluster": name},
+                        help="集群是否饱和（连续多次采样空闲资源不足）")
+            latest = self.latest(name)
+            if latest is None:
+                continue
+            for kind, capacity in latest["sources"].items():
+                if capacity is None:
+                    continue
+                labels = {"cluster": name, "source": kind}
+                metrics.add("oge_cluster_free_cores", capacity["free_cores"], labels, help="集群空闲核数")
+                metrics.add("oge_cluster_total_cores", capacity["total_cores"], labels, help="集群总核数")
+                metrics.add("oge_cluster_free_memory_mb", capacity["free_memory_mb"], labels, help="集群空闲内存（MB）")
+                metrics.add("oge_cluster_queued_apps", capacity["queued_apps"], labels, help="集群排队中的应用数")
+            metrics.add("oge_cluster_capacity_sample_age_seconds", round(time.time() - latest["at"], 3),
+                        {"cluster": name}, help="最近一次有效容量采样距今的秒数")
+        for key, count in self.stats["errors"].items():
+            name, kind = key.split("|", 1)
+            metrics.add("oge_cluster_capacity_sample_errors_total", count, {"cluster": name, "source": kind},
+                        help="集群容量采样失败次数", type="counter")
+        metrics.add("oge_cluster_delayed_submissions_total", self.stats["delayed_submissions"],
+                    help="因集群饱和而延迟的提交次数", type="counter")
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+请求截止时间与被放弃任务的清理
+工具调用内部各层超时（executeCode 300秒、addTaskRecord 300秒、等待完成1800秒、默认120秒）原本互不相关，
+调用方断开后工具协程仍在轮询，集群上的Spark任务也继续运行。这里提供：
+
+- deadline_scope：每个请求一个截止时间（contextvars传递），嵌套时取更早的一个；到期时取消整棵协程树；
+- clamp_timeout：子调用的超时不超过剩余时间；
+- JobWatchers：记录每个集群任务当前有几个等待者，最后一个等待者因断开或超时离开时，
+  宽限期后仍无人接手则调用 on_orphan 取消集群上的任务。
+
+MCP调用方可以在请求的 _meta.deadlineSeconds 中指定截止时间，未指定时使用 DEFAULT_REQUEST_DEADLINE。
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger("shandong_mcp")
+
+# ============ 配置部分 ============
+
+DEFAULT_REQUEST_DEADLINE = float(os.getenv("OGE_REQUEST_DEADLINE", "3900"))  # 覆盖最长的3600秒等待
+MAX_REQUEST_DEADLINE = 4 * 3600
+ORPHAN_GRACE_SECONDS = 30   # 最后一个等待者离开后，等待重连的宽限时间
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求超过截止时间"""
+
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("oge_request_deadline", default=None)
+
+
+def remaining() -> Optional[float]:
+    """当前请求剩余的秒数，没有截止时间时返回None"""
+    at = _deadline.get()
+    if at is None:
+        return None
+    return at - asyncio.get_running_loop().time()
+
+
+def clamp_timeout(timeout: float) -> float:
+    """子调用的超时不超过请求剩余时间；已经到期时直接抛出 DeadlineExceeded"""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("请求已超过截止时间")
+    return min(timeout, left)
+
+
+@asynccontextmanager
+async def deadline_scope(seconds: float):
+    """在截止时间内执行，到期时取消块内的所有子调用并抛出 DeadlineExceeded"""
+    loop = asyncio.get_running_loop()
+    at = loop.time() + seconds
+    parent = _deadline.get()
+    if parent is not None:
+        at = min(at, parent)
+    token = _deadline.set(at)
+    try:
+        async with asyncio.timeout_at(at):
+            yield at
+    except TimeoutError as e:
+        if loop.time() >= at and not isinstance(e, DeadlineExceeded):
+            raise DeadlineExceeded(f"请求超过截止时间（{seconds:g}秒）") from e
+        raise
+    finally:
+        _deadline.reset(token)
+
+
+def request_deadline_seconds(meta, default: float = DEFAULT_REQUEST_DEADLINE) -> float:
+    """从MCP请求的 _meta 中读取 deadlineSeconds"""
+    extra = getattr(meta, "model_extra", None) or {}
+    try:
+        seconds = float(extra.get("deadlineSeconds") or default)
+    except (TypeError, ValueError):
+        seconds = default
+    return max(1.0, min(seconds, MAX_REQUEST_DEADLINE))
+
+
+def install_request_deadlines(server, default: float = DEFAULT_REQUEST_DEADLINE) -> None:
+    """给MCP服务器的工具调用加上请求级截止时间；客户端断开时mcp会取消处理协程，同样沿协程树传播"""
+    from mcp import types
+
+    handler = server.request_handlers[types.CallToolRequest]
+
+    async def call_tool_with_deadline(req: types.CallToolRequest):
+        seconds = request_deadline_seconds(req.params.meta, default)
+        try:
+            async with deadline_scope(seconds):
+                return await handler(req)
+        except DeadlineExceeded as e:
+            logger.warning(f"工具 {req.params.name} 超过截止时间 {seconds:.0f}秒，已取消")
+            return types.ServerResult(types.CallToolResult(
+                content=[types.TextContent(type="text", text=f"{req.params.name} 执行失败: {e}")],
+                isError=True
+            ))
+
+    server.request_handlers[types.CallToolRequest] = call_tool_with_deadline
+
+
+class JobWatchers:
+    """集群任务的等待者计数，只在事件循环线程中使用"""
+
+    def __init__(self, on_orphan: Optional[Callable[[str], Awaitable[None]]] = None,
+                 grace: float = ORPHAN_GRACE_SECONDS):
+        self.on_orphan = on_orphan
+        self.grace = grace
+        self._counts: Dict[str, int] = {}
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.stats = {"abandoned": 0, "reattached": 0, "orphaned": 0}
+
+    def waiters(self, job_id: str) -> int:
+        return self._counts.get(job_id, 0)
+
+    def attach(self, job_id: str) -> None:
+        self._counts[job_id] = self._counts.get(job_id, 0) + 1
+        pending = self._pending.pop(job_id, None)
+        if pending is not None:
+            pending.cancel()
+            self.stats["reattached"] += 1
+
+    def detach(self, job_id: str, abandoned: bool = False) -> None:
+        count = self._counts.get(job_id, 0) - 1
+        if count > 0:
+            self._counts[job_id] = count
+            return
+        self._counts.pop(job_id, None)
+        if abandoned and self.on_orphan is not None and job_id not in self._pending:
+            self.stats["abandoned"] += 1
+            # 清理任务不继承已取消请求的截止时间
+            task = asyncio.get_running_loop().create_task(self._reap(job_id), context=contextvars.Context())
+            self._pending[job_id] = task
+            task.add_done_callback(lambda t: self._pending.pop(job_id, None) if self._pending.get(job_id) is t else None)
+
+    async def _reap(self, job_id: str) -> None:
+        await asyncio.sleep(self.grace)
+        if self.waiters(job_id):
+            return
+        self.stats["orphaned"] += 1
+        try:
+            await self.on_orphan(job_id)
+        except Exception as e:
+            logger.warning(f"取消被放弃的集群任务失败 {job_id}: {e}")
+
+    @contextmanager
+    def watching(self, job_id: str):
+        """在块内作为等待者；块因取消或超时退出时视为放弃"""
+        self.attach(job_id)
+        abandoned = False
+        try:
+            yield
+        except (asyncio.CancelledError, TimeoutError):
+            abandoned = True
+            raise
+        finally:
+            self.detach(job_id, abandoned=abandoned)
+
+    def snapshot(self) -> dict:
+        return {"waiting": dict(self._counts), "pending_orphans": sorted(self._pending), **self.stats}
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+多入口路由
+OGE网关有多个等价入口（内网 172.20.70.142、172.30.22.116，外网穿透 111.37.195.111:7002），
+DAG批处理也有多个编号集群（oge-dag-22 等）。这里维护各入口的健康状态和延迟（EWMA），
+每次调用按“健康优先、延迟最低”排序并自动故障转移；DAG提交选择未饱和且负载最低的集群，
+并在共享状态中记录 dagId 归属的集群，后续的提交与状态查询都发往同一个集群。
+"""
+
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
+import httpx
+
+from oge_shared_state import get_state_backend
+
+# ============ 配置部分 ============
+
+LATENCY_EWMA_ALPHA = 0.3        # 延迟EWMA平滑系数
+FAILURE_THRESHOLD = 2           # 连续失败多少次判为不健康
+UNHEALTHY_COOLDOWN = 30         # 不健康入口冷却多少秒后重新尝试
+DAG_OWNER_TTL = 7 * 86400       # dagId -> 集群 的归属记录保留7天
+DAG_ACTIVE_TTL = 2 * 3600       # 活跃DAG计数的最长保留时间，防止异常退出导致负载虚高
+ACTIVE_LOCK_WAIT = 0.5          # 等待其他worker释放活跃计数锁的最长时间（秒）
+ACTIVE_LOCK_POLL = 0.01
+
+DAG_OWNER_KEY_PREFIX = "dag_cluster:"
+DAG_ACTIVE_KEY_PREFIX = "dag_cluster_active:"
+
+
+class Endpoint:
+    """单个入口的健康与延迟统计（进程内）"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.total_calls = 0
+        self.total_failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.consecutive_failures < FAILURE_THRESHOLD or time.monotonic() >= self.unhealthy_until
+
+    def record_success(self, latency: float):
+        self.total_calls += 1
+        self.consecutive_failures = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * self.latency
+
+    def record_failure(self):
+        self.total_calls += 1
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= FAILURE_THRESHOLD:
+            self.unhealthy_until = time.monotonic() + UNHEALTHY_COOLDOWN
+
+    def snapshot(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "latency_ewma": round(self.latency, 4) if self.latency is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "total_calls": self.total_calls,
+            "total_failures": self.total_failures
+        }
+
+
+class EndpointPool:
+    """一组等价入口，按健康状态和延迟排序"""
+
+    def __init__(self, name: str, base_urls: List[str]):
+        self.name = name
+        self.endpoints = [Endpoint(url) for url in dict.fromkeys(base_urls)]
+
+    def ordered(self) -> List[Endpoint]:
+        """健康入口在前（未测过延迟的优先试一次，刚失败过的靠后），不健康入口放在最后兜底"""
+        def sort_key(ep: Endpoint):
+            return (not ep.healthy, ep.consecutive_failures > 0, ep.latency if ep.latency is not None else -1.0)
+        return sorted(self.endpoints, key=sort_key)
+
+    def match(self, url: str) -> Optional[Tuple[Endpoint, str]]:
+        """判断url是否属于本池，返回(所属入口, 路径后缀)"""
+        for ep in self.endpoints:
+            if url == ep.base_url or url.startswith(ep.base_url + "/"):
+                return ep, url[len(ep.base_url):]
+        return None
+
+    def candidates(self, url: str) -> List[Tuple[Endpoint, str]]:
+        """把url改写到各个等价入口上，按优先级返回"""
+        matched = self.match(url)
+        if matched is None:
+            return []
+        _, suffix = matched
+        return [(ep, ep.base_url + suffix) for ep in self.ordered()]
+
+    def snapshot(self) -> dict:
+        return {"name": self.name, "endpoints": [ep.snapshot() for ep in self.ordered()]}
+
+
+class DagClusterRouter(EndpointPool):
+    """DAG集群路由：新任务发往负载最低的健康集群，已有dagId固定发往其所属集群"""
+
+    # 集群容量监控（oge_cluster_capacity.CapacityMonitor），设置后饱和的集群排在后面
+    capacity = None
+
+    def __init__(self, name: str, base_urls: List[str]):
+        super().__init__(name, base_urls)
+        # 进程内的更新先按集群串行，跨进程再由共享状态锁保护，等待锁时不阻塞事件循环
+        self._active_locks = {ep.base_url: asyncio.Lock() for ep in self.endpoints}
+
+    def saturated(self, ep: Endpoint) -> bool:
+        return self.capacity is not None and self.capacity.saturated(ep.base_url)
+
+    def active_count(self, ep: Endpoint) -> int:
+        active = get_state_backend().get(f"{DAG_ACTIVE_KEY_PREFIX}{ep.base_url}") or {}
+        now = time.time()
+        return sum(1 for assigned_at in active.values() if now - assigned_at < DAG_ACTIVE_TTL)
+
+    def submission_order(self) -> List[Endpoint]:
+        """健康优先，其次未饱和，再按活跃DAG数最少、延迟"""
+        def sort_key(ep: Endpoint):
+            return (
+                not ep.healthy,
+                self.saturated(ep),
+                self.active_count(ep),
+                ep.consecutive_failures > 0,
+                ep.latency if ep.latency is not None else -1.0
+            )
+        return sorted(self.endpoints, key=sort_key)
+
+    async def assign(self, dag_id: str, ep: Endpoint):
+        state = get_state_backend()
+        state.set(f"{DAG_OWNER_KEY_PREFIX}{dag_id}", ep.base_url, ttl=DAG_OWNER_TTL)
+        await self._update_active(ep.base_url, dag_id, add=True)
+
+    async def release(self, dag_id: str):
+        """DAG进入终态后释放集群负载计数"""
+        owner = self.owner(dag_id)
+        if owner:
+            await self._update_active(owner, dag_id, add=False)
+
+    def owner(self, dag_id: str) -> Optional[str]:
+        return get_state_backend().get(f"{DAG_OWNER_KEY_PREFIX}{dag_id}")
+
+    def url_for(self, dag_id: str, path: str) -> str:
+        """按dagId所属集群拼接接口地址，未知归属时使用首选集群"""
+        base = self.owner(dag_id) or self.endpoints[0].base_url
+        return f"{base}{path}"
+
+    async def _update_active(self, base_url: str, dag_id: str, add: bool):
+        state = get_state_backend()
+        key = f"{DAG_ACTIVE_KEY_PREFIX}{base_url}"
+        async with self._active_locks.setdefault(base_url, asyncio.Lock()):
+            lock_token = state.acquire_lock(key, ttl=5)
+            deadline = time.monotonic() + ACTIVE_LOCK_WAIT
+            while lock_token is None and time.monotonic() < deadline:
+                await asyncio.sleep(ACTIVE_LOCK_POLL)
+                lock_token = state.acquire_lock(key, ttl=5)
+            try:
+                active = state.get(key) or {}
+                now = time.time()
+                active = {k: v for k, v in active.items() if now - v < DAG_ACTIVE_TTL}
+                if add:
+                    active[dag_id] = now
+                else:
+                    active.pop(dag_id, None)
+                state.set(key, active)
+            finally:
+                if lock_token:
+                    state.release_lock(key, lock_token)
+
+    def snapshot(self) -> dict:
+        data = super().snapshot()
+        for item, ep in zip(data["endpoints"], self.ordered()):
+            item["active_dags"] = self.active_count(ep)
+            item["saturated"] = self.saturated(ep)
+        return data
+
+
+# 请求还没有发出去的网络异常，换入口重发不会造成重复执行
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout,
+                    httpx.ProxyError, httpx.UnsupportedProtocol)
+
+
+def transport_error_kind(exc: BaseException) -> Optional[str]:
+    """
+    网络异常分类，随call_api_with_timing的错误返回（transport_error 字段）：
+    connect 请求未发出；timeout 已发出但等待响应超时；io 已发出后连接中断；非网络异常返回None
+    """
+    if isinstance(exc, _NOT_SENT_ERRORS):
+        return "connect"
+    if isinstance(exc, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(exc, httpx.TransportError):
+        return "io"
+    return None
+
+
+def is_endpoint_failure(result, idempotent: bool = True) -> bool:
+    """
+    判断call_api_with_timing的返回是否属于入口故障，是否可以换入口重发：
+    - 请求未发出（连接失败）总是可以切换；
+    - 读超时不切换：后端可能仍在处理，换入口重发只会让慢任务再跑一遍；
+    - 请求已发出后的连接中断和5xx，只有幂等请求才切换。executeCode、addTaskRecord、结果登记等
+      非幂等POST此时可能已经在后端生效，重发会产生重复的DAG或任务记录；
+    - 业务错误和非网络异常不切换。
+    """
+    if not isinstance(result, dict) or "error" not in result:
+        return False
+    if result.get("code") == 40003:
+        return False
+    transport_error = result.get("transport_error")
+    if transport_error is not None:
+        return transport_error == "connect" or (idempotent and transport_error == "io")
+    status_code = result.get("status_code")
+    return idempotent and status_code is not None and status_code >= 500
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+CPU密集任务的执行子系统
+几何处理、大JSON的解析与编码、结果汇总原先直接在事件循环里运行，一个用户加载大的流出结果时，
+其他SSE会话全部停顿。这里提供：
+
+- run_cpu：进程池执行纯Python的CPU密集函数（函数须为模块级函数，参数和返回值可pickle），
+  每个任务执行前按 memory_limit 设置 RLIMIT_AS，超限时在调用方抛出 MemoryError；
+- run_blocking：线程池执行会释放GIL的库调用（rasterio、numpy、zlib、SQLite等）或需要共享本进程内存的计算；
+- 队列深度与耗时指标；
+- LoopWatchdog：后台线程监视事件循环心跳，循环被阻塞超过阈值时抓取循环线程的调用栈并记录。
+
+参数的pickle和结果的反序列化都在进程池的管理线程中进行，不占用事件循环。
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Deque, Optional
+
+try:
+    import resource
+except ImportError:  # 非Unix平台没有RLIMIT_AS，不做内存限制
+    resource = None
+
+from oge_metrics import MetricsText
+
+logger = logging.getLogger("shandong_mcp")
+
+# ============ 配置部分 ============
+
+PROCESS_WORKERS = int(os.getenv("OGE_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+THREAD_WORKERS = int(os.getenv("OGE_THREAD_WORKERS", "8"))
+TASK_MEMORY_LIMIT = int(os.getenv("OGE_TASK_MEMORY_LIMIT_MB", "2048")) * 1024 * 1024   # 单个进程任务的地址空间上限
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("OGE_LOOP_LAG_MS", "200"))   # 事件循环阻塞超过该值时记录调用栈
+LOOP_HEARTBEAT_INTERVAL = 0.05
+LOOP_LAG_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+STALL_HISTORY = 20
+
+
+def _invoke(func: Callable, args: tuple, kwargs: dict, memory_limit: Optional[int]):
+    """在工作进程中执行，返回 (结果, 开始时间, 结束时间)"""
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = hard
+        if memory_limit:
+            limit = memory_limit if hard == resource.RLIM_INFINITY else min(memory_limit, hard)
+        if limit != soft:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    started = time.time()
+    result = func(*args, **kwargs)
+    return result, started, time.time()
+
+
+class PoolStats:
+    """单个池的排队与耗时统计，只在事件循环线程中更新"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.inflight = 0
+        self.max_inflight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def submit(self) -> None:
+        self.submitted += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+
+    def finish(self, queue_wait: Optional[float], run_time: Optional[float], ok: bool) -> None:
+        self.inflight -= 1
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        if queue_wait is not None:
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        if run_time is not None:
+            self.run_total += run_time
+            self.run_max = max(self.run_max, run_time)
+
+    @property
+    def running(self) -> int:
+        return min(self.inflight, self.workers)
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.inflight - self.workers)
+
+    def snapshot(self) -> dict:
+        done = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "inflight": self.inflight,
+            "running": self.running,
+            "queued": self.queued,
+            "max_inflight": self.max_inflight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_queue_wait_ms": round(self.queue_wait_total / done * 1000, 2) if done else 0.0,
+            "max_queue_wait_ms": round(self.queue_wait_max * 1000, 2),
+            "avg_run_ms": round(self.run_total / done * 1000, 2) if done else 0.0,
+            "max_run_ms": round(self.run_max * 1000, 2),
+        }
+
+
+class Executor:
+    """进程池 + 线程池，惰性创建"""
+
+    def __init__(self, process_workers: int = PROCESS_WORKERS, thread_workers: int = THREAD_WORKERS,
+                 memory_limit: int = TASK_MEMORY_LIMIT):
+        self.process_workers = max(1, process_workers)
+        self.thread_workers = max(1, thread_workers)
+        self.memory_limit = memory_limit
+        self._process_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._thread_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._pid = None
+        self.process_stats = PoolStats("process", self.process_workers)
+        self.thread_stats = PoolStats("thread", self.thread_workers)
+        self.pool_restarts = 0
+
+    def _processes(self) -> concurrent.futures.ProcessPoolExecutor:
+        # fork之后（uvicorn多worker）不能复用父进程的池
+        if self._process_pool is None or self._pid != os.getpid():
+            # 事件循环进程里有多个线程，用forkserver/spawn启动工作进程，避免fork持锁的线程
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.process_workers, mp_context=multiprocessing.get_context(method)
+            )
+            self._pid = os.getpid()
+        return self._process_pool
+
+    def _threads(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.thread_workers, thread_name_prefix="oge-blocking"
+            )
+        return self._thread_pool
+
+    async def run_cpu(self, func: Callable, *args, memory_limit: Optional[int] = None, **kwargs) -> Any:
+        """在进程池中执行CPU密集函数；memory_limit 为字节数，默认 TASK_MEMORY_LIMIT"""
+        stats = self.process_stats
+        stats.submit()
+        submitted = time.time()
+        queue_wait = run_time = None
+        ok = False
+        try:
+            future = self._processes().submit(_invoke, func, args, kwargs, memory_limit or self.memory_limit)
+            result, started, finished = await asyncio.wrap_future(future)
+            queue_wait, run_time = max(0.0, started - submitted), finished - started
+            ok = True
+            return result
+        except BrokenProcessPool as e:
+            # 工作进程被系统杀掉（通常是内存超限），重建进程池
+            self._process_pool = None
+            self.pool_restarts += 1
+            raise RuntimeError(f"计算进程异常退出（可能超过内存上限）: {getattr(func, '__name__', func)}") from e
+        finally:
+            stats.finish(queue_wait, run_time, ok)
+
+    async def run_blocking(self, func: Callable, *args, **kwargs) -> Any:
+        """在线程池中执行阻塞调用"""
+        stats = self.thread_stats
+        stats.submit()
+        submitted = time.perf_counter()
+        timing = {}
+
+        def call():
+            timing["started"] = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing["finished"] = time.perf_counter()
+
+        ok = False
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._threads(), call)
+            ok = True
+            return result
+        finally:
+            started = timing.get("started")
+            stats.finish(
+                started - submitted if started is not None else None,
+                timing["finished"] - started if "finished" in timing else None,
+                ok
+            )
+
+    def shutdown(self) -> None:
+        if self._process_pool is not None and self._pid == os.getpid():
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
+        self._process_pool = self._thread_pool = None
+
+    def snapshot(self) -> dict:
+        return {
+            "process": self.process_stats.snapshot(),
+            "thread": self.thread_stats.snapshot(),
+            "memory_limit_mb": self.memory_limit // (1024 * 1024) if resource is not None else None,
+            "pool_restarts": self.pool_restarts,
+        }
+
+    def write_metrics(self, metrics: MetricsText) -> None:
+        for stats in (self.process_stats, self.thread_stats):
+            labels = {"pool": stats.name}
+            metrics.add("oge_executor_workers", stats.workers, labels, help="池中的工作进程/线程数")
+            metrics.add("oge_executor_running", stats.running, labels, help="正在执行的任务数")
+            metrics.add("oge_executor_queued", stats.queued, labels, help="排队等待执行的任务数")
+            metrics.add("oge_executor_tasks_total", stats.completed, {**labels, "outcome": "ok"},
+                        help="已结束的任务数", type="counter")
+            metrics.add("oge_executor_tasks_total", stats.failed, {**labels, "outcome": "error"}, type="counter")
+            metrics.add("oge_executor_queue_wait_seconds_total", round(stats.queue_wait_total, 6), labels,
+                        help="任务排队时间累计", type="counter")
+            metrics.add("oge_executor_run_seconds_total", round(stats.run_total, 6), labels,
+                        help="任务执行时间累计", type="counter")
+        metrics.add("oge_executor_pool_restarts_total", self.pool_restarts, help="进程池重建次数", type="counter")
+
+
+class LoopWatchdog:
+    """事件循环卡顿看门狗：循环内的心跳协程测量调度延迟，后台线程在心跳停止超过阈值时抓取调用栈"""
+
+    def __init__(self, threshold_ms: float = LOOP_LAG_THRESHOLD_MS, interval: float = LOOP_HEARTBEAT_INTERVAL):
+        self.threshold = threshold_ms / 1000.0
+        self.interval = interval
+        self.stalls: Deque[dict] = collections.deque(maxlen=STALL_HISTORY)
+        self.lag_buckets = {bound: 0 for bound in LOOP_LAG_BUCKETS_MS}
+        self.lag_count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.stall_count = 0
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._current_stall: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """在事件循环线程中调用"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="oge-loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - scheduled - self.interval)
+            self._last_beat = time.monotonic()
+            self._record_lag(lag)
+            stall = self._current_stall
+            if stall is not None:
+                # 卡顿结束，记录实际阻塞时长
+                stall["blocked_ms"] = round(lag * 1000, 1)
+                self._current_stall = None
+                logger.warning(f"事件循环阻塞 {stall['blocked_ms']}ms，调用栈见 /metrics?format=json")
+
+    def _record_lag(self, lag: float) -> None:
+        lag_ms = lag * 1000
+        self.lag_count += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        for bound in LOOP_LAG_BUCKETS_MS:
+            if lag_ms <= bound:
+                self.lag_buckets[bound] += 1
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.threshold / 2):
+            blocked = time.monotonic() - self._last_beat - self.interval
+            if blocked <= self.threshold or self._current_stall is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            stall = {"at": time.time(), "blocked_ms": round(blocked * 1000, 1), "stack": stack}
+            self._current_stall = stall
+            self.stalls.append(stall)
+            self.stall_count += 1
+            logger.warning(f"事件循环已阻塞超过 {blocked * 1000:.0f}ms，当前调用栈:\n{stack}")
+
+    def snapshot(self) -> dict:
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "lag_max_ms": round(self.lag_max * 1000, 2),
+            "lag_avg_ms": round(self.lag_total / self.lag_count * 1000, 2) if self.lag_count else 0.0,
+            "stall_count": self.stall_count,
+            "stalls": list(self.stalls),
+        }
+
+    def write_metrics(self, metrics: MetricsText) -> None:
+        buckets = {bound / 1000: count for bound, count in self.lag_buckets.items()}
+        buckets[float("inf")] = self.lag_count
+        metrics.histogram("oge_loop_lag_seconds", buckets, round(self.lag_total, 6), self.lag_count,
+                          help="事件循环调度延迟")
+        metrics.add("oge_loop_lag_max_seconds", round(self.lag_max, 6), help="事件循环最大调度延迟")
+        metrics.add("oge_loop_stalls_total", self.stall_count, help="事件循环阻塞超过阈值的次数", type="counter")
+
+
+_executor: Optional[Executor] = None
+_watchdog: Optional[LoopWatchdog] = None
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        _executor = Executor()
+    return _executor
+
+
+def get_watchdog() -> LoopWatchdog:
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = LoopWatchdog()
+    return _watchdog
+
+
+async def run_cpu(func: Callable, *args, memory_limit: Optional[int] = None, **kwargs) -> Any:
+    """CPU密集函数交给进程池执行"""
+    return await get_executor().run_cpu(func, *args, memory_limit=memory_limit, **kwargs)
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """阻塞调用交给线程池执行"""
+    return await get_executor().run_blocking(func, *args, **kwargs)
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+本地地名库（镇/村）
+每次耕地查询的第一步都是把用户说的地名解析为标准的镇/村名（ZLDWMC），前端的 /geocode、/reverse-geocode
+也需要同样的能力。这里在进程内维护一个地名库，正反向查询都不访问上游：
+
+- 正向：名称、去掉“村/镇/林场”等后缀的简称、拼音全拼与首字母建立前缀树，支持前缀匹配、
+  地址中包含地名（如“雪野镇房干村”）和编辑距离容错；拼音依赖 pypinyin，未安装时只按汉字匹配；
+- 反向：各地名的多边形外包框建立R树，再做点在多边形内判断，村优先于镇。
+
+地名来源：内置的雪野镇村名、地区目录中的 region_name；多边形优先使用行政区划边界文件
+（GeoJSON，属性 name/level/parent），没有边界文件的村用流出结果中该村地块的凸包近似，随结果增加逐步扩展。
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    from pypinyin import Style, lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+from oge_shared_state import get_state_backend
+from oge_geo_stats import STRTree
+from oge_script_planner import VILLAGE_FIELD
+
+# ============ 配置部分 ============
+
+TOWN_NAME = "雪野镇"
+XUEYE_VILLAGES = [
+    '三槐树村', '上游村', '上秋林村', '东下游村', '东峪村', '东张村', '东抬头村', '东栾宫村', '东站村', '冬暖村',
+    '北双王村', '北峪村', '北栾宫村', '北江水村', '北白座村', '华山村', '华山林场', '南双王村', '南圈村', '南峪村',
+    '南嵬石村', '南栾宫村', '南白座村', '吕祖泉村', '大厂村', '大寨村', '大罗圈村', '娘娘庙村', '学山村', '安子湾村',
+    '官正村', '富家庄村', '小楼村', '岭东村', '房干村', '望米台村', '朱公泉村', '李家庄村', '李白杨村', '栖龙湾村',
+    '桥子村', '毛家林村', '狂山村', '王老村', '石子口村', '石泉村', '红哨子村', '胡多罗村', '胡家庄村', '船厂村',
+    '花峪村', '蜂窝村', '西下游村', '西峪河北村', '西峪河南村', '西嵬石村', '西抬头村', '西站村', '邢家峪村', '酉坡村',
+    '阁老村', '雪野村', '雪野水库', '青合圈村', '马家峪村', '马鞍山林场', '鲁地村', '鹿野村', '黑山村', '龙马庄村',
+]
+NAME_SUFFIXES = ("林场", "水库", "街道", "村", "镇", "乡")
+BOUNDARY_FILE = Path(os.getenv("OGE_GAZETTEER_BOUNDARIES", "data/gazetteer/boundaries.geojson"))
+NAMES_KEY = "gazetteer:names"               # 地区目录中出现过的地名 {name: parent}
+DERIVED_KEY = "gazetteer:derived"           # 由结果地块推得的村凸包 {name: [[x, y], ...]}
+REFRESH_INTERVAL = 30                       # 进程内地名库检查数据源变化的间隔（秒）
+MIN_RESOLVE_SCORE = 0.6
+NEAREST_MAX_DEG = 0.05                      # 反向查询不在任何多边形内时，最近地名的最大距离
+
+BBox = Tuple[float, float, float, float]
+
+
+# ============ 名称处理 ============
+
+def short_name(name: str) -> str:
+    for suffix in NAME_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix) + 1:
+            return name[:-len(suffix)]
+    return name
+
+
+def pinyin_keys(name: str) -> List[str]:
+    """拼音全拼与首字母（如 房干村 -> fangancun, fgc），未安装 pypinyin 时为空"""
+    if lazy_pinyin is None:
+        return []
+    syllables = lazy_pinyin(name)
+    initials = lazy_pinyin(name, style=Style.FIRST_LETTER)
+    return ["".join(syllables).lower(), "".join(initials).lower()]
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein距离，超过 limit 时提前返回 limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class PrefixTrie:
+    """前缀树：键 -> 地名序号集合"""
+
+    _END = "\0"
+
+    def __init__(self):
+        self.root: dict = {}
+
+    def insert(self, key: str, item: int) -> None:
+        node = self.root
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(self._END, set()).add(item)
+
+    def exact(self, key: str) -> set:
+        node = self._find(key)
+        return set(node.get(self._END, ())) if node else set()
+
+    def prefix(self, prefix: str, limit: int = 20) -> List[int]:
+        """以 prefix 开头的键对应的地名，键越短越靠前"""
+        node = self._find(prefix)
+        if node is None:
+            return []
+        found, level = [], [node]
+        while level and len(found) < limit:
+            next_level = []
+            for current in level:
+                for char, child in current.items():
+                    if char == self._END:
+                        found.extend(item for item in sorted(child) if item not in found)
+                    else:
+                        next_level.append(child)
+            level = next_level
+        return found[:limit]
+
+    def _find(self, key: str) -> Optional[dict]:
+        node = self.root
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+
+# ============ 几何 ============
+
+def point_in_ring(x: float, y: float, ring: Sequence[Sequence[float]]) -> bool:
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def point_in_polygons(x: float, y: float, polygons: Sequence) -> bool:
+    """polygons 为 [[外环, 洞...], ...]"""
+    for rings in polygons:
+        if rings and point_in_ring(x, y, rings[0]) and not any(point_in_ring(x, y, hole) for hole in rings[1:]):
+            return True
+    return False
+
+
+def convex_hull(points: Iterable[Sequence[float]]) -> List[List[float]]:
+    """单调链凸包，返回闭合的环"""
+    pts = sorted(set((round(p[0], 7), round(p[1], 7)) for p in points))
+    if len(pts) < 3:
+        return [list(p) for p in pts]
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower, upper = [], []
+    for p in pts:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    for p in reversed(pts):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    hull = lower[:-1] + upper[:-1]
+    return [list(p) for p in hull + hull[:1]]
+
+
+def _geometry_polygons(geometry: dict) -> List:
+    if geometry.get("type") == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry.get("type") == "MultiPolygon":
+        return list(geometry["coordinates"])
+    return []
+
+
+def _polygons_bbox(polygons: Sequence) -> Optional[BBox]:
+    xs = [p[0] for rings in polygons for p in rings[0]] if polygons else []
+    ys = [p[1] for rings in polygons for p in rings[0]] if polygons else []
+    return (min(xs), min(ys), max(xs), max(ys)) if xs else None
+
+
+# ============ 地名库 ============
+
+class Gazetteer:
+    """不可变的地名库，数据源变化时整体重建"""
+
+    def __init__(self, places: List[dict]):
+        self.places = places
+        self.by_name = {place["name"]: i for i, place in enumerate(places)}
+        self.name_trie = PrefixTrie()
+        self.pinyin_trie = PrefixTrie()
+        self.fuzzy_keys: List[Tuple[str, int]] = []
+        for i, place in enumerate(places):
+            for key in {place["name"], short_name(place["name"])}:
+                self.name_trie.insert(key, i)
+                self.fuzzy_keys.append((key, i))
+            for key in pinyin_keys(place["name"]):
+                self.pinyin_trie.insert(key, i)
+                self.fuzzy_keys.append((key, i))
+        located = [i for i, place in enumerate(places) if place.get("bbox")]
+        self.tree = STRTree([places[i]["bbox"] for i in located], located)
+
+    def _result(self, i: int, match: str, score: float) -> dict:
+        place = self.places[i]
+        return {
+            "name": place["name"],
+            "level": place["level"],
+            "parent": place.get("parent"),
+            "center": place.get("center"),
+            "bbox": list(place["bbox"]) if place.get("bbox") else None,
+            "match": match,
+            "score": round(score, 3)
+        }
+
+    def geocode(self, query: str, limit: int = 5) -> List[dict]:
+        """正向查询，按匹配程度排序"""
+        text = "".join((query or "").split())
+        if not text:
+            return []
+        key = text.lower()
+        scored: Dict[int, Tuple[float, str]] = {}
+
+        def offer(i, score, match):
+            if i not in scored or scored[i][0] < score:
+                scored[i] = (score, match)
+
+        if text in self.by_name:
+            offer(self.by_name[text], 1.0, "exact")
+        for i in self.name_trie.exact(text) | self.pinyin_trie.exact(key):
+            offer(i, 0.95, "exact")
+        # 地址中包含地名，如“雪野镇房干村”，村比镇更具体
+        for name, i in self.by_name.items():
+            if name in text and name != text:
+                offer(i, 0.9 if self.places[i]["level"] == "village" else 0.85, "contains")
+        for i in self.name_trie.prefix(text) + self.pinyin_trie.prefix(key):
+            offer(i, 0.8, "prefix")
+        if not scored:
+            limit_distance = max(1, len(key) // 3)
+            for candidate, i in self.fuzzy_keys:
+                distance = edit_distance(key, candidate, limit_distance)
+                if distance <= limit_distance:
+                    offer(i, 0.7 - 0.1 * distance, "fuzzy")
+
+        # 同分时镇优先（“雪野”指雪野镇），再按名称长度
+        ranked = sorted(scored.items(), key=lambda item: (
+            -item[1][0], self.places[item[0]]["level"] != "town", len(self.places[item[0]]["name"])
+        ))
+        return [self._result(i, match, score) for i, (score, match) in ranked[:limit]]
+
+    def resolve(self, query: str) -> Optional[str]:
+        """
+        把用户输入的地名解析为标准名称，匹配程度不够或有歧义时返回None。
+        """
+        return self.resolve_candidates(query)[0]
+
+    def resolve_candidates(self, query: str, limit: int = 5) -> Tuple[Optional[str], List[str]]:
+        """
+        返回 (标准名称, 歧义候选)。前缀与容错匹配有多个同分候选时不做猜测，名称为None并返回候选：
+        如“西峪”同时是西峪河北村、西峪河南村的前缀，“西峪村”与东峪村/北峪村/南峪村都只差一个字。
+        前缀匹配同分时镇优先（“雪野”指雪野镇），只有同级别的同分候选才算歧义。
+        """
+        matches = [m for m in self.geocode(query, limit=limit) if m["score"] >= MIN_RESOLVE_SCORE]
+        if not matches:
+            return None, []
+        top = matches[0]
+        if top["match"] == "prefix":
+            tied = [m for m in matches if m["score"] == top["score"] and m["level"] == top["level"]]
+        elif top["match"] == "fuzzy":
+            tied = [m for m in matches if m["score"] == top["score"]]
+        else:
+            tied = [top]
+        if len(tied) > 1:
+            return None, [m["name"] for m in tied]
+        return top["name"], []
+
+    def reverse(self, lng: float, lat: float) -> List[dict]:
+        """包含该点的地名（村在前、镇在后）；不在任何多边形内时返回近处最近的一个地名"""
+        hits = [i for i in self.tree.query((lng, lat, lng, lat))
+                if point_in_polygons(lng, lat, self.places[i]["polygons"])]
+        if hits:
+            hits.sort(key=lambda i: 0 if self.places[i]["level"] == "village" else 1)
+            return [self._result(i, "contains", 1.0) for i in hits]
+        window = (lng - NEAREST_MAX_DEG, lat - NEAREST_MAX_DEG, lng + NEAREST_MAX_DEG, lat + NEAREST_MAX_DEG)
+        nearby = [i for i in self.tree.query(window) if self.places[i]["level"] == "village"]
+        if not nearby:
+            return []
+
+        def distance(i):
+            cx, cy = self.places[i]["center"]
+            return ((cx - lng) ** 2 + (cy - lat) ** 2) ** 0.5
+
+        nearest = min(nearby, key=distance)
+        return [self._result(nearest, "nearest", max(0.0, 1 - distance(nearest) / NEAREST_MAX_DEG))]
+
+    def bounds(self, names: Sequence[str], sources: Optional[Sequence[str]] = None) -> Dict[str, BBox]:
+        """
+        有范围信息的村 {名称: bbox}，供分片按空间邻近划分。
+        sources 指定时只返回这些来源的范围：结果地块凸包只覆盖有流出地块的部分，比村的实际范围小，
+        需要完整范围的场合（如确定光环）应只用边界文件（"boundary"）
+        """
+        result = {}
+        for name in names:
+            i = self.by_name.get(name)
+            if i is None or not self.places[i].get("bbox"):
+                continue
+            if sources is None or self.places[i]["source"] in sources:
+                result[name] = tuple(self.places[i]["bbox"])
+        return result
+
+    def snapshot(self) -> dict:
+        return {
+            "places": len(self.places),
+            "with_polygon": sum(1 for place in self.places if place.get("polygons")),
+            "sources": sorted({place["source"] for place in self.places}),
+            "pinyin": lazy_pinyin is not None
+        }
+
+
+def _load_boundary_file(path: Path) -> Dict[str, dict]:
+    if not path.exists():
+        return {}
+    collection = json.loads(path.read_text(encoding="utf-8"))
+    places = {}
+    for feature in collection.get("features", []):
+        props = feature.get("properties") or {}
+        name = props.get("name") or props.get(VILLAGE_FIELD)
+        polygons = _geometry_polygons(feature.get("geometry") or {})
+        if name and polygons:
+            places[name] = {"level": props.get("level") or ("town" if name.endswith("镇") else "village"),
+                            "parent": props.get("parent"), "polygons": polygons, "source": "boundary"}
+    return places
+
+
+def build_gazetteer() -> Gazetteer:
+    """合并各数据源：边界文件 > 结果地块凸包 > 仅名称"""
+    state = get_state_backend()
+    official = _load_boundary_file(BOUNDARY_FILE)
+    derived = state.get(DERIVED_KEY) or {}
+    names = {name: TOWN_NAME for name in XUEYE_VILLAGES}
+    names.update(state.get(NAMES_KEY) or {})
+
+    places = {}
+    for name, parent in names.items():
+        places[name] = {"level": "village", "parent": parent, "polygons": [], "source": "catalog"}
+        if name in derived and len(derived[name]) >= 4:
+            places[name].update({"polygons": [[derived[name]]], "source": "parcels"})
+    places.update(official)
+    if TOWN_NAME not in places:
+        # 镇的范围取各村范围的凸包
+        points = [p for place in places.values() if place.get("parent") == TOWN_NAME
+                  for rings in place["polygons"] for p in rings[0]]
+        hull = convex_hull(points) if points else []
+        places[TOWN_NAME] = {"level": "town", "parent": None, "polygons": [[hull]] if len(hull) >= 4 else [],
+                             "source": "derived" if points else "catalog"}
+
+    result = []
+    for name, place in sorted(places.items()):
+        bbox = _polygons_bbox(place["polygons"])
+        center = [round((bbox[0] + bbox[2]) / 2, 6), round((bbox[1] + bbox[3]) / 2, 6)] if bbox else None
+        result.append({"name": name, **place, "bbox": bbox, "center": center})
+    return Gazetteer(result)
+
+
+_gazetteer: Optional[Gazetteer] = None
+_gazetteer_version = None
+_checked_at = 0.0
+
+
+def _source_version() -> tuple:
+    state = get_state_backend()
+    mtime = BOUNDARY_FILE.stat().st_mtime if BOUNDARY_FILE.exists() else None
+    return mtime, json.dumps(state.get(NAMES_KEY), sort_keys=True), json.dumps(state.get(DERIVED_KEY), sort_keys=True)
+
+
+def get_gazetteer() -> Gazetteer:
+    """进程内地名库，每隔 REFRESH_INTERVAL 秒检查一次数据源是否变化"""
+    global _gazetteer, _gazetteer_version, _checked_at
+    now = time.time()
+    if _gazetteer is None or now - _checked_at > REFRESH_INTERVAL:
+        _checked_at = now
+        version = _source_version()
+        if _gazetteer is None or version != _gazetteer_version:
+            _gazetteer = build_gazetteer()
+            _gazetteer_version = version
+    return _gazetteer
+
+
+def register_names(names: Iterable[str], parent: str = TOWN_NAME) -> None:
+    """登记地区目录中的地名，已登记的不重复写入"""
+    state = get_state_backend()
+    known = state.get(NAMES_KEY) or {}
+    added = {name: parent for name in names if name and name not in known and name != parent}
+    if added:
+        state.set(NAMES_KEY, {**known, **added})
+
+
+def update_derived_boundaries(collection: dict) -> int:
+    """用结果地块扩展各村的凸包（与已有凸包合并），返回更新的村数"""
+    points: Dict[str, list] = {}
+    for feature in collection.get("features", []):
+        village = (feature.get("properties") or {}).get(VILLAGE_FIELD)
+        if not village:
+            continue
+        for rings in _geometry_polygons(feature.get("geometry") or {}):
+            points.setdefault(village, []).extend(rings[0])
+    if not points:
+        return 0
+    state = get_state_backend()
+    lock_token = state.acquire_lock(DERIVED_KEY, ttl=10)
+    try:
+        derived = state.get(DERIVED_KEY) or {}
+        for village, village_points in points.items():
+            derived[village] = convex_hull(village_points + derived.get(village, []))
+        state.set(DERIVED_KEY, derived)
+    finally:
+        if lock_token:
+            state.release_lock(DERIVED_KEY, lock_token)
+    return len(points)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+流出结果空间统计
+前端 mapService.getGeoStats 向 /geo-stats 提交当前视图范围，这里对流出结果按范围统计
+各流出原因（reason）、各村（ZLDWMC）的地块数和面积：
+
+- 要素外包框建立 STR（Sort-Tile-Recursive）打包的R树；
+- 与范围边界相交的地块裁剪到范围内，面积按裁剪前后的几何面积比例折算要素的 area 字段
+  （area 由集群在 EPSG:4527 下计算，比例在经纬度下计算，地块尺度上误差可以忽略）；
+- 预先按固定网格统计“完全落在单个网格内”的地块，查询时完全落在范围内的网格直接累加预统计结果，
+  只有范围边缘的网格和跨网格的地块需要逐个裁剪，整个视图的查询主要由预统计结果回答。
+
+裁剪只需要矩形窗口，使用 Sutherland-Hodgman 算法，不依赖 shapely。
+"""
+
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from oge_layer_registry import bbox_intersects, feature_bbox, union_bbox
+from oge_script_planner import VILLAGE_FIELD
+
+# ============ 配置部分 ============
+
+STATS_TILE_SIZE_DEG = 0.01          # 预统计网格边长（度），约1公里，远大于单个地块
+RTREE_NODE_CAPACITY = 16
+ENGINE_CACHE_SIZE = 4               # 进程内保留的统计引擎（按图层版本）数
+GROUP_FIELDS = {"reason": "reason", "village": VILLAGE_FIELD}
+
+BBox = Tuple[float, float, float, float]
+
+
+# ============ R树 ============
+
+class STRTree:
+    """STR打包的静态R树，只存外包框和要素序号"""
+
+    def __init__(self, boxes: Sequence[BBox], ids: Optional[Sequence[int]] = None,
+                 capacity: int = RTREE_NODE_CAPACITY):
+        self.capacity = capacity
+        entries = list(zip(boxes, ids if ids is not None else range(len(boxes))))
+        self.root = self._build([(box, item, None) for box, item in entries]) if entries else None
+
+    def _build(self, nodes: List[tuple]) -> tuple:
+        """自底向上逐层打包：按x排序切成竖条，每条内按y排序，每 capacity 个合成一个父节点"""
+        while len(nodes) > 1:
+            leaf_count = math.ceil(len(nodes) / self.capacity)
+            slice_count = math.ceil(math.sqrt(leaf_count))
+            slice_size = slice_count * self.capacity
+            nodes.sort(key=lambda node: node[0][0] + node[0][2])
+            parents = []
+            for i in range(0, len(nodes), slice_size):
+                strip = sorted(nodes[i:i + slice_size], key=lambda node: node[0][1] + node[0][3])
+                for j in range(0, len(strip), self.capacity):
+                    children = strip[j:j + self.capacity]
+                    parents.append((union_bbox([child[0] for child in children]), None, children))
+            nodes = parents
+        return nodes[0]
+
+    def query(self, bbox: Sequence[float]) -> List[int]:
+        """外包框与bbox相交的要素序号"""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            box, item, children = stack.pop()
+            if not bbox_intersects(box, bbox):
+                continue
+            if children is None:
+                found.append(item)
+            else:
+                stack.extend(children)
+        return found
+
+
+# ============ 几何计算 ============
+
+def ring_area(ring: Sequence[Sequence[float]]) -> float:
+    """鞋带公式，返回绝对面积"""
+    total = 0.0
+    for i in range(len(ring) - 1):
+        total += ring[i][0] * ring[i + 1][1] - ring[i + 1][0] * ring[i][1]
+    return abs(total) / 2.0
+
+
+def clip_ring(ring: Sequence[Sequence[float]], bbox: Sequence[float]) -> List[Tuple[float, float]]:
+    """Sutherland-Hodgman：把环裁剪到矩形内，返回闭合的环（可能为空）"""
+    points = [(p[0], p[1]) for p in ring]
+    if points and points[0] == points[-1]:
+        points = points[:-1]
+    edges = [
+        (lambda p: p[0] >= bbox[0], lambda a, b: _cross_x(a, b, bbox[0])),
+        (lambda p: p[0] <= bbox[2], lambda a, b: _cross_x(a, b, bbox[2])),
+        (lambda p: p[1] >= bbox[1], lambda a, b: _cross_y(a, b, bbox[1])),
+        (lambda p: p[1] <= bbox[3], lambda a, b: _cross_y(a, b, bbox[3])),
+    ]
+    for inside, cross in edges:
+        if not points:
+            break
+        clipped = []
+        previous = points[-1]
+        for current in points:
+            if inside(current):
+                if not inside(previous):
+                    clipped.append(cross(previous, current))
+                clipped.append(current)
+            elif inside(previous):
+                clipped.append(cross(previous, current))
+            previous = current
+        points = clipped
+    return points + points[:1]
+
+
+def _cross_x(a, b, x):
+    t = (x - a[0]) / (b[0] - a[0])
+    return x, a[1] + t * (b[1] - a[1])
+
+
+def _cross_y(a, b, y):
+    t = (y - a[1]) / (b[1] - a[1])
+    return a[0] + t * (b[0] - a[0]), y
+
+
+def _polygons(geometry: dict) -> Iterable[Sequence[Sequence[Sequence[float]]]]:
+    kind = geometry.get("type")
+    if kind == "Polygon":
+        yield geometry["coordinates"]
+    elif kind == "MultiPolygon":
+        yield from geometry["coordinates"]
+    elif kind == "GeometryCollection":
+        for part in geometry.get("geometries", []):
+            yield from _polygons(part)
+
+
+def geometry_area(geometry: dict, bbox: Optional[Sequence[float]] = None) -> float:
+    """几何面积（经纬度单位），给定bbox时为裁剪到bbox内的面积；洞的面积从外环中扣除"""
+    total = 0.0
+    for rings in _polygons(geometry or {}):
+        for i, ring in enumerate(rings):
+            area = ring_area(clip_ring(ring, bbox) if bbox else ring)
+            total += area if i == 0 else -area
+    return max(total, 0.0)
+
+
+def feature_area(feature: dict) -> float:
+    """要素的 area 字段（平方米），缺失时为0"""
+    try:
+        return float((feature.get("properties") or {}).get("area") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# ============ 统计 ============
+
+def empty_summary() -> dict:
+    return {"count": 0, "area": 0.0, "by_reason": {}, "by_village": {}}
+
+
+def _add(summary: dict, groups: Dict[str, str], area: float, count: int = 1) -> None:
+    summary["count"] += count
+    summary["area"] += area
+    for name, value in groups.items():
+        item = summary[f"by_{name}"].setdefault(value, {"count": 0, "area": 0.0})
+        item["count"] += count
+        item["area"] += area
+
+
+def _merge(target: dict, source: dict) -> None:
+    target["count"] += source["count"]
+    target["area"] += source["area"]
+    for name in GROUP_FIELDS:
+        for value, item in source[f"by_{name}"].items():
+            merged = target[f"by_{name}"].setdefault(value, {"count": 0, "area": 0.0})
+            merged["count"] += item["count"]
+            merged["area"] += item["area"]
+
+
+def _rounded(summary: dict) -> dict:
+    result = {"count": summary["count"], "area": round(summary["area"], 2)}
+    for name in GROUP_FIELDS:
+        result[f"by_{name}"] = {
+            value: {"count": item["count"], "area": round(item["area"], 2)}
+            for value, item in sorted(summary[f"by_{name}"].items(), key=lambda kv: -kv[1]["area"])
+        }
+    return result
+
+
+class GeoStatsEngine:
+    """一个流出结果的统计引擎：R树 + 网格预统计，构建后只读（线程安全）"""
+
+    def __init__(self, collection: dict, tile_size: float = STATS_TILE_SIZE_DEG):
+        self.tile_size = tile_size
+        self.features: List[dict] = []
+        self.boxes: List[BBox] = []
+        self.groups: List[Dict[str, str]] = []
+        self.geometry_areas: List[float] = []
+        for feature in collection.get("features", []):
+            box = feature_bbox(feature)
+            if not box:
+                continue
+            props = feature.get("properties") or {}
+            self.features.append(feature)
+            self.boxes.append(box)
+            self.groups.append({name: str(props.get(field) or "unknown") for name, field in GROUP_FIELDS.items()})
+            self.geometry_areas.append(geometry_area(feature.get("geometry")))
+
+        # 完全落在单个网格内的地块计入该网格的预统计，跨网格的地块单独建树
+        self.tiles: Dict[Tuple[int, int], dict] = {}
+        contained, straddling = [], []
+        for i, box in enumerate(self.boxes):
+            tile = self._tile_of(box)
+            if tile is None:
+                straddling.append(i)
+                continue
+            contained.append(i)
+            _add(self.tiles.setdefault(tile, empty_summary()), self.groups[i], feature_area(self.features[i]))
+        self.contained_tree = STRTree([self.boxes[i] for i in contained], contained)
+        self.straddling_tree = STRTree([self.boxes[i] for i in straddling], straddling)
+        self.straddling_count = len(straddling)
+        self.total = empty_summary()
+        for i in range(len(self.features)):
+            _add(self.total, self.groups[i], feature_area(self.features[i]))
+        self.bounds = union_bbox(self.boxes) if self.boxes else None
+
+    def _tile_of(self, box: BBox) -> Optional[Tuple[int, int]]:
+        col0, row0 = math.floor(box[0] / self.tile_size), math.floor(box[1] / self.tile_size)
+        col1, row1 = math.floor(box[2] / self.tile_size), math.floor(box[3] / self.tile_size)
+        return (col0, row0) if (col0, row0) == (col1, row1) else None
+
+    def _clipped_area(self, i: int, bbox: Sequence[float]) -> Optional[float]:
+        """地块在bbox内部分的面积（平方米），几何与bbox不相交时返回None"""
+        box = self.boxes[i]
+        if box[0] >= bbox[0] and box[1] >= bbox[1] and box[2] <= bbox[2] and box[3] <= bbox[3]:
+            return feature_area(self.features[i])
+        full = self.geometry_areas[i]
+        clipped = geometry_area(self.features[i].get("geometry"), bbox) if full > 0 else 0.0
+        if clipped <= 0:
+            return None
+        return feature_area(self.features[i]) * clipped / full
+
+    def _add_clipped(self, summary: dict, ids: Iterable[int], bbox: Sequence[float]) -> int:
+        """逐个裁剪候选地块（外包框相交但几何不相交的不计入），返回裁剪的地块数"""
+        clipped = 0
+        for i in ids:
+            clipped += 1
+            area = self._clipped_area(i, bbox)
+            if area is not None:
+                _add(summary, self.groups[i], area)
+        return clipped
+
+    def query(self, bbox: Optional[Sequence[float]] = None) -> dict:
+        """统计范围内的地块数与面积（平方米），bbox为空时统计全部"""
+        if bbox is None:
+            return {**_rounded(self.total), "tiles_used": len(self.tiles), "features_clipped": 0}
+        summary = empty_summary()
+        size = self.tile_size
+        # 完全落在范围内的网格
+        col0, row0 = math.ceil(round(bbox[0] / size, 9)), math.ceil(round(bbox[1] / size, 9))
+        col1, row1 = math.floor(round(bbox[2] / size, 9)) - 1, math.floor(round(bbox[3] / size, 9)) - 1
+        inner = (col0 * size, row0 * size, (col1 + 1) * size, (row1 + 1) * size) if col0 <= col1 and row0 <= row1 else None
+
+        tiles_used = 0
+        if inner:
+            for (col, row), tile_summary in self.tiles.items():
+                if col0 <= col <= col1 and row0 <= row <= row1:
+                    _merge(summary, tile_summary)
+                    tiles_used += 1
+
+        # 边缘：范围内、内部网格以外的单网格地块逐个裁剪
+        if inner:
+            def in_inner(i):
+                tile = self._tile_of(self.boxes[i])
+                return col0 <= tile[0] <= col1 and row0 <= tile[1] <= row1
+            strips = [
+                (bbox[0], bbox[1], inner[0], bbox[3]), (inner[2], bbox[1], bbox[2], bbox[3]),
+                (inner[0], bbox[1], inner[2], inner[1]), (inner[0], inner[3], inner[2], bbox[3]),
+            ]
+            edge_ids = {i for strip in strips for i in self.contained_tree.query(strip) if not in_inner(i)}
+        else:
+            edge_ids = set(self.contained_tree.query(bbox))
+        clipped = self._add_clipped(summary, sorted(edge_ids), bbox)
+        # 跨网格的地块不在预统计中，直接裁剪
+        clipped += self._add_clipped(summary, self.straddling_tree.query(bbox), bbox)
+        return {**_rounded(summary), "tiles_used": tiles_used, "features_clipped": clipped}
+
+    def tile_summaries(self, bbox: Optional[Sequence[float]] = None) -> List[dict]:
+        """各网格的预统计结果（不含跨网格地块），供前端按网格渲染热力/分级图"""
+        items = []
+        for (col, row), summary in sorted(self.tiles.items()):
+            tile_bbox = (col * self.tile_size, row * self.tile_size, (col + 1) * self.tile_size, (row + 1) * self.tile_size)
+            if bbox is not None and not bbox_intersects(tile_bbox, bbox):
+                continue
+            items.append({"tile": [col, row], "bbox": [round(v, 6) for v in tile_bbox],
+                          "count": summary["count"], "area": round(summary["area"], 2)})
+        return items
+
+
+_engine_cache: "OrderedDict[Tuple[str, str], GeoStatsEngine]" = OrderedDict()
+_engine_lock = threading.Lock()
+
+
+def get_engine(entry: dict, load_collection) -> GeoStatsEngine:
+    """按 (图层ID, 版本) 缓存的统计引擎；load_collection 读取图层的FeatureCollection，在线程池中调用"""
+    cache_key = (entry["id"], entry["version"])
+    with _engine_lock:
+        engine = _engine_cache.get(cache_key)
+        if engine is not None:
+            _engine_cache.move_to_end(cache_key)
+            return engine
+    engine = GeoStatsEngine(load_collection(entry))
+    with _engine_lock:
+        _engine_cache[cache_key] = engine
+        while len(_engine_cache) > ENGINE_CACHE_SIZE:
+            _engine_cache.popitem(last=False)
+    return engine
+
+
+def parse_bounds(bounds) -> Optional[BBox]:
+    """
+    解析前端提交的范围：[minLon, minLat, maxLon, maxLat]、[[west, south], [east, north]]、
+    mapbox LngLatBounds 序列化结果 {_sw: {lng, lat}, _ne: {lng, lat}} 或 {west, south, east, north}
+    """
+    if bounds is None:
+        return None
+    if isinstance(bounds, dict):
+        if "_sw" in bounds and "_ne" in bounds:
+            values = [bounds["_sw"]["lng"], bounds["_sw"]["lat"], bounds["_ne"]["lng"], bounds["_ne"]["lat"]]
+        else:
+            values = [bounds["west"], bounds["south"], bounds["east"], bounds["north"]]
+    elif len(bounds) == 2:
+        values = [bounds[0][0], bounds[0][1], bounds[1][0], bounds[1][1]]
+    else:
+        values = list(bounds)
+    values = [float(v) for v in values]
+    if len(values) != 4 or values[0] > values[2] or values[1] > values[3]:
+        raise ValueError(f"无效的范围: {bounds}")
+    return values[0], values[1], values[2], values[3]
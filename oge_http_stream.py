@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+流式读取HTTP响应
+call_api_with_timing 原先通过 response.text、strip() 和 response.json() 处理响应，大的目录或日志响应
+在内存中会同时存在两三份。这里提供：
+
+- read_capped：按块读取响应体，超过上限立即中止（ResponseTooLarge），只保留一份字节；
+- parse_body：直接从字节解析JSON，解析失败时才解码为文本；
+- select_json：对已知的大接口（如结果目录）按前缀增量解析，只保留满足条件的元素和需要的字段，
+  凑够 limit 条后不再读取剩余内容。安装了 ijson 时边下载边解析，否则读取（受上限约束）后整体解析再筛选。
+
+前缀沿用 ijson 的写法：对象成员用 "."，数组元素为 "item"，例如 "data.item" 表示顶层 data 数组中的每个元素。
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+try:
+    import ijson
+except ImportError:  # 可选依赖：没有ijson时整体解析后筛选
+    ijson = None
+
+# ============ 配置部分 ============
+
+MAX_RESPONSE_BYTES = int(os.getenv("OGE_MAX_RESPONSE_BYTES", str(64 * 1024 * 1024)))
+READ_CHUNK_SIZE = 64 * 1024
+TEXT_PREVIEW_CHARS = 2000   # 错误响应保留的文本长度
+
+
+def available() -> bool:
+    """是否可以边下载边解析JSON"""
+    return ijson is not None
+
+
+class ResponseTooLarge(Exception):
+    """响应体超过允许的大小"""
+
+
+@dataclass
+class JsonSelect:
+    """只取JSON中 prefix 处满足 where 条件的元素；fields 为需要保留的字段，limit 为最多取几条"""
+    prefix: str = "data.item"
+    where: Optional[Dict[str, Any]] = None
+    fields: Optional[Sequence[str]] = None
+    limit: Optional[int] = None
+
+    def matches(self, item: Any) -> bool:
+        if not self.where:
+            return True
+        return isinstance(item, dict) and all(item.get(k) == v for k, v in self.where.items())
+
+    def project(self, item: Any) -> Any:
+        if not self.fields or not isinstance(item, dict):
+            return item
+        return {k: item[k] for k in self.fields if k in item}
+
+    @property
+    def container(self) -> str:
+        """结果中存放筛选元素的键：去掉末尾的 item，取最后一级名称"""
+        parts = [p for p in self.prefix.split(".") if p != "item"]
+        return parts[-1] if parts else "items"
+
+
+def _check_declared_size(response: httpx.Response, max_bytes: int) -> None:
+    declared = response.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise ResponseTooLarge(f"响应体 {int(declared)} 字节，超过上限 {max_bytes} 字节")
+
+
+async def read_capped(response: httpx.Response, max_bytes: int = MAX_RESPONSE_BYTES) -> bytes:
+    """按块读取（已解压的）响应体，超过上限时中止"""
+    _check_declared_size(response, max_bytes)
+    body = bytearray()
+    async for chunk in response.aiter_bytes(READ_CHUNK_SIZE):
+        body += chunk
+        if len(body) > max_bytes:
+            raise ResponseTooLarge(f"响应体超过上限 {max_bytes} 字节")
+    return bytes(body)
+
+
+def parse_body(body: bytes) -> Tuple[Any, Optional[str]]:
+    """返回 (解析结果, 错误信息)；不是JSON时返回去掉首尾空白的文本"""
+    try:
+        return json.loads(body), None
+    except ValueError as e:
+        return body.decode("utf-8", errors="replace").strip(), str(e)
+
+
+def text_preview(body: bytes) -> str:
+    return body[:TEXT_PREVIEW_CHARS * 4].decode("utf-8", errors="replace")[:TEXT_PREVIEW_CHARS]
+
+
+class _CappedReader:
+    """给 ijson 使用的异步文件对象，读取量超过上限时中止"""
+
+    def __init__(self, response: httpx.Response, max_bytes: int):
+        self._chunks = response.aiter_bytes(READ_CHUNK_SIZE)
+        self._buffer = b""
+        self._done = False
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    async def read(self, size: int = -1) -> bytes:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+                break
+            self.bytes_read += len(chunk)
+            if self.bytes_read > self.max_bytes:
+                raise ResponseTooLarge(f"响应体超过上限 {self.max_bytes} 字节")
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _walk(obj: Any, parts: List[str]):
+    """按前缀遍历已解析的对象"""
+    if not parts:
+        yield obj
+        return
+    head, rest = parts[0], parts[1:]
+    if head == "item":
+        if isinstance(obj, list):
+            for value in obj:
+                yield from _walk(value, rest)
+    elif isinstance(obj, dict) and head in obj:
+        yield from _walk(obj[head], rest)
+
+
+def _selected(select: JsonSelect, top: dict, items: list, scanned: int, truncated: bool) -> dict:
+    return {
+        **top,
+        select.container: items,
+        "selected": {"prefix": select.prefix, "scanned": scanned, "matched": len(items), "truncated": truncated}
+    }
+
+
+async def select_json(response: httpx.Response, select: JsonSelect, max_bytes: int = MAX_RESPONSE_BYTES) -> dict:
+    """
+    从响应中只取出需要的元素，同时保留顶层的标量字段（code、msg 等，供token过期等判断使用）。
+    返回 {顶层标量..., <容器名>: [元素...], "selected": {...}}
+    """
+    _check_declared_size(response, max_bytes)
+    top: Dict[str, Any] = {}
+    items: List[Any] = []
+    scanned = 0
+
+    if ijson is None:
+        parsed, error = parse_body(await read_capped(response, max_bytes))
+        if error is not None:
+            raise ValueError(f"响应不是JSON: {error}")
+        if isinstance(parsed, dict):
+            top = {k: v for k, v in parsed.items() if not isinstance(v, (dict, list))}
+        for item in _walk(parsed, [p for p in select.prefix.split(".") if p]):
+            scanned += 1
+            if select.matches(item):
+                items.append(select.project(item))
+                if select.limit and len(items) >= select.limit:
+                    return _selected(select, top, items, scanned, True)
+        return _selected(select, top, items, scanned, False)
+
+    builder = None
+    depth = 0
+    async for prefix, event, value in ijson.parse_async(_CappedReader(response, max_bytes), use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth > 0:
+                continue
+            item, builder = builder.value, None
+        elif prefix == select.prefix and event in ("start_map", "start_array"):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            depth = 1
+            continue
+        elif prefix == select.prefix and event not in ("map_key", "end_map", "end_array"):
+            item = value
+        else:
+            # 顶层标量：prefix 不含 "." 且不是容器事件
+            if prefix and "." not in prefix and event in ("string", "number", "integer", "double", "boolean", "null"):
+                top[prefix] = value
+            continue
+
+        scanned += 1
+        if select.matches(item):
+            items.append(select.project(item))
+            if select.limit and len(items) >= select.limit:
+                # 已经凑够，不再读取剩余内容
+                return _selected(select, top, items, scanned, True)
+    return _selected(select, top, items, scanned, False)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+图层登记表与按范围取数
+/layers 原来返回写死的三个图层，前端按 bbox 调用的 /layers/{id}/data 也没有实现。这里维护一个图层登记表：
+
+- 已完成的分析结果（GeoJSON矢量结果、tif栅格结果）在下载到本地结果缓存后登记为图层；
+- 约束图层：底图服务上的瓦片图层，以及物化约束图层登记表中的当前版本；
+- 矢量图层按需建立网格空间索引（进程内LRU），/layers/{id}/data 只返回与 bbox 相交的要素。
+
+登记表放在共享状态中，各worker共用；每个图层带版本号（本地文件的修改时间和大小），
+响应的ETag由版本号和请求参数决定，地图平移时数据未变化的请求直接返回304。
+"""
+
+import gzip
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from oge_shared_state import get_state_backend
+from oge_materialized_layers import get_registry as get_materialized_registry
+from oge_tile_proxy import TILE_LAYERS, TILE_LAYER_CENTER, proxied_tile_url
+
+# ============ 配置部分 ============
+
+REGISTRY_KEY = "layers:registry"
+RESULT_LAYER_LIMIT = 50             # 登记表中保留的结果图层数，超出时移除最早登记的
+INDEX_CACHE_SIZE = 8                # 进程内保留空间索引的图层数
+DEFAULT_FEATURE_LIMIT = 5000        # 单次请求默认最多返回的要素数
+MAX_FEATURE_LIMIT = 50000
+COMPRESS_MIN_BYTES = 1024           # 小于该值的响应不压缩
+
+BBox = Tuple[float, float, float, float]
+
+
+def layer_id_for(key: str) -> str:
+    """结果图层ID，由结果对象名决定，同一结果重复登记时覆盖原条目"""
+    return "result-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+# ============ 登记表 ============
+
+def _static_layers() -> List[dict]:
+    """约束图层瓦片（经本服务代理）与物化约束图层，不写入登记表，每次按当前配置生成"""
+    layers = [{
+        "id": f"tile-{item['table']}",
+        "name": item["name"],
+        "type": "tile",
+        "category": item["category"],
+        "source": "constraint",
+        "url": proxied_tile_url(item["table"]),
+        "center": TILE_LAYER_CENTER,
+        "version": "static",
+        "has_data": False,
+        "visible": False
+    } for item in TILE_LAYERS]
+    for key, entry in sorted(get_materialized_registry().items()):
+        if not entry.get("asset"):
+            continue
+        layers.append({
+            "id": f"constraint-{entry['asset']}",
+            "name": entry["asset"],
+            "type": "vector",
+            "category": "constraint",
+            "source": "materialized",
+            "table": entry.get("table"),
+            "crs": entry.get("crs"),
+            "version": str(entry.get("version")),
+            "built_at": entry.get("built_at"),
+            "has_data": False,
+            "visible": False
+        })
+    return layers
+
+
+def _registered() -> Dict[str, dict]:
+    return get_state_backend().get(REGISTRY_KEY) or {}
+
+
+def _register(entry: dict) -> dict:
+    """写入登记表，结果图层超过上限时移除最早登记的"""
+    state = get_state_backend()
+    lock_token = state.acquire_lock(REGISTRY_KEY, ttl=10)
+    try:
+        registry = _registered()
+        registry[entry["id"]] = entry
+        if len(registry) > RESULT_LAYER_LIMIT:
+            ordered = sorted(registry.values(), key=lambda item: item.get("registered_at", 0))
+            for stale in ordered[:len(registry) - RESULT_LAYER_LIMIT]:
+                registry.pop(stale["id"], None)
+        state.set(REGISTRY_KEY, registry)
+    finally:
+        if lock_token:
+            state.release_lock(REGISTRY_KEY, lock_token)
+    return entry
+
+
+def file_version(path: Path) -> str:
+    stat = path.stat()
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def register_vector_layer(layer_id: str, name: str, path: Path, source_key: Optional[str] = None,
+                          category: str = "result") -> dict:
+    """把本地GeoJSON结果登记为矢量图层（读取一次以统计范围和要素数）"""
+    collection = json.loads(path.read_text(encoding="utf-8"))
+    features = collection.get("features", [])
+    boxes = [box for box in (feature_bbox(feature) for feature in features) if box]
+    return _register({
+        "id": layer_id,
+        "name": name,
+        "type": "vector",
+        "category": category,
+        "source": "result",
+        "key": source_key,
+        "path": str(path),
+        "bounds": list(union_bbox(boxes)) if boxes else None,
+        "feature_count": len(features),
+        "version": file_version(path),
+        "registered_at": time.time(),
+        "has_data": True,
+        "visible": True
+    })
+
+
+def register_raster_layer(layer_id: str, name: str, tiles_url: str, bounds: Optional[Sequence[float]],
+                          source_key: Optional[str] = None, version: str = "") -> dict:
+    """把已转换为COG的栅格结果登记为瓦片图层"""
+    return _register({
+        "id": layer_id,
+        "name": name,
+        "type": "raster",
+        "category": "result",
+        "source": "result",
+        "key": source_key,
+        "url": tiles_url,
+        "bounds": list(bounds) if bounds else None,
+        "version": version,
+        "registered_at": time.time(),
+        "has_data": False,
+        "visible": True
+    })
+
+
+def list_layers() -> List[dict]:
+    """全部图层：约束图层在前，结果图层按登记时间倒序"""
+    results = sorted(_registered().values(), key=lambda item: item.get("registered_at", 0), reverse=True)
+    return _static_layers() + [{k: v for k, v in entry.items() if k != "path"} for entry in results]
+
+
+def get_layer(layer_id: str) -> Optional[dict]:
+    entry = _registered().get(layer_id)
+    if entry is None:
+        entry = next((layer for layer in _static_layers() if layer["id"] == layer_id), None)
+    return entry
+
+
+def latest_vector_layer() -> Optional[dict]:
+    """最近登记的矢量结果图层"""
+    layers = [entry for entry in _registered().values() if entry.get("has_data")]
+    return max(layers, key=lambda entry: entry.get("registered_at", 0)) if layers else None
+
+
+def read_collection(entry: dict) -> dict:
+    return json.loads(Path(entry["path"]).read_text(encoding="utf-8"))
+
+
+# ============ 空间索引 ============
+
+def _iter_positions(coordinates) -> Iterable[Sequence[float]]:
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for part in coordinates or []:
+        yield from _iter_positions(part)
+
+
+def geometry_bbox(geometry: Optional[dict]) -> Optional[BBox]:
+    if not geometry:
+        return None
+    if geometry.get("type") == "GeometryCollection":
+        boxes = [box for box in (geometry_bbox(g) for g in geometry.get("geometries", [])) if box]
+        return union_bbox(boxes) if boxes else None
+    xs, ys = [], []
+    for position in _iter_positions(geometry.get("coordinates")):
+        xs.append(position[0])
+        ys.append(position[1])
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def feature_bbox(feature: dict) -> Optional[BBox]:
+    return geometry_bbox(feature.get("geometry"))
+
+
+def union_bbox(boxes: Sequence[BBox]) -> BBox:
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def bbox_intersects(a: Sequence[float], b: Sequence[float]) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class FeatureIndex:
+    """
+    均匀网格空间索引：按要素外包框登记到覆盖的网格单元，查询时只检查与bbox相交的单元中的要素。
+    网格边数取 sqrt(要素数/4)，平均每个单元约4个要素。
+    """
+
+    def __init__(self, collection: dict):
+        self.crs = collection.get("crs")
+        self.features = []
+        self.boxes: List[BBox] = []
+        for feature in collection.get("features", []):
+            box = feature_bbox(feature)
+            if box:
+                self.features.append(feature)
+                self.boxes.append(box)
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        if not self.boxes:
+            self.bounds = None
+            return
+        self.bounds = union_bbox(self.boxes)
+        self.side = max(1, min(512, int(math.sqrt(len(self.boxes) / 4))))
+        self.cell_w = (self.bounds[2] - self.bounds[0]) / self.side or 1e-9
+        self.cell_h = (self.bounds[3] - self.bounds[1]) / self.side or 1e-9
+        for i, box in enumerate(self.boxes):
+            for cell in self._cells(box):
+                self.cells.setdefault(cell, []).append(i)
+
+    def _cells(self, box: Sequence[float]) -> Iterable[Tuple[int, int]]:
+        def clamp(value):
+            return min(max(value, 0), self.side - 1)
+
+        col0 = clamp(int((box[0] - self.bounds[0]) / self.cell_w))
+        col1 = clamp(int((box[2] - self.bounds[0]) / self.cell_w))
+        row0 = clamp(int((box[1] - self.bounds[1]) / self.cell_h))
+        row1 = clamp(int((box[3] - self.bounds[1]) / self.cell_h))
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                yield col, row
+
+    def query(self, bbox: Optional[Sequence[float]] = None) -> List[int]:
+        """与bbox外包框相交的要素序号（按原顺序），bbox为空时返回全部"""
+        if bbox is None:
+            return list(range(len(self.features)))
+        if self.bounds is None or not bbox_intersects(bbox, self.bounds):
+            return []
+        candidates = set()
+        for cell in self._cells(bbox):
+            candidates.update(self.cells.get(cell, ()))
+        return sorted(i for i in candidates if bbox_intersects(self.boxes[i], bbox))
+
+
+_index_cache: "OrderedDict[Tuple[str, str], FeatureIndex]" = OrderedDict()
+_index_lock = threading.Lock()
+
+
+def load_index(entry: dict) -> FeatureIndex:
+    """图层的空间索引，按 (图层ID, 版本) 缓存；在线程池中调用"""
+    cache_key = (entry["id"], entry["version"])
+    with _index_lock:
+        index = _index_cache.get(cache_key)
+        if index is not None:
+            _index_cache.move_to_end(cache_key)
+            return index
+    index = FeatureIndex(read_collection(entry))
+    with _index_lock:
+        _index_cache[cache_key] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def query_layer_features(entry: dict, bbox: Optional[Sequence[float]], limit: int = DEFAULT_FEATURE_LIMIT) -> dict:
+    """按bbox取图层要素，超过 limit 时截断并标记 truncated"""
+    index = load_index(entry)
+    matched = index.query(bbox)
+    collection = {
+        "type": "FeatureCollection",
+        "features": [index.features[i] for i in matched[:limit]],
+        "layerId": entry["id"],
+        "version": entry["version"],
+        "matched": len(matched),
+        "truncated": len(matched) > limit
+    }
+    if index.crs:
+        collection["crs"] = index.crs
+    return collection
+
+
+# ============ HTTP缓存与压缩 ============
+
+def parse_bbox(text: Optional[str]) -> Optional[BBox]:
+    """解析 bbox=minLon,minLat,maxLon,maxLat"""
+    if not text:
+        return None
+    parts = [float(v) for v in text.split(",")]
+    if len(parts) != 4 or parts[0] > parts[2] or parts[1] > parts[3]:
+        raise ValueError(f"无效的边界框: {text}")
+    return parts[0], parts[1], parts[2], parts[3]
+
+
+def make_etag(*parts) -> str:
+    """弱ETag：同一内容的gzip/br/未压缩表示共用"""
+    digest = hashlib.sha1(json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == opaque:
+            return True
+    return False
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """按 Accept-Encoding 选择压缩方式，优先br（需要安装 brotli）"""
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def encode_body(body: bytes, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """按协商结果压缩响应体，返回 (响应体, Content-Encoding)"""
+    if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if encoding == "br":
+        return brotli.compress(body, quality=5), "br"
+    return gzip.compress(body, compresslevel=6), "gzip"
+
+
+def json_body(payload) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Livy预热会话池
+通过 DAG_API_BASE_URL 提交的批处理任务每次都要冷启动Spark，小任务的大部分耗时花在启动上。
+这里维护若干个已预加载OGE的Livy交互式会话（pyspark），小任务作为语句在空闲会话上执行：
+
+- 会话按需创建，创建后先执行预加载代码（LIVY_PRELOAD_CODE），再记录内存基线；
+- 空闲超过 LIVY_HEALTH_CHECK_IDLE 秒的会话在借出前检查状态，已失效的直接丢弃；
+- 会话执行 LIVY_MAX_STATEMENTS 条语句、或内存较基线增长超过 LIVY_MAX_MEMORY_GROWTH_MB 后回收重建；
+- 语句超时或调用方取消时取消语句并回收会话；
+- 会话创建失败后 LIVY_FAILURE_COOLDOWN 秒内不再尝试，调用方直接回退到批处理。
+
+所有失败都抛出 LivyError，调用方据此回退到批处理路径。
+语句执行前会定义 oge_batch_output（filename、format、crs、scale、userId 等），与批处理提交时的输出参数一致，
+预加载代码负责让会话中的 export 按它写入结果存储（oge-user/<uid>/result/<filename>.<format>）。
+默认的预加载代码只初始化OGE，不处理导出，因此预加载代码中没有引用 oge_batch_output 时会话池不启用；
+调用方在语句完成后还应确认结果文件确实已写入，再报告完成。
+会话池属于单个进程，多worker部署时每个worker各自维护 LIVY_POOL_SIZE 个会话。
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from oge_metrics import MetricsText
+
+logger = logging.getLogger("shandong_mcp")
+
+# ============ 配置部分 ============
+
+LIVY_POOL_ENABLED = os.getenv("OGE_LIVY_POOL", "0") == "1"
+LIVY_POOL_SIZE = int(os.getenv("OGE_LIVY_POOL_SIZE", "2"))
+LIVY_MAX_STATEMENTS = int(os.getenv("OGE_LIVY_MAX_STATEMENTS", "50"))              # 每个会话最多执行的语句数
+LIVY_MAX_MEMORY_GROWTH_MB = int(os.getenv("OGE_LIVY_MAX_MEMORY_GROWTH_MB", "1024"))  # 内存较基线增长超过该值时回收
+LIVY_SESSION_KIND = "pyspark"
+LIVY_SESSION_CONF = json.loads(os.getenv("OGE_LIVY_SESSION_CONF", "{}"))           # 创建会话时的参数（driverMemory、conf等）
+LIVY_PRELOAD_CODE = os.getenv(
+    "OGE_LIVY_PRELOAD",
+    "import oge\noge.initialize()\nservice = oge.Service.initialize()"
+)
+LIVY_SESSION_START_TIMEOUT = 300   # 会话启动并完成预加载的最长时间
+LIVY_STATEMENT_TIMEOUT = 1800
+LIVY_ACQUIRE_TIMEOUT = 30          # 等待空闲会话的最长时间，超过则回退到批处理
+LIVY_HEALTH_CHECK_IDLE = 60        # 空闲超过该秒数的会话借出前检查状态
+LIVY_FAILURE_COOLDOWN = 120        # 会话创建失败后暂停使用会话池的秒数
+LIVY_REQUEST_TIMEOUT = 30
+LIVY_POLL_INTERVAL_MIN = 0.2
+LIVY_POLL_INTERVAL_MAX = 2.0
+
+SESSION_READY_STATES = ("idle",)
+SESSION_STARTING_STATES = ("not_started", "starting", "busy")
+STATEMENT_FINAL_STATES = ("available", "error", "cancelled")
+
+# 内存探针：Python进程峰值RSS + JVM已用堆，单位字节
+MEMORY_PROBE_CODE = """import resource as _oge_resource
+try:
+    _oge_runtime = sc._jvm.java.lang.Runtime.getRuntime()
+    _oge_jvm_used = _oge_runtime.totalMemory() - _oge_runtime.freeMemory()
+except Exception:
+    _oge_jvm_used = 0
+print(_oge_resource.getrusage(_oge_resource.RUSAGE_SELF).ru_maxrss * 1024 + _oge_jvm_used)"""
+
+
+class LivyError(Exception):
+    """会话池不可用或语句执行失败，调用方应回退到批处理"""
+
+
+def build_statement(code: str, output: Dict[str, Any], preload: str = LIVY_PRELOAD_CODE) -> str:
+    """去掉与预加载代码重复的初始化行，并在前面定义 oge_batch_output"""
+    preloaded = {line.strip() for line in preload.splitlines() if line.strip()}
+    body = "\n".join(line for line in code.splitlines() if line.strip() not in preloaded)
+    return f"oge_batch_output = {output!r}\n{body}"
+
+
+class WarmSession:
+    """一个已预加载的Livy会话"""
+
+    def __init__(self, session_id: int):
+        self.id = session_id
+        self.created = time.time()
+        self.last_used = time.monotonic()
+        self.statements = 0
+        self.baseline_bytes: Optional[int] = None
+        self.memory_bytes: Optional[int] = None
+
+    @property
+    def memory_growth_mb(self) -> float:
+        if self.baseline_bytes is None or self.memory_bytes is None:
+            return 0.0
+        return (self.memory_bytes - self.baseline_bytes) / (1024 * 1024)
+
+    def snapshot(self) -> dict:
+        return {
+            "id": self.id,
+            "age_seconds": round(time.time() - self.created, 1),
+            "statements": self.statements,
+            "memory_growth_mb": round(self.memory_growth_mb, 1)
+        }
+
+
+class LivyPool:
+    """Livy交互式会话池，只在事件循环线程中使用"""
+
+    def __init__(self, base_url: str, size: int = LIVY_POOL_SIZE, enabled: bool = LIVY_POOL_ENABLED,
+                 preload: str = LIVY_PRELOAD_CODE, max_statements: int = LIVY_MAX_STATEMENTS,
+                 max_memory_growth_mb: float = LIVY_MAX_MEMORY_GROWTH_MB,
+                 session_conf: Optional[dict] = None):
+        self.base_url = (base_url or "").rstrip("/")
+        self.size = max(0, size)
+        # 预加载代码不按 oge_batch_output 导出时，会话中的结果不会写入结果存储，不能代替批处理
+        self.routes_export = "oge_batch_output" in (preload or "")
+        self.enabled = enabled and bool(self.base_url) and self.size > 0 and self.routes_export
+        if enabled and not self.routes_export:
+            logger.warning("Livy预加载代码未按 oge_batch_output 导出结果，预热会话池不启用")
+        self.preload = preload
+        self.max_statements = max_statements
+        self.max_memory_growth_mb = max_memory_growth_mb
+        self.session_conf = session_conf if session_conf is not None else dict(LIVY_SESSION_CONF)
+        self._idle: List[WarmSession] = []
+        self._busy: Dict[int, WarmSession] = {}
+        self._starting = 0
+        self._released: Optional[asyncio.Condition] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._unavailable_until = 0.0
+        self._background: set = set()
+        self.stats = {
+            "statements": 0, "statement_errors": 0, "fallbacks": 0, "sessions_created": 0,
+            "session_failures": 0, "recycled": 0, "health_check_failures": 0
+        }
+
+    # ---------- Livy REST ----------
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=LIVY_REQUEST_TIMEOUT)
+        return self._client
+
+    async def _request(self, method: str, path: str, json_data: Optional[dict] = None) -> dict:
+        try:
+            response = await self._http().request(method, path, json=json_data,
+                                                  headers={"X-Requested-By": "oge"})
+        except httpx.HTTPError as e:
+            raise LivyError(f"Livy请求失败 {method} {path}: {e}") from e
+        if response.status_code >= 400:
+            raise LivyError(f"Livy返回 {response.status_code} {method} {path}: {response.text[:200]}")
+        try:
+            return response.json() if response.content else {}
+        except ValueError as e:
+            raise LivyError(f"Livy响应不是JSON {method} {path}") from e
+
+    async def _session_state(self, session_id: int) -> str:
+        return (await self._request("GET", f"/sessions/{session_id}")).get("state", "unknown")
+
+    async def _wait_ready(self, session_id: int, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        interval = LIVY_POLL_INTERVAL_MIN
+        while True:
+            state = await self._session_state(session_id)
+            if state in SESSION_READY_STATES:
+                return
+            if state not in SESSION_STARTING_STATES:
+                raise LivyError(f"Livy会话 {session_id} 状态异常: {state}")
+            if time.monotonic() >= deadline:
+                raise LivyError(f"Livy会话 {session_id} 在{timeout:.0f}秒内未就绪（{state}）")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, LIVY_POLL_INTERVAL_MAX)
+
+    async def _execute(self, session: WarmSession, code: str, timeout: float, counted: bool = True) -> str:
+        """执行一条语句，返回 text/plain 输出；语句报错或超时时抛出 LivyError。counted 为False的语句（预加载、探针）不计入语句数"""
+        statement = await self._request("POST", f"/sessions/{session.id}/statements", {"code": code})
+        statement_id = statement.get("id")
+        if counted:
+            session.statements += 1
+        session.last_used = time.monotonic()
+        deadline = time.monotonic() + timeout
+        interval = LIVY_POLL_INTERVAL_MIN
+        try:
+            while statement.get("state") not in STATEMENT_FINAL_STATES:
+                if time.monotonic() >= deadline:
+                    raise LivyError(f"语句 {session.id}/{statement_id} 超过{timeout:.0f}秒未完成")
+                await asyncio.sleep(interval)
+                interval = min(interval * 1.5, LIVY_POLL_INTERVAL_MAX)
+                statement = await self._request("GET", f"/sessions/{session.id}/statements/{statement_id}")
+        except BaseException:
+            # 超时或调用方取消：在后台取消语句，会话随后回收
+            self._spawn(self._request("POST", f"/sessions/{session.id}/statements/{statement_id}/cancel"))
+            raise
+        finally:
+            session.last_used = time.monotonic()
+
+        output = statement.get("output") or {}
+        if statement.get("state") != "available" or output.get("status") != "ok":
+            raise LivyError(
+                f"语句 {session.id}/{statement_id} 执行失败: "
+                f"{output.get('ename') or statement.get('state')}: {output.get('evalue', '')}".rstrip(": ")
+            )
+        return str((output.get("data") or {}).get("text/plain", ""))
+
+    async def _probe_memory(self, session: WarmSession) -> Optional[int]:
+        try:
+            text = await self._execute(session, MEMORY_PROBE_CODE, LIVY_REQUEST_TIMEOUT, counted=False)
+            return int(text.strip().splitlines()[-1])
+        except (LivyError, ValueError, IndexError) as e:
+            logger.warning(f"Livy会话 {session.id} 内存探针失败: {e}")
+            return None
+
+    # ---------- 会话生命周期 ----------
+
+    async def _create(self) -> WarmSession:
+        body = {"kind": LIVY_SESSION_KIND, "name": f"oge-warm-{os.getpid()}-{int(time.time() * 1000)}",
+                **self.session_conf}
+        created = await self._request("POST", "/sessions", body)
+        session = WarmSession(created["id"])
+        try:
+            await self._wait_ready(session.id, LIVY_SESSION_START_TIMEOUT)
+            if self.preload.strip():
+                await self._execute(session, self.preload, LIVY_SESSION_START_TIMEOUT, counted=False)
+            session.baseline_bytes = await self._probe_memory(session)
+            session.memory_bytes = session.baseline_bytes
+        except BaseException:
+            self._spawn(self._delete(session.id))
+            raise
+        self.stats["sessions_created"] += 1
+        logger.info(f"Livy预热会话 {session.id} 已就绪")
+        return session
+
+    async def _delete(self, session_id: int) -> None:
+        try:
+            await self._request("DELETE", f"/sessions/{session_id}")
+        except LivyError as e:
+            logger.warning(f"删除Livy会话 {session_id} 失败: {e}")
+
+    def _spawn(self, coro) -> None:
+        # 清理任务不继承调用方的截止时间，也不随调用方取消
+        task = asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _condition(self) -> asyncio.Condition:
+        if self._released is None:
+            self._released = asyncio.Condition()
+        return self._released
+
+    @property
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._unavailable_until
+
+    async def _healthy(self, session: WarmSession) -> bool:
+        if time.monotonic() - session.last_used < LIVY_HEALTH_CHECK_IDLE:
+            return True
+        try:
+            state = await self._session_state(session.id)
+        except LivyError:
+            state = "unreachable"
+        if state in SESSION_READY_STATES:
+            return True
+        self.stats["health_check_failures"] += 1
+        logger.warning(f"Livy会话 {session.id} 健康检查失败（{state}），丢弃")
+        return False
+
+    async def acquire(self, timeout: float = LIVY_ACQUIRE_TIMEOUT) -> WarmSession:
+        """借出一个空闲会话；没有空闲会话且未达上限时新建，否则等待归还"""
+        if not self.available:
+            raise LivyError("Livy会话池不可用")
+        deadline = time.monotonic() + timeout
+        condition = self._condition()
+        while True:
+            while self._idle:
+                session = self._idle.pop()
+                if await self._healthy(session):
+                    self._busy[session.id] = session
+                    return session
+                self._spawn(self._delete(session.id))
+            if len(self._busy) + self._starting < self.size:
+                self._starting += 1
+                try:
+                    session = await self._create()
+                except LivyError as e:
+                    self.stats["session_failures"] += 1
+                    self._unavailable_until = time.monotonic() + LIVY_FAILURE_COOLDOWN
+                    raise LivyError(f"创建Livy会话失败: {e}") from e
+                finally:
+                    self._starting -= 1
+                self._busy[session.id] = session
+                return session
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise LivyError(f"{timeout:.0f}秒内没有空闲的Livy会话")
+            async with condition:
+                try:
+                    await asyncio.wait_for(condition.wait(), left)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, session: WarmSession, reusable: bool = True) -> None:
+        """归还会话；语句数或内存增长超过上限、或不可复用时回收"""
+        self._busy.pop(session.id, None)
+        reason = None
+        if not reusable:
+            reason = "执行异常"
+        elif session.statements >= self.max_statements:
+            reason = f"已执行{session.statements}条语句"
+        else:
+            session.memory_bytes = await self._probe_memory(session)
+            if session.memory_bytes is None:
+                reason = "内存探针失败"
+            elif session.memory_growth_mb > self.max_memory_growth_mb:
+                reason = f"内存增长{session.memory_growth_mb:.0f}MB"
+        if reason:
+            self.stats["recycled"] += 1
+            logger.info(f"回收Livy会话 {session.id}: {reason}")
+            self._spawn(self._delete(session.id))
+        else:
+            self._idle.append(session)
+        condition = self._condition()
+        async with condition:
+            condition.notify()
+
+    async def run(self, code: str, output: Dict[str, Any], timeout: float = LIVY_STATEMENT_TIMEOUT) -> dict:
+        """在预热会话上执行OGE代码，返回 {session_id, statement_count, output, elapsed}"""
+        started = time.perf_counter()
+        session = await self.acquire()
+        reusable = False
+        try:
+            text = await self._execute(session, build_statement(code, output, self.preload), timeout)
+            reusable = True
+            self.stats["statements"] += 1
+            return {
+                "session_id": session.id,
+                "statement_count": session.statements,
+                "output": text,
+                "elapsed": time.perf_counter() - started
+            }
+        except LivyError:
+            self.stats["statement_errors"] += 1
+            raise
+        finally:
+            # 内存探针在后台进行，不占用本次调用的耗时；失败或被取消的会话状态不可信，直接回收
+            self._spawn(self.release(session, reusable))
+
+    def start(self) -> None:
+        """应用启动时在后台预热会话，失败时等第一次使用再创建"""
+        if not self.enabled:
+            return
+
+        async def warm():
+            try:
+                await self.release(await self.acquire())
+            except LivyError as e:
+                logger.warning(f"Livy会话池预热失败: {e}")
+
+        self._spawn(warm())
+
+    async def close(self) -> None:
+        # 先等后台的归还与回收完成，归还中的会话也一并删除
+        if self._background:
+            await asyncio.wait(list(self._background), timeout=LIVY_REQUEST_TIMEOUT)
+        sessions = self._idle + list(self._busy.values())
+        self._idle, self._busy = [], {}
+        for session in sessions:
+            await self._delete(session.id)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "routes_export": self.routes_export,
+            "available": self.available,
+            "base_url": self.base_url,
+            "size": self.size,
+            "idle": [s.snapshot() for s in self._idle],
+            "busy": [s.snapshot() for s in self._busy.values()],
+            "starting": self._starting,
+            **self.stats
+        }
+
+    def write_metrics(self, metrics: MetricsText) -> None:
+        metrics.add("oge_livy_sessions", len(self._idle), {"state": "idle"}, help="Livy预热会话数")
+        metrics.add("oge_livy_sessions", len(self._busy), {"state": "busy"})
+        metrics.add("oge_livy_sessions", self._starting, {"state": "starting"})
+        metrics.add("oge_livy_available", self.available, help="Livy会话池是否可用")
+        for key in ("statements", "statement_errors", "fallbacks", "sessions_created",
+                    "session_failures", "recycled", "health_check_failures"):
+            metrics.add(f"oge_livy_{key}_total", self.stats[key], type="counter")
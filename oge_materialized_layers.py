@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+约束图层物化管理
+坡度（pdjb > 4）、城镇开发边界、生态保护红线一年才变化一次，但每次流出分析都要从头过滤并重投影到 EPSG:4527。
+这里维护这些图层的物化版本：通过维护DAG一次性生成“已过滤、已重投影”的图层，按版本号命名，
+在共享状态中登记当前版本，脚本规划器生成脚本时直接读取物化图层。
+
+物化图层按导出名通过 getFeatureCollection 读取。只有重建DAG成功的图层才会登记，登记表为空（尚未重建）
+的图层继续读取原始图层；集群不支持按导出名读取时可设置 OGE_MATERIALIZED_LAYERS=0 关闭，重建仍会登记版本。
+"""
+
+import os
+import time
+from typing import Dict, List, Optional
+
+from oge_shared_state import get_state_backend
+from oge_script_planner import ConstraintLayer, TARGET_CRS, outflow_constraint_layers, render_layer
+
+# ============ 配置部分 ============
+
+MATERIALIZED_LAYERS_ENABLED = os.getenv("OGE_MATERIALIZED_LAYERS", "1") != "0"
+REGISTRY_KEY = "materialized:registry"
+HISTORY_LIMIT = 5                 # 每个图层保留的历史版本数
+
+
+def asset_name(layer: ConstraintLayer, version: int) -> str:
+    """物化图层在集群上的名称，如 mv_shp_podu_pdjb_gt4_4527_v3"""
+    op_alias = {"greater_than": "gt", "less_than": "lt", "equals": "eq"}
+    parts = [f"mv_{layer.table}"]
+    for field, op, value in layer.metadata_filters:
+        parts.append(f"{field}_{op_alias.get(op, op)}{value}")
+    parts.append(TARGET_CRS.split(":")[-1])
+    return "_".join(parts) + f"_v{version}"
+
+
+def get_registry() -> Dict[str, dict]:
+    return get_state_backend().get(REGISTRY_KEY) or {}
+
+
+def current_assets() -> Dict[str, str]:
+    """分析脚本使用的物化图层 {layer_key: asset}；关闭 MATERIALIZED_LAYERS_ENABLED 时为空，脚本读取原始图层"""
+    if not MATERIALIZED_LAYERS_ENABLED:
+        return {}
+    return {key: entry["asset"] for key, entry in get_registry().items() if entry.get("asset")}
+
+
+def registry_version_tag() -> str:
+    """当前物化图层版本的摘要，图层重建后依赖它的结果缓存随之失效"""
+    registry = get_registry()
+    return ";".join(f"{key}={registry[key].get('version')}" for key in sorted(registry))
+
+
+def next_version(layer: ConstraintLayer) -> int:
+    entry = get_registry().get(layer.key) or {}
+    return int(entry.get("version") or 0) + 1
+
+
+def build_materialize_script(layer: ConstraintLayer, version: int) -> str:
+    """维护DAG脚本：过滤 + 重投影后导出为带版本号的物化图层（不做范围裁剪）"""
+    lines = render_layer(layer, layer.logical_ops())
+    return "\n".join([
+        "import oge",
+        "oge.initialize()",
+        "",
+        "service = oge.Service.initialize()",
+        *lines,
+        f'{layer.var}.export("{asset_name(layer, version)}")'
+    ])
+
+
+def register_version(layer: ConstraintLayer, version: int, dag_id: str):
+    """维护DAG成功后登记为当前版本，旧版本保留在历史中"""
+    state = get_state_backend()
+    lock_token = state.acquire_lock(REGISTRY_KEY, ttl=10)
+    try:
+        registry = get_registry()
+        key = layer.key
+        previous = registry.get(key)
+        history = (previous or {}).get("history", [])
+        if previous:
+            history = ([{k: previous[k] for k in ("asset", "version", "built_at", "dag_id")}] + history)[:HISTORY_LIMIT]
+        registry[key] = {
+            "asset": asset_name(layer, version),
+            "version": version,
+            "table": layer.table,
+            "filters": layer.metadata_filters,
+            "crs": TARGET_CRS,
+            "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "dag_id": dag_id,
+            "history": history
+        }
+        state.set(REGISTRY_KEY, registry)
+    finally:
+        if lock_token:
+            state.release_lock(REGISTRY_KEY, lock_token)
+
+
+def materializable_layers(slope_threshold: int = 4, tables: Optional[List[str]] = None) -> List[ConstraintLayer]:
+    """需要物化的约束图层，可按图层名筛选"""
+    layers = outflow_constraint_layers(slope_threshold)
+    if tables:
+        layers = [layer for layer in layers if layer.table in tables]
+    return layers
+
+
+def known_tables(slope_threshold: int = 4) -> List[str]:
+    """可以物化的约束图层名"""
+    return [layer.table for layer in outflow_constraint_layers(slope_threshold)]
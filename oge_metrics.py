@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+/metrics 输出
+各子系统把自己的指标写入 MetricsText，由服务器按 Prometheus 文本格式统一输出。
+"""
+
+from typing import Dict, List, Optional
+
+
+def _format_labels(labels: Optional[Dict[str, object]]) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        text = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{text}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value) -> str:
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsText:
+    """Prometheus文本格式构造器，同名指标的 HELP/TYPE 只输出一次"""
+
+    def __init__(self):
+        self._lines: List[str] = []
+        self._declared = set()
+
+    def add(self, name: str, value, labels: Optional[Dict[str, object]] = None,
+            help: str = "", type: str = "gauge") -> None:
+        family = name
+        for suffix in ("_bucket", "_sum", "_count"):
+            if type == "histogram" and name.endswith(suffix):
+                family = name[:-len(suffix)]
+        if family not in self._declared:
+            self._declared.add(family)
+            if help:
+                self._lines.append(f"# HELP {family} {help}")
+            self._lines.append(f"# TYPE {family} {type}")
+        self._lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    def histogram(self, name: str, buckets: Dict[float, int], total: float, count: int,
+                  labels: Optional[Dict[str, object]] = None, help: str = "") -> None:
+        """buckets 为 {上界: 累计次数}，上界按升序"""
+        for bound, cumulative in buckets.items():
+            bucket_labels = {**(labels or {}), "le": "+Inf" if bound == float("inf") else bound}
+            self.add(f"{name}_bucket", cumulative, bucket_labels, help=help, type="histogram")
+        self.add(f"{name}_sum", total, labels, type="histogram")
+        self.add(f"{name}_count", count, labels, type="histogram")
+
+    def render(self) -> str:
+        return "\n".join(self._lines) + "\n"
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+栅格结果瓦片服务
+DAG导出的tif结果（坡度/坡向等）动辄几百MB，前端不可能整文件下载后再显示。这里把已完成的tif结果
+转换为云优化GeoTIFF（COG：内部256x256分块 + 多级金字塔），再按XYZ瓦片（Web墨卡托）窗口读取、
+着色并编码为PNG，渲染好的瓦片放在进程内LRU缓存中。
+
+依赖 numpy 与 rasterio，未安装时 available() 返回False。PNG编码只用标准库。
+"""
+
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.vrt import WarpedVRT
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import from_bounds
+    import rasterio.shutil
+except ImportError:
+    rasterio = None
+
+# ============ 配置部分 ============
+
+COG_DIR = Path(os.getenv("OGE_COG_DIR", "results/cog"))
+COG_BLOCK_SIZE = 256
+TILE_SIZE = 256
+TILE_CACHE_MAX_BYTES = 64 * 1024 * 1024     # 渲染好的PNG瓦片缓存上限
+WEB_MERCATOR_HALF = 20037508.342789244
+
+PALETTES: Dict[str, List[str]] = {
+    # 与坡向分析示例脚本的 vis_params 一致
+    "aspect": ["#808080", "#949494", "#a9a9a9", "#bdbebd", "#d3d3d3", "#e9e9e9"],
+    "slope": ["#1a9850", "#91cf60", "#d9ef8b", "#fee08b", "#fc8d59", "#d73027"],
+    "gray": ["#000000", "#ffffff"],
+}
+
+
+def available() -> bool:
+    return np is not None and rasterio is not None
+
+
+# ============ COG转换 ============
+
+def cog_path_for(key: str) -> Path:
+    """结果对象（<uid>/result/<文件名>）对应的COG路径：保留完整的对象路径，不同用户的同名结果互不覆盖"""
+    relative = Path(key)
+    return COG_DIR / relative.parent / f"{relative.stem}.cog.tif"
+
+
+def convert_to_cog(source: Path, target: Path) -> Path:
+    """
+    把普通GeoTIFF转换为COG，目标文件比源文件新时直接复用。
+    GDAL 3.1+ 使用COG驱动；旧版本先生成分块GTiff并建金字塔，再带金字塔复制。
+    """
+    if target.exists() and target.stat().st_mtime >= source.stat().st_mtime:
+        return target
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_target = target.with_name(target.name + f".{os.getpid()}.tmp")
+
+    with rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS"):
+        if _has_driver("COG"):
+            rasterio.shutil.copy(
+                source, tmp_target, driver="COG",
+                BLOCKSIZE=COG_BLOCK_SIZE, COMPRESS="DEFLATE", OVERVIEWS="AUTO", RESAMPLING="AVERAGE"
+            )
+        else:
+            staging = target.with_name(target.name + f".{os.getpid()}.staging.tif")
+            rasterio.shutil.copy(
+                source, staging, driver="GTiff",
+                TILED="YES", BLOCKXSIZE=COG_BLOCK_SIZE, BLOCKYSIZE=COG_BLOCK_SIZE, COMPRESS="DEFLATE"
+            )
+            with rasterio.open(staging, "r+") as dst:
+                dst.build_overviews(overview_factors(dst.width, dst.height), Resampling.average)
+            rasterio.shutil.copy(
+                staging, tmp_target, driver="GTiff", COPY_SRC_OVERVIEWS="YES",
+                TILED="YES", BLOCKXSIZE=COG_BLOCK_SIZE, BLOCKYSIZE=COG_BLOCK_SIZE, COMPRESS="DEFLATE"
+            )
+            staging.unlink(missing_ok=True)
+    tmp_target.replace(target)
+    return target
+
+
+def _has_driver(name: str) -> bool:
+    with rasterio.Env() as env:
+        return name in env.drivers()
+
+
+def overview_factors(width: int, height: int) -> List[int]:
+    """金字塔倍数，一直建到最长边不超过一个分块"""
+    factors, factor = [], 2
+    while max(width, height) / factor >= COG_BLOCK_SIZE / 2:
+        factors.append(factor)
+        factor *= 2
+    return factors or [2]
+
+
+def raster_info(path: Path) -> dict:
+    """COG的范围（WGS84）、金字塔层级、值域等信息"""
+    with rasterio.open(path) as src:
+        bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds) if src.crs else tuple(src.bounds)
+        band = src.read(1, out_shape=(min(src.height, 512), min(src.width, 512)), masked=True)
+        valid = band.compressed()
+        return {
+            "bounds": [round(v, 8) for v in bounds],
+            "width": src.width,
+            "height": src.height,
+            "crs": str(src.crs) if src.crs else None,
+            "overviews": src.overviews(1),
+            "block_shapes": [list(shape) for shape in src.block_shapes],
+            "min": float(valid.min()) if valid.size else None,
+            "max": float(valid.max()) if valid.size else None,
+        }
+
+
+# ============ XYZ瓦片渲染 ============
+
+def tile_bounds_3857(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    span = 2 * WEB_MERCATOR_HALF / (1 << z)
+    left = -WEB_MERCATOR_HALF + x * span
+    top = WEB_MERCATOR_HALF - y * span
+    return left, top - span, left + span, top
+
+
+def _hex_to_rgb(color: str) -> Tuple[int, int, int]:
+    color = color.lstrip("#")
+    return int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)
+
+
+def colorize(values, mask, vmin: float, vmax: float, palette: Sequence[str]):
+    """按值域线性插值着色，mask为True的像元透明，返回 HxWx4 的uint8数组"""
+    colors = np.array([_hex_to_rgb(c) for c in palette], dtype=np.float64)
+    scale = (values - vmin) / ((vmax - vmin) or 1.0)
+    position = np.clip(np.nan_to_num(scale), 0.0, 1.0) * (len(colors) - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, len(colors) - 1)
+    weight = (position - lower)[..., None]
+    rgb = colors[lower] * (1 - weight) + colors[upper] * weight
+    alpha = np.where(mask, 0, 255)[..., None]
+    return np.concatenate([rgb, alpha], axis=-1).astype(np.uint8)
+
+
+def encode_png(rgba) -> bytes:
+    """RGBA数组编码为PNG（标准库zlib实现）"""
+    height, width, _ = rgba.shape
+    raw = b"".join(b"\x00" + rgba[row].tobytes() for row in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b"")
+
+
+def render_tile(path: Path, z: int, x: int, y: int, vmin: float, vmax: float, palette: Sequence[str]) -> Optional[bytes]:
+    """
+    窗口读取并渲染一个XYZ瓦片；瓦片与栅格不相交时返回None。
+    读取时输出尺寸固定为256x256，GDAL会自动选用合适的金字塔层级。
+    """
+    left, bottom, right, top = tile_bounds_3857(z, x, y)
+    with rasterio.open(path) as src:
+        with WarpedVRT(src, crs="EPSG:3857", resampling=Resampling.bilinear) as vrt:
+            if right <= vrt.bounds.left or left >= vrt.bounds.right or top <= vrt.bounds.bottom or bottom >= vrt.bounds.top:
+                return None
+            window = from_bounds(left, bottom, right, top, transform=vrt.transform)
+            data = vrt.read(1, window=window, out_shape=(TILE_SIZE, TILE_SIZE), boundless=True, masked=True,
+                            resampling=Resampling.bilinear)
+    values = data.astype(np.float64).filled(np.nan)
+    mask = np.ma.getmaskarray(data) | ~np.isfinite(values)
+    return encode_png(colorize(values, mask, vmin, vmax, palette))
+
+
+def empty_tile() -> bytes:
+    """全透明瓦片（瓦片与栅格不相交时返回）"""
+    return encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+class TileLRUCache:
+    """
+    渲染好的PNG瓦片的进程内LRU缓存，按字节数限制容量（线程安全，渲染在线程池中进行）。
+    sizeof 计算单个缓存值的字节数，缓存值不是bytes时（如带响应头的代理瓦片）由调用方提供。
+    """
+
+    def __init__(self, max_bytes: int = TILE_CACHE_MAX_BYTES, sizeof: Callable[[object], int] = len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._items: "OrderedDict[tuple, object]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[object]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value) -> None:
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self.sizeof(self._items.pop(key))
+            self._items[key] = value
+            self._bytes += self.sizeof(value)
+            while self._bytes > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= self.sizeof(evicted)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"tiles": len(self._items), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
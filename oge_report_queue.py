@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+结果登记的持久化写后队列
+任务完成后调用 INSERT_REPORT_URL 绑定 recordId 与结果文件，原先在工具调用中同步等待，失败只记一条警告，
+进程退出时正在进行的登记也会丢失。这里先把登记写入本机SQLite（WAL模式，多个worker进程共用一个文件），
+工具立即返回，由后台协程批量发送：
+
+- 同一 key（recordId）重复登记时覆盖未发送的记录，已发送的不再重复发送；
+- 每批最多领取 REPORT_BATCH_SIZE 条，领取时写入租约，worker异常退出后租约到期由其他worker重新领取；
+- 发送失败按指数退避（带抖动）重试，超过 REPORT_MAX_ATTEMPTS 次后标记为 dead，保留待人工处理；
+- 已发送的记录保留 REPORT_SENT_RETENTION 秒后清理。
+
+登记接口一次只接受一条记录，一批内的记录并发发送（最多 REPORT_SEND_CONCURRENCY 个），结果在一个事务中写回。
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from oge_metrics import MetricsText
+
+logger = logging.getLogger("shandong_mcp")
+
+# ============ 配置部分 ============
+
+REPORT_QUEUE_PATH = os.getenv("OGE_REPORT_QUEUE", "state/oge_reports.db")
+REPORT_BATCH_SIZE = 20
+REPORT_SEND_CONCURRENCY = 4
+REPORT_BATCH_WINDOW = 0.2        # 新登记后等待凑批的秒数
+REPORT_POLL_INTERVAL = 5.0       # 没有新登记时检查到期重试（及其他worker写入）的间隔
+REPORT_RETRY_BASE = 5            # 第一次重试的等待秒数，之后每次翻倍
+REPORT_RETRY_MAX = 600
+REPORT_MAX_ATTEMPTS = 20
+REPORT_LEASE_SECONDS = 120       # 领取后的租约
+REPORT_SENT_RETENTION = 7 * 86400
+REPORT_STOP_TIMEOUT = 10         # 退出时最后一次发送的最长时间
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE,
+    url TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    last_error TEXT,
+    sent_at REAL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_reports_due ON reports (status, next_attempt_at);
+"""
+
+# 发送函数：返回 (是否成功, 响应)
+Sender = Callable[[str, dict], Awaitable[Tuple[bool, Any]]]
+
+
+def retry_delay(attempts: int) -> float:
+    """第 attempts 次失败后的等待秒数"""
+    delay = min(REPORT_RETRY_MAX, REPORT_RETRY_BASE * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class ReportQueue:
+    """SQLite写后队列；登记与发送都在事件循环线程中调用"""
+
+    def __init__(self, path: str = REPORT_QUEUE_PATH, sender: Optional[Sender] = None):
+        self.path = path
+        self.sender = sender
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"enqueued": 0, "sent": 0, "failed_attempts": 0, "dead": 0, "batches": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        # fork之后不能复用父进程的连接，按pid重新建立
+        if self._conn is None or self._pid != os.getpid():
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(reports)")}
+            if "version" not in columns:
+                conn.execute("ALTER TABLE reports ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    # ---------- 写入 ----------
+
+    def enqueue(self, url: str, payload: dict, key: Optional[str] = None) -> None:
+        """
+        登记一条待发送记录（写入磁盘后返回），并唤醒后台发送。
+        同一 key 的记录正在发送（持有租约）时只更新内容并递增版本，租约保留，不会被并发重复发送；
+        发送完成后版本不一致，旧内容的发送结果不写回，记录按新内容重新发送
+        """
+        now = time.time()
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO reports (key, url, payload, status, attempts, enqueued_at, next_attempt_at)"
+                " VALUES (?, ?, ?, 'pending', 0, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET url = excluded.url, payload = excluded.payload,"
+                " status = 'pending', attempts = 0, next_attempt_at = excluded.next_attempt_at,"
+                " last_error = NULL, version = reports.version + 1 WHERE reports.status != 'sent'",
+                (key, url, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+        self.stats["enqueued"] += 1
+        self.start()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _claim(self, limit: int) -> List[sqlite3.Row]:
+        """领取到期的记录并写入租约"""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, url, payload, attempts, version FROM reports WHERE status = 'pending'"
+                    " AND next_attempt_at <= ? AND (lease_until IS NULL OR lease_until < ?) ORDER BY id LIMIT ?",
+                    (now, now, limit)
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE reports SET lease_until = ? WHERE id = ?",
+                    [(now + REPORT_LEASE_SECONDS, row["id"]) for row in rows]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _complete(self, outcomes: List[Tuple[sqlite3.Row, bool, Optional[str]]]) -> None:
+        """一个事务写回一批发送结果"""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row, ok, error in outcomes:
+                    if ok:
+                        cursor = conn.execute(
+                            "UPDATE reports SET status = 'sent', sent_at = ?, attempts = attempts + 1,"
+                            " lease_until = NULL, last_error = NULL WHERE id = ? AND version = ?",
+                            (now, row["id"], row["version"])
+                        )
+                    else:
+                        attempts = row["attempts"] + 1
+                        status = "dead" if attempts >= REPORT_MAX_ATTEMPTS else "pending"
+                        cursor = conn.execute(
+                            "UPDATE reports SET status = ?, attempts = ?, next_attempt_at = ?, lease_until = NULL,"
+                            " last_error = ? WHERE id = ? AND version = ?",
+                            (status, attempts, now + retry_delay(attempts), (error or "")[:500],
+                             row["id"], row["version"])
+                        )
+                    if cursor.rowcount == 0:
+                        # 发送期间被重新登记：释放租约，按新内容尽快发送
+                        conn.execute("UPDATE reports SET lease_until = NULL WHERE id = ?", (row["id"],))
+                        continue
+                    if not ok and status == "dead":
+                        self.stats["dead"] += 1
+                        logger.error(f"结果登记 {row['id']} 重试{attempts}次仍失败，已停止重试: {error}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def purge(self, retention: float = REPORT_SENT_RETENTION) -> int:
+        with self._lock:
+            cursor = self._connection().execute(
+                "DELETE FROM reports WHERE status = 'sent' AND sent_at < ?", (time.time() - retention,)
+            )
+        return cursor.rowcount
+
+    # ---------- 发送 ----------
+
+    async def _send(self, row: sqlite3.Row, semaphore: asyncio.Semaphore) -> Tuple[sqlite3.Row, bool, Optional[str]]:
+        async with semaphore:
+            try:
+                ok, response = await self.sender(row["url"], json.loads(row["payload"]))
+            except Exception as e:
+                ok, response = False, f"{type(e).__name__}: {e}"
+        if not ok:
+            self.stats["failed_attempts"] += 1
+            logger.warning(f"结果登记 {row['id']} 第{row['attempts'] + 1}次发送失败: {response}")
+            return row, False, str(response)
+        self.stats["sent"] += 1
+        return row, True, None
+
+    async def flush(self) -> int:
+        """发送所有到期的记录，返回本次处理的条数"""
+        if self.sender is None:
+            return 0
+        handled = 0
+        semaphore = asyncio.Semaphore(REPORT_SEND_CONCURRENCY)
+        while True:
+            rows = self._claim(REPORT_BATCH_SIZE)
+            if not rows:
+                return handled
+            outcomes = await asyncio.gather(*[self._send(row, semaphore) for row in rows])
+            self._complete(outcomes)
+            self.stats["batches"] += 1
+            handled += len(rows)
+
+    async def _run(self) -> None:
+        last_purge = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), REPORT_POLL_INTERVAL)
+                await asyncio.sleep(REPORT_BATCH_WINDOW)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if time.time() - last_purge > 3600:
+                    self.purge()
+                    last_purge = time.time()
+            except Exception as e:
+                logger.error(f"结果登记队列发送出错: {e}")
+
+    def start(self) -> None:
+        """启动后台发送（同一事件循环中只启动一次）；启动时也会发送上次退出前未发送的记录"""
+        if self.sender is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._worker is not None and not self._worker.done() and self._worker.get_loop() is loop:
+            return
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        # 后台发送不继承调用方的截止时间
+        self._worker = loop.create_task(self._run(), context=contextvars.Context())
+
+    async def stop(self, timeout: float = REPORT_STOP_TIMEOUT) -> None:
+        """停止后台发送，退出前尽量发送一次；未发送的记录留在磁盘上，下次启动继续"""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except Exception as e:
+            logger.warning(f"退出前发送结果登记未完成，剩余记录下次启动时发送: {e}")
+
+    # ---------- 查询 ----------
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._connection().execute("SELECT status, COUNT(*) AS n FROM reports GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def oldest_pending_age(self) -> float:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT MIN(enqueued_at) AS t FROM reports WHERE status = 'pending'"
+            ).fetchone()
+        return time.time() - row["t"] if row and row["t"] is not None else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "path": self.path,
+            "running": self._worker is not None and not self._worker.done(),
+            "counts": self.counts(),
+            "oldest_pending_seconds": round(self.oldest_pending_age(), 1),
+            **self.stats
+        }
+
+    def write_metrics(self, metrics: MetricsText) -> None:
+        counts = self.counts()
+        for status in ("pending", "sent", "dead"):
+            metrics.add("oge_report_queue_records", counts.get(status, 0), {"status": status},
+                        help="结果登记队列中的记录数")
+        metrics.add("oge_report_queue_oldest_pending_seconds", round(self.oldest_pending_age(), 3),
+                    help="最早一条未发送登记的等待时间")
+        metrics.add("oge_report_queue_failed_attempts_total", self.stats["failed_attempts"],
+                    help="结果登记发送失败次数", type="counter")
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+结果文件获取与本地缓存
+DAG执行完成的结果保存在MinIO的 oge-user/<uid>/result/ 下。这里提供：
+
+- 并行分段下载：大文件按固定块大小发起多个 HTTP Range 请求并发下载，写入本地缓存；
+- 容量受限的本地磁盘缓存：按最近访问时间淘汰，总大小不超过上限，多个worker共用同一目录；
+  缓存记录对象存储的ETag（登记在共享状态），命中后超过 RESULT_REVALIDATE_INTERVAL 秒时用条件HEAD确认，
+  同名结果被重新计算覆盖后丢弃旧文件重新下载；
+- 透传读取：本地未缓存时把客户端的 Range 请求直接转发到对象存储，边收边发，不在服务端缓冲整个文件；
+- 后台预取：任务一完成就把结果下载到本地缓存，用户第一次查看时直接从本地读取。
+
+访问MinIO使用 S3 V4 签名（只用到 GET/HEAD），不依赖 boto3；任何S3兼容的本地替身服务
+（如本地起一个 MinIO）都可以通过 OGE_RESULT_STORE_URL 指定。
+"""
+
+import asyncio
+import datetime
+import hashlib
+import heapq
+import hmac
+import itertools
+import os
+import time
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import quote, urlparse
+
+import httpx
+
+from oge_executor import run_blocking
+from oge_shared_state import get_state_backend
+from yaogan_environment_config import MINIO_ACCESS_KEY, MINIO_ENDPOINT, MINIO_SECRET_KEY
+
+# ============ 配置部分 ============
+
+RESULT_STORE_URL = os.getenv("OGE_RESULT_STORE_URL", MINIO_ENDPOINT).rstrip("/")
+RESULT_STORE_ACCESS_KEY = os.getenv("OGE_RESULT_STORE_ACCESS_KEY", MINIO_ACCESS_KEY)
+RESULT_STORE_SECRET_KEY = os.getenv("OGE_RESULT_STORE_SECRET_KEY", MINIO_SECRET_KEY)
+RESULT_STORE_REGION = os.getenv("OGE_RESULT_STORE_REGION", "us-east-1")
+RESULT_BUCKET = "oge-user"
+
+RESULT_CACHE_DIR = Path(os.getenv("OGE_RESULT_CACHE_DIR", "results/cache"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("OGE_RESULT_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))   # 默认5GB
+RANGE_CHUNK_SIZE = 8 * 1024 * 1024       # 分段下载的块大小
+RANGE_CONCURRENCY = 4                    # 单个文件的并发分段数
+STREAM_CHUNK_SIZE = 256 * 1024           # 本地文件流式输出的块大小
+DOWNLOAD_LOCK_TTL = 600                  # 同一对象同一时间只允许一个进程下载
+PREFETCH_CONCURRENCY = 2                 # 后台预取的并发文件数
+PREFETCH_MAX_PENDING = 50                # 预取队列上限，超出时丢弃最旧的任务
+RESULT_REVALIDATE_INTERVAL = float(os.getenv("OGE_RESULT_REVALIDATE_SECONDS", "30"))   # 缓存命中后向对象存储确认的间隔
+RESULT_META_KEY_PREFIX = "result_meta:"  # 已缓存对象的ETag等信息
+RESULT_META_TTL = 30 * 86400
+
+
+class InvalidKeyError(ValueError):
+    """对象名不合法：含 .. 或 . 段、空段、绝对路径、反斜杠或控制字符"""
+
+
+def validate_key(key: str) -> str:
+    """检查对象名，只允许由普通路径段组成的相对名称；对象名来自请求路径，不能借此访问缓存目录以外的文件"""
+    if not key or key.startswith("/") or "\\" in key or any(ord(c) < 32 for c in key):
+        raise InvalidKeyError(f"非法的对象名: {key!r}")
+    if any(part in ("", ".", "..") for part in key.split("/")):
+        raise InvalidKeyError(f"非法的对象名: {key!r}")
+    return key
+
+
+def result_key(filename: str, user_id: str) -> str:
+    """结果文件在桶内的对象名（user_id、filename 来自请求时不合法会抛出 InvalidKeyError）"""
+    if not user_id or "/" in user_id:
+        raise InvalidKeyError(f"非法的用户ID: {user_id!r}")
+    return validate_key(f"{user_id}/result/{filename}")
+
+
+def object_url(key: str, bucket: str = RESULT_BUCKET) -> str:
+    return f"{RESULT_STORE_URL}/{bucket}/{quote(validate_key(key))}"
+
+
+# ============ S3 V4 签名 ============
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+def sign_headers(method: str, url: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """为GET/HEAD请求生成S3 V4签名头，未配置密钥时原样返回（匿名访问）"""
+    headers = dict(headers or {})
+    if not RESULT_STORE_ACCESS_KEY or not RESULT_STORE_SECRET_KEY:
+        return headers
+    parsed = urlparse(url)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date_stamp = now.strftime("%Y%m%d")
+    payload_hash = "UNSIGNED-PAYLOAD"
+
+    headers.update({"host": parsed.netloc, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash})
+    signed_names = sorted(name.lower() for name in headers)
+    lowered = {name.lower(): str(value).strip() for name, value in headers.items()}
+    canonical_headers = "".join(f"{name}:{lowered[name]}\n" for name in signed_names)
+    signed_headers = ";".join(signed_names)
+    canonical_request = "\n".join([
+        method, parsed.path or "/", parsed.query, canonical_headers, signed_headers, payload_hash
+    ])
+
+    scope = f"{date_stamp}/{RESULT_STORE_REGION}/s3/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+    ])
+    signing_key = _hmac(_hmac(_hmac(_hmac(
+        f"AWS4{RESULT_STORE_SECRET_KEY}".encode("utf-8"), date_stamp), RESULT_STORE_REGION), "s3"), "aws4_request")
+    signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    headers["Authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={RESULT_STORE_ACCESS_KEY}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    headers.pop("host")
+    return headers
+
+
+# ============ 本地缓存 ============
+
+def cache_path(key: str, bucket: str = RESULT_BUCKET) -> Path:
+    """对象在本地缓存中的路径，解析后必须仍在 RESULT_CACHE_DIR 之下"""
+    root = RESULT_CACHE_DIR.resolve()
+    path = (root / bucket / validate_key(key)).resolve()
+    if not path.is_relative_to(root / bucket):
+        raise InvalidKeyError(f"对象名超出缓存目录: {key!r}")
+    return path
+
+
+def cached_file(key: str, bucket: str = RESULT_BUCKET) -> Optional[Path]:
+    """已缓存的文件路径（同时刷新访问时间），未缓存返回None"""
+    path = cache_path(key, bucket)
+    if not path.is_file():
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return path
+
+
+def cache_usage() -> Tuple[int, int]:
+    """(文件数, 总字节数)"""
+    files = [p for p in RESULT_CACHE_DIR.rglob("*") if p.is_file() and not p.name.endswith(".part")]
+    return len(files), sum(p.stat().st_size for p in files)
+
+
+def evict(reserve: int = 0) -> int:
+    """按最近访问时间淘汰，直到总大小（加上即将写入的 reserve 字节）不超过上限，返回淘汰的文件数"""
+    files = []
+    for p in RESULT_CACHE_DIR.rglob("*"):
+        if p.is_file() and not p.name.endswith(".part"):
+            stat = p.stat()
+            files.append((stat.st_mtime, stat.st_size, p))
+    total = sum(size for _, size, _ in files) + reserve
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= RESULT_CACHE_MAX_BYTES:
+            break
+        try:
+            path.unlink()
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def cached_meta(key: str, bucket: str = RESULT_BUCKET) -> Optional[dict]:
+    """已缓存对象在对象存储上的 {etag, last_modified, size, checked_at}"""
+    return get_state_backend().get(f"{RESULT_META_KEY_PREFIX}{bucket}/{key}")
+
+
+def _record_meta(key: str, bucket: str, meta: dict):
+    get_state_backend().set(f"{RESULT_META_KEY_PREFIX}{bucket}/{key}", {
+        "etag": meta.get("etag"),
+        "last_modified": meta.get("last_modified"),
+        "size": meta.get("size"),
+        "checked_at": time.time()
+    }, ttl=RESULT_META_TTL)
+
+
+# ============ 对象存储访问 ============
+
+def _object_meta(response: httpx.Response) -> dict:
+    return {
+        "size": int(response.headers.get("content-length", 0)),
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+        "content_type": response.headers.get("content-type", "application/octet-stream")
+    }
+
+
+async def head_object(client: httpx.AsyncClient, key: str, bucket: str = RESULT_BUCKET) -> Optional[dict]:
+    url = object_url(key, bucket)
+    response = await client.head(url, headers=sign_headers("HEAD", url))
+    if response.status_code != 200:
+        return None
+    return _object_meta(response)
+
+
+async def object_exists(key: str, bucket: str = RESULT_BUCKET) -> bool:
+    """对象是否存在（HEAD）"""
+    async with httpx.AsyncClient(timeout=httpx.Timeout(30)) as client:
+        return await head_object(client, key, bucket) is not None
+
+
+async def _download_range(client: httpx.AsyncClient, url: str, part_path: Path, start: int, end: Optional[int] = None) -> int:
+    """把 [start, end] 区间写入 part_path 的对应位置，end 为None时下载整个对象，返回写入的字节数"""
+    headers = {"Range": f"bytes={start}-{end}"} if end is not None else {}
+    written = 0
+    async with client.stream("GET", url, headers=sign_headers("GET", url, headers)) as response:
+        if response.status_code != (206 if end is not None else 200):
+            raise RuntimeError(f"下载失败 {headers.get('Range', '')}: HTTP {response.status_code}")
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            async for chunk in response.aiter_bytes():
+                f.write(chunk)
+                written += len(chunk)
+    return written
+
+
+async def revalidate(key: str, bucket: str = RESULT_BUCKET, max_age: Optional[float] = None) -> Optional[Path]:
+    """
+    与对象存储一致的已缓存文件，未缓存返回None。上次确认超过 max_age 秒时发条件HEAD（If-None-Match）：
+    对象已变化或已删除时删除本地文件并返回None；对象存储暂时不可达时沿用缓存。max_age 默认 RESULT_REVALIDATE_INTERVAL
+    """
+    max_age = RESULT_REVALIDATE_INTERVAL if max_age is None else max_age
+    path = cached_file(key, bucket)
+    if path is None:
+        return None
+    size = path.stat().st_size
+    meta = cached_meta(key, bucket)
+    etag = (meta or {}).get("etag")
+    if etag and meta.get("size") == size and time.time() - meta.get("checked_at", 0) < max_age:
+        return path
+
+    url = object_url(key, bucket)
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(10)) as client:
+            response = await client.head(url, headers=sign_headers("HEAD", url, {"If-None-Match": etag} if etag else None))
+    except httpx.HTTPError:
+        return path
+    if response.status_code == 304:
+        unchanged = True
+    elif response.status_code == 200:
+        upstream = _object_meta(response)
+        # 没有ETag记录（如升级前缓存的文件）时只比较大小
+        unchanged = upstream["size"] == size and (etag is None or upstream["etag"] == etag)
+        meta = upstream
+    elif response.status_code == 404:
+        unchanged = False
+    else:
+        return path
+    if unchanged:
+        _record_meta(key, bucket, meta)
+        return path
+    path.unlink(missing_ok=True)
+    return None
+
+
+async def download(key: str, bucket: str = RESULT_BUCKET, max_age: Optional[float] = None) -> Optional[Path]:
+    """
+    下载对象到本地缓存并返回本地路径；已缓存且未变化时直接返回（确认间隔见 revalidate），对象不存在时返回None。
+    大文件按 RANGE_CHUNK_SIZE 分段并发下载；多个进程同时请求同一对象时只有一个真正下载，其余等待。
+    """
+    path = await revalidate(key, bucket, max_age)
+    if path is not None:
+        return path
+
+    state = get_state_backend()
+    lock_name = f"result_download:{bucket}/{key}"
+    lock_token = state.acquire_lock(lock_name, ttl=DOWNLOAD_LOCK_TTL)
+    if lock_token is None:
+        deadline = time.monotonic() + DOWNLOAD_LOCK_TTL
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            path = cached_file(key, bucket)
+            if path is not None:
+                return path
+            if state.get(f"lock:{lock_name}") is None:
+                break
+        return cached_file(key, bucket)
+
+    url = object_url(key, bucket)
+    path = cache_path(key, bucket)
+    part_path = path.with_name(path.name + f".{os.getpid()}.part")
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60, read=300)) as client:
+            meta = await head_object(client, key, bucket)
+            if meta is None:
+                return None
+            size = meta["size"]
+            evict(reserve=size)
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+
+            if size <= RANGE_CHUNK_SIZE:
+                written = await _download_range(client, url, part_path, 0)
+            else:
+                semaphore = asyncio.Semaphore(RANGE_CONCURRENCY)
+
+                async def fetch(start):
+                    async with semaphore:
+                        return await _download_range(client, url, part_path, start, min(start + RANGE_CHUNK_SIZE, size) - 1)
+
+                written = sum(await asyncio.gather(*[fetch(start) for start in range(0, size, RANGE_CHUNK_SIZE)]))
+
+            if written != size:
+                raise RuntimeError(f"下载的字节数不一致: {written} != {size}")
+            part_path.replace(path)
+            _record_meta(key, bucket, meta)
+            return path
+    except Exception:
+        part_path.unlink(missing_ok=True)
+        raise
+    finally:
+        state.release_lock(lock_name, lock_token)
+
+
+# ============ 后台预取 ============
+
+class ResultPrefetcher:
+    """
+    任务完成后把结果文件预取到本地缓存。队列按优先级（越新的任务越优先）出队，
+    由固定数量的后台协程下载；队列满时丢弃优先级最低的任务。
+    """
+
+    def __init__(self, concurrency: int = PREFETCH_CONCURRENCY, max_pending: int = PREFETCH_MAX_PENDING,
+                 on_complete: Optional[Callable[[str, Path], Awaitable[None]]] = None):
+        self.concurrency = concurrency
+        self.on_complete = on_complete      # 下载完成后的回调（如tif转COG）
+        self.max_pending = max_pending
+        self._heap = []
+        self._pending = set()
+        self._counter = itertools.count()
+        self._loop = None
+        self._event = None
+        self._workers = []
+        self.stats = {"queued": 0, "completed": 0, "failed": 0, "dropped": 0, "skipped": 0}
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        # 事件循环变化（如测试中多次asyncio.run）时重新启动后台协程，队列保留
+        self._loop = loop
+        self._event = asyncio.Event()
+        self._workers = [loop.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def enqueue(self, key: str, priority: Optional[float] = None, bucket: str = RESULT_BUCKET) -> bool:
+        """
+        加入预取队列，已在队列中时返回False；priority 越大越先下载（默认当前时间）。
+        已缓存的对象同样入队：任务刚完成时同名结果可能已被覆盖，下载前总是向对象存储确认
+        """
+        item = (bucket, key)
+        if item in self._pending:
+            self.stats["skipped"] += 1
+            return False
+        self._ensure_workers()
+        heapq.heappush(self._heap, (-(priority if priority is not None else time.time()), next(self._counter), item))
+        self._pending.add(item)
+        self.stats["queued"] += 1
+        if len(self._heap) > self.max_pending:
+            lowest = max(self._heap)
+            self._heap.remove(lowest)
+            heapq.heapify(self._heap)
+            self._pending.discard(lowest[2])
+            self.stats["dropped"] += 1
+        self._event.set()
+        return True
+
+    async def _worker(self):
+        while True:
+            while not self._heap:
+                self._event.clear()
+                await self._event.wait()
+            _, _, item = heapq.heappop(self._heap)
+            bucket, key = item
+            try:
+                path = await download(key, bucket, max_age=0)
+                self.stats["completed" if path is not None else "failed"] += 1
+                if path is not None and self.on_complete is not None:
+                    await self.on_complete(key, path)
+            except Exception:
+                self.stats["failed"] += 1
+            finally:
+                self._pending.discard(item)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "pending": len(self._heap),
+            "next": [item[1] for _, _, item in heapq.nsmallest(5, self._heap)]
+        }
+
+
+# ============ 流式输出 ============
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """解析单段Range请求头，返回闭区间 (start, end)；无Range或格式不支持时返回None，越界时抛ValueError"""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, _, end_text = range_header[len("bytes="):].strip().partition("-")
+    if start_text == "":
+        length = int(end_text)
+        if length <= 0:
+            raise ValueError(range_header)
+        start, end = max(size - length, 0), size - 1
+    else:
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError(range_header)
+    return start, end
+
+
+async def iter_file(path: Path, start: int, end: int) -> AsyncIterator[bytes]:
+    """按块读取本地文件的 [start, end] 区间"""
+    remaining = end - start + 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = await run_blocking(f.read, min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def open_upstream(key: str, range_header: Optional[str] = None, bucket: str = RESULT_BUCKET):
+    """
+    打开对象存储上的流式响应（转发客户端的Range），返回 (client, response)，调用方负责关闭。
+    """
+    url = object_url(key, bucket)
+    headers = {"Range": range_header} if range_header else {}
+    client = httpx.AsyncClient(timeout=httpx.Timeout(60, read=300))
+    request = client.build_request("GET", url, headers=sign_headers("GET", url, headers))
+    response = await client.send(request, stream=True)
+    return client, response
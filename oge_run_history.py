@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+工作流运行记录（列式存储）
+execute_dag_workflow 每次运行记录一行：各阶段耗时（executeCode、addTaskRecord、排队、运行、目录确认、结果登记）、
+输入规模（村数、地块数、面积 all_area）、集群、执行方式与结果，供容量规划按时间窗口统计分位数。
+
+存储为按天分段的列式文件（只用标准库）：
+
+- 每个进程先在内存中累积，达到 RUN_HISTORY_FLUSH_ROWS 行时写出，后台定时器（start）每 RUN_HISTORY_FLUSH_INTERVAL 秒
+  也写出一次，写出为分段文件 runs-YYYYMMDD-<pid>-<毫秒时间戳>-<序号>.col，多个worker互不干扰；
+- 定时器同时合并已经过去的日期（UTC）的小分段：同一天的多个分段合并为一个，新分段头的 replaces 列出被替换的分段，
+  查询时跳过被替换的分段，删除旧分段前后都不会重复计数；
+- 分段文件第一行是JSON头（行数、时间范围、各列的位置与类型、分类列的字典），之后是各列经zlib压缩的数组；
+- 数值列为 float32/float64 数组，缺失值为 NaN；分类列（分析类型、集群、执行方式、结果）按分段字典编码为 uint16；
+- 查询只读取时间范围内的分段和需要的列，分段头中的时间范围不相交时整段跳过。
+
+未写出的行只对本进程可见（最多 RUN_HISTORY_FLUSH_INTERVAL 秒）；超过 RUN_HISTORY_RETENTION_DAYS 天的分段在写出时删除。
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from oge_executor import run_blocking
+from oge_shared_state import get_state_backend
+
+logger = logging.getLogger("shandong_mcp")
+
+# ============ 配置部分 ============
+
+RUN_HISTORY_DIR = os.getenv("OGE_RUN_HISTORY_DIR", "state/run_history")
+RUN_HISTORY_FLUSH_ROWS = 256
+RUN_HISTORY_FLUSH_INTERVAL = 120     # 有未写出的行时，最长多少秒写出一次
+RUN_HISTORY_COMPACT_LOCK_TTL = 300   # 合并某一天分段时持有的跨进程锁
+RUN_HISTORY_RETENTION_DAYS = 180
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+WINDOWS = {"1h": 3600, "6h": 6 * 3600, "24h": 86400, "7d": 7 * 86400, "30d": 30 * 86400, "90d": 90 * 86400}
+
+PHASE_COLUMNS = ("total", "capacity_wait", "execute_code", "add_task_record", "queue", "run", "catalog_confirm",
+                 "report_insert")
+SIZE_COLUMNS = ("villages", "parcels", "all_area")
+CATEGORY_COLUMNS = ("analysis", "cluster", "executor", "outcome")
+
+# 列名 -> array类型码：d=float64，f=float32，H=uint16（分类编码）
+COLUMNS: Dict[str, str] = {
+    "started_at": "d",
+    **{name: "f" for name in PHASE_COLUMNS},
+    "villages": "f",
+    "parcels": "f",
+    "all_area": "d",
+    **{name: "H" for name in CATEGORY_COLUMNS},
+}
+
+SEGMENT_FORMAT = "oge-runs"
+SEGMENT_VERSION = 1
+
+
+def parse_window(window: Any) -> float:
+    """时间窗口：WINDOWS 中的名称（如 24h、7d）或秒数"""
+    if isinstance(window, (int, float)):
+        return float(window)
+    text = str(window).strip().lower()
+    if text in WINDOWS:
+        return float(WINDOWS[text])
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def percentile(sorted_values: Sequence[float], p: float) -> Optional[float]:
+    """线性插值分位数，sorted_values 须已排序"""
+    if not sorted_values:
+        return None
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    rank = (len(sorted_values) - 1) * p / 100
+    low = int(math.floor(rank))
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def _number(value: Any) -> float:
+    try:
+        return float(value) if value is not None else math.nan
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y%m%d")
+
+
+class RunHistory:
+    """按天分段的列式运行记录"""
+
+    def __init__(self, directory: str = RUN_HISTORY_DIR):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._buffer: List[Dict[str, Any]] = []
+        self._last_flush = time.time()
+        self._sequence = 0
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"recorded": 0, "segments_written": 0, "segments_purged": 0, "segments_compacted": 0}
+
+    # ---------- 写入 ----------
+
+    def record(self, row: Dict[str, Any]) -> None:
+        """记录一次运行；row 中缺少的列记为缺失值，started_at 默认为当前时间"""
+        row = {**row, "started_at": row.get("started_at") or time.time()}
+        with self._lock:
+            self._buffer.append(row)
+            self.stats["recorded"] += 1
+            due = len(self._buffer) >= RUN_HISTORY_FLUSH_ROWS
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """把内存中的行按天写出为分段文件，返回写出的行数"""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            self._last_flush = time.time()
+        if not rows:
+            return 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+        by_day: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            by_day.setdefault(_day(row["started_at"]), []).append(row)
+        for day, day_rows in by_day.items():
+            self._write_segment(day, day_rows)
+        self.purge()
+        return len(rows)
+
+    def _write_segment(self, day: str, rows: List[Dict[str, Any]], replaces: Optional[List[str]] = None) -> None:
+        dictionaries: Dict[str, List[str]] = {}
+        blobs: List[bytes] = []
+        layout: Dict[str, List[Any]] = {}
+        offset = 0
+        for name, typecode in COLUMNS.items():
+            if typecode == "H":
+                values = dictionaries.setdefault(name, [])
+                index = {}
+                codes = array("H")
+                for row in rows:
+                    text = str(row.get(name) or "")
+                    if text not in index:
+                        index[text] = len(values)
+                        values.append(text)
+                    codes.append(index[text])
+                data = codes
+            else:
+                data = array(typecode, (_number(row.get(name)) for row in rows))
+            blob = zlib.compress(data.tobytes(), 6)
+            layout[name] = [typecode, offset, len(blob)]
+            blobs.append(blob)
+            offset += len(blob)
+        started = [row["started_at"] for row in rows]
+        header = {
+            "format": SEGMENT_FORMAT,
+            "version": SEGMENT_VERSION,
+            "rows": len(rows),
+            "min_started_at": min(started),
+            "max_started_at": max(started),
+            "columns": layout,
+            "dictionaries": dictionaries,
+        }
+        if replaces:
+            header["replaces"] = replaces
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        path = self.directory / f"runs-{day}-{os.getpid()}-{int(time.time() * 1000)}-{sequence}.col"
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n")
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp, path)
+        self.stats["segments_written"] += 1
+
+    def compact(self, day: str) -> int:
+        """把某一天的多个分段合并为一个，返回被合并的分段数；其他进程正在合并同一天时跳过"""
+        state = get_state_backend()
+        lock_name = f"run_history_compact:{self.directory}:{day}"
+        lock_token = state.acquire_lock(lock_name, ttl=RUN_HISTORY_COMPACT_LOCK_TTL)
+        if lock_token is None:
+            return 0
+        try:
+            headers = self._headers(self.directory.glob(f"runs-{day}-*.col"))
+            replaced = {name for header in headers.values() for name in header.get("replaces", [])}
+            # 上次合并后未来得及删除的旧分段
+            for path in headers:
+                if path.name in replaced:
+                    path.unlink(missing_ok=True)
+            live = sorted(path for path in headers if path.name not in replaced)
+            if len(live) < 2:
+                return 0
+            rows: List[Dict[str, Any]] = []
+            merged: List[Path] = []
+            for path in live:
+                try:
+                    block = self._read_segment(path, list(COLUMNS))
+                except (OSError, ValueError, zlib.error):
+                    # 损坏的分段保持原样，查询时同样会跳过
+                    continue
+                if block is not None:
+                    rows.extend({name: block[name][i] for name in COLUMNS} for i in range(block["header"]["rows"]))
+                    merged.append(path)
+            if len(merged) < 2:
+                return 0
+            self._write_segment(day, rows, replaces=[path.name for path in merged])
+            for path in merged:
+                path.unlink(missing_ok=True)
+            self.stats["segments_compacted"] += len(merged)
+            return len(merged)
+        finally:
+            state.release_lock(lock_name, lock_token)
+
+    def compact_closed_days(self) -> int:
+        """合并已经过去的日期中有多个分段的日子，当天的分段仍在写入，不合并"""
+        if not self.directory.exists():
+            return 0
+        today = _day(time.time())
+        counts: Dict[str, int] = {}
+        for path in self.directory.glob("runs-*.col"):
+            day = path.name.split("-")[1]
+            if day < today:
+                counts[day] = counts.get(day, 0) + 1
+        return sum(self.compact(day) for day, count in sorted(counts.items()) if count > 1)
+
+    # ---------- 后台定时写出 ----------
+
+    def start(self) -> None:
+        """启动后台定时写出与合并（同一事件循环中只启动一次）"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._worker is not None and not self._worker.done() and self._worker.get_loop() is loop:
+            return
+        # 后台任务不继承调用方的截止时间
+        self._worker = loop.create_task(self._run(), context=contextvars.Context())
+
+    def stop(self) -> None:
+        """停止后台任务并写出剩余的行"""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(RUN_HISTORY_FLUSH_INTERVAL)
+            try:
+                await run_blocking(self.flush)
+                await run_blocking(self.compact_closed_days)
+            except Exception as e:
+                logger.warning(f"运行记录定时写出出错: {e}")
+
+    def purge(self, retention_days: int = RUN_HISTORY_RETENTION_DAYS) -> int:
+        if not self.directory.exists():
+            return 0
+        cutoff = _day(time.time() - retention_days * 86400)
+        removed = 0
+        for path in self.directory.glob("runs-*.col"):
+            if path.name.split("-")[1] < cutoff:
+                path.unlink(missing_ok=True)
+                removed += 1
+        self.stats["segments_purged"] += removed
+        return removed
+
+    # ---------- 查询 ----------
+
+    @staticmethod
+    def _headers(paths: Iterable[Path]) -> Dict[Path, dict]:
+        """读取各分段的JSON头，读不出的分段（写入中断或已被删除）跳过"""
+        headers = {}
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    header = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+            if header.get("format") == SEGMENT_FORMAT:
+                headers[path] = header
+        return headers
+
+    def _segments(self, since: float, until: float) -> Iterable[Path]:
+        if not self.directory.exists():
+            return []
+        first, last = _day(since), _day(until)
+        return sorted(p for p in self.directory.glob("runs-*.col") if first <= p.name.split("-")[1] <= last)
+
+    @staticmethod
+    def _read_segment(path: Path, columns: Sequence[str]) -> Optional[Dict[str, Any]]:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("format") != SEGMENT_FORMAT:
+                return None
+            base = f.tell()
+            result = {"header": header}
+            for name in columns:
+                spec = header["columns"].get(name)
+                if spec is None:
+                    result[name] = [None] * header["rows"]
+                    continue
+                typecode, offset, length = spec
+                f.seek(base + offset)
+                data = array(typecode)
+                data.frombytes(zlib.decompress(f.read(length)))
+                if typecode == "H":
+                    dictionary = header["dictionaries"][name]
+                    result[name] = [dictionary[code] or None for code in data]
+                else:
+                    result[name] = [None if math.isnan(v) else v for v in data]
+            return result
+
+    def scan(self, since: float, until: Optional[float] = None, columns: Optional[Sequence[str]] = None,
+             where: Optional[Dict[str, Any]] = None) -> Dict[str, list]:
+        """返回时间范围内满足 where（分类列等值）的行，按列组织：{列名: [值...]}"""
+        until = until if until is not None else time.time()
+        wanted = list(dict.fromkeys(["started_at", *(columns or COLUMNS), *(where or {})]))
+        out: Dict[str, list] = {name: [] for name in wanted}
+
+        def take(block: Dict[str, list], count: int) -> None:
+            for i in range(count):
+                started = block["started_at"][i]
+                if started is None or not since <= started < until:
+                    continue
+                if where and any(block[k][i] != v for k, v in where.items()):
+                    continue
+                for name in wanted:
+                    out[name].append(block[name][i])
+
+        headers = self._headers(self._segments(since, until))
+        replaced = {name for header in headers.values() for name in header.get("replaces", [])}
+        for path, header in headers.items():
+            if path.name in replaced:
+                continue
+            if header.get("max_started_at", until) < since or header.get("min_started_at", since) >= until:
+                continue
+            try:
+                block = self._read_segment(path, wanted)
+            except (OSError, ValueError, zlib.error):
+                # 写入中断或损坏的分段跳过
+                continue
+            if block is not None:
+                take(block, block["header"]["rows"])
+
+        with self._lock:
+            pending = list(self._buffer)
+        if pending:
+            block = {name: [] for name in wanted}
+            for row in pending:
+                for name in wanted:
+                    value = row.get(name)
+                    if COLUMNS.get(name) == "H":
+                        value = str(value) if value else None
+                    else:
+                        value = _number(value)
+                        value = None if math.isnan(value) else value
+                    block[name].append(value)
+            take(block, len(pending))
+        return out
+
+    def stats_for(self, window: Any = "24h", group_by: Optional[str] = None, where: Optional[Dict[str, Any]] = None,
+                  metrics: Sequence[str] = PHASE_COLUMNS + SIZE_COLUMNS,
+                  percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> Dict[str, Any]:
+        """
+        时间窗口内各指标的分位数，可按分类列分组。
+        返回 {"window", "since", "until", "groups": {分组: {"runs", "outcomes": {...}, "metrics": {指标: {count, mean, max, p50...}}}}}
+        """
+        if group_by is not None and group_by not in CATEGORY_COLUMNS:
+            raise ValueError(f"group_by 只能是 {', '.join(CATEGORY_COLUMNS)}")
+        unknown = [m for m in metrics if m not in COLUMNS or COLUMNS[m] == "H"]
+        if unknown:
+            raise ValueError(f"未知指标: {', '.join(unknown)}")
+        until = time.time()
+        seconds = parse_window(window)
+        since = until - seconds
+        columns = list(dict.fromkeys([*metrics, "outcome", *([group_by] if group_by else [])]))
+        data = self.scan(since, until, columns, where)
+
+        groups: Dict[str, Dict[str, Any]] = {}
+        keys = data[group_by] if group_by else ["all"] * len(data["started_at"])
+        for i, key in enumerate(keys):
+            group = groups.setdefault(key or "unknown", {"indices": []})
+            group["indices"].append(i)
+
+        result_groups = {}
+        for key, group in groups.items():
+            indices = group["indices"]
+            outcomes: Dict[str, int] = {}
+            for i in indices:
+                outcome = data["outcome"][i] or "unknown"
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            summary = {}
+            for metric in metrics:
+                values = sorted(v for v in (data[metric][i] for i in indices) if v is not None)
+                entry = {"count": len(values)}
+                if values:
+                    entry["mean"] = round(sum(values) / len(values), 3)
+                    entry["max"] = round(values[-1], 3)
+                    for p in percentiles:
+                        entry[f"p{p:g}"] = round(percentile(values, p), 3)
+                summary[metric] = entry
+            result_groups[key] = {"runs": len(indices), "outcomes": outcomes, "metrics": summary}
+
+        return {
+            "window": window if isinstance(window, str) else f"{seconds:g}s",
+            "since": since,
+            "until": until,
+            "group_by": group_by,
+            "where": where or {},
+            "groups": result_groups,
+        }
+
+    def snapshot(self) -> dict:
+        segments = list(self.directory.glob("runs-*.col")) if self.directory.exists() else []
+        return {
+            "directory": str(self.directory),
+            "segments": len(segments),
+            "bytes": sum(p.stat().st_size for p in segments),
+            "buffered": len(self._buffer),
+            **self.stats
+        }
+
+
+_history: Optional[RunHistory] = None
+
+
+def get_run_history() -> RunHistory:
+    """获取当前进程使用的运行记录（惰性创建）"""
+    global _history
+    if _history is None:
+        _history = RunHistory(RUN_HISTORY_DIR)
+    return _history
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+任务耗时预估
+execute_dag_workflow 原先不论任务大小都固定 10 秒轮询、1800 秒超时：小任务等得太久，大任务被误判超时。
+这里用运行记录（oge_run_history）中已完成的批处理运行训练一个简单模型，按分析类型和输入规模
+（guoTuBianGeng 统计中的地块数 cnt）预估从提交到完成的耗时，并据此给出：
+
+- first_poll：提交后第一次查询状态前的等待时间；
+- poll_interval：之后的查询间隔，运行超过预估上界后逐步放慢；
+- timeout：等待完成的超时时间；
+- eta：预计完成时间，随提交结果返回并写入任务表（前端显示预计耗时和进度）。
+
+模型：每种分析类型在对数坐标下拟合 耗时 = a * 地块数^b，残差的 p90 作为上界系数；
+样本不足或没有输入规模时用该类型耗时的中位数/p90；完全没有记录时沿用原来的固定值。
+"""
+
+import math
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from oge_run_history import get_run_history, parse_window, percentile
+
+# ============ 配置部分 ============
+
+ESTIMATOR_WINDOW = "30d"          # 训练使用的运行记录时间范围
+ESTIMATOR_REFRESH = 600           # 模型重新训练的间隔（秒）
+MIN_HISTORY_SAMPLES = 3           # 按类型统计中位数所需的最少样本
+MIN_SIZE_SAMPLES = 8              # 按输入规模拟合所需的最少样本
+
+DEFAULT_FIRST_POLL = 10           # 没有历史记录时沿用原来的固定值
+DEFAULT_POLL_INTERVAL = 10
+DEFAULT_TIMEOUT = 1800
+
+FIRST_POLL_FRACTION = 0.5         # 首次查询在预估耗时的一半时进行
+POLL_FRACTION = 0.1               # 查询间隔为预估耗时的十分之一
+TIMEOUT_FACTOR = 3.0              # 超时为预估上界的三倍
+MIN_FIRST_POLL, MAX_FIRST_POLL = 3, 60
+MIN_POLL_INTERVAL, MAX_POLL_INTERVAL = 2, 60
+MIN_TIMEOUT, MAX_TIMEOUT = 300, 4 * 3600
+
+ALL_ANALYSES = "*"
+
+
+def _clamp(value: float, low: float, high: float) -> float:
+    return min(max(value, low), high)
+
+
+def _fit_loglog(points: List[Tuple[float, float]]) -> Optional[Dict[str, float]]:
+    """最小二乘拟合 log(耗时) = a + b*log(地块数)，返回 a、b 与残差p90对应的上界系数"""
+    xs = [math.log(size) for size, _ in points]
+    ys = [math.log(duration) for _, duration in points]
+    n = len(xs)
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x <= 1e-9:
+        return None
+    b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    a = mean_y - b * mean_x
+    residuals = sorted(y - (a + b * x) for x, y in zip(xs, ys))
+    return {"a": a, "b": b, "upper_factor": math.exp(max(0.0, percentile(residuals, 90)))}
+
+
+class RuntimeEstimator:
+    """按分析类型与输入规模预估耗时，模型在事件循环外训练"""
+
+    def __init__(self, window: str = ESTIMATOR_WINDOW, refresh: float = ESTIMATOR_REFRESH):
+        self.window = window
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._models: Dict[str, Dict[str, Any]] = {}
+        self._trained_at = 0.0
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - self._trained_at >= self.refresh
+
+    def train(self) -> Dict[str, Dict[str, Any]]:
+        """从运行记录训练模型（读文件，应在线程池中调用）"""
+        now = time.time()
+        data = get_run_history().scan(
+            now - parse_window(self.window), now,
+            ["analysis", "executor", "parcels", "queue", "run", "catalog_confirm"],
+            where={"outcome": "completed"}
+        )
+        samples: Dict[str, List[Tuple[Optional[float], float, Optional[float]]]] = {}
+        for i in range(len(data["started_at"])):
+            # 只用批处理运行：预热会话上的运行不经过轮询
+            if data["executor"][i] not in (None, "batch") or data["run"][i] is None:
+                continue
+            duration = sum(v for v in (data["queue"][i], data["run"][i], data["catalog_confirm"][i]) if v)
+            if duration <= 0:
+                continue
+            row = (data["parcels"][i], duration, data["queue"][i])
+            samples.setdefault(data["analysis"][i] or "unknown", []).append(row)
+            samples.setdefault(ALL_ANALYSES, []).append(row)
+
+        models = {}
+        for analysis, rows in samples.items():
+            durations = sorted(d for _, d, _ in rows)
+            queues = sorted(q for _, _, q in rows if q is not None)
+            model = {
+                "samples": len(rows),
+                "median": percentile(durations, 50),
+                "p90": percentile(durations, 90),
+                "queue_p50": percentile(queues, 50) if queues else None,
+                "size_fit": None
+            }
+            sized = [(size, d) for size, d, _ in rows if size and size > 0]
+            if len(sized) >= MIN_SIZE_SAMPLES:
+                model["size_fit"] = _fit_loglog(sized)
+            models[analysis] = model
+        with self._lock:
+            self._models = models
+            self._trained_at = now
+        return models
+
+    def maybe_train(self) -> None:
+        if self.stale:
+            self.train()
+
+    def estimate(self, analysis: str, input_size: Optional[dict] = None) -> Dict[str, Any]:
+        """返回 {expected_seconds, upper_seconds, queue_seconds, basis, samples}，没有可用记录时 expected_seconds 为None"""
+        with self._lock:
+            model = self._models.get(analysis)
+            if model is None or model["samples"] < MIN_HISTORY_SAMPLES:
+                # 该类型样本不足时用全部类型的记录
+                model = self._models.get(ALL_ANALYSES)
+        parcels = (input_size or {}).get("parcels")
+        if not model or model["samples"] < MIN_HISTORY_SAMPLES:
+            return {"expected_seconds": None, "upper_seconds": None, "queue_seconds": None,
+                    "basis": "default", "samples": model["samples"] if model else 0}
+        fit = model.get("size_fit")
+        if fit and parcels and parcels > 0:
+            expected = math.exp(fit["a"] + fit["b"] * math.log(parcels))
+            upper = expected * fit["upper_factor"]
+            basis = "size_model"
+        else:
+            expected, upper = model["median"], max(model["p90"], model["median"])
+            basis = "history"
+        return {"expected_seconds": expected, "upper_seconds": upper, "queue_seconds": model["queue_p50"],
+                "basis": basis, "samples": model["samples"]}
+
+    def schedule(self, analysis: str, input_size: Optional[dict] = None, check_interval: Optional[float] = None,
+                 max_wait_time: Optional[float] = None) -> Dict[str, Any]:
+        """轮询计划；调用方显式给出的 check_interval / max_wait_time 优先"""
+        estimate = self.estimate(analysis, input_size)
+        expected, upper = estimate["expected_seconds"], estimate["upper_seconds"]
+        if expected is None:
+            first_poll, interval, timeout = DEFAULT_FIRST_POLL, DEFAULT_POLL_INTERVAL, DEFAULT_TIMEOUT
+        else:
+            first_poll = _clamp(expected * FIRST_POLL_FRACTION, MIN_FIRST_POLL, MAX_FIRST_POLL)
+            interval = _clamp(expected * POLL_FRACTION, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL)
+            timeout = _clamp(upper * TIMEOUT_FACTOR, MIN_TIMEOUT, MAX_TIMEOUT)
+        if check_interval:
+            interval = check_interval
+        if max_wait_time:
+            timeout = max_wait_time
+        now = time.time()
+        return {
+            **{k: round(v, 1) if isinstance(v, float) else v for k, v in estimate.items()},
+            "first_poll": round(first_poll, 1),
+            "poll_interval": round(interval, 1),
+            "timeout": round(timeout),
+            "eta": now + expected if expected is not None else None,
+            "eta_text": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now + expected)) if expected is not None else None
+        }
+
+    @staticmethod
+    def next_interval(schedule: Dict[str, Any], elapsed: float) -> float:
+        """当前的查询间隔：超过预估上界后每次放慢一倍，不超过 MAX_POLL_INTERVAL"""
+        interval = schedule["poll_interval"]
+        upper = schedule.get("upper_seconds")
+        if upper and elapsed > upper:
+            grown = interval * 2 ** min(4, int(elapsed / upper))
+            interval = max(interval, min(grown, MAX_POLL_INTERVAL))
+        return interval
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            models = {k: dict(v) for k, v in self._models.items()}
+        return {"window": self.window, "trained_at": self._trained_at or None, "models": models}
+
+
+_estimator: Optional[RuntimeEstimator] = None
+
+
+def get_runtime_estimator() -> RuntimeEstimator:
+    """获取当前进程使用的耗时预估器（惰性创建）"""
+    global _estimator
+    if _estimator is None:
+        _estimator = RuntimeEstimator()
+    return _estimator
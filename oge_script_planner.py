@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+耕地流出分析OGE脚本规划器
+把约束图层（城镇开发边界、生态保护红线、大于15度坡度）描述为“数据源 -> 属性过滤 -> 重投影”的处理链，
+再由规划器统一做空间范围下推：在重投影、相交、擦除之前先用耕地范围裁剪每个约束图层，
+使集群的计算量只与查询区域相关，而不是整个山东省。
+耕地数据本身是 EPSG:4527，约束图层原始数据是 CGCS2000 地理坐标，下推到重投影之前时使用
+同一坐标系下的耕地范围（由查询区域内的少量耕地重投影后求得），保证范围比较的坐标系一致。
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+# ============ 配置部分 ============
+
+TARGET_CRS = "EPSG:4527"       # 相交/擦除/面积计算使用的投影坐标系
+OUTPUT_CRS = "EPSG:4490"       # 结果输出坐标系（CGCS2000）
+SOURCE_CRS = "EPSG:4490"       # 约束图层原始坐标系 GCS_China_Geodetic_Coordinate_System_2000
+BOUNDS_VAR = "cultivated_bounds"
+VILLAGE_FIELD = "ZLDWMC"          # 耕地的村名（坐落单位名称）字段
+
+
+def bounds_var(crs: str) -> str:
+    """耕地范围在脚本中的变量名，目标坐标系下为 cultivated_bounds，其他坐标系带EPSG编码后缀"""
+    return BOUNDS_VAR if crs == TARGET_CRS else f"{BOUNDS_VAR}_{crs.split(':')[-1]}"
+
+
+class ConstraintLayer:
+    """一个约束图层的逻辑处理链"""
+
+    def __init__(self, var: str, table: str, comment: str, metadata_filters: Optional[List[Tuple[str, str, object]]] = None,
+                 source_crs: str = SOURCE_CRS):
+        self.var = var                      # 处理完成后在脚本中的变量名
+        self.table = table                  # getFeatureCollection 的图层名
+        self.comment = comment
+        self.metadata_filters = metadata_filters or []
+        self.source_crs = source_crs
+        self.materialized_asset: Optional[str] = None   # 已物化（过滤+重投影完成）的图层名
+
+    @property
+    def key(self) -> str:
+        """图层名 + 属性过滤条件 + 目标坐标系，条件不同视为不同的物化图层"""
+        filters = ",".join(f"{field}:{op}:{value}" for field, op, value in self.metadata_filters)
+        return f"{self.table}|{filters}|{TARGET_CRS}"
+
+    def logical_ops(self) -> List[tuple]:
+        """未优化的处理链：数据源 -> 属性过滤 -> 重投影；已物化的图层直接读取物化结果"""
+        if self.materialized_asset:
+            return [("source", self.materialized_asset)]
+        ops = [("source", self.table)]
+        ops += [("filterMetadata", f) for f in self.metadata_filters]
+        ops.append(("reproject", TARGET_CRS))
+        return ops
+
+
+def outflow_constraint_layers(slope_threshold: int = 4, materialized: Optional[Dict[str, str]] = None) -> List[ConstraintLayer]:
+    """耕地流出分析用到的三个约束图层；materialized 为 {图层key: 物化图层名}"""
+    layers = [
+        ConstraintLayer("slope_extent", "shp_podu", "坡度 GCS_China_Geodetic_Coordinate_System_2000",
+                        [("pdjb", "greater_than", slope_threshold)]),
+        ConstraintLayer("urban", "shp_chengzhenkaifa", "城镇开发边界"),
+        ConstraintLayer("ecology", "shp_shengtaibaohu", "生态保护红线"),
+    ]
+    for layer in layers:
+        layer.materialized_asset = (materialized or {}).get(layer.key)
+    return layers
+
+
+def push_down_bounds(layer: ConstraintLayer, ops: List[tuple]) -> List[tuple]:
+    """
+    空间范围下推：把 filterBounds 放到属性过滤之后、第一个重投影之前。
+    属性过滤代价低且能先减少要素数，范围过滤再把图层裁到查询区域，之后的重投影只处理区域内要素。
+    重投影之前图层仍是原始坐标系，使用同坐标系的耕地范围；已物化的图层已在目标坐标系下。
+    """
+    ops = [op for op in ops if op[0] != "filterBounds"]
+    insert_at = next((i for i, op in enumerate(ops) if op[0] == "reproject"), None)
+    if insert_at is None:
+        crs = TARGET_CRS if layer.materialized_asset else layer.source_crs
+        return ops + [("filterBounds", bounds_var(crs))]
+    return ops[:insert_at] + [("filterBounds", bounds_var(layer.source_crs))] + ops[insert_at:]
+
+
+def render_layer(layer: ConstraintLayer, ops: List[tuple]) -> List[str]:
+    """把处理链渲染为OGE脚本行，最后一步的结果赋给 layer.var"""
+    suffixes = {"source": "_", "filterMetadata": "_filtered", "filterBounds": "_bounded", "reproject": "_reprojected"}
+    lines = []
+    current = None
+    for i, (kind, arg) in enumerate(ops):
+        var = layer.var if i == len(ops) - 1 else f"{layer.var}{suffixes.get(kind, '_' + kind)}"
+        if kind == "source":
+            comment = f"{layer.comment}（物化图层）" if layer.materialized_asset else layer.comment
+            lines.append(f'{var} = service.getFeatureCollection("{arg}") #{comment}')
+        elif kind == "filterMetadata":
+            field, op, value = arg
+            lines.append(f'{var} = service.getProcess("FeatureCollection.filterMetadata").execute({current}, "{field}", "{op}", {value!r})')
+        elif kind == "filterBounds":
+            lines.append(f'{var} = service.getProcess("FeatureCollection.filterBounds").execute({current}, {arg})')
+        elif kind == "reproject":
+            lines.append(f'{var} = service.getProcess("FeatureCollection.reproject").execute({current}, "{arg}")')
+        else:
+            raise ValueError(f"未知的处理步骤: {kind}")
+        current = var
+    return lines
+
+
+def plan_constraint_layers(layers: List[ConstraintLayer], pushdown: bool = True) -> List[str]:
+    """生成所有约束图层的脚本行，以及各图层所需坐标系下的耕地范围"""
+    layer_lines = []
+    bounds_vars = set()
+    for layer in layers:
+        ops = layer.logical_ops()
+        if pushdown:
+            ops = push_down_bounds(layer, ops)
+        bounds_vars.update(arg for kind, arg in ops if kind == "filterBounds")
+        layer_lines += render_layer(layer, ops)
+
+    lines = []
+    for crs in sorted({layer.source_crs for layer in layers} - {TARGET_CRS}):
+        var = bounds_var(crs)
+        if var in bounds_vars:
+            code = crs.split(":")[-1]
+            lines.append(f'cultivated_{code} = service.getProcess("FeatureCollection.reproject").execute(cultivated, "{crs}")')
+            lines.append(f'{var} = service.getProcess("FeatureCollection.bounds").execute(cultivated_{code})')
+    return lines + layer_lines
+
+
+def plan_output_filter(source_var: str, keep_villages: Optional[List[str]]) -> List[str]:
+    """按村名逐个过滤后合并，结果赋给 deprecated_core；不需要过滤时不生成任何脚本行"""
+    if not keep_villages:
+        return []
+    lines, parts = [], []
+    for i, village in enumerate(keep_villages):
+        var = f"deprecated_core_{i}"
+        lines.append(f'{var} = service.getProcess("FeatureCollection.filterMetadata").execute({source_var}, "{VILLAGE_FIELD}", "equals", {village!r})')
+        parts.append(var)
+    lines.append(f'deprecated_core = service.getProcess("FeatureCollection.mergeAll").execute([{",".join(parts)}]) #只保留本次计算的村')
+    return lines
+
+
+def build_outflow_script(
+    data_query_sql: str,
+    slope_threshold: int = 4,
+    fragment_area_threshold: float = 3333.3333,
+    buffer_distance: float = 10.0,
+    peripheral_area_threshold: float = 6666.6667,
+    pushdown: bool = True,
+    export_name: str = "cultivated_protected",
+    materialized: Optional[Dict[str, str]] = None,
+    halo_query: Optional[str] = None,
+    keep_villages: Optional[List[str]] = None
+) -> str:
+    """
+    生成耕地流出分析的完整OGE脚本
+
+    halo_query 不为空时（分片/增量计算），输入耕地为 halo_query 结果中落在本次耕地缓冲范围内的全部耕地，
+    保证边界地块做细碎化判定时能看到缓冲距离内的邻近地块。
+    keep_villages 不为空时，导出结果只保留这些村的要素（去掉光环中邻村的要素）。
+    """
+    layers = outflow_constraint_layers(slope_threshold, materialized)
+    constraint_lines = "\n".join(plan_constraint_layers(layers, pushdown))
+    output_lines = "".join(line + "\n" for line in plan_output_filter("deprecated_area", keep_villages))
+    output_var = "deprecated_core" if keep_villages else "deprecated_area"
+
+    if halo_query:
+        cultivated_lines = f"""query = r"{data_query_sql}"
+core = service.getProcess("FeatureCollection.runBigQuery").execute(query, "geom") #本次计算的耕地
+halo_query = r"{halo_query}"
+halo_candidates = service.getProcess("FeatureCollection.runBigQuery").execute(halo_query, "geom")
+core_halo = service.getProcess("FeatureCollection.buffer").execute(core, {buffer_distance:g})
+core_halo_bounds = service.getProcess("FeatureCollection.bounds").execute(core_halo)
+cultivated = service.getProcess("FeatureCollection.filterBounds").execute(halo_candidates, core_halo_bounds) #耕地（含缓冲范围内的邻近耕地）"""
+    else:
+        cultivated_lines = f"""query = r"{data_query_sql}"
+cultivated = service.getProcess("FeatureCollection.runBigQuery").execute(query, "geom") #耕地"""
+
+    return f"""import oge
+oge.initialize()
+
+service = oge.Service.initialize()
+{cultivated_lines}
+{BOUNDS_VAR} = service.getProcess("FeatureCollection.bounds").execute(cultivated)
+# 约束图层：先按耕地范围裁剪，再重投影（已物化的图层直接裁剪）
+{constraint_lines}
+
+urban_intersection = service.getProcess("FeatureCollection.intersection").execute(cultivated, urban) #流出1
+urban_erase = service.getProcess("FeatureCollection.erase").execute(cultivated, urban)
+ecology_intersection = service.getProcess("FeatureCollection.intersection").execute(urban_erase, ecology) ##流出3
+ecology_erase = service.getProcess("FeatureCollection.erase").execute(urban_erase, ecology)
+slope_intersection = service.getProcess("FeatureCollection.intersection").execute(ecology_erase, slope_extent) #流出4
+slope_erase = service.getProcess("FeatureCollection.erase").execute(ecology_erase, slope_extent)
+
+#筛选细碎化耕地
+cultivated1_area = service.getProcess("FeatureCollection.area").execute(slope_erase) #增加area字段
+cultivated1_lessthan5 = service.getProcess("FeatureCollection.filterMetadata").execute(cultivated1_area, "area", "less_than", {fragment_area_threshold})
+cultivated1_buffer = service.getProcess("FeatureCollection.buffer").execute(cultivated1_lessthan5, {buffer_distance:g})
+cultivated1_join = service.getProcess("FeatureCollection.spatialJoinOneToOne").execute(cultivated1_buffer, cultivated1_area, "buffer", "geom", True, "Intersects", ["area"], ["sum"])
+cultivated1_subtract = service.getProcess("FeatureCollection.subtract").execute(cultivated1_join, "area_sum", "area", "area_peri")
+deprecated1 = service.getProcess("FeatureCollection.filterMetadata").execute(cultivated1_subtract, "area_peri", "less_than", "{peripheral_area_threshold}") #流出5
+
+urban_intersection_reason = service.getProcess("FeatureCollection.constantColumn").execute(urban_intersection, "reason", "urban")
+ecology_intersection_reason = service.getProcess("FeatureCollection.constantColumn").execute(ecology_intersection, "reason", "ecology")
+slope_intersection_reason = service.getProcess("FeatureCollection.constantColumn").execute(slope_intersection, "reason", "slope")
+deprecated1_reason = service.getProcess("FeatureCollection.constantColumn").execute(deprecated1, "reason", "fragmented")
+
+deprecated = service.getProcess("FeatureCollection.mergeAll").execute([urban_intersection_reason,ecology_intersection_reason,slope_intersection_reason,deprecated1_reason]) #需要流出的耕地
+deprecated_area = service.getProcess("FeatureCollection.area").execute(deprecated)
+{output_lines}deprecated_CGCS2000 = service.getProcess("FeatureCollection.reproject").execute({output_var}, "{OUTPUT_CRS}")
+deprecated_CGCS2000.export("{export_name}")"""
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+耕地流出分析分片执行
+覆盖整个镇的查询会变成一个巨大的DAG，擦除/相交/空间连接都挤在一个Spark作业里。
+这里把村列表（来自 ZLDWMC IN (...) 子句或地区目录）按地块数切成均衡的分片，每个分片单独生成DAG并行提交，
+最后把各分片的输出合并成一个结果。
+
+细碎化判定需要10米缓冲范围内邻近地块的面积，分片边界上的地块会受其他分片影响，
+所以每个分片的脚本都带“缓冲区光环”：输入为分片耕地缓冲范围内的全部耕地，合并时只保留属于本分片村的要素。
+光环的候选耕地只查询范围与分片村外扩范围相交的村（村范围来自地名库），不读取全镇。
+"""
+
+import json
+import os
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from oge_script_planner import VILLAGE_FIELD
+
+# ============ 配置部分 ============
+
+# 村过滤子句连同与其他条件相连的 AND 一起匹配：前面有 AND 时去掉前面的，是 WHERE 后第一个条件时去掉后面的
+VILLAGE_IN_PATTERN = re.compile(
+    r"\s+AND\s+ZLDWMC\s+IN\s*\(([^)]*)\)|ZLDWMC\s+IN\s*\(([^)]*)\)\s+AND\s+|ZLDWMC\s+IN\s*\(([^)]*)\)",
+    re.IGNORECASE
+)
+# 光环候选村的范围外扩（度）：覆盖10米缓冲距离，并容忍地名库村范围的误差
+HALO_MARGIN_DEG = float(os.getenv("OGE_HALO_MARGIN_DEG", "0.002"))
+
+
+def parse_villages(sql: str) -> Optional[List[str]]:
+    """从查询语句的 ZLDWMC IN (...) 子句中解析村名，没有该子句（镇级查询）时返回None"""
+    match = VILLAGE_IN_PATTERN.search(sql)
+    if not match:
+        return None
+    values = next(group for group in match.groups() if group is not None)
+    return [v.strip().strip("'\"") for v in values.split(",") if v.strip().strip("'\"")]
+
+
+def strip_villages(sql: str) -> str:
+    """去掉村过滤条件，得到同一地类条件下的全镇查询（作为光环的候选耕地）"""
+    stripped = VILLAGE_IN_PATTERN.sub("", sql, count=1).strip()
+    return re.sub(r"\s+WHERE$", "", stripped, flags=re.IGNORECASE)
+
+
+def with_villages(sql: str, villages: Sequence[str]) -> str:
+    """把查询语句的村过滤替换为指定村列表"""
+    village_sql = ", ".join(f"'{v}'" for v in villages)
+    base = strip_villages(sql)
+    joiner = "AND" if re.search(r"\sWHERE\s", base, re.IGNORECASE) else "WHERE"
+    return f"{base} {joiner} {VILLAGE_FIELD} IN ({village_sql})"
+
+
+def halo_villages(
+    core_villages: Sequence[str],
+    candidates: Sequence[str],
+    village_bounds: Dict[str, Tuple[float, float, float, float]],
+    margin: float = HALO_MARGIN_DEG
+) -> Optional[List[str]]:
+    """
+    光环需要读取的村：本次计算的村，加上范围与其外扩范围相交的候选村（没有范围信息的候选村也保留，宁多勿漏）。
+    本次计算的村缺少范围信息时无法确定光环，返回None（由调用方退回全镇查询）。
+    """
+    if not core_villages or not all(v in village_bounds for v in core_villages):
+        return None
+    core_boxes = [
+        (minx - margin, miny - margin, maxx + margin, maxy + margin)
+        for minx, miny, maxx, maxy in (village_bounds[v] for v in core_villages)
+    ]
+
+    def near_core(v: str) -> bool:
+        box = village_bounds.get(v)
+        if box is None:
+            return True
+        return any(box[0] <= c[2] and box[2] >= c[0] and box[1] <= c[3] and box[3] >= c[1] for c in core_boxes)
+
+    return list(dict.fromkeys(list(core_villages) + [v for v in candidates if near_core(v)]))
+
+
+def choose_shard_count(total_parcels: int, target_parcels_per_shard: int, max_shards: int, village_count: int) -> int:
+    """按总地块数决定分片数"""
+    if target_parcels_per_shard <= 0:
+        return 1
+    shards = -(-total_parcels // target_parcels_per_shard)
+    return max(1, min(shards, max_shards, village_count))
+
+
+def _morton_key(x: float, y: float, bounds: Tuple[float, float, float, float], bits: int = 16) -> int:
+    """二维坐标的Z序编码，用于让同一分片的村在空间上尽量相邻"""
+    minx, miny, maxx, maxy = bounds
+    scale = (1 << bits) - 1
+    xi = int((x - minx) / ((maxx - minx) or 1) * scale)
+    yi = int((y - miny) / ((maxy - miny) or 1) * scale)
+    key = 0
+    for i in range(bits):
+        key |= ((xi >> i) & 1) << (2 * i) | ((yi >> i) & 1) << (2 * i + 1)
+    return key
+
+
+def balance_shards(
+    villages: Sequence[str],
+    parcel_counts: Dict[str, int],
+    shard_count: int,
+    village_bounds: Optional[Dict[str, Tuple[float, float, float, float]]] = None
+) -> List[List[str]]:
+    """
+    按地块数把村划分为 shard_count 个均衡分片。
+    有村范围信息时按Z序排列后连续切分，分片在空间上紧凑、光环小；否则用最长处理时间优先（LPT）贪心分配。
+    """
+    villages = list(dict.fromkeys(villages))
+    shard_count = max(1, min(shard_count, len(villages)))
+    if shard_count == 1:
+        return [villages]
+
+    if village_bounds and all(v in village_bounds for v in villages):
+        extent = (
+            min(village_bounds[v][0] for v in villages), min(village_bounds[v][1] for v in villages),
+            max(village_bounds[v][2] for v in villages), max(village_bounds[v][3] for v in villages)
+        )
+
+        def centroid_key(v):
+            minx, miny, maxx, maxy = village_bounds[v]
+            return _morton_key((minx + maxx) / 2, (miny + maxy) / 2, extent)
+
+        ordered = sorted(villages, key=centroid_key)
+        total = sum(max(parcel_counts.get(v, 1), 1) for v in ordered)
+        shards, current, acc = [], [], 0
+        for v in ordered:
+            current.append(v)
+            acc += max(parcel_counts.get(v, 1), 1)
+            remaining_shards = shard_count - len(shards) - 1
+            if remaining_shards > 0 and acc >= total * (len(shards) + 1) / shard_count:
+                shards.append(current)
+                current = []
+        if current:
+            shards.append(current)
+        return shards
+
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for v in sorted(villages, key=lambda name: parcel_counts.get(name, 1), reverse=True):
+        i = loads.index(min(loads))
+        shards[i].append(v)
+        loads[i] += max(parcel_counts.get(v, 1), 1)
+    return [s for s in shards if s]
+
+
+def merge_feature_collections(collections: Sequence[dict], keep_villages: Optional[Sequence[set]] = None) -> dict:
+    """
+    合并各分片输出的GeoJSON FeatureCollection。
+    keep_villages 与 collections 一一对应，只保留属于该分片村的要素（光环里的邻村要素由其所属分片负责）。
+    """
+    features = []
+    for i, collection in enumerate(collections):
+        allowed = keep_villages[i] if keep_villages else None
+        for feature in (collection or {}).get("features", []):
+            if allowed is not None:
+                village = (feature.get("properties") or {}).get(VILLAGE_FIELD)
+                if village is not None and village not in allowed:
+                    continue
+            features.append(feature)
+    merged = {"type": "FeatureCollection", "features": features}
+    for collection in collections:
+        if collection and "crs" in collection:
+            merged["crs"] = collection["crs"]
+            break
+    return merged
+
+
+def summarize_outflow(collection: dict) -> dict:
+    """按流出原因统计要素数与面积"""
+    summary = {}
+    for feature in collection.get("features", []):
+        props = feature.get("properties") or {}
+        reason = props.get("reason", "unknown")
+        item = summary.setdefault(reason, {"count": 0, "area": 0.0})
+        item["count"] += 1
+        try:
+            item["area"] += float(props.get("area") or 0)
+        except (TypeError, ValueError):
+            pass
+    return summary
+
+
+def write_merged_outflow(sources: Sequence[str], keep_villages: Optional[Sequence[set]], path: str) -> dict:
+    """
+    读取各分片/已缓存村的结果文件，合并后写入 path，返回流出统计。
+    由进程池执行：传入和回传的都只有文件路径与统计，要素集合不在进程间传递
+    """
+    collections = []
+    for source in sources:
+        with open(source, "rb") as f:
+            collections.append(json.loads(f.read()))
+    merged = merge_feature_collections(collections, keep_villages)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(merged, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return summarize_outflow(merged)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+跨进程共享状态后端
+多worker HTTP模式下，认证token、地区目录和结果缓存需要在各进程之间保持一致。
+默认使用本地SQLite（WAL模式，适合单机多进程），也可以通过环境变量切换到Redis兼容服务：
+
+    OGE_STATE_BACKEND=sqlite:///state/oge_shared_state.db   (默认)
+    OGE_STATE_BACKEND=redis://127.0.0.1:6379/0
+
+Redis客户端只用到 GET/SET/DEL/RPUSH/PEXPIRE/EVAL 几个基础命令，任何兼容RESP协议的本地替身服务都可以使用。
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+# ============ 配置部分 ============
+
+DEFAULT_STATE_BACKEND = "sqlite:///state/oge_shared_state.db"
+STATE_BACKEND_URL = os.getenv("OGE_STATE_BACKEND", DEFAULT_STATE_BACKEND)
+
+# 共享状态中使用的key前缀，集中定义避免各处拼写不一致
+TOKEN_KEY = "auth:intranet_token"
+REGION_CATALOG_KEY = "catalog:regions"
+DAG_STATUS_KEY_PREFIX = "dag_status:"
+TASK_WATCH_KEY_PREFIX = "task_watch:"
+SSE_SESSION_KEY_PREFIX = "mcp_sse:session:"
+SSE_INBOX_KEY_PREFIX = "mcp_sse:inbox:"
+
+EXPIRED_PURGE_INTERVAL = 60      # SQLite后端清理过期行的最小间隔（秒），在写入时顺带执行
+
+
+def region_catalog_key(url: str, params: Optional[dict] = None) -> str:
+    """地区统计目录的缓存key：不同接口地址或查询参数的目录分开缓存"""
+    digest = hashlib.sha1(
+        json.dumps([url, params or {}], ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:16]
+    return f"{REGION_CATALOG_KEY}:{digest}"
+
+
+class SharedStateBackend:
+    """共享状态后端基类，值统一以JSON形式存储"""
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """仅当key不存在（或已过期）时写入，返回是否写入成功"""
+        raise NotImplementedError
+
+    def push(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """追加到key对应的队列末尾；ttl为整个队列的过期时间"""
+        raise NotImplementedError
+
+    def pop_all(self, key: str) -> list:
+        """原子地取出并清空队列，按追加顺序返回"""
+        raise NotImplementedError
+
+    def acquire_lock(self, name: str, ttl: float = 30) -> Optional[str]:
+        """获取跨进程锁，成功返回锁令牌，失败返回None；锁在ttl秒后自动失效"""
+        lock_token = uuid.uuid4().hex
+        if self.add(f"lock:{name}", lock_token, ttl=ttl):
+            return lock_token
+        return None
+
+    def release_lock(self, name: str, lock_token: str) -> None:
+        """释放锁，只有持有者（令牌一致）才会真正删除"""
+        if self.get(f"lock:{name}") == lock_token:
+            self.delete(f"lock:{name}")
+
+    def describe(self) -> dict:
+        raise NotImplementedError
+
+
+class SQLiteStateBackend(SharedStateBackend):
+    """基于SQLite文件的共享状态，同一台机器上的多个worker进程共用一个数据库文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._purged_at = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        # fork之后不能复用父进程的连接，按pid重新建立
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS queue_key ON queue (key, id)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value, expires_at FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return json.loads(value)
+
+    def _purge_expired(self, conn: sqlite3.Connection, now: float):
+        """删除过期的行（调用方持有 self._lock）；get 不会返回过期值，但不删除就会一直占用空间"""
+        if now - self._purged_at < EXPIRED_PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        conn.execute("DELETE FROM queue WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            self._purge_expired(conn, now)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            conn = self._connection()
+            # BEGIN IMMEDIATE 保证“检查过期 + 写入”在进程间是原子的
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "DELETE FROM kv WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+                    (key, now)
+                )
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), expires_at)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    def release_lock(self, name: str, lock_token: str) -> None:
+        # 比较与删除在一条语句中完成，锁过期后被其他进程重新获取时不会误删
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM kv WHERE key = ? AND value = ?",
+                (f"lock:{name}", json.dumps(lock_token, ensure_ascii=False))
+            )
+
+    def push(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO queue (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            self._purge_expired(conn, now)
+
+    def pop_all(self, key: str) -> list:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT value, expires_at FROM queue WHERE key = ? ORDER BY id", (key,)
+                ).fetchall()
+                if rows:
+                    conn.execute("DELETE FROM queue WHERE key = ?", (key,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [json.loads(value) for value, expires_at in rows if expires_at is None or expires_at > now]
+
+    def describe(self) -> dict:
+        return {"type": "sqlite", "path": self.path}
+
+
+class RedisStateBackend(SharedStateBackend):
+    """Redis兼容的共享状态，使用最小化的RESP客户端，不依赖redis第三方包"""
+
+    # 取出并清空队列需要原子执行，避免两个worker各取到一部分
+    POP_ALL_SCRIPT = (
+        "local values = redis.call('LRANGE', KEYS[1], 0, -1) "
+        "redis.call('DEL', KEYS[1]) "
+        "return values"
+    )
+    # 只有值仍是自己的令牌时才删除锁：GET和DEL分两次执行时，锁可能恰好过期并被其他进程获取
+    RELEASE_LOCK_SCRIPT = (
+        "if redis.call('GET', KEYS[1]) == ARGV[1] then "
+        "return redis.call('DEL', KEYS[1]) "
+        "end "
+        "return 0"
+    )
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+        self._pid = None
+
+    def _connect(self):
+        if self._sock is not None and self._pid == os.getpid():
+            return
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        self._sock = sock
+        self._reader = sock.makefile("rb")
+        self._pid = os.getpid()
+        if self.password:
+            self._command("AUTH", self.password)
+        if self.db:
+            self._command("SELECT", str(self.db))
+
+    def _command(self, *args: str):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg.encode("utf-8")
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis连接已关闭")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode()
+        if prefix == b"-":
+            raise RuntimeError(f"Redis错误: {payload.decode()}")
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if prefix == b"*":
+            return [self._read_reply() for _ in range(int(payload))]
+        raise RuntimeError(f"无法解析的Redis响应: {line!r}")
+
+    def _execute(self, *args: str):
+        with self._lock:
+            try:
+                self._connect()
+                return self._command(*args)
+            except (OSError, ConnectionError):
+                # 连接断开时重连一次
+                self._sock = None
+                self._connect()
+                return self._command(*args)
+
+    def get(self, key: str) -> Any:
+        value = self._execute("GET", key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        args = ["SET", key, json.dumps(value, ensure_ascii=False)]
+        if ttl:
+            args += ["PX", str(int(ttl * 1000))]
+        self._execute(*args)
+
+    def delete(self, key: str) -> None:
+        self._execute("DEL", key)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        args = ["SET", key, json.dumps(value, ensure_ascii=False), "NX"]
+        if ttl:
+            args += ["PX", str(int(ttl * 1000))]
+        return self._execute(*args) == "OK"
+
+    def release_lock(self, name: str, lock_token: str) -> None:
+        self._execute("EVAL", self.RELEASE_LOCK_SCRIPT, "1", f"lock:{name}",
+                      json.dumps(lock_token, ensure_ascii=False))
+
+    def push(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._execute("RPUSH", key, json.dumps(value, ensure_ascii=False))
+        if ttl:
+            self._execute("PEXPIRE", key, str(int(ttl * 1000)))
+
+    def pop_all(self, key: str) -> list:
+        values = self._execute("EVAL", self.POP_ALL_SCRIPT, "1", key)
+        return [json.loads(value) for value in values or []]
+
+    def describe(self) -> dict:
+        return {"type": "redis", "host": self.host, "port": self.port, "db": self.db}
+
+
+_backend: Optional[SharedStateBackend] = None
+
+
+def create_state_backend(url: str) -> SharedStateBackend:
+    """根据URL创建共享状态后端"""
+    if url.startswith("redis://"):
+        return RedisStateBackend(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteStateBackend(url[len("sqlite:///"):])
+    raise ValueError(f"不支持的共享状态后端: {url}")
+
+
+def get_state_backend() -> SharedStateBackend:
+    """获取当前进程使用的共享状态后端（惰性创建）"""
+    global _backend
+    if _backend is None:
+        _backend = create_state_backend(STATE_BACKEND_URL)
+    return _backend
+
+
+def configure_state_backend(url: str) -> SharedStateBackend:
+    """显式指定共享状态后端，供命令行参数使用；同时写入环境变量，让worker子进程沿用同一配置"""
+    global _backend, STATE_BACKEND_URL
+    STATE_BACKEND_URL = url
+    os.environ["OGE_STATE_BACKEND"] = url
+    _backend = create_state_backend(url)
+    return _backend
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+按输入规模给出Spark资源建议
+submit_batch_task 原先对所有DAG使用集群默认资源：一个村的小任务也占满默认的executor，
+全镇的大任务分区太少、内存不够而溢写到磁盘。这里按输入规模（地区统计目录中的地块数 cnt 与面积 all_area）
+估算输入数据量，给出 executor 数、每个 executor 的核数与内存、shuffle 分区数，随提交请求（addTaskRecord 的 sparkConf）下发：
+
+- 分区数：输入量 / PARTITION_TARGET_MB，每个分区的数据量保持在一个合适的范围；
+- executor 数：每个核处理 TASKS_PER_CORE 轮分区，不超过 MAX_EXECUTORS；
+- executor 内存：同时运行的分区数 × 单分区数据量 × MEMORY_EXPANSION（几何对象反序列化与叠加分析的放大），
+  加上固定开销，按GB取整。
+
+输入规模未知时不给建议，沿用集群默认配置。
+"""
+
+import math
+import os
+from typing import Any, Dict, Optional
+
+# ============ 配置部分 ============
+
+SPARK_HINTS_ENABLED = os.getenv("OGE_SPARK_HINTS", "1") == "1"
+PARCEL_KB = 6.0                   # 每个地块（几何+属性）的平均数据量
+AREA_MB_PER_KM2 = 0.5             # 约束图层按耕地范围裁剪后，每平方公里的数据量
+AREA_UNIT_KM2 = 1e-6              # all_area 的单位换算为平方公里（统计目录中为平方米）
+
+PARTITION_TARGET_MB = 32          # 每个分区的目标数据量
+MIN_PARTITIONS, MAX_PARTITIONS = 4, 400
+EXECUTOR_CORES = 2
+TASKS_PER_CORE = 2
+MIN_EXECUTORS = 1
+MAX_EXECUTORS = int(os.getenv("OGE_SPARK_MAX_EXECUTORS", "16"))
+MEMORY_EXPANSION = 6              # 分区数据在内存中的放大倍数
+EXECUTOR_BASE_MB = 1024           # executor 固定开销（JVM、GeoTools等）
+MIN_EXECUTOR_GB, MAX_EXECUTOR_GB = 2, 8
+OVERHEAD_FRACTION = 0.15          # 堆外内存（spark.executor.memoryOverhead）
+MIN_OVERHEAD_MB = 512
+
+
+def _clamp(value: float, low: float, high: float) -> float:
+    return min(max(value, low), high)
+
+
+def estimate_input_mb(input_size: Optional[dict]) -> Optional[float]:
+    """按地块数与面积估算输入数据量（MB），两者都未知时返回None"""
+    input_size = input_size or {}
+    parcels = input_size.get("parcels")
+    all_area = input_size.get("all_area")
+    if not parcels and not all_area:
+        return None
+    mb = (parcels or 0) * PARCEL_KB / 1024
+    mb += (all_area or 0) * AREA_UNIT_KM2 * AREA_MB_PER_KM2
+    return mb
+
+
+def spark_resource_hints(input_size: Optional[dict], max_executors: int = MAX_EXECUTORS) -> Optional[Dict[str, Any]]:
+    """
+    返回 {input_mb, partitions, executors, executor_cores, executor_memory, memory_overhead, conf}，
+    conf 为随提交下发的Spark配置；未启用或输入规模未知时返回None
+    """
+    if not SPARK_HINTS_ENABLED:
+        return None
+    input_mb = estimate_input_mb(input_size)
+    if input_mb is None:
+        return None
+
+    partitions = int(_clamp(math.ceil(input_mb / PARTITION_TARGET_MB), MIN_PARTITIONS, MAX_PARTITIONS))
+    executors = int(_clamp(math.ceil(partitions / (EXECUTOR_CORES * TASKS_PER_CORE)),
+                           MIN_EXECUTORS, max(MIN_EXECUTORS, max_executors)))
+    # executor 数被上限截断时，每个executor要处理更多轮分区，但同时运行的仍只有 EXECUTOR_CORES 个
+    partition_mb = input_mb / partitions
+    working_mb = EXECUTOR_CORES * partition_mb * MEMORY_EXPANSION + EXECUTOR_BASE_MB
+    memory_gb = int(_clamp(math.ceil(working_mb / 1024), MIN_EXECUTOR_GB, MAX_EXECUTOR_GB))
+    overhead_mb = max(MIN_OVERHEAD_MB, int(memory_gb * 1024 * OVERHEAD_FRACTION))
+
+    conf = {
+        "spark.executor.instances": str(executors),
+        "spark.executor.cores": str(EXECUTOR_CORES),
+        "spark.executor.memory": f"{memory_gb}g",
+        "spark.executor.memoryOverhead": f"{overhead_mb}m",
+        "spark.sql.shuffle.partitions": str(partitions),
+        "spark.default.parallelism": str(partitions),
+        # 集群开启动态分配时，上限与建议的executor数一致，小任务不会扩张占用空闲资源
+        "spark.dynamicAllocation.maxExecutors": str(executors)
+    }
+    return {
+        "input_mb": round(input_mb, 1),
+        "partitions": partitions,
+        "executors": executors,
+        "executor_cores": EXECUTOR_CORES,
+        "executor_memory": f"{memory_gb}g",
+        "memory_overhead": f"{overhead_mb}m",
+        "conf": conf
+    }
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+多worker模式下的MCP SSE消息转发
+SseServerTransport 把会话（session_id 到读流的映射）保存在进程内存里。多worker时客户端的
+GET /sse 和之后的 POST /messages/?session_id=… 多半落在不同的worker上，后者找不到会话返回404。
+这里通过共享状态后端（oge_shared_state）把消息转交给持有会话的worker：
+
+- 持有会话的worker在向客户端发送 endpoint 事件之前登记会话（客户端拿到session_id时登记已经可见），
+  连接期间定时续期，断开时删除登记；
+- 其他worker收到该会话的消息时校验JSON-RPC格式，追加到会话的收件队列后返回202；
+- 持有会话的worker轮询收件队列，把消息按原顺序交给本进程的 SseServerTransport 处理。
+
+单worker模式不需要转发，也不创建 SseSessionRelay。
+"""
+
+import asyncio
+import logging
+import os
+import re
+import uuid
+from typing import Dict, Optional, Set
+from urllib.parse import parse_qs
+
+from mcp import types
+from mcp.server.sse import SseServerTransport
+from mcp.server.transport_security import DEFAULT_MAX_REQUEST_BODY_SIZE, RequestBodyLimitMiddleware
+from pydantic import ValidationError
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from oge_executor import run_blocking
+from oge_shared_state import SSE_INBOX_KEY_PREFIX, SSE_SESSION_KEY_PREFIX, SharedStateBackend
+
+logger = logging.getLogger("shandong_mcp")
+
+# ============ 配置部分 ============
+
+SSE_RELAY_POLL_INTERVAL = float(os.getenv("OGE_SSE_RELAY_POLL", "0.05"))   # 收件队列轮询间隔（秒）
+SSE_SESSION_TTL = 60             # 会话登记的有效期，连接期间每 1/3 有效期续期一次
+SSE_INBOX_TTL = 300              # 收件队列的有效期，持有会话的worker异常退出后由后端清除
+FORWARDED_HEADERS = ("content-type", "host", "origin")   # 转交时保留的请求头，供传输层做同样的校验
+
+ENDPOINT_SESSION_PATTERN = re.compile(rb"session_id=([0-9a-f]{32})")
+
+
+class SseSessionRelay:
+    """把其他worker收到的会话消息转交给持有会话的worker"""
+
+    def __init__(self, transport: SseServerTransport, backend: SharedStateBackend,
+                 poll_interval: float = SSE_RELAY_POLL_INTERVAL):
+        self.transport = transport
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._local: Set[str] = set()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._forward_app = RequestBodyLimitMiddleware(self._forward_post_message, DEFAULT_MAX_REQUEST_BODY_SIZE)
+        self.stats = {"forwarded": 0, "delivered": 0}
+
+    def track(self, send: Send, session: dict) -> Send:
+        """
+        包装SSE连接的ASGI send：发现 endpoint 事件中的session_id时先登记会话、启动收件转发，再发给客户端。
+        session 用于把session_id带回调用方，连接结束时交给 forget
+        """
+
+        async def tracking_send(message):
+            if "id" not in session and message.get("type") == "http.response.body":
+                match = ENDPOINT_SESSION_PATTERN.search(message.get("body", b""))
+                if match:
+                    session["id"] = match.group(1).decode()
+                    self._register(session["id"])
+            await send(message)
+
+        return tracking_send
+
+    def _register(self, session_id: str):
+        self.backend.set(f"{SSE_SESSION_KEY_PREFIX}{session_id}", self.worker_id, ttl=SSE_SESSION_TTL)
+        self._local.add(session_id)
+        self._tasks[session_id] = asyncio.get_running_loop().create_task(self._deliver(session_id))
+
+    async def forget(self, session: dict):
+        """SSE连接结束：停止转发并删除登记"""
+        session_id = session.get("id")
+        if session_id is None:
+            return
+        self._local.discard(session_id)
+        task = self._tasks.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+        await run_blocking(self.backend.delete, f"{SSE_SESSION_KEY_PREFIX}{session_id}")
+
+    async def _deliver(self, session_id: str):
+        """轮询会话的收件队列，按顺序交给本进程的传输层；定时续期会话登记"""
+        inbox = f"{SSE_INBOX_KEY_PREFIX}{session_id}"
+        session_key = f"{SSE_SESSION_KEY_PREFIX}{session_id}"
+        loop = asyncio.get_running_loop()
+        renewed = loop.time()
+        while session_id in self._local:
+            if loop.time() - renewed >= SSE_SESSION_TTL / 3:
+                await run_blocking(self.backend.set, session_key, self.worker_id, SSE_SESSION_TTL)
+                renewed = loop.time()
+            for item in await run_blocking(self.backend.pop_all, inbox):
+                await self._replay(session_id, item)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _replay(self, session_id: str, item: dict):
+        """以本地POST请求的形式把转交的消息交给 SseServerTransport"""
+        body = item["body"].encode("utf-8")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/messages/",
+            "root_path": "",
+            "query_string": f"session_id={session_id}".encode(),
+            "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in item["headers"]],
+            "client": None,
+            "server": None,
+        }
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                return {"type": "http.disconnect"}
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        status = {}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+
+        try:
+            await self.transport.handle_post_message(scope, receive, send)
+        except Exception as e:
+            logger.error(f"转交SSE会话 {session_id} 的消息失败: {e}")
+            return
+        if status.get("code", 500) >= 400:
+            logger.warning(f"转交SSE会话 {session_id} 的消息被拒绝: HTTP {status.get('code')}")
+        else:
+            self.stats["delivered"] += 1
+
+    async def handle_post_message(self, scope: Scope, receive: Receive, send: Send):
+        """/messages/ 的ASGI应用：本进程的会话直接处理，其他worker持有的会话转交，否则按原逻辑返回404"""
+        session_id = self._session_param(scope)
+        if (scope["method"] == "POST" and session_id and session_id not in self._local
+                and await run_blocking(self.backend.get, f"{SSE_SESSION_KEY_PREFIX}{session_id}") is not None):
+            return await self._forward_app(scope, receive, send)
+        await self.transport.handle_post_message(scope, receive, send)
+
+    @staticmethod
+    def _session_param(scope: Scope) -> Optional[str]:
+        values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("session_id")
+        if not values:
+            return None
+        try:
+            return uuid.UUID(hex=values[0]).hex
+        except ValueError:
+            return None
+
+    async def _forward_post_message(self, scope: Scope, receive: Receive, send: Send):
+        request = Request(scope, receive)
+        body = await request.body()
+        try:
+            types.JSONRPCMessage.model_validate_json(body)
+        except ValidationError:
+            return await Response("Could not parse message", status_code=400)(scope, receive, send)
+        session_id = self._session_param(scope)
+        headers = [[name, request.headers[name]] for name in FORWARDED_HEADERS if name in request.headers]
+        await run_blocking(self.backend.push, f"{SSE_INBOX_KEY_PREFIX}{session_id}",
+                           {"body": body.decode("utf-8"), "headers": headers}, SSE_INBOX_TTL)
+        self.stats["forwarded"] += 1
+        await Response("Accepted", status_code=202)(scope, receive, send)
+
+    def snapshot(self) -> dict:
+        return {"worker_id": self.worker_id, "local_sessions": len(self._local), **self.stats}
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+本地任务登记表
+批处理任务提交后登记到本机SQLite（WAL模式，多个worker进程共用一个文件），按用户、提交时间和状态建索引，
+供 /task_status 长轮询和 /task_history 查询使用：
+
+- 每个任务有一个版本号，只有状态真正变化时才递增，长轮询以 since_version 判断是否有新内容；
+- 状态变化同时写入事件表，作为前端任务面板的日志；
+- 同进程内的状态变化立即唤醒等待者，其他worker写入的变化按 CROSS_WORKER_CHECK_INTERVAL 周期检查。
+
+前端使用的状态统一为 pending / running / completed / failed / cancelled，上游原始状态保留在 state 字段。
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+# ============ 配置部分 ============
+
+TASK_STORE_PATH = os.getenv("OGE_TASK_STORE", "state/oge_tasks.db")
+TASK_HISTORY_LIMIT = 50
+TASK_HISTORY_MAX_LIMIT = 500
+TASK_EVENT_LIMIT = 50
+LONG_POLL_MAX_WAIT = 60             # 单次长轮询最多挂起的秒数
+CROSS_WORKER_CHECK_INTERVAL = 1.0   # 等待期间检查其他worker写入的间隔
+
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+_COMPLETED_STATES = {"success", "succeeded", "finished", "completed"}
+_FAILED_STATES = {"failed", "error", "dead", "killed"}
+_CANCELLED_STATES = {"cancelled", "canceled"}
+_RUNNING_STATES = {"starting", "running", "busy"}
+
+_TASK_COLUMNS = (
+    "dag_id", "user_id", "username", "task_name", "filename", "format", "batch_session_id",
+    "state", "status", "version", "submitted_at", "updated_at", "checked_at", "finished_at", "detail"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    dag_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    username TEXT,
+    task_name TEXT,
+    filename TEXT,
+    format TEXT,
+    batch_session_id TEXT,
+    state TEXT,
+    status TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    submitted_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    checked_at REAL,
+    finished_at REAL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_user_time ON tasks (user_id, submitted_at DESC);
+CREATE INDEX IF NOT EXISTS idx_tasks_status_time ON tasks (status, submitted_at DESC);
+CREATE INDEX IF NOT EXISTS idx_tasks_time ON tasks (submitted_at DESC);
+CREATE TABLE IF NOT EXISTS task_events (
+    dag_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    at REAL NOT NULL,
+    level TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_task_events_task ON task_events (dag_id, version);
+"""
+
+
+def normalize_status(state: Optional[str], is_completed: bool = False, is_failed: bool = False) -> str:
+    """把DAG/目录返回的状态统一成前端使用的状态"""
+    if is_completed:
+        return "completed"
+    if is_failed:
+        return "failed"
+    value = (state or "").strip().lower()
+    if value in _COMPLETED_STATES:
+        return "completed"
+    if value in _FAILED_STATES:
+        return "failed"
+    if value in _CANCELLED_STATES:
+        return "cancelled"
+    if value in _RUNNING_STATES:
+        return "running"
+    return "pending"
+
+
+def _status_message(status: str, state: Optional[str]) -> str:
+    text = {
+        "pending": "任务等待执行",
+        "running": "任务执行中",
+        "completed": "任务执行完成",
+        "failed": "任务执行失败",
+        "cancelled": "任务已取消",
+    }[status]
+    return f"{text}（{state}）" if state else text
+
+
+def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    task = dict(row)
+    task["detail"] = json.loads(task["detail"]) if task.get("detail") else {}
+    return task
+
+
+class TaskStore:
+    """SQLite任务表；状态更新和长轮询等待都应在事件循环线程中调用"""
+
+    def __init__(self, path: str = TASK_STORE_PATH):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._waiters: Dict[str, Set[asyncio.Event]] = {}
+
+    def _connection(self) -> sqlite3.Connection:
+        # fork之后不能复用父进程的连接，按pid重新建立
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    # ---------- 写入 ----------
+
+    def register(self, dag_id: str, *, task_name: Optional[str] = None, filename: Optional[str] = None,
+                 format: Optional[str] = None, user_id: Optional[str] = None, username: Optional[str] = None,
+                 batch_session_id: Optional[str] = None, state: Optional[str] = None,
+                 detail: Optional[dict] = None) -> Dict[str, Any]:
+        """登记新提交的任务；同一dag_id重复提交时覆盖原记录并递增版本号"""
+        now = time.time()
+        status = normalize_status(state)
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT version FROM tasks WHERE dag_id = ?", (dag_id,)).fetchone()
+                version = row["version"] + 1 if row else 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO tasks (dag_id, user_id, username, task_name, filename, format,"
+                    " batch_session_id, state, status, version, submitted_at, updated_at, checked_at, finished_at, detail)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, ?)",
+                    (dag_id, user_id, username, task_name or dag_id, filename, format, batch_session_id,
+                     state, status, version, now, now, json.dumps(detail or {}, ensure_ascii=False))
+                )
+                conn.execute(
+                    "INSERT INTO task_events (dag_id, version, at, level, message) VALUES (?, ?, ?, ?, ?)",
+                    (dag_id, version, now, "info", f"任务已提交：{task_name or dag_id}")
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self._notify(dag_id)
+        return self.get(dag_id)
+
+    def update_state(self, dag_id: str, state: Optional[str], status: Optional[str] = None,
+                     detail: Optional[dict] = None) -> Optional[Dict[str, Any]]:
+        """记录一次上游状态查询结果；状态变化时递增版本号并写入事件。未登记的任务返回None"""
+        now = time.time()
+        status = status or normalize_status(state)
+        changed = False
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT * FROM tasks WHERE dag_id = ?", (dag_id,)).fetchone()
+                if row is None:
+                    conn.execute("ROLLBACK")
+                    return None
+                merged = {**(json.loads(row["detail"]) if row["detail"] else {}), **(detail or {})}
+                changed = row["status"] != status or row["state"] != state
+                if changed:
+                    version = row["version"] + 1
+                    finished_at = now if status in FINAL_STATUSES else None
+                    conn.execute(
+                        "UPDATE tasks SET state = ?, status = ?, version = ?, updated_at = ?, checked_at = ?,"
+                        " finished_at = ?, detail = ? WHERE dag_id = ?",
+                        (state, status, version, now, now, finished_at, json.dumps(merged, ensure_ascii=False), dag_id)
+                    )
+                    conn.execute(
+                        "INSERT INTO task_events (dag_id, version, at, level, message) VALUES (?, ?, ?, ?, ?)",
+                        (dag_id, version, now, "error" if status == "failed" else "info", _status_message(status, state))
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE tasks SET checked_at = ?, detail = ? WHERE dag_id = ?",
+                        (now, json.dumps(merged, ensure_ascii=False), dag_id)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if changed:
+            self._notify(dag_id)
+        return self.get(dag_id)
+
+    # ---------- 查询 ----------
+
+    def get(self, dag_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection().execute("SELECT * FROM tasks WHERE dag_id = ?", (dag_id,)).fetchone()
+        return _row_to_dict(row) if row else None
+
+    def version(self, dag_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._connection().execute("SELECT version FROM tasks WHERE dag_id = ?", (dag_id,)).fetchone()
+        return row["version"] if row else None
+
+    def events(self, dag_id: str, limit: int = TASK_EVENT_LIMIT) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT version, at, level, message FROM task_events WHERE dag_id = ?"
+                " ORDER BY version DESC, rowid DESC LIMIT ?", (dag_id, limit)
+            ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def history(self, user_id: Optional[str] = None, status: Optional[str] = None,
+                since: Optional[float] = None, until: Optional[float] = None,
+                limit: int = TASK_HISTORY_LIMIT, offset: int = 0) -> List[Dict[str, Any]]:
+        """按提交时间倒序列出任务，user_id/status/时间范围都走索引"""
+        clauses, params = [], []
+        if user_id:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if since is not None:
+            clauses.append("submitted_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("submitted_at < ?")
+            params.append(until)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        limit = max(1, min(int(limit), TASK_HISTORY_MAX_LIMIT))
+        with self._lock:
+            rows = self._connection().execute(
+                f"SELECT * FROM tasks{where} ORDER BY submitted_at DESC LIMIT ? OFFSET ?",
+                (*params, limit, max(0, int(offset)))
+            ).fetchall()
+        return [_row_to_dict(row) for row in rows]
+
+    def counts(self, user_id: Optional[str] = None) -> Dict[str, int]:
+        """各状态任务数"""
+        sql = "SELECT status, COUNT(*) AS n FROM tasks"
+        params = ()
+        if user_id:
+            sql += " WHERE user_id = ?"
+            params = (user_id,)
+        with self._lock:
+            rows = self._connection().execute(sql + " GROUP BY status", params).fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    # ---------- 长轮询 ----------
+
+    def _notify(self, dag_id: str) -> None:
+        for event in self._waiters.pop(dag_id, ()):
+            event.set()
+
+    async def wait_for_change(self, dag_id: str, since_version: int, timeout: float) -> Optional[Dict[str, Any]]:
+        """等待任务版本号超过 since_version 或超时，返回当前任务记录"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max(0.0, min(timeout, LONG_POLL_MAX_WAIT))
+        while True:
+            current = self.version(dag_id)
+            remaining = deadline - loop.time()
+            if current is None or current > since_version or remaining <= 0:
+                return self.get(dag_id)
+            event = asyncio.Event()
+            waiters = self._waiters.setdefault(dag_id, set())
+            waiters.add(event)
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, CROSS_WORKER_CHECK_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiters.discard(event)
+                if not waiters and self._waiters.get(dag_id) is waiters:
+                    del self._waiters[dag_id]
+
+    def snapshot(self) -> dict:
+        return {
+            "path": self.path,
+            "counts": self.counts(),
+            "waiting_tasks": len(self._waiters),
+            "waiters": sum(len(w) for w in self._waiters.values())
+        }
+
+
+def _progress(task: Dict[str, Any], detail: Dict[str, Any]) -> int:
+    """完成为100；运行中按预估耗时（detail.estimated_time，秒）估算，最多到95"""
+    if task["status"] == "completed":
+        return 100
+    estimated = detail.get("estimated_time")
+    if task["status"] in ("pending", "running") and estimated:
+        return min(95, int((time.time() - task["submitted_at"]) / estimated * 100))
+    return detail.get("progress", 0)
+
+
+def task_view(task: Dict[str, Any], events: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """转换成 TaskProgress.vue 使用的字段，时间为毫秒时间戳"""
+    status = task["status"]
+    detail = task.get("detail") or {}
+    view = {
+        "id": task["dag_id"],
+        "task_id": task["dag_id"],
+        "task_name": task.get("task_name") or task["dag_id"],
+        "user_id": task.get("user_id"),
+        "filename": task.get("filename"),
+        "format": task.get("format"),
+        "status": status,
+        "state": task.get("state"),
+        "version": task["version"],
+        "progress": _progress(task, detail),
+        "current_step": _status_message(status, task.get("state")),
+        "start_time": int(task["submitted_at"] * 1000),
+        "end_time": int(task["finished_at"] * 1000) if task.get("finished_at") else None,
+        "updated_time": int(task["updated_at"] * 1000),
+        "estimated_time": detail.get("estimated_time"),
+        "result": None,
+    }
+    if status in ("completed", "failed"):
+        view["result"] = {
+            "success": status == "completed",
+            "message": _status_message(status, task.get("state")),
+        }
+        if status == "failed":
+            view["result"]["error"] = detail.get("error") or _status_message(status, task.get("state"))
+    if events is not None:
+        view["logs"] = [
+            {"timestamp": int(e["at"] * 1000), "level": e["level"], "message": e["message"]} for e in events
+        ]
+    return view
+
+
+_store: Optional[TaskStore] = None
+
+
+def get_task_store() -> TaskStore:
+    """获取当前进程使用的任务表（惰性创建）"""
+    global _store
+    if _store is None:
+        _store = TaskStore(TASK_STORE_PATH)
+    return _store
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+本地地形计算引擎
+小范围的坡度/坡向计算本身只需要几毫秒，但一次 Coverage.aspect 集群往返要几十秒。
+这里直接读取本地（或从对象存储下载缓存的）ASTER GDEM GeoTIFF，按窗口读取后用NumPy
+向量化差分模板计算坡度和坡向，支持 Horn（3x3加权）与 Zevenbergen-Thorne（4邻域）两种核。
+
+依赖 numpy 与 rasterio，未安装时 available() 返回False，调用方回退到集群计算。
+
+坡向约定与集群输出一致：正北为0度顺时针递增，平地为-1。
+"""
+
+import hashlib
+import math
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import from_bounds
+except ImportError:
+    rasterio = None
+
+# ============ 配置部分 ============
+
+DEM_STORE_DIR = Path(os.getenv("OGE_DEM_STORE", "data/dem"))
+DEM_STORE_URL = os.getenv("OGE_DEM_STORE_URL", "")          # 本地缺少DEM分幅时从该地址下载，如 MinIO 桶地址
+DEM_TILE_TEMPLATE = "ASTGTMV003_{lat_tag}{lon_tag}_dem.tif"  # ASTER GDEM 1x1度分幅，按西南角命名
+TERRAIN_OUTPUT_DIR = Path("results/terrain")
+METERS_PER_DEGREE_LAT = 110574.0
+METERS_PER_DEGREE_LON = 111320.0
+FLAT_ASPECT = -1.0
+KERNELS = ("horn", "zevenbergen_thorne")
+
+
+def available() -> bool:
+    return np is not None and rasterio is not None
+
+
+def dem_tile_name(lon: int, lat: int) -> str:
+    lat_tag = f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}"
+    lon_tag = f"{'E' if lon >= 0 else 'W'}{abs(lon):03d}"
+    return DEM_TILE_TEMPLATE.format(lat_tag=lat_tag, lon_tag=lon_tag)
+
+
+def dem_tiles_for_bbox(bbox: Sequence[float]) -> List[Tuple[int, int]]:
+    """覆盖bbox的1度分幅（西南角经纬度）"""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return [
+        (lon, lat)
+        for lat in range(math.floor(min_lat), math.ceil(max_lat))
+        for lon in range(math.floor(min_lon), math.ceil(max_lon))
+    ]
+
+
+def ensure_dem_tile(lon: int, lat: int) -> Optional[Path]:
+    """本地DEM分幅路径，本地没有且配置了下载地址时先下载到本地库"""
+    path = DEM_STORE_DIR / dem_tile_name(lon, lat)
+    if path.exists():
+        return path
+    if not DEM_STORE_URL:
+        return None
+    url = f"{DEM_STORE_URL.rstrip('/')}/{path.name}"
+    try:
+        with httpx.stream("GET", url, timeout=120) as response:
+            if response.status_code != 200:
+                return None
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".part")
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_bytes():
+                    f.write(chunk)
+        tmp_path.replace(path)
+        return path
+    except httpx.HTTPError:
+        return None
+
+
+def dem_available(bbox: Sequence[float]) -> bool:
+    return all(ensure_dem_tile(lon, lat) is not None for lon, lat in dem_tiles_for_bbox(bbox))
+
+
+def window_shape(bbox: Sequence[float], pixel_size: float) -> Tuple[int, int]:
+    """bbox对应的像元行列数"""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return max(1, round((max_lat - min_lat) / pixel_size)), max(1, round((max_lon - min_lon) / pixel_size))
+
+
+def read_dem_window(bbox: Sequence[float], pixel_size: float, halo_pixels: int = 0):
+    """
+    读取bbox（外扩 halo_pixels 个像元）范围内的DEM，跨分幅时拼接。
+    返回 (高程数组, 左上角经度, 左上角纬度)，数组行自北向南、列自西向东。
+    nodata 与分幅范围之外的像元为NaN（不能填0：填充的高程0会在分幅边缘形成假的陡坡），相邻像元的坡度/坡向随之为NaN。
+    """
+    halo = halo_pixels * pixel_size
+    min_lon, min_lat, max_lon, max_lat = bbox[0] - halo, bbox[1] - halo, bbox[2] + halo, bbox[3] + halo
+    rows, cols = window_shape((min_lon, min_lat, max_lon, max_lat), pixel_size)
+    dem = np.full((rows, cols), np.nan, dtype=np.float64)
+
+    for lon, lat in dem_tiles_for_bbox((min_lon, min_lat, max_lon, max_lat)):
+        path = ensure_dem_tile(lon, lat)
+        if path is None:
+            raise FileNotFoundError(f"缺少DEM分幅: {dem_tile_name(lon, lat)}")
+        part = (max(min_lon, lon), max(min_lat, lat), min(max_lon, lon + 1), min(max_lat, lat + 1))
+        with rasterio.open(path) as src:
+            window = from_bounds(*part, transform=src.transform)
+            data = src.read(1, window=window, boundless=True, masked=True,
+                            out_shape=window_shape(part, pixel_size)).astype(np.float64).filled(np.nan)
+        row0 = round((max_lat - part[3]) / pixel_size)
+        col0 = round((part[0] - min_lon) / pixel_size)
+        dem[row0:row0 + data.shape[0], col0:col0 + data.shape[1]] = data[:rows - row0, :cols - col0]
+    return dem, min_lon, max_lat
+
+
+def _shift(z, dy: int, dx: int, r: int):
+    """取偏移 (dy, dx)*r 处的邻域值（去掉 r 宽的边框）"""
+    rows, cols = z.shape
+    return z[r + dy * r:rows - r + dy * r, r + dx * r:cols - r + dx * r]
+
+
+def gradients(z, xres, yres, kernel: str = "horn", radius: int = 1):
+    """
+    东向与北向高程梯度 (dz/dx, dz/dy)，单位米/米；xres 可以是按行变化的数组（地理坐标下经向像元宽度随纬度变化）。
+    输出比输入每边少 radius 个像元。
+    """
+    r = max(int(radius), 1)
+    if kernel == "horn":
+        a, b, c = _shift(z, -1, -1, r), _shift(z, -1, 0, r), _shift(z, -1, 1, r)
+        d, f = _shift(z, 0, -1, r), _shift(z, 0, 1, r)
+        g, h, i = _shift(z, 1, -1, r), _shift(z, 1, 0, r), _shift(z, 1, 1, r)
+        dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * r * xres)
+        dzdy = ((a + 2 * b + c) - (g + 2 * h + i)) / (8 * r * yres)
+    elif kernel == "zevenbergen_thorne":
+        dzdx = (_shift(z, 0, 1, r) - _shift(z, 0, -1, r)) / (2 * r * xres)
+        dzdy = (_shift(z, -1, 0, r) - _shift(z, 1, 0, r)) / (2 * r * yres)
+    else:
+        raise ValueError(f"不支持的地形核: {kernel}，可选 {KERNELS}")
+    return dzdx, dzdy
+
+
+def slope_aspect(z, pixel_size: float, top_lat: float, kernel: str = "horn", radius: int = 1):
+    """地理坐标DEM的坡度（度）与坡向（度，正北顺时针，平地为-1），输出与输入同尺寸，边框为NaN"""
+    r = max(int(radius), 1)
+    rows = z.shape[0]
+    lats = top_lat - (np.arange(r, rows - r) + 0.5) * pixel_size
+    xres = (pixel_size * METERS_PER_DEGREE_LON * np.cos(np.radians(lats)))[:, None]
+    yres = pixel_size * METERS_PER_DEGREE_LAT
+    dzdx, dzdy = gradients(z, xres, yres, kernel, r)
+
+    slope = np.degrees(np.arctan(np.hypot(dzdx, dzdy)))
+    # 坡向为下坡方向：(-dz/dx, -dz/dy) 相对正北的顺时针角度
+    aspect = np.degrees(np.arctan2(-dzdx, -dzdy)) % 360.0
+    aspect[(dzdx == 0) & (dzdy == 0)] = FLAT_ASPECT
+
+    full_slope = np.full(z.shape, np.nan)
+    full_aspect = np.full(z.shape, np.nan)
+    full_slope[r:rows - r, r:z.shape[1] - r] = slope
+    full_aspect[r:rows - r, r:z.shape[1] - r] = aspect
+    return full_slope, full_aspect
+
+
+def compute_terrain(
+    bbox: Sequence[float],
+    pixel_size: float,
+    radius: int = 1,
+    kernel: str = "horn"
+) -> Dict[str, object]:
+    """计算bbox范围的坡度与坡向，读取时外扩 radius 个像元，结果裁回bbox"""
+    r = max(int(radius), 1)
+    dem, west, north = read_dem_window(bbox, pixel_size, halo_pixels=r)
+    slope, aspect = slope_aspect(dem, pixel_size, north, kernel, r)
+    return {
+        "slope": slope[r:slope.shape[0] - r, r:slope.shape[1] - r],
+        "aspect": aspect[r:aspect.shape[0] - r, r:aspect.shape[1] - r],
+        "west": west + r * pixel_size,
+        "north": north - r * pixel_size,
+        "pixel_size": pixel_size
+    }
+
+
+def raster_statistics(values, circular: bool = False) -> dict:
+    """有效像元的统计信息；坡向按8个方位统计占比"""
+    valid = values[np.isfinite(values)]
+    if circular:
+        valid = valid[valid >= 0]
+    if valid.size == 0:
+        return {"valid_pixels": 0}
+    stats = {
+        "valid_pixels": int(valid.size),
+        "min": round(float(valid.min()), 4),
+        "max": round(float(valid.max()), 4),
+    }
+    if circular:
+        directions = ["N", "NE", "E", "SE", "S", "SW", "W", "NW"]
+        sector = ((valid + 22.5) // 45).astype(int) % 8
+        counts = np.bincount(sector, minlength=8)
+        stats["direction_ratio"] = {d: round(float(c) / valid.size, 4) for d, c in zip(directions, counts)}
+    else:
+        stats["mean"] = round(float(valid.mean()), 4)
+    return stats
+
+
+def write_geotiff(path: Path, array, west: float, north: float, pixel_size: float) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(
+        path, "w", driver="GTiff", height=array.shape[0], width=array.shape[1], count=1,
+        dtype="float32", crs="EPSG:4326", nodata=np.nan,
+        transform=from_origin(west, north, pixel_size, pixel_size), compress="deflate"
+    ) as dst:
+        dst.write(array.astype(np.float32), 1)
+    return path
+
+
+def output_path(kind: str, bbox: Sequence[float], radius: int, kernel: str) -> Path:
+    digest = hashlib.sha1(f"{kind}:{list(bbox)}:{radius}:{kernel}".encode()).hexdigest()[:16]
+    return TERRAIN_OUTPUT_DIR / f"{kind}_{kernel}_{digest}.tif"
+
+
+def compare_aspect(local, reference, tolerance: float = 1.0) -> dict:
+    """
+    本地坡向与参考坡向（集群输出）逐像元比较，角度差按圆周计算（359度与1度相差2度）。
+    只比较双方都有效且非平地的像元。
+    """
+    if local.shape != reference.shape:
+        raise ValueError(f"栅格尺寸不一致: {local.shape} vs {reference.shape}")
+    mask = np.isfinite(local) & np.isfinite(reference) & (local >= 0) & (reference >= 0)
+    if not mask.any():
+        return {"compared_pixels": 0}
+    diff = np.abs(local[mask] - reference[mask]) % 360.0
+    diff = np.minimum(diff, 360.0 - diff)
+    return {
+        "compared_pixels": int(mask.sum()),
+        "flat_mismatch": int(((local == FLAT_ASPECT) != (reference == FLAT_ASPECT)).sum()),
+        "max_diff": round(float(diff.max()), 4),
+        "mean_diff": round(float(diff.mean()), 4),
+        "rmse": round(float(np.sqrt((diff ** 2).mean())), 4),
+        "within_tolerance": round(float((diff <= tolerance).mean()), 6),
+        "tolerance": tolerance
+    }
+
+
+def read_reference(path: Path):
+    """读取参考栅格，返回 (数组, 左上角经度, 左上角纬度, 像元大小)"""
+    with rasterio.open(path) as src:
+        data = src.read(1).astype(np.float64)
+        if src.nodata is not None:
+            data[data == src.nodata] = np.nan
+        return data, src.transform.c, src.transform.f, src.transform.a
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+wvts矢量瓦片缓存代理
+耕地流出分析返回的约束图层瓦片（生态保护红线、城镇开发边界、耕地地块、坡度）都指向同一个上游
+瓦片服务，每个浏览器都直接向它请求同样的静态瓦片。这里在MCP服务器上提供瓦片代理：
+
+- 两级缓存：进程内LRU + 本地磁盘（多个worker共用同一目录），磁盘瓦片超过有效期后重新向上游获取；
+- 请求合并：同一瓦片的并发未命中只向上游发起一次请求；
+- 预热：按演示范围（默认以 [121.709, 37.309] 为中心）预先拉取常用缩放级别的瓦片。
+
+只代理 TILE_LAYERS 中登记的图层，不作为任意上游的开放代理。上游返回204/404（无数据）的瓦片同样缓存。
+"""
+
+import asyncio
+import json
+import math
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from oge_executor import run_blocking
+from oge_raster_tiles import TileLRUCache
+
+# ============ 配置部分 ============
+
+TILE_UPSTREAM_URL = os.getenv("OGE_TILE_UPSTREAM_URL", "http://59.206.223.134:7000/service").rstrip("/")
+MCP_PUBLIC_URL = os.getenv("OGE_MCP_PUBLIC_URL", "http://localhost:8000").rstrip("/")
+TILE_PROXY_CACHE_DIR = Path(os.getenv("OGE_TILE_PROXY_CACHE_DIR", "results/tile_cache"))
+TILE_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+TILE_DISK_TTL = 7 * 86400           # 磁盘瓦片有效期，过期后重新获取
+TILE_UPSTREAM_TIMEOUT = 15.0
+SEED_ZOOMS = range(10, 15)          # 预热的缩放级别
+SEED_HALF_SPAN_DEG = 0.15           # 预热范围：中心点外扩的经纬度
+SEED_CONCURRENCY = 8
+SEED_MAX_TILES = 2000
+
+# 代理的约束图层瓦片（wvts）
+TILE_LAYERS = [
+    {"table": "xueye_bio_protected_boundary", "name": "生态保护红线", "category": "ecology"},
+    {"table": "xueye_urban_boundary", "name": "城镇开发边界", "category": "town"},
+    {"table": "ogeArable", "name": "耕地地块数据", "category": "farmland"},
+    {"table": "xueye_slope_boundary", "name": "大于15度的坡度", "category": "slope"},
+]
+TILE_TABLES = {item["table"] for item in TILE_LAYERS}
+TILE_LAYER_CENTER = [121.709337, 37.308754]
+
+TileKey = Tuple[str, int, int, int]
+
+
+def upstream_tile_url(table: str, z: int, x: int, y: int, base_url: str = TILE_UPSTREAM_URL) -> str:
+    return f"{base_url}/{table}?type=wvts&tablename={table}&z={z}&x={x}&y={y}"
+
+
+def proxied_tile_url(table: str) -> str:
+    """返回给前端的代理瓦片地址模板"""
+    return f"{MCP_PUBLIC_URL}/tiles/wvts/{table}/{{z}}/{{x}}/{{y}}"
+
+
+def lonlat_to_tile(lon: float, lat: float, z: int) -> Tuple[int, int]:
+    n = 1 << z
+    lat_rad = math.radians(max(min(lat, 85.0511), -85.0511))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_extent(bbox: Sequence[float], zooms: Sequence[int]) -> List[Tuple[int, int, int]]:
+    """覆盖经纬度范围的 (z, x, y)，低缩放级别在前"""
+    tiles = []
+    for z in zooms:
+        x0, y0 = lonlat_to_tile(bbox[0], bbox[3], z)
+        x1, y1 = lonlat_to_tile(bbox[2], bbox[1], z)
+        tiles.extend((z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+    return tiles
+
+
+def _tile_size(tile: dict) -> int:
+    return len(tile["body"]) + 256
+
+
+class TileProxy:
+    """两级缓存 + 请求合并的瓦片代理，在事件循环中使用"""
+
+    def __init__(self, upstream_url: str = TILE_UPSTREAM_URL, cache_dir: Path = TILE_PROXY_CACHE_DIR,
+                 memory_max_bytes: int = TILE_MEMORY_MAX_BYTES, disk_ttl: float = TILE_DISK_TTL):
+        self.upstream_url = upstream_url
+        self.cache_dir = cache_dir
+        self.disk_ttl = disk_ttl
+        self.memory = TileLRUCache(memory_max_bytes, sizeof=_tile_size)
+        self._inflight: Dict[TileKey, asyncio.Future] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop = None
+        self._seed_task: Optional[asyncio.Task] = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "upstream": 0, "coalesced": 0, "errors": 0}
+
+    def _http(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(timeout=TILE_UPSTREAM_TIMEOUT)
+            self._client_loop = loop
+        return self._client
+
+    # ---------- 磁盘缓存 ----------
+
+    def _disk_path(self, key: TileKey) -> Path:
+        table, z, x, y = key
+        return self.cache_dir / table / str(z) / str(x) / f"{y}.tile"
+
+    def _read_disk(self, key: TileKey) -> Optional[dict]:
+        path = self._disk_path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.disk_ttl:
+                return None
+            header, _, body = path.read_bytes().partition(b"\n")
+            meta = json.loads(header)
+        except (OSError, ValueError):
+            return None
+        return {**meta, "body": body} if isinstance(meta, dict) else None
+
+    def _write_disk(self, key: TileKey, tile: dict) -> None:
+        """元数据（一行JSON）与瓦片内容写在同一个文件中整体替换，读取时不会拿到不匹配的两部分"""
+        path = self._disk_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        meta = {k: v for k, v in tile.items() if k != "body"}
+        tmp = path.with_suffix(f".tile.{os.getpid()}.tmp")
+        tmp.write_bytes(json.dumps(meta).encode("utf-8") + b"\n" + tile["body"])
+        tmp.replace(path)
+
+    # ---------- 获取瓦片 ----------
+
+    async def _fetch_upstream(self, key: TileKey) -> dict:
+        table, z, x, y = key
+        self.stats["upstream"] += 1
+        url = upstream_tile_url(table, z, x, y, self.upstream_url)
+        async with self._http().stream("GET", url) as response:
+            if response.status_code in (204, 404):
+                return {"status": 204, "body": b"", "content_type": None, "content_encoding": None}
+            response.raise_for_status()
+            # 读取未解压的原始内容，上游的压缩格式原样缓存和转发
+            body = b"".join([chunk async for chunk in response.aiter_raw()])
+            return {
+                "status": 200,
+                "body": body,
+                "content_type": response.headers.get("content-type", "application/octet-stream"),
+                "content_encoding": response.headers.get("content-encoding"),
+            }
+
+    async def _load(self, key: TileKey) -> Tuple[dict, str]:
+        tile = await run_blocking(self._read_disk, key)
+        if tile is not None:
+            self.stats["disk_hits"] += 1
+            self.memory.put(key, tile)
+            return tile, "disk"
+        tile = await self._fetch_upstream(key)
+        self.memory.put(key, tile)
+        await run_blocking(self._write_disk, key, tile)
+        return tile, "upstream"
+
+    async def get(self, table: str, z: int, x: int, y: int) -> Tuple[dict, str]:
+        """返回 (瓦片, 来源)，来源为 memory/disk/upstream；上游失败时抛出异常（不缓存）"""
+        if table not in TILE_TABLES:
+            raise KeyError(table)
+        key = (table, z, x, y)
+        tile = self.memory.get(key)
+        if tile is not None:
+            self.stats["memory_hits"] += 1
+            return tile, "memory"
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(self._load(key))
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+
+    # ---------- 预热 ----------
+
+    async def seed(self, tables: Optional[Sequence[str]] = None, center: Sequence[float] = TILE_LAYER_CENTER,
+                   zooms: Sequence[int] = SEED_ZOOMS, half_span: float = SEED_HALF_SPAN_DEG) -> dict:
+        """预先拉取中心点附近的瓦片，已缓存的瓦片不会重复请求上游"""
+        tables = [t for t in (tables or [item["table"] for item in TILE_LAYERS]) if t in TILE_TABLES]
+        extent = (center[0] - half_span, center[1] - half_span, center[0] + half_span, center[1] + half_span)
+        tiles = tiles_for_extent(extent, zooms)
+        jobs = [(table, *tile) for tile in tiles for table in tables][:SEED_MAX_TILES]
+        semaphore = asyncio.Semaphore(SEED_CONCURRENCY)
+        counts = {"memory": 0, "disk": 0, "upstream": 0, "failed": 0}
+
+        async def fetch(job):
+            async with semaphore:
+                try:
+                    _, source = await self.get(*job)
+                    counts[source] += 1
+                except Exception:
+                    counts["failed"] += 1
+
+        started = time.time()
+        await asyncio.gather(*[fetch(job) for job in jobs])
+        return {"tables": tables, "extent": [round(v, 6) for v in extent], "zooms": list(zooms), "tiles": len(jobs),
+                **counts, "seconds": round(time.time() - started, 2)}
+
+    def ensure_seeded(self) -> None:
+        """本进程首次需要时在后台预热一次"""
+        if self._seed_task is None:
+            self._seed_task = asyncio.ensure_future(self.seed())
+
+    def snapshot(self) -> dict:
+        return {
+            "upstream_url": self.upstream_url,
+            "memory": self.memory.snapshot(),
+            "inflight": len(self._inflight),
+            "seeded": self._seed_task is not None and self._seed_task.done(),
+            **self.stats
+        }
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+栅格分析瓦片化执行
+任意bbox直接提交一次 Coverage.aspect，大范围容易超时，相互重叠的bbox也会重复计算。
+这里把请求范围对齐到固定的经纬度瓦片网格，每个瓦片外扩 radius 个像元的“光环”后单独计算
+（坡度/坡向是邻域运算，瓦片边缘需要邻近像元），按 (产品, 瓦片, radius) 缓存，
+最后把覆盖请求范围的瓦片拼接（裁剪到请求窗口）。平移或略微移动bbox时只需计算新增的边缘瓦片。
+"""
+
+import math
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from oge_shared_state import get_state_backend
+
+# ============ 配置部分 ============
+
+TILE_SIZE_DEG = 0.1                 # 瓦片边长（度），ASTER GDEM 30米约360x360像元
+TILE_CACHE_TTL = 30 * 86400         # DEM产品不变，瓦片结果保留30天
+TILE_KEY_PREFIX = "raster_tile:"
+DEFAULT_PIXEL_SIZE_DEG = 1 / 3600   # 1角秒
+PRODUCT_PIXEL_SIZE_DEG = {
+    "Platform:Product:ASTER_GDEM_DEM30": 1 / 3600,
+}
+
+Tile = Tuple[int, int]
+BBox = Tuple[float, float, float, float]
+
+
+def pixel_size(product: str) -> float:
+    return PRODUCT_PIXEL_SIZE_DEG.get(product, DEFAULT_PIXEL_SIZE_DEG)
+
+
+def tiles_for_bbox(bbox: Sequence[float], tile_size: float = TILE_SIZE_DEG) -> List[Tile]:
+    """覆盖bbox的瓦片 (col, row)，按行优先排列"""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if min_lon >= max_lon or min_lat >= max_lat:
+        raise ValueError(f"无效的边界框: {list(bbox)}")
+    # 先四舍五入到1e-9，避免浮点误差把恰好落在网格线上的坐标分到相邻瓦片
+    def grid(value):
+        return round(value / tile_size, 9)
+
+    col0, row0 = math.floor(grid(min_lon)), math.floor(grid(min_lat))
+    # 恰好落在网格线上的右/上边界不再多取一列/一行
+    col1, row1 = math.ceil(grid(max_lon)) - 1, math.ceil(grid(max_lat)) - 1
+    return [(col, row) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+
+def tile_bbox(tile: Tile, tile_size: float = TILE_SIZE_DEG, halo: float = 0.0) -> BBox:
+    """瓦片范围，halo 为外扩距离（度）"""
+    col, row = tile
+    return (
+        round(col * tile_size - halo, 10),
+        round(row * tile_size - halo, 10),
+        round((col + 1) * tile_size + halo, 10),
+        round((row + 1) * tile_size + halo, 10),
+    )
+
+
+def halo_size(product: str, radius: int) -> float:
+    """邻域半径对应的外扩距离（度）"""
+    return max(radius, 0) * pixel_size(product)
+
+
+def tile_key(operation: str, product: str, tile: Tile, radius: int, tile_size: float = TILE_SIZE_DEG, **variant) -> str:
+    """瓦片缓存键：(算子, 产品, 瓦片, radius)，影响结果的其他参数放在 variant 中"""
+    extra = "".join(f":{k}={variant[k]}" for k in sorted(variant))
+    return f"{TILE_KEY_PREFIX}{operation}:{product}:{tile_size:g}:{tile[0]}:{tile[1]}:r{radius}{extra}"
+
+
+def lookup_tiles(keys: Dict[Tile, str]) -> Tuple[Dict[Tile, object], List[Tile]]:
+    """返回 (已缓存的 {瓦片: 结果}, 需要计算的瓦片)"""
+    state = get_state_backend()
+    cached, missing = {}, []
+    for tile, key in keys.items():
+        value = state.get(key)
+        if value is None:
+            missing.append(tile)
+        else:
+            cached[tile] = value
+    return cached, missing
+
+
+def store_tile(key: str, value) -> None:
+    get_state_backend().set(key, value, ttl=TILE_CACHE_TTL)
+
+
+def clip_bbox(a: Sequence[float], b: Sequence[float]) -> BBox:
+    """两个bbox的交集"""
+    return (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+
+
+def mosaic(
+    window: Sequence[float],
+    tile_results: Dict[Tile, object],
+    tile_size: float = TILE_SIZE_DEG,
+    describe: Callable[[object], object] = lambda value: value
+) -> dict:
+    """
+    拼接覆盖请求窗口的瓦片：每个瓦片只取其核心范围（不含光环）与窗口的交集，
+    按行（自北向南）、列（自西向东）排列，返回拼接清单。
+    集群接口的返回不含像元数据，无法在这里合并成一个栅格；清单中每个瓦片保留原始返回（result），
+    由调用方按 window_bbox 裁剪后拼接。
+    """
+    rows = sorted({row for _, row in tile_results}, reverse=True)
+    cols = sorted({col for col, _ in tile_results})
+    items = []
+    for row in rows:
+        for col in cols:
+            if (col, row) not in tile_results:
+                continue
+            core = tile_bbox((col, row), tile_size)
+            items.append({
+                "tile": [col, row],
+                "grid_position": [rows.index(row), cols.index(col)],
+                "bbox": list(core),
+                "window_bbox": list(clip_bbox(core, window)),
+                "result": describe(tile_results[(col, row)])
+            })
+    return {
+        "window": list(window),
+        "tile_size": tile_size,
+        "grid_shape": [len(rows), len(cols)],
+        "tiles": items
+    }
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+耕地流出分析按村结果缓存
+同一会话里经常先问 {A, B, C} 再问 {A, B, C, D}，按村缓存后新请求只需计算还没有缓存的村，
+再与已缓存的各村结果合并成最终结果。
+
+细碎化判定用到10米缓冲范围内邻近地块的面积，一个村的结果取决于邻村边界附近的地块。
+写入缓存的结果都来自带光环的计算（光环取自行政区划边界与本村相邻的村，见 oge_sharding.halo_villages；
+没有边界文件时光环为全镇），所以每个村的结果与本次请求还包含哪些村无关，可以跨请求复用；
+全镇查询、分析参数和物化图层版本都是缓存键的一部分。
+"""
+
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from oge_shared_state import get_state_backend
+from oge_materialized_layers import registry_version_tag
+from oge_script_planner import VILLAGE_FIELD
+
+# ============ 配置部分 ============
+
+VILLAGE_CACHE_DIR = Path("results/village_cache")
+VILLAGE_CACHE_TTL = 30 * 86400          # 单村结果保留30天
+VILLAGE_RESULT_KEY_PREFIX = "village_result:"
+
+
+def cache_signature(base_query: str, script_params: dict) -> str:
+    """全镇查询 + 分析参数 + 物化图层版本，任意一项变化都视为不同的缓存"""
+    params = {k: v for k, v in script_params.items() if k != "materialized"}
+    payload = json.dumps(
+        {"query": base_query, "params": params, "layers": registry_version_tag()},
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _entry_key(signature: str, village: str) -> str:
+    return f"{VILLAGE_RESULT_KEY_PREFIX}{signature}:{village}"
+
+
+def _entry_path(signature: str, village: str) -> Path:
+    digest = hashlib.sha1(f"{signature}:{village}".encode("utf-8")).hexdigest()
+    return VILLAGE_CACHE_DIR / f"{digest}.geojson"
+
+
+def lookup(villages: Sequence[str], signature: str) -> Tuple[Dict[str, str], List[str]]:
+    """返回 (已缓存的 {村: 结果文件路径}, 需要计算的村)；结果文件在合并时由进程池读取"""
+    state = get_state_backend()
+    cached, missing = {}, []
+    for village in dict.fromkeys(villages):
+        entry = state.get(_entry_key(signature, village))
+        path = Path(entry["path"]) if entry else None
+        if path is not None and path.exists():
+            cached[village] = str(path)
+            continue
+        missing.append(village)
+    return cached, missing
+
+
+def split_by_village(collection: dict, villages: Sequence[str]) -> Optional[Dict[str, dict]]:
+    """
+    把一个结果按村拆分，没有要素的村得到空集合（同样需要缓存）。
+    存在缺少村名字段的要素时无法拆分，返回None。
+    """
+    parts = {village: [] for village in villages}
+    for feature in collection.get("features", []):
+        village = (feature.get("properties") or {}).get(VILLAGE_FIELD)
+        if village is None:
+            return None
+        if village in parts:
+            parts[village].append(feature)
+    result = {}
+    for village, features in parts.items():
+        part = {"type": "FeatureCollection", "features": features}
+        if "crs" in collection:
+            part["crs"] = collection["crs"]
+        result[village] = part
+    return result
+
+
+def write_parts(collection: dict, villages: Sequence[str], signature: str) -> Optional[Dict[str, dict]]:
+    """按村拆分并写入缓存文件，返回 {村: {path, features}}，无法拆分时返回None；不写共享状态"""
+    parts = split_by_village(collection, villages)
+    if parts is None:
+        return None
+    VILLAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    written = {}
+    for village, part in parts.items():
+        path = _entry_path(signature, village)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(part, ensure_ascii=False), encoding="utf-8")
+        tmp_path.replace(path)
+        written[village] = {"path": str(path), "features": len(part["features"])}
+    return written
+
+
+def store_file(path: str, villages: Sequence[str], signature: str) -> Optional[Dict[str, dict]]:
+    """
+    读取一次带光环计算的结果文件并按村写入缓存文件，由进程池执行：
+    解析、拆分和写文件都在工作进程中完成，只回传各村的文件路径与要素数。结果文件不是合法JSON时抛出ValueError
+    """
+    with open(path, "rb") as f:
+        collection = json.loads(f.read())
+    return write_parts(collection, villages, signature)
+
+
+def register(parts: Dict[str, dict], signature: str, dag_id: Optional[str] = None) -> None:
+    """把 write_parts/store_file 写好的各村结果登记到共享状态，之后的请求即可命中"""
+    state = get_state_backend()
+    for village, part in parts.items():
+        state.set(_entry_key(signature, village), {
+            **part,
+            "dag_id": dag_id,
+            "cached_at": time.time()
+        }, ttl=VILLAGE_CACHE_TTL)
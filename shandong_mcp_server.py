@@ -22,7 +22,7 @@ try:
     from mcp.server import Server
     from starlette.applications import Starlette
     from starlette.requests import Request
-    from starlette.responses import JSONResponse
+    from starlette.responses import JSONResponse, Response
     from starlette.routing import Mount, Route
     import uvicorn
     import argparse
@@ -31,6 +31,25 @@ except ImportError as e:
     print("Please install: pip install fastmcp starlette uvicorn")
     exit(1)
 
+from oge_layer_registry import (
+    DEFAULT_FEATURE_LIMIT,
+    MAX_FEATURE_LIMIT,
+    list_layers,
+    get_layer,
+    latest_vector_layer,
+    read_collection as read_layer_collection,
+    query_layer_features,
+    parse_bbox,
+    make_etag,
+    etag_matches,
+    negotiate_encoding,
+    encode_body,
+    json_body
+)
+from oge_tile_proxy import TileProxy
+from oge_geo_stats import get_engine as get_geo_stats_engine, parse_bounds
+from oge_gazetteer import get_gazetteer
+
 T = TypeVar("T")
 
 # ============ 配置部分 - 更新为可用OGE环境 ============
@@ -61,6 +80,10 @@ LIVY_API_BASE_URL = f"{COMPUTE_CLUSTER_MASTER}/livy"
 DEFAULT_USER_ID = "mcp-user"
 DEFAULT_USERNAME = "admin"  # 根据实际情况调整
 
+# 地名查询
+GEOCODE_DEFAULT_LIMIT = 5
+GEOCODE_MAX_LIMIT = 20  # 单次正向查询最多返回的地名数
+
 # 移除不可用的MinIO配置，使用OGE后端存储
 # MINIO_ENDPOINT = "http://10.101.240.23:9007"  # 注释掉不可用的配置
 # MINIO_ACCESS_KEY = "oge"
@@ -579,6 +602,9 @@ async def check_token_status(ctx: Context = None) -> str:
 
 # ============ HTTP服务器设置 ============
 
+# 约束图层瓦片代理（图层列表中的瓦片地址指向本服务）
+tile_proxy = TileProxy()
+
 def create_starlette_app(mcp_server: Server, *, debug: bool = False) -> Starlette:
     """创建支持SSE的Starlette应用"""
     sse = SseServerTransport("/messages/")
@@ -686,17 +712,116 @@ def create_starlette_app(mcp_server: Server, *, debug: bool = False) -> Starlett
             "message": "会话创建成功"
         })
 
+    def conditional_headers(etag: str) -> dict:
+        return {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    def cached_json_response(request: Request, payload, etag: str) -> Response:
+        """带ETag的JSON响应，按 Accept-Encoding 压缩（br/gzip）"""
+        body, content_encoding = encode_body(json_body(payload), negotiate_encoding(request.headers.get("accept-encoding")))
+        headers = conditional_headers(etag)
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        return Response(body, media_type="application/json", headers=headers)
+
     async def handle_layers(request: Request):
-        """处理图层获取请求"""
-        return JSONResponse({
+        """处理图层获取请求：图层登记表中的约束图层与分析结果，内容未变化时返回304"""
+        layers = await asyncio.to_thread(list_layers)
+        etag = make_etag(layers)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=conditional_headers(etag))
+        return cached_json_response(request, {
             "success": True,
-            "data": [
-                {"id": 1, "name": "底图图层", "type": "base", "visible": True},
-                {"id": 2, "name": "卫星影像", "type": "raster", "visible": False},
-                {"id": 3, "name": "遥感大楼数据", "type": "vector", "visible": True}
-            ],
+            "data": layers,
             "message": "图层数据获取成功"
-        })
+        }, etag)
+
+    async def handle_layer_data(request: Request):
+        """按范围取矢量图层要素：参数 bbox=minLon,minLat,maxLon,maxLat、limit"""
+        layer_id = request.path_params["layer_id"]
+        entry = await asyncio.to_thread(get_layer, layer_id)
+        if entry is None or not entry.get("has_data") or not Path(entry["path"]).exists():
+            return JSONResponse({"success": False, "message": f"图层不存在或没有本地矢量数据: {layer_id}"}, status_code=404)
+        try:
+            bbox = parse_bbox(request.query_params.get("bbox"))
+            limit = int(request.query_params.get("limit", DEFAULT_FEATURE_LIMIT))
+            if limit < 1:
+                raise ValueError("limit 需要为正整数")
+            limit = min(limit, MAX_FEATURE_LIMIT)
+        except ValueError as e:
+            return JSONResponse({"success": False, "message": f"参数错误: {e}"}, status_code=400)
+        etag = make_etag(entry["id"], entry["version"], bbox, limit)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=conditional_headers(etag))
+        collection = await asyncio.to_thread(query_layer_features, entry, bbox, limit)
+        return cached_json_response(request, {
+            "success": True,
+            "data": collection,
+            "message": f"返回{len(collection['features'])}个要素"
+        }, etag)
+
+    async def handle_geocode(request: Request):
+        """地名正向查询：address 为地名或包含地名的地址，支持拼音、简称和容错"""
+        address = request.query_params.get("address", "")
+        try:
+            limit = int(request.query_params.get("limit", GEOCODE_DEFAULT_LIMIT))
+        except ValueError:
+            return JSONResponse({"success": False, "message": "limit 需要为整数"}, status_code=400)
+        limit = max(1, min(limit, GEOCODE_MAX_LIMIT))
+        matches = get_gazetteer().geocode(address, limit=limit)
+        if not matches:
+            return JSONResponse({"success": False, "data": [], "message": f"未找到地名: {address}"}, status_code=404)
+        return JSONResponse({"success": True, "data": matches, "message": f"找到{len(matches)}个地名"})
+
+    async def handle_reverse_geocode(request: Request):
+        """地名反向查询：返回包含该点的村/镇"""
+        try:
+            lng = float(request.query_params["lng"])
+            lat = float(request.query_params["lat"])
+        except (KeyError, ValueError):
+            return JSONResponse({"success": False, "message": "需要数值参数 lng、lat"}, status_code=400)
+        matches = get_gazetteer().reverse(lng, lat)
+        if not matches:
+            return JSONResponse({"success": False, "data": [], "message": "该位置不在已知的村镇范围内"}, status_code=404)
+        return JSONResponse({"success": True, "data": matches, "message": matches[0]["name"]})
+
+    async def handle_geo_stats(request: Request):
+        """按范围统计流出地块数与面积（按流出原因、按村），请求体 {bounds, layerId?, tiles?}"""
+        try:
+            body = await request.json() if await request.body() else {}
+        except ValueError:
+            return JSONResponse({"success": False, "message": "请求体不是JSON"}, status_code=400)
+        if not isinstance(body, dict):
+            return JSONResponse({"success": False, "message": "请求体需要为JSON对象"}, status_code=400)
+        try:
+            bounds = parse_bounds(body.get("bounds"))
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            return JSONResponse({"success": False, "message": f"范围参数错误: {e}"}, status_code=400)
+        layer_id = body.get("layerId")
+        entry = await asyncio.to_thread(get_layer, layer_id) if layer_id else await asyncio.to_thread(latest_vector_layer)
+        if entry is None or not entry.get("has_data") or not Path(entry["path"]).exists():
+            return JSONResponse({"success": False, "message": "没有可统计的流出结果图层"}, status_code=404)
+        engine = await asyncio.to_thread(get_geo_stats_engine, entry, read_layer_collection)
+        stats = await asyncio.to_thread(engine.query, bounds)
+        if body.get("tiles"):
+            stats["tile_summaries"] = await asyncio.to_thread(engine.tile_summaries, bounds)
+        stats.update({"layerId": entry["id"], "layerName": entry["name"], "bounds": list(bounds) if bounds else None})
+        return JSONResponse({"success": True, "data": stats, "message": "统计完成"})
+
+    async def handle_wvts_tile(request: Request):
+        """约束图层瓦片代理，按上游的内容类型和压缩格式原样返回"""
+        table = request.path_params["table"]
+        z, x, y = (request.path_params[name] for name in ("z", "x", "y"))
+        try:
+            tile, source = await tile_proxy.get(table, z, x, y)
+        except KeyError:
+            return JSONResponse({"success": False, "message": f"未代理的图层: {table}"}, status_code=404)
+        except Exception as e:
+            logger.warning(f"瓦片上游请求失败 {table}/{z}/{x}/{y}: {e}")
+            return JSONResponse({"success": False, "message": "瓦片上游服务不可用"}, status_code=502)
+        headers = {"Cache-Control": "public, max-age=86400", "X-Tile-Cache": source}
+        if tile["content_encoding"]:
+            headers["Content-Encoding"] = tile["content_encoding"]
+        return Response(tile["body"], status_code=tile["status"], media_type=tile["content_type"], headers=headers)
 
     return Starlette(
         debug=debug,
@@ -708,6 +833,11 @@ def create_starlette_app(mcp_server: Server, *, debug: bool = False) -> Starlett
             Route("/check_yaogan_environment", endpoint=handle_check_environment, methods=["GET", "POST"]),
             Route("/ai/session", endpoint=handle_ai_session, methods=["POST"]),
             Route("/layers", endpoint=handle_layers, methods=["GET"]),
+            Route("/layers/{layer_id}/data", endpoint=handle_layer_data, methods=["GET"]),
+            Route("/tiles/wvts/{table}/{z:int}/{x:int}/{y:int}", endpoint=handle_wvts_tile),
+            Route("/geo-stats", endpoint=handle_geo_stats, methods=["POST"]),
+            Route("/geocode", endpoint=handle_geocode, methods=["GET"]),
+            Route("/reverse-geocode", endpoint=handle_reverse_geocode, methods=["GET"]),
             Mount("/messages/", app=sse.handle_post_message),
         ],
     )
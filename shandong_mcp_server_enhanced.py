@@ -5,10 +5,19 @@
 """
 
 import asyncio
+import contextvars
+import hashlib
+import hmac
 import json
 import logging
 import httpx
+import math
+import mimetypes
+import os
+import sys
 import time
+import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Optional, TypeVar
@@ -25,7 +34,8 @@ try:
     from mcp.server import Server
     from starlette.applications import Starlette
     from starlette.requests import Request
-    from starlette.responses import JSONResponse
+    from starlette.background import BackgroundTask
+    from starlette.responses import JSONResponse, Response, StreamingResponse
     from starlette.routing import Mount, Route
     import uvicorn
     import argparse
@@ -34,6 +44,102 @@ except ImportError as e:
     print("Please install: pip install fastmcp starlette uvicorn")
     exit(1)
 
+from oge_shared_state import (
+    get_state_backend,
+    configure_state_backend,
+    TOKEN_KEY,
+    region_catalog_key,
+    DAG_STATUS_KEY_PREFIX,
+    TASK_WATCH_KEY_PREFIX,
+)
+from oge_http_stream import (
+    JsonSelect, MAX_RESPONSE_BYTES, ResponseTooLarge, read_capped, parse_body, select_json, text_preview
+)
+from oge_executor import run_cpu, run_blocking, get_executor, get_watchdog
+from oge_metrics import MetricsText
+from oge_deadline import install_request_deadlines, clamp_timeout, JobWatchers, ORPHAN_GRACE_SECONDS
+from oge_livy_pool import LivyPool, LivyError
+from oge_report_queue import ReportQueue
+from oge_run_history import get_run_history, CATEGORY_COLUMNS
+from oge_runtime_estimator import get_runtime_estimator
+from oge_spark_hints import spark_resource_hints
+from oge_cluster_capacity import CapacityMonitor, capacity_sources
+from oge_task_store import (
+    get_task_store, normalize_status, task_view, FINAL_STATUSES, LONG_POLL_MAX_WAIT, TASK_HISTORY_LIMIT
+)
+from oge_endpoints import EndpointPool, DagClusterRouter, is_endpoint_failure, transport_error_kind
+from oge_script_planner import build_outflow_script
+from oge_sharding import (
+    parse_villages, strip_villages, with_villages, choose_shard_count, balance_shards,
+    halo_villages, write_merged_outflow
+)
+from oge_tiles import (
+    TILE_SIZE_DEG,
+    pixel_size as raster_pixel_size,
+    tiles_for_bbox,
+    tile_bbox as raster_tile_bbox,
+    halo_size as raster_halo_size,
+    tile_key as raster_tile_key,
+    lookup_tiles as lookup_raster_tiles,
+    store_tile as store_raster_tile,
+    mosaic as mosaic_raster_tiles
+)
+import oge_terrain
+from oge_result_store import (
+    InvalidKeyError,
+    result_key,
+    object_url as result_object_url,
+    cached_meta as cached_result_meta,
+    revalidate as revalidate_result,
+    cache_usage as result_cache_usage,
+    download as download_result,
+    object_exists as result_object_exists,
+    parse_range,
+    iter_file,
+    open_upstream as open_result_upstream,
+    ResultPrefetcher
+)
+import oge_raster_tiles
+from oge_geo_stats import get_engine as get_geo_stats_engine, parse_bounds
+from oge_gazetteer import get_gazetteer, register_names as register_gazetteer_names, update_derived_boundaries
+from oge_tile_proxy import TileProxy, proxied_tile_url
+from oge_sse_relay import SseSessionRelay
+from yaogan_environment_config import LIVY_API_URL as YAOGAN_LIVY_API_URL
+from oge_materialized_layers import (
+    get_registry as get_materialized_registry,
+    current_assets as current_materialized_assets,
+    materializable_layers,
+    known_tables as materializable_tables,
+    next_version as next_materialized_version,
+    asset_name as materialized_asset_name,
+    build_materialize_script,
+    register_version as register_materialized_version,
+)
+from oge_village_cache import (
+    cache_signature as village_cache_signature,
+    lookup as lookup_village_results,
+    store_file as store_village_file,
+    register as register_village_results
+)
+from oge_layer_registry import (
+    DEFAULT_FEATURE_LIMIT,
+    MAX_FEATURE_LIMIT,
+    layer_id_for,
+    list_layers,
+    get_layer,
+    latest_vector_layer,
+    read_collection as read_layer_collection,
+    register_vector_layer,
+    register_raster_layer,
+    query_layer_features,
+    parse_bbox,
+    make_etag,
+    etag_matches,
+    negotiate_encoding,
+    encode_body,
+    json_body
+)
+
 T = TypeVar("T")
 
 # ============ 配置部分 ============
@@ -57,6 +163,60 @@ CATALOG_URL   = "http://172.20.70.141/api/asset/batch-result/catalog"
 # 执行结果与dagId绑定，数据插入
 INSERT_REPORT_URL = BASE_GATEWAY_URL+"/asset/algorithm-processing-result/insert"
 
+# 多入口配置：等价的网关入口和DAG集群，按健康与延迟自动选择（逗号分隔的环境变量可覆盖）
+GATEWAY_BASE_URLS = os.getenv("OGE_GATEWAY_URLS", ",".join([
+    BASE_GATEWAY_URL,
+    "http://172.30.22.116:16555/gateway",
+    "http://111.37.195.111:7002/gateway",   # 外网穿透入口
+])).split(",")
+DAG_API_BASE_URLS = os.getenv("OGE_DAG_API_URLS", DAG_API_BASE_URL).split(",")
+
+# 被放弃任务的取消接口：有Livy批任务ID时 DELETE {LIVY_API_URL}/batches/{id}；
+# DAG集群的取消接口需按部署配置路径（GET {集群}{路径}?dagId=...，返回 code=200 视为已取消），未配置时不调用
+LIVY_API_URL = os.getenv("OGE_LIVY_URL", YAOGAN_LIVY_API_URL).rstrip("/")
+DAG_CANCEL_PATH = os.getenv("OGE_DAG_CANCEL_PATH", "")
+
+# 共享状态缓存配置（多worker模式下各进程共用）
+REGION_CATALOG_TTL = 600         # 地区目录缓存10分钟
+DAG_STATUS_FRESH_TTL = 5         # 运行中任务状态在5秒内由各worker共用，避免重复轮询
+DAG_STATUS_FINAL_TTL = 86400     # 终态结果缓存1天
+TOKEN_REFRESH_LOCK_TTL = 30      # 同一时间只允许一个worker刷新token
+
+# 耕地流出分析分片执行配置
+REGION_STAT_URL = BASE_GATEWAY_URL+"/computation-api/vector/statistical/guoTuBianGeng"
+OUTFLOW_DLMC_LIST = ["旱地", "水浇地", "水田"]
+SHARD_PARCEL_THRESHOLD = 5000    # 自动模式下地块总数超过该值才分片
+SHARD_TARGET_PARCELS = 3000      # 每个分片的目标地块数
+MAX_SHARDS = 8
+SHARD_CONCURRENCY = 4            # 同时运行的分片DAG数
+SHARD_MAX_RETRIES = 2            # 单个分片失败后的重试次数
+WARM_SESSION_MAX_PARCELS = int(os.getenv("OGE_WARM_SESSION_MAX_PARCELS", "2000"))  # 地块数不超过该值的任务在Livy预热会话上执行
+
+# 本地结果目录（分片合并结果等）；MinIO结果存储与下载缓存的配置见 oge_result_store
+RESULT_LOCAL_DIR = Path("results")
+
+# 栅格分析瓦片化配置
+TILE_CONCURRENCY = 4             # 同时计算的瓦片数
+MAX_TILES_PER_REQUEST = 64       # 单次请求最多的瓦片数（0.1度瓦片，约80x80公里）
+
+# 本地地形计算引擎配置（小范围坡度/坡向直接在本进程计算，不走集群）
+LOCAL_TERRAIN_MAX_PIXELS = 1_000_000   # 自动模式下像元数不超过该值时使用本地引擎（约0.28度见方）
+TERRAIN_KERNEL = "horn"
+
+# 维护接口（如重建物化约束图层）的访问令牌：请求头 Authorization: Bearer <令牌>，未配置时维护接口不开放
+ADMIN_TOKEN = os.getenv("OGE_ADMIN_TOKEN", "")
+REBUILD_JOB_KEY_PREFIX = "materialized:rebuild:"
+REBUILD_JOB_TTL = 7 * 86400       # 重建任务状态保留7天
+REBUILD_LOCK_TTL = 3 * 3600       # 同一时间只运行一个重建任务，异常退出后锁到期释放
+
+# 结果文件下载接口 /results 以服务器的对象存储凭据读取文件：需要维护令牌，或任务状态接口给出的签名链接
+RESULT_LINK_SECRET = os.getenv("OGE_RESULT_LINK_SECRET", "") or ADMIN_TOKEN
+RESULT_LINK_TTL = 24 * 3600       # 签名链接的有效期
+
+# 地名查询接口
+GEOCODE_DEFAULT_LIMIT = 5
+GEOCODE_MAX_LIMIT = 20            # 单次正向查询最多返回的地名数
+
 
 
 
@@ -153,11 +313,133 @@ api_logger = setup_mcp_logger("shandong_api", "logs/api_calls.log")
 # ============ FastMCP实例 ============
 
 mcp = FastMCP(MCP_SERVER_NAME)
+# 每次工具调用带请求级截止时间，到期或客户端断开时取消整棵协程树
+install_request_deadlines(mcp._mcp_server)
+
+# ============ 多入口路由 ============
+
+gateway_pool = EndpointPool("gateway", GATEWAY_BASE_URLS)
+dag_router = DagClusterRouter("dag", DAG_API_BASE_URLS)
+# 集群容量监控：后台采样Spark Master与YARN的空闲资源，饱和的集群提交时排在后面
+capacity_monitor = CapacityMonitor(capacity_sources(DAG_API_BASE_URLS))
+dag_router.capacity = capacity_monitor
+
+# 栅格结果瓦片：tif结果转换为COG后按XYZ瓦片输出，渲染好的瓦片放在LRU缓存中
+raster_tile_cache = oge_raster_tiles.TileLRUCache()
+_cog_tasks: Dict[str, asyncio.Task] = {}
+_background_tasks: set = set()    # 后台任务（物化图层重建、按村拆分结果等），保留引用避免被回收
+_raster_info_cache: Dict[str, dict] = {}
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """在后台运行协程，不继承当前请求的上下文（截止时间等）"""
+    task = asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def ensure_result_cog(key: str, source: Optional[Path] = None) -> Optional[Path]:
+    """结果tif对应的COG路径，必要时先下载并转换；同一文件的并发请求共用一次转换"""
+    task = _cog_tasks.get(key)
+    if task is None:
+        async def convert():
+            path = source or await download_result(key)
+            if path is None:
+                return None
+            return await run_blocking(oge_raster_tiles.convert_to_cog, path, oge_raster_tiles.cog_path_for(key))
+
+        task = asyncio.ensure_future(convert())
+        _cog_tasks[key] = task
+        task.add_done_callback(lambda _: _cog_tasks.pop(key, None))
+    return await task
+
+
+async def result_raster_info(cog: Path) -> dict:
+    """COG的范围与值域信息，按文件路径和修改时间缓存（结果重新计算后COG会重新生成）"""
+    cache_key = f"{cog}:{cog.stat().st_mtime}"
+    info = _raster_info_cache.get(cache_key)
+    if info is None:
+        info = await run_blocking(oge_raster_tiles.raster_info, cog)
+        _raster_info_cache[cache_key] = info
+    return info
+
+
+async def _after_result_prefetch(key: str, path: Path):
+    """
+    预取完成的结果登记为图层：GeoJSON登记为矢量图层；tif结果顺带转换为COG，
+    首次看图时不必再等转换，再登记为瓦片图层
+    """
+    suffix = path.suffix.lower()
+    try:
+        if suffix == ".geojson":
+            entry = await run_blocking(register_vector_layer, layer_id_for(key), path.stem, path, key)
+            # 流出结果带村名字段，顺带扩展地名库中各村的范围
+            await run_blocking(lambda: update_derived_boundaries(read_layer_collection(entry)))
+        elif suffix in (".tif", ".tiff") and oge_raster_tiles.available():
+            cog = await ensure_result_cog(key, path)
+            if cog is not None:
+                info = await result_raster_info(cog)
+                user_id, _, filename = key.split("/", 2)
+                register_raster_layer(
+                    layer_id_for(key), path.stem,
+                    f"/raster/{user_id}/{filename}/tiles/{{z}}/{{x}}/{{y}}.png",
+                    info["bounds"], key, version=str(int(cog.stat().st_mtime))
+                )
+    except Exception as e:
+        logger.warning(f"结果登记为图层失败 {key}: {e}")
+
+
+# 结果预取：任务完成后把结果文件下载到本地结果缓存
+result_prefetcher = ResultPrefetcher(on_complete=_after_result_prefetch)
+
+# 约束图层瓦片代理：内存LRU + 磁盘两级缓存，并发未命中合并为一次上游请求
+tile_proxy = TileProxy()
+
+# Livy预热会话池：小任务在已加载OGE的交互式会话上执行，省去Spark冷启动（OGE_LIVY_POOL=1 时启用）
+livy_pool = LivyPool(LIVY_API_URL)
 
 # ============ Token管理 ============
 
+def get_intranet_token() -> str:
+    """获取当前内网token，优先使用共享状态中其他worker刷新过的token"""
+    global INTRANET_AUTH_TOKEN
+    try:
+        shared_token = get_state_backend().get(TOKEN_KEY)
+        if shared_token:
+            INTRANET_AUTH_TOKEN = shared_token
+    except Exception as e:
+        logger.warning(f"读取共享token失败，使用进程内token: {e}")
+    return INTRANET_AUTH_TOKEN
+
+
 async def refresh_intranet_token() -> tuple[bool, str]:
-    """自动刷新内网token"""
+    """刷新内网token，多worker时只有拿到锁的进程真正请求认证接口，其余进程等待共享结果"""
+    state = get_state_backend()
+    stale_token = get_intranet_token()
+    lock_token = state.acquire_lock("token_refresh", ttl=TOKEN_REFRESH_LOCK_TTL)
+
+    if lock_token is None:
+        logger.info("其他worker正在刷新token，等待共享结果...")
+        deadline = time.monotonic() + TOKEN_REFRESH_LOCK_TTL
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            current = get_intranet_token()
+            if current != stale_token:
+                return True, current
+        return False, "等待其他worker刷新token超时"
+
+    try:
+        success, token_or_error = await _request_intranet_token()
+        if success:
+            state.set(TOKEN_KEY, token_or_error)
+        return success, token_or_error
+    finally:
+        state.release_lock("token_refresh", lock_token)
+
+
+async def _request_intranet_token() -> tuple[bool, str]:
+    """请求认证接口获取新的内网token"""
     global INTRANET_AUTH_TOKEN
     
     try:
@@ -223,7 +505,54 @@ async def call_api_with_timing(
     headers: dict = None,
     timeout: int = 120,
     auto_retry_on_token_expire: bool = True,
-    use_intranet_token: bool = False
+    use_intranet_token: bool = False,
+    select: Optional[JsonSelect] = None,
+    max_response_bytes: int = MAX_RESPONSE_BYTES,
+    idempotent: Optional[bool] = None
+) -> tuple[dict, float]:
+    """
+    通用API调用；网关地址会路由到最快的健康入口，入口故障时自动切换到下一个。
+    响应体流式读取，超过 max_response_bytes 时中止；select 指定时只返回JSON中需要的元素（见 oge_http_stream）
+    idempotent 默认按方法判断（GET 幂等）；只读的POST计算请求可传 True，非幂等请求只在请求未发出时切换入口
+    """
+    timeout = clamp_timeout(timeout)
+    if idempotent is None:
+        idempotent = method.upper() in ("GET", "HEAD")
+    candidates = gateway_pool.candidates(url)
+    if not candidates:
+        return await _call_api_with_timing(
+            url, method, params, json_data, headers, timeout,
+            auto_retry_on_token_expire, use_intranet_token, select, max_response_bytes
+        )
+
+    result, execution_time = {"error": f"没有可用的网关入口: {url}"}, 0.0
+    for endpoint, candidate_url in candidates:
+        result, execution_time = await _call_api_with_timing(
+            candidate_url, method, params, json_data,
+            dict(headers) if headers else None, timeout,
+            auto_retry_on_token_expire, use_intranet_token, select, max_response_bytes
+        )
+        if is_endpoint_failure(result, idempotent):
+            endpoint.record_failure()
+            logger.warning(f"网关入口故障，切换下一个入口 - {endpoint.base_url}: {result.get('error')}")
+            continue
+        # 已发出的请求超时或中断但不能重发：不算入口故障，也不计入延迟统计
+        if not (isinstance(result, dict) and result.get("transport_error")):
+            endpoint.record_success(execution_time)
+        return result, execution_time
+    return result, execution_time
+
+async def _call_api_with_timing(
+    url: str,
+    method: str = 'POST',
+    params: dict | None = None, 
+    json_data: dict = None,
+    headers: dict = None,
+    timeout: int = 120,
+    auto_retry_on_token_expire: bool = True,
+    use_intranet_token: bool = False,
+    select: Optional[JsonSelect] = None,
+    max_response_bytes: int = MAX_RESPONSE_BYTES
 ) -> tuple[dict, float]:
     """通用API调用，带性能监控和自动token刷新"""
     global INTRANET_AUTH_TOKEN
@@ -233,7 +562,7 @@ async def call_api_with_timing(
     if use_intranet_token:
         if headers is None:
             headers = {"Content-Type": "application/json"}
-        headers["Authorization"] = INTRANET_AUTH_TOKEN
+        headers["Authorization"] = get_intranet_token()
         logger.info(f"使用内网token: {INTRANET_AUTH_TOKEN[:50]}...")
         logger.info(f"实际发送headers: {dict((k, v[:50] + '...' if k == 'Authorization' and len(v) > 50 else v) for k, v in headers.items())}")
     
@@ -245,43 +574,38 @@ async def call_api_with_timing(
     
     try:
         async with httpx.AsyncClient(timeout=timeout) as client:
-            # 处理GET请求的参数
-            if method.upper() == "GET":
-                # headers.pop("Content-Type")
-                response = await client.get(
-                    # method=method.upper(),
-                    url=url,
-                    params=params,
-                    headers=headers or {"Content-Type": "application/json"}
-                )
-            else:
-                response = await client.request(
-                    method=method.upper(),
-                    url=url,
-                    json=json_data,
-                    headers=headers or {"Content-Type": "application/json"}
-                )
+            # 处理GET请求的参数；响应体按块读取，不再经过 text/strip/json 多份拷贝
+            request_kwargs = {"params": params} if method.upper() == "GET" else {"json": json_data}
+            async with client.stream(
+                method.upper(),
+                url,
+                headers=headers or {"Content-Type": "application/json"},
+                **request_kwargs
+            ) as response:
+                body = None
+                if response.status_code == 200 and select is not None:
+                    result = await select_json(response, select, max_response_bytes)
+                else:
+                    body = await read_capped(response, max_response_bytes)
             
             execution_time = time.perf_counter() - start_time
             
             if response.status_code == 200:
-                # 安全处理JSON解析
-                response_text = response.text.strip()
-                try:
-                    result = response.json()
-                    # result["info-url"] = str(response.url)
-                except Exception as json_error:
-                    # 如果JSON解析失败，返回原始文本作为结果
-                    logger.info(f"响应不是JSON格式，作为纯文本处理: {response_text[:100]}...")
-                    # 对于DAG状态查询，直接返回文本状态
-                    if "/getState" in url:
-                        result = response_text if response_text else "unknown"
-                    else:
-                        result = {
-                            "raw_text": response_text,
-                            "json_parse_error": str(json_error),
-                            "content_type": response.headers.get("content-type", "unknown")
-                        }
+                if body is not None:
+                    # 直接从字节解析JSON，失败时才作为文本处理
+                    result, json_error = parse_body(body)
+                    if json_error is not None:
+                        response_text = result
+                        logger.info(f"响应不是JSON格式，作为纯文本处理: {response_text[:100]}...")
+                        # 对于DAG状态查询，直接返回文本状态
+                        if "/getState" in url:
+                            result = response_text if response_text else "unknown"
+                        else:
+                            result = {
+                                "raw_text": response_text,
+                                "json_parse_error": json_error,
+                                "content_type": response.headers.get("content-type", "unknown")
+                            }
                 
                 # 检查是否为token过期错误
                 if (should_auto_retry and 
@@ -305,7 +629,7 @@ async def call_api_with_timing(
                             }
                         
                         # 重新调用API（递归，但禁用自动重试避免无限循环）
-                        return await call_api_with_timing(
+                        return await _call_api_with_timing(
                             url=url,
                             method=method,
                             params=params,
@@ -313,7 +637,9 @@ async def call_api_with_timing(
                             headers=new_headers,
                             timeout=timeout,
                             auto_retry_on_token_expire=False,  # 禁用重试避免循环
-                            use_intranet_token=False  # 已经手动设置headers了，不需要再次设置
+                            use_intranet_token=False,  # 已经手动设置headers了，不需要再次设置
+                            select=select,
+                            max_response_bytes=max_response_bytes
                         )
                     else:
                         logger.error(f"Token刷新失败: {new_token}")
@@ -341,7 +667,7 @@ async def call_api_with_timing(
                         }
                     
                     # 重新调用API（递归，但禁用自动重试避免无限循环）
-                    return await call_api_with_timing(
+                    return await _call_api_with_timing(
                         url=url,
                         method=method,
                         params=params,
@@ -349,7 +675,9 @@ async def call_api_with_timing(
                         headers=new_headers,
                         timeout=timeout,
                         auto_retry_on_token_expire=False,  # 禁用重试避免循环
-                        use_intranet_token=False  # 已经手动设置headers了，不需要再次设置
+                        use_intranet_token=False,  # 已经手动设置headers了，不需要再次设置
+                        select=select,
+                        max_response_bytes=max_response_bytes
                     )
                 else:
                     logger.error(f"Token刷新失败: {new_token}")
@@ -361,12 +689,31 @@ async def call_api_with_timing(
                     current_token_preview = INTRANET_AUTH_TOKEN[:30] + "..." if INTRANET_AUTH_TOKEN else "None"
                     error_detail += f" - 当前token预览: {current_token_preview}"
                 api_logger.error(error_detail)
-                return {"error": response.text, "status_code": response.status_code}, execution_time
+                return {"error": text_preview(body), "status_code": response.status_code}, execution_time
                 
+    except ResponseTooLarge as e:
+        # 响应过大属于请求本身的问题，不算入口故障（不触发入口切换）
+        execution_time = time.perf_counter() - start_time
+        api_logger.error(f"API响应过大 - URL: {url} - {e}")
+        return {"error": str(e), "status_code": 413}, execution_time
     except Exception as e:
         execution_time = time.perf_counter() - start_time
         api_logger.error(f"API调用异常 - URL: {url} - 错误: {str(e)} - 耗时: {execution_time:.4f}s")
-        return {"error": str(e)}, execution_time
+        result = {"error": str(e) or type(e).__name__}
+        kind = transport_error_kind(e)
+        if kind:
+            result["transport_error"] = kind
+        return result, execution_time
+
+
+async def send_report(url: str, payload: dict) -> tuple[bool, Any]:
+    """发送一条结果登记（绑定recordId与结果文件），供结果登记队列使用"""
+    response, _ = await call_api_with_timing(url=url, json_data=payload, use_intranet_token=True)
+    return isinstance(response, dict) and response.get("code") == 200, response
+
+
+# 结果登记写后队列：登记先落盘，后台批量发送并按退避重试，进程退出也不会丢失
+report_queue = ReportQueue(sender=send_report)
 
 # ============ 工具定义 ============
 
@@ -433,6 +780,7 @@ async def check_token_status(ctx: Context = None) -> str:
     """
     global INTRANET_AUTH_TOKEN
     operation = "检查Token状态"
+    get_intranet_token()
     
     try:
         if ctx:
@@ -516,10 +864,14 @@ async def coverage_aspect_analysis(
     pretreatment: bool = True,
     product_value: str = "Platform:Product:ASTER_GDEM_DEM30",
     radius: int = 1,
+    engine: str = "auto",
     ctx: Context = None
 ) -> str:
     """
     坡向分析 - 基于DEM数据计算坡向信息
+
+    小范围且本地DEM库可用时直接用本地地形引擎计算；其余情况请求范围按固定瓦片网格分块提交集群计算
+    （每块外扩radius个像元），瓦片结果按(产品, 瓦片, radius)缓存，只计算缺失的瓦片，最后拼接为请求窗口的结果。
     
     Parameters:
     - bbox: 边界框坐标 [minLon, minLat, maxLon, maxLat]
@@ -527,49 +879,102 @@ async def coverage_aspect_analysis(
     - pretreatment: 是否进行预处理
     - product_value: 产品数据源
     - radius: 计算半径
+    - engine: 计算引擎，auto（按范围大小自动选择）/ local（本地）/ cluster（集群）
+
+    Returns:
+    集群计算时 data 为瓦片拼接清单（不再是单次 Coverage.aspect 的原始返回）：
+    - window / tile_size / grid_shape: 请求窗口、瓦片边长与瓦片行列数
+    - tiles: 自北向南、自西向东排列的瓦片，每项含 tile、grid_position、bbox（瓦片核心范围）、
+      window_bbox（核心范围与请求窗口的交集，拼接时按此裁剪）和 result（该瓦片 Coverage.aspect 的原始返回）
+    - cached_tiles / computed_tiles: 来自缓存与本次计算的瓦片数
+    本地引擎计算时 data 为结果文件与统计信息（见 run_local_aspect）。
     """
     operation = "坡向分析"
+    start_time = time.perf_counter()
     
     try:
         if ctx:
             await ctx.session.send_log_message("info", f"开始执行{operation}...")
         
         logger.info(f"开始执行{operation} - 边界框: {bbox}")
-        
-        # 构建算法参数
-        algorithm_args = {
-            "coverage": {
-                "type": coverage_type,
-                "pretreatment": pretreatment,
-                "preParams": {"bbox": bbox},
-                "value": [product_value]
-            },
-            "radius": radius
-        }
-        
-        # 调用内网API
-        api_payload = {
-            "name": "Coverage.aspect",
-            "args": algorithm_args,
-            "dockerImageSource": "DOCKER_HUB"
+
+        if await use_local_terrain_engine(bbox, product_value, engine):
+            data = await run_blocking(run_local_aspect, bbox, product_value, radius, TERRAIN_KERNEL)
+            execution_time = time.perf_counter() - start_time
+            result = Result.succ(
+                data=data,
+                msg=f"{operation}执行成功（本地地形引擎）",
+                map_type="coverage_aspect_analysis",
+                operation=operation,
+                execution_time=execution_time,
+                api_endpoint="local"
+            )
+            logger.info(f"{operation}执行完成 - 本地引擎, 耗时: {execution_time:.2f}秒")
+            return result.model_dump_json()
+
+        tiles = tiles_for_bbox(bbox, TILE_SIZE_DEG)
+        if len(tiles) > MAX_TILES_PER_REQUEST:
+            result = Result.failed(
+                msg=f"{operation}失败: 范围过大，需要{len(tiles)}个瓦片（上限{MAX_TILES_PER_REQUEST}）",
+                map_type="coverage_aspect_analysis",
+                operation=operation
+            )
+            return result.model_dump_json()
+
+        keys = {
+            tile: raster_tile_key("Coverage.aspect", product_value, tile, radius, TILE_SIZE_DEG,
+                                  type=coverage_type, pretreatment=pretreatment)
+            for tile in tiles
         }
-        
-        api_result, execution_time = await call_api_with_timing(
-            url=INTRANET_API_BASE_URL,
-            json_data=api_payload,
-            use_intranet_token=True
-        )
-        
-        if "error" in api_result:
+        cached, missing = lookup_raster_tiles(keys)
+        halo = raster_halo_size(product_value, radius)
+
+        async def compute_tile(tile, semaphore):
+            # 构建算法参数：瓦片范围外扩光环，保证瓦片边缘像元的邻域完整
+            algorithm_args = {
+                "coverage": {
+                    "type": coverage_type,
+                    "pretreatment": pretreatment,
+                    "preParams": {"bbox": list(raster_tile_bbox(tile, TILE_SIZE_DEG, halo))},
+                    "value": [product_value]
+                },
+                "radius": radius
+            }
+            api_payload = {
+                "name": "Coverage.aspect",
+                "args": algorithm_args,
+                "dockerImageSource": "DOCKER_HUB"
+            }
+            async with semaphore:
+                api_result, _ = await call_api_with_timing(
+                    url=INTRANET_API_BASE_URL,
+                    json_data=api_payload,
+                    use_intranet_token=True,
+                    idempotent=True
+                )
+            if "error" not in api_result:
+                store_raster_tile(keys[tile], api_result)
+            return tile, api_result
+
+        semaphore = asyncio.Semaphore(TILE_CONCURRENCY)
+        computed = await asyncio.gather(*[compute_tile(tile, semaphore) for tile in missing])
+        failed = {tile: api_result.get("error") for tile, api_result in computed if "error" in api_result}
+        tile_results = {**cached, **{tile: api_result for tile, api_result in computed if tile not in failed}}
+        execution_time = time.perf_counter() - start_time
+
+        if failed:
             result = Result.failed(
-                msg=f"{operation}失败: {api_result.get('error')}",
+                msg=f"{operation}失败: {len(failed)}个瓦片计算失败（成功的瓦片已缓存，可重试）- {next(iter(failed.values()))}",
                 map_type="coverage_aspect_analysis",
                 operation=operation
             )
+            result.data = {"failed_tiles": [list(tile) for tile in failed]}
         else:
+            mosaic_data = mosaic_raster_tiles(bbox, tile_results, TILE_SIZE_DEG)
+            mosaic_data.update({"cached_tiles": len(cached), "computed_tiles": len(missing)})
             result = Result.succ(
-                data=api_result,
-                msg=f"{operation}执行成功",
+                data=mosaic_data,
+                msg=f"{operation}执行成功（{len(tiles)}个瓦片，其中{len(cached)}个来自缓存）",
                 map_type="coverage_aspect_analysis",
                 operation=operation,
                 execution_time=execution_time,
@@ -579,7 +984,7 @@ async def coverage_aspect_analysis(
         if ctx:
             await ctx.session.send_log_message("info", f"{operation}执行完成，耗时{execution_time:.2f}秒")
         
-        logger.info(f"{operation}执行完成 - 耗时: {execution_time:.2f}秒")
+        logger.info(f"{operation}执行完成 - 瓦片: {len(tiles)}, 缓存命中: {len(cached)}, 耗时: {execution_time:.2f}秒")
         return result.model_dump_json()
         
     except Exception as e:
@@ -591,6 +996,110 @@ async def coverage_aspect_analysis(
         )
         return result.model_dump_json()
 
+async def use_local_terrain_engine(bbox: List[float], product_value: str, engine: str = "auto") -> bool:
+    """判断是否使用本地地形引擎：local 强制本地，auto 时范围足够小且本地DEM库可用"""
+    if engine == "cluster":
+        return False
+    if not oge_terrain.available():
+        if engine == "local":
+            raise RuntimeError("本地地形引擎不可用，需要安装 numpy 和 rasterio")
+        return False
+    if engine == "local":
+        return True
+    rows, cols = oge_terrain.window_shape(bbox, raster_pixel_size(product_value))
+    if rows * cols > LOCAL_TERRAIN_MAX_PIXELS:
+        return False
+    return await run_blocking(oge_terrain.dem_available, bbox)
+
+
+def run_local_aspect(bbox: List[float], product_value: str, radius: int = 1, kernel: str = TERRAIN_KERNEL) -> dict:
+    """本地计算坡向并写出GeoTIFF，返回结果文件与统计信息"""
+    terrain = oge_terrain.compute_terrain(bbox, raster_pixel_size(product_value), radius, kernel)
+    path = oge_terrain.output_path("aspect", bbox, radius, kernel)
+    oge_terrain.write_geotiff(path, terrain["aspect"], terrain["west"], terrain["north"], terrain["pixel_size"])
+    return {
+        "engine": "local",
+        "kernel": kernel,
+        "bbox": bbox,
+        "shape": list(terrain["aspect"].shape),
+        "result_file": str(path),
+        "statistics": oge_terrain.raster_statistics(terrain["aspect"], circular=True)
+    }
+
+
+# @mcp.tool()
+async def terrain_engine_cross_check(
+    bbox: List[float],
+    radius: int = 1,
+    kernel: str = TERRAIN_KERNEL,
+    tolerance: float = 1.0,
+    ctx: Context = None
+) -> str:
+    """
+    本地地形引擎与集群 Coverage.aspect 的一致性校验（维护用）
+
+    在集群上对bbox所在的DEM分幅计算坡向并导出GeoTIFF，下载后与本地引擎在同一网格上逐像元比较，
+    返回角度差的最大值、均值、RMSE以及容差内像元占比。
+    """
+    operation = "地形引擎一致性校验"
+    try:
+        if not oge_terrain.available():
+            raise RuntimeError("本地地形引擎不可用，需要安装 numpy 和 rasterio")
+        lon, lat = oge_terrain.dem_tiles_for_bbox(bbox)[0]
+        coverage_id = "ASTGTM_" + oge_terrain.dem_tile_name(lon, lat).split("_")[1]
+        filename = f"terrain_cross_check_{coverage_id}_r{radius}"
+        oge_code = f"""import oge
+
+oge.initialize()
+service = oge.Service()
+
+dem = service.getCoverage(coverageID="{coverage_id}", productID="ASTER_GDEM_DEM30")
+aspect = service.getProcess("Coverage.aspect").execute(dem, {radius})
+aspect.export("aspect")"""
+
+        workflow_data = json.loads(await execute_dag_workflow(
+            code=oge_code,
+            task_name=filename,
+            filename=filename,
+            format="tif",
+            auto_submit=True,
+            wait_for_completion=True,
+            analysis_type="terrain_cross_check",
+            ctx=ctx
+        ))
+        if workflow_data.get("data", {}).get("final_status") != "completed":
+            raise RuntimeError(f"集群计算未完成: {workflow_data.get('msg')}")
+
+        reference_path = await fetch_result_file(filename, "tif")
+        if reference_path is None:
+            raise RuntimeError("无法下载集群结果")
+        reference, ref_west, ref_north, ref_pixel = await run_blocking(oge_terrain.read_reference, reference_path)
+
+        terrain = await run_blocking(oge_terrain.compute_terrain, bbox, ref_pixel, radius, kernel)
+        local = terrain["aspect"]
+        row0 = round((ref_north - terrain["north"]) / ref_pixel)
+        col0 = round((terrain["west"] - ref_west) / ref_pixel)
+        if row0 < 0 or col0 < 0:
+            raise ValueError("bbox超出集群结果范围")
+        window = reference[row0:row0 + local.shape[0], col0:col0 + local.shape[1]]
+        comparison = oge_terrain.compare_aspect(local[:window.shape[0], :window.shape[1]], window, tolerance)
+
+        result = Result.succ(
+            data={"coverage_id": coverage_id, "kernel": kernel, "radius": radius, "comparison": comparison},
+            msg=f"{operation}完成 - 容差{tolerance}度内像元占比 {comparison.get('within_tolerance')}",
+            map_type="terrain_engine_cross_check",
+            operation=operation
+        )
+        return result.model_dump_json()
+    except Exception as e:
+        logger.error(f"{operation}失败: {str(e)}")
+        result = Result.failed(
+            msg=f"{operation}失败: {str(e)}",
+            map_type="terrain_engine_cross_check",
+            operation=operation
+        )
+        return result.model_dump_json()
+
 # spatial_intersection 工具已删除
 
 # coverage_slope_analysis 工具已删除
@@ -661,8 +1170,7 @@ oge.mapclient.centerMap({center_lon}, {center_lat}, {zoom_level})"""
             filename="shandong_aspect_analysis",
             auto_submit=True,
             wait_for_completion=wait_for_completion,
-            check_interval=10,          # 每10秒轮询一次
-            max_wait_time=1800,         # 30分钟超时
+            analysis_type="coverage_aspect",   # 查询间隔与超时按该类型的历史耗时预估
             ctx=ctx
         )
         
@@ -874,23 +1382,8 @@ async def shandong_farmland_vector_query(
     #     params["ZLDWMC"] = zldwmc
     
     try:
-        # 调用通用接口函数
-        resp, _ = await call_api_with_timing(
-            url=vector_query_url,
-            method="GET",
-            params=params,
-            # 如果你们内部需要 token，可以加 use_intranet_token=True
-            use_intranet_token=True
-        )
-        
-        MC_list = []
-        # 检查 code、拿到 data
-        if isinstance(resp, dict) and resp.get("code") == 20000:
-            # ZLDWMC 就是一个 [{ "cnt": 3, "region_name": "...", "all_area": ... }, ...] 的列表
-            MC_list = resp.get("data", [])
-        else:
-            # 根据实际情况抛错或返回空
-            raise RuntimeError(f"调用失败：{resp}")
+        # 地区目录在各worker之间共享缓存，过期后才重新请求统计接口
+        MC_list = await get_region_catalog(vector_query_url, params)
 
         if ctx:
             if year and administrative_divisions:
@@ -909,15 +1402,30 @@ async def shandong_farmland_vector_query(
         valid_villages = []
 
         query = ""
-        # 初始去重
-        administrative_divisions = set(administrative_divisions)
+        # 经本地地名库把简称、拼音、错别字解析为标准地名，再去重；有歧义的不替换，返回候选供用户确认
+        gazetteer = get_gazetteer()
+        corrected_divisions = {}
+        ambiguous_divisions = {}
+        for name in administrative_divisions:
+            canonical, candidates = gazetteer.resolve_candidates(name)
+            if canonical and canonical != name:
+                corrected_divisions[name] = canonical
+            elif candidates:
+                ambiguous_divisions[name] = candidates
+        administrative_divisions = set(corrected_divisions.get(name, name) for name in administrative_divisions)
+        if corrected_divisions:
+            logger.info(f"地名已规范化: {corrected_divisions}")
+        if ambiguous_divisions:
+            logger.info(f"地名有歧义，未替换: {ambiguous_divisions}")
         api_result = {
             "status_code": 200,
             "msg": "",
             "data": {
                 "query_sql": query,
                 "valid_villages":valid_villages,
-                "removed_divisions":removed_divisions
+                "removed_divisions":removed_divisions,
+                "corrected_divisions":corrected_divisions,
+                "ambiguous_divisions":ambiguous_divisions
             }
         }
 
@@ -950,6 +1458,12 @@ async def shandong_farmland_vector_query(
             api_result = {"info": f"数据库内没有该年份或地区的数据", "status_code": 200,"data":None}
             res_msg = "数据库内没有该年份/地区的数据"
             data_is_exist = False
+        if ambiguous_divisions:
+            # 有歧义的地名没有替换，提示候选由用户确认
+            res_msg += "；以下地名有多个可能的标准名称，请确认：" + "；".join(
+                f"{name}（{'/'.join(candidates)}）" for name, candidates in ambiguous_divisions.items())
+            if api_result.get("data") is None:
+                api_result["ambiguous_divisions"] = ambiguous_divisions
         
         if "error" in api_result:
             error_detail = api_result.get('error', '未知错误')
@@ -986,16 +1500,47 @@ async def shandong_farmland_vector_query(
         )
         return result.model_dump_json()
 
+async def get_region_catalog(vector_query_url: str, params: dict) -> list:
+    """获取地区统计目录（[{"cnt", "region_name", "all_area"}, ...]），优先读取共享缓存"""
+    state = get_state_backend()
+    cache_key = region_catalog_key(vector_query_url, params)
+    cached = state.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # 调用通用接口函数
+    resp, _ = await call_api_with_timing(
+        url=vector_query_url,
+        method="GET",
+        params=params,
+        # 如果你们内部需要 token，可以加 use_intranet_token=True
+        use_intranet_token=True
+    )
+
+    # 检查 code、拿到 data
+    if isinstance(resp, dict) and resp.get("code") == 20000:
+        # ZLDWMC 就是一个 [{ "cnt": 3, "region_name": "...", "all_area": ... }, ...] 的列表
+        MC_list = resp.get("data", [])
+    else:
+        # 根据实际情况抛错或返回空
+        raise RuntimeError(f"调用失败：{resp}")
+
+    state.set(cache_key, MC_list, ttl=REGION_CATALOG_TTL)
+    register_gazetteer_names(item["region_name"] for item in MC_list if item.get("region_name"))
+    return MC_list
+
 # 耕地适宜性分析
 @mcp.tool()
 async def farmland_suitability_analysis(
     data_query_sql: Annotated[str,Field(description="数据预处理的query_sql",required = True)],
     wait_for_completion: bool = True,
+    shard_count: Annotated[int, Field(description="分片数，0为按地块数自动决定，1为不分片", required=False)] = 0,
     ctx: Context = None
 ) -> str:
     """
     耕地地块合并
 
+    等待完成时结果按村缓存，后续请求只计算未缓存的村；村较多时按地块数切成多个分片并行计算，再合并结果。
     """
     operation = "耕地流出分析"
     slope_threshold: int = 4           # 坡度等级阈值，4对应15度
@@ -1008,25 +1553,25 @@ async def farmland_suitability_analysis(
             {
                 "name": "生态保护红线",
                 "type": "ecology",
-                "url": "http://59.206.223.134:7000/service/xueye_bio_protected_boundary?type=wvts&tablename=xueye_bio_protected_boundary&z={z}&x={x}&y={y}",
+                "url": proxied_tile_url("xueye_bio_protected_boundary"),
                 "detailmeta": "{center: [121.709337,37.308754],zoom:12}"
             },
             {
                 "name": "城镇开发边界",
                 "type": "town",
-                "url": "http://59.206.223.134:7000/service/xueye_urban_boundary?type=wvts&tablename=xueye_urban_boundary&z={z}&x={x}&y={y}",
+                "url": proxied_tile_url("xueye_urban_boundary"),
                 "detailmeta": "{center: [121.709337,37.308754],zoom:12}"
             },
             {
                 "name": "耕地地块数据",
                 "type": "farmland",
-                "url": "http://59.206.223.134:7000/service/ogeArable?type=wvts&tablename=ogeArable&z={z}&x={x}&y={y}",
+                "url": proxied_tile_url("ogeArable"),
                 "detailmeta": "{center: [121.709337,37.308754],zoom:12}"
             },
             {
                 "name": "大于15度的坡度",
                 "type": "slope",
-                "url": "http://59.206.223.134:7000/service/xueye_slope_boundary?type=wvts&tablename=xueye_slope_boundary&z={z}&x={x}&y={y}",
+                "url": proxied_tile_url("xueye_slope_boundary"),
                 "detailmeta": "{center: [121.709337,37.308754],zoom:12}"
             }
         ],
@@ -1055,61 +1600,87 @@ async def farmland_suitability_analysis(
     }
     
     try:
+        # 约束图层瓦片经本服务代理，首次调用时在后台预热演示范围的瓦片
+        tile_proxy.ensure_seeded()
         if ctx:
             await ctx.session.send_log_message("info", "进行已提取耕地地块合并")
         
         logger.info(f"开始执行{operation} - 坡度阈值: {slope_threshold}, 面积阈值: {fragment_area_threshold}")
-        
-        # 构建OGE代码
-        oge_code = f"""import oge
-oge.initialize()
 
-service = oge.Service.initialize()
-query = r"{data_query_sql}"
-cultivated = service.getProcess("FeatureCollection.runBigQuery").execute(query, "geom") #耕地
-cultivated_bounds = service.getProcess("FeatureCollection.bounds").execute(cultivated)
-# 重点管控区域 大于15度耕地 几何
-slope = service.getFeatureCollection("shp_podu") #坡度 GCS_China_Geodetic_Coordinate_System_2000
-slope_morethan15_ = service.getProcess("FeatureCollection.filterMetadata").execute(slope, "pdjb", "greater_than", 4) #超过15度的耕地
-slope_morethan15 = service.getProcess("FeatureCollection.reproject").execute(slope_morethan15_, "EPSG:4527")
-slope_extent = service.getProcess("FeatureCollection.filterBounds").execute(slope_morethan15, cultivated_bounds)
-urban_ = service.getFeatureCollection("shp_chengzhenkaifa") #城镇开发边界
-urban = service.getProcess("FeatureCollection.reproject").execute(urban_, "EPSG:4527")
-ecology_ = service.getFeatureCollection("shp_shengtaibaohu") #生态保护红线
-ecology = service.getProcess("FeatureCollection.reproject").execute(ecology_, "EPSG:4527")
-
-# cultivated_protected = service.getProcess("FeatureCollection.reproject").execute(cultivated, "EPSG:4527")
-
-urban_intersection = service.getProcess("FeatureCollection.intersection").execute(cultivated, urban) #流出1
-urban_erase = service.getProcess("FeatureCollection.erase").execute(cultivated, urban)
-ecology_intersection = service.getProcess("FeatureCollection.intersection").execute(urban_erase, ecology) ##流出3
-ecology_erase = service.getProcess("FeatureCollection.erase").execute(urban_erase, ecology)
-slope_intersection = service.getProcess("FeatureCollection.intersection").execute(ecology_erase, slope_extent) #流出4
-slope_erase = service.getProcess("FeatureCollection.erase").execute(ecology_erase, slope_extent)
-
-#筛选细碎化耕地
-cultivated1_area = service.getProcess("FeatureCollection.area").execute(slope_erase) #增加area字段
-cultivated1_lessthan5 = service.getProcess("FeatureCollection.filterMetadata").execute(cultivated1_area, "area", "less_than", 3333.3333)
-cultivated1_buffer = service.getProcess("FeatureCollection.buffer").execute(cultivated1_lessthan5, 10)
-cultivated1_join = service.getProcess("FeatureCollection.spatialJoinOneToOne").execute(cultivated1_buffer, cultivated1_area, "buffer", "geom", True, "Intersects", ["area"], ["sum"])
-cultivated1_subtract = service.getProcess("FeatureCollection.subtract").execute(cultivated1_join, "area_sum", "area", "area_peri")
-deprecated1 = service.getProcess("FeatureCollection.filterMetadata").execute(cultivated1_subtract, "area_peri", "less_than", "6666.6667") #流出5
-
-urban_intersection_reason = service.getProcess("FeatureCollection.constantColumn").execute(urban_intersection, "reason", "urban")
-ecology_intersection_reason = service.getProcess("FeatureCollection.constantColumn").execute(ecology_intersection, "reason", "ecology")
-slope_intersection_reason = service.getProcess("FeatureCollection.constantColumn").execute(slope_intersection, "reason", "slope")
-deprecated1_reason = service.getProcess("FeatureCollection.constantColumn").execute(deprecated1, "reason", "fragmented")
-
-deprecated = service.getProcess("FeatureCollection.mergeAll").execute([urban_intersection_reason,ecology_intersection_reason,slope_intersection_reason,deprecated1_reason]) #需要流出的耕地
-deprecated_area = service.getProcess("FeatureCollection.area").execute(deprecated)
-deprecated_CGCS2000 = service.getProcess("FeatureCollection.reproject").execute(deprecated_area, "EPSG:4490")
-deprecated_CGCS2000.export("cultivated_protected")"""  
+        script_kwargs = {
+            "slope_threshold": slope_threshold,
+            "fragment_area_threshold": fragment_area_threshold,
+            "buffer_distance": buffer_distance,
+            "peripheral_area_threshold": peripheral_area_threshold,
+            "materialized": current_materialized_assets()
+        }
+        plan = None
+        if wait_for_completion:
+            try:
+                plan = await plan_outflow_run(data_query_sql, shard_count, script_kwargs)
+            except Exception as e:
+                logger.warning(f"按村缓存/分片规划失败，按整体计算执行: {e}")
+        if plan and (plan["cached"] or len(plan["shards"]) > 1):
+            res_filename = "大模型farmland_outflow_result"+str(time.time())
+            sharded = await run_sharded_outflow(data_query_sql, plan, script_kwargs, res_filename, ctx)
+            shard_dag_ids = [shard["dag_id"] for shard in sharded["shards"] if shard.get("dag_id")]
+            primary_dag_id = shard_dag_ids[0] if shard_dag_ids else "unknown"
+            result_data = {
+                "analysis_type": "farmland_outflow_analysis",
+                "workflow_status": sharded["final_status"],
+                "dag_id": primary_dag_id,
+                "shard_dag_ids": shard_dag_ids,
+                "shards": sharded["shards"],
+                "cached_villages": sorted(plan["cached"]),
+                "computed_villages": [v for shard in plan["shards"] for v in shard],
+                "merged_result": sharded.get("merged_path"),
+                "outflow_summary": sharded.get("summary")
+            }
+            if sharded["final_status"] == "completed":
+                if plan["shards"]:
+                    msg = f"{operation}执行成功 - {len(plan['cached'])}个村使用缓存结果，" + \
+                          f"{len(result_data['computed_villages'])}个村分{len(plan['shards'])}个分片计算，已合并"
+                else:
+                    msg = f"{operation}执行成功 - 全部{len(plan['cached'])}个村使用缓存结果"
+                result = Result.succ(
+                    data=result_data,
+                    msg=msg,
+                    map_type="farmland_suitability_analysis",
+                    operation=operation,
+                    api_endpoint="dag_workflow"
+                )
+            else:
+                failed = [shard["index"] for shard in sharded["shards"] if not shard["success"]]
+                result = Result.failed(
+                    msg=f"{operation}失败: 分片{failed}重试后仍未成功",
+                    map_type="farmland_suitability_analysis",
+                    operation=operation
+                )
+                result.data = result_data
+            additional_json_data = update_process_id(additional_json_data, primary_dag_id)
+            logger.info(f"{operation}分片执行完成 - 最终状态: {sharded['final_status']}")
+            result.data = {**(result.data or {}), **additional_json_data}
+            return result.model_dump_json()
+
+        # 构建OGE代码：由脚本规划器生成，约束图层先按耕地范围裁剪再重投影
+        # 村级查询带光环计算，结果与全镇计算一致，可以按村写入缓存
+        if plan and not plan["town_level"]:
+            oge_code = build_outflow_script(
+                data_query_sql,
+                halo_query=halo_query_for(data_query_sql, plan["villages"], plan["town_villages"]),
+                keep_villages=plan["villages"],
+                **script_kwargs
+            )
+        else:
+            oge_code = build_outflow_script(data_query_sql, **script_kwargs)
         
     
         logger.info(f"生成的OGE代码长度: {len(oge_code)} 字符")
         
         # 调用execute_dag_workflow执行完整工作流
         res_filename = "大模型farmland_outflow_result"+str(time.time())
+        input_size = {"villages": len(plan["villages"]), "parcels": plan["parcels"], "all_area": plan["all_area"]} if plan else None
+        report_insert_time = None
         workflow_result = await execute_dag_workflow(
             code=oge_code,
             task_name=res_filename,
@@ -1117,14 +1688,19 @@ deprecated_CGCS2000.export("cultivated_protected")"""
             auto_submit=True,
             wait_for_completion=wait_for_completion,
             format="geojson",
-            check_interval=10,          # 每10秒轮询一次
-            max_wait_time=1800,         # 30分钟超时
+            analysis_type="farmland_outflow",   # 查询间隔与超时按该类型和地块数的历史耗时预估
+            input_size=input_size,
+            record_run=False,           # 结果登记完成后连同登记耗时一起记录
             ctx=ctx
         )
         
         # 解析workflow结果
         import json
         workflow_data = json.loads(workflow_result)
+        # 预热会话上的运行没有OGE平台的dagId，不能登记结果或替换processId
+        workflow_details = workflow_data.get("data") or {}
+        warm_run = (workflow_details.get("task_info") or {}).get("executor") == "livy"
+        record_id = None if warm_run else workflow_details.get("dag_ids", ["unknown"])[0]
         
         if workflow_data.get("success"):
             # 提取关键信息
@@ -1134,7 +1710,8 @@ deprecated_CGCS2000.export("cultivated_protected")"""
             result_data = {
                 "analysis_type": "farmland_outflow_analysis",
                 "workflow_status": final_status,
-                "dag_id": workflow_details.get("dag_ids", ["unknown"])[0]
+                "dag_id": workflow_details.get("dag_ids", ["unknown"])[0],
+                "estimate": workflow_details.get("estimate")
                 # "outflow_categories": [
                 #     {"type": "urban", "description": "城镇开发边界内耕地"},
                 #     {"type": "nature", "description": "自然保护地内耕地"},
@@ -1153,26 +1730,26 @@ deprecated_CGCS2000.export("cultivated_protected")"""
                     "resultStatus": 1,
                     "resultFileStatus": 1,
                     "processingTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # 或传入值
-                    "recordId": workflow_details.get("dag_ids", ["unknown"])[0],  # 或替换为自定义recordId
+                    "recordId": record_id,  # 或替换为自定义recordId
                     "filePath": f"oge-user/f950cff2-07c8-461a-9c24-9162d59e2ef6/result/"
                 }
 
-                # 调用统一封装函数,绑定id与结果文件
-                workflow_report_result, _ = await call_api_with_timing(
-                    url=INSERT_REPORT_URL,
-                    json_data=workflow_report_payload,
-                    use_intranet_token=True  # 关键点：开启内网token自动处理
-                )
+                # 登记写入持久化队列后立即返回，由后台发送并在失败时重试（使用内网token）
+                if record_id:
+                    report_start = time.perf_counter()
+                    report_queue.enqueue(INSERT_REPORT_URL, workflow_report_payload, key=record_id)
+                    report_insert_time = time.perf_counter() - report_start
+                    logger.info("算法处理结果已加入上报队列，绑定processId")
 
-                # 你可以根据返回做额外处理
-                if isinstance(workflow_report_result, dict) and workflow_report_result.get("code") == 200:
-                    logger.info("算法处理结果成功上报绑定processId")
-                else:
-                    logger.warning(f"上报失败，响应: {workflow_report_result}")
+                if plan:
+                    # 下载、解析和按村拆分在后台完成，不拖慢本次返回
+                    spawn_background(cache_village_results(res_filename, plan["villages"], plan["signature"], result_data["dag_id"]))
 
             elif final_status == "submitted":
                 primary_dag_id = workflow_details.get("dag_ids", ["unknown"])[0]
+                eta_text = (workflow_details.get("estimate") or {}).get("eta_text")
                 msg = f"{operation}任务已提交 - dagId/processId/recordId: {primary_dag_id}\n" + \
+                      (f"预计完成时间：{eta_text}\n" if eta_text else "") + \
                       f"请使用以下命令查询进度：\n" + \
                       f"query_task_status(recordId=\"{primary_dag_id}\")\n" + \
                       f"分析参数：坡度阈值{slope_threshold}级，面积阈值{fragment_area_threshold/666.67:.1f}亩"
@@ -1197,7 +1774,9 @@ deprecated_CGCS2000.export("cultivated_protected")"""
                 operation=operation
             )
             result.data = workflow_data.get("data")
-        additional_json_data = update_process_id(additional_json_data,workflow_details.get("dag_ids", ["unknown"])[0])
+        record_workflow_run(workflow_details or {}, "farmland_outflow", input_size, report_insert=report_insert_time)
+        if record_id:
+            additional_json_data = update_process_id(additional_json_data, record_id)
         if ctx:
             await ctx.session.send_log_message("info", "耕地地块合并完成")
         
@@ -1218,6 +1797,215 @@ deprecated_CGCS2000.export("cultivated_protected")"""
         return result.model_dump_json()
 
 
+async def plan_outflow_run(data_query_sql: str, shard_count: int = 0, script_kwargs: Optional[dict] = None) -> Optional[dict]:
+    """
+    规划一次耕地流出计算：确定涉及的村（镇级查询时取地区目录中的全部村），查按村缓存，
+    再把未缓存的村按地块数划分分片。shard_count 为0时按地块总数自动决定，为1时不分片。
+    """
+    params = {"DLMC": ",".join(OUTFLOW_DLMC_LIST), "ZLDWMC": ""}
+    catalog = await get_region_catalog(REGION_STAT_URL, params)
+    parcel_counts = {item["region_name"]: int(item.get("cnt") or 0) for item in catalog}
+    areas = {item["region_name"]: float(item.get("all_area") or 0) for item in catalog}
+
+    villages = parse_villages(data_query_sql)
+    town_level = villages is None
+    if town_level:
+        villages = list(parcel_counts)
+    if not villages:
+        return None
+
+    signature = village_cache_signature(strip_villages(data_query_sql), script_kwargs or {})
+    cached, missing = lookup_village_results(villages, signature)
+
+    shards = []
+    if missing:
+        if shard_count <= 0:
+            total_parcels = sum(parcel_counts.get(v, 0) for v in missing)
+            shard_count = 1
+            if total_parcels >= SHARD_PARCEL_THRESHOLD:
+                shard_count = choose_shard_count(total_parcels, SHARD_TARGET_PARCELS, MAX_SHARDS, len(missing))
+        # 地名库中有村范围时按空间邻近划分分片，光环更小
+        shards = balance_shards(missing, parcel_counts, shard_count, village_bounds=get_gazetteer().bounds(missing))
+    return {
+        "villages": villages,
+        "town_level": town_level,
+        "signature": signature,
+        "cached": cached,
+        "shards": shards,
+        "parcels": sum(parcel_counts.get(v, 0) for v in missing),
+        "all_area": sum(areas.get(v, 0.0) for v in missing),
+        "village_sizes": {v: (parcel_counts.get(v, 0), areas.get(v, 0.0)) for v in missing},
+        "town_villages": list(parcel_counts)
+    }
+
+
+def halo_query_for(data_query_sql: str, core_villages: List[str], town_villages: List[str]) -> str:
+    """
+    光环候选耕地的查询：只读取与本次计算的村外扩范围相邻的村。
+    只使用边界文件中的村范围；由结果地块推得的凸包比村的实际范围小，会漏掉真正相邻的村，
+    本次计算的村没有边界时退回全镇查询（结果写入按村缓存，光环宁大勿漏）
+    """
+    candidates = list(dict.fromkeys(list(town_villages) + list(core_villages)))
+    halo = halo_villages(core_villages, candidates, get_gazetteer().bounds(candidates, sources=("boundary",)))
+    if halo is None:
+        logger.info(f"部分村没有行政区划边界，光环使用全镇查询: {core_villages[:5]}")
+        return strip_villages(data_query_sql)
+    return with_villages(data_query_sql, halo)
+
+
+def result_file_url(filename: str, ext: str, user_id: str = DEFAULT_USER_ID) -> str:
+    """DAG导出结果在结果存储中的地址"""
+    return result_object_url(result_key(f"{filename}.{ext}", user_id))
+
+
+def result_link_signature(key: str, expires: int) -> str:
+    """结果下载链接的签名，覆盖对象名和过期时间"""
+    return hmac.new(RESULT_LINK_SECRET.encode("utf-8"), f"{key}\n{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def signed_result_query(key: str) -> str:
+    """结果下载链接的查询参数；未配置签名密钥时为空（只能凭维护令牌下载）"""
+    if not RESULT_LINK_SECRET:
+        return ""
+    expires = int(time.time() + RESULT_LINK_TTL)
+    return f"expires={expires}&signature={result_link_signature(key, expires)}"
+
+
+async def fetch_result_file(filename: str, ext: str, user_id: str = DEFAULT_USER_ID) -> Optional[Path]:
+    """把DAG导出的结果文件下载到本地结果缓存，返回本地路径"""
+    try:
+        return await download_result(result_key(f"{filename}.{ext}", user_id))
+    except Exception as e:
+        logger.warning(f"下载结果文件失败 {result_file_url(filename, ext, user_id)}: {e}")
+        return None
+
+
+async def store_village_results(path: Path, villages: List[str], signature: str, dag_id: Optional[str]) -> bool:
+    """
+    把带光环计算的结果文件按村写入缓存，返回结果文件是否可用（合法的GeoJSON）。
+    解析与拆分在进程池中完成，进程间只传递文件路径和各村的路径/要素数
+    """
+    try:
+        parts = await run_cpu(store_village_file, str(path), villages, signature)
+    except (OSError, ValueError, MemoryError, RuntimeError) as e:
+        logger.warning(f"解析结果文件失败 {path}: {e}")
+        return False
+    if parts is None:
+        logger.warning(f"结果无法按村拆分，未写入按村缓存: {path}")
+    else:
+        register_village_results(parts, signature, dag_id)
+    return True
+
+
+async def cache_village_results(filename: str, villages: List[str], signature: str, dag_id: str):
+    """读取整体计算的结果并按村写入缓存（后台任务）"""
+    try:
+        path = await fetch_result_file(filename, "geojson")
+        if path is not None:
+            await store_village_results(path, villages, signature, dag_id)
+    except Exception as e:
+        logger.warning(f"结果按村写入缓存失败 {filename}: {e}")
+
+
+async def _run_outflow_shard(
+    index: int,
+    villages: List[str],
+    data_query_sql: str,
+    script_kwargs: dict,
+    base_filename: str,
+    semaphore: asyncio.Semaphore,
+    signature: str,
+    village_sizes: Optional[dict] = None,
+    town_villages: Optional[List[str]] = None
+) -> dict:
+    """执行单个分片（带光环），失败时重试，成功后下载分片结果并按村写入缓存"""
+    shard_sql = with_villages(data_query_sql, villages)
+    code = build_outflow_script(
+        shard_sql,
+        halo_query=halo_query_for(data_query_sql, villages, town_villages or []),
+        keep_villages=villages,
+        **script_kwargs
+    )
+    filename = f"{base_filename}_shard{index}"
+    sizes = [(village_sizes or {}).get(v, (0, 0.0)) for v in villages]
+    input_size = {"villages": len(villages), "parcels": sum(n for n, _ in sizes), "all_area": sum(a for _, a in sizes)}
+    shard = {"index": index, "villages": villages, "filename": filename, "dag_id": None, "attempts": 0, "success": False}
+
+    for attempt in range(1 + SHARD_MAX_RETRIES):
+        shard["attempts"] = attempt + 1
+        async with semaphore:
+            workflow_json = await execute_dag_workflow(
+                code=code,
+                task_name=filename,
+                filename=filename,
+                auto_submit=True,
+                wait_for_completion=True,
+                format="geojson",
+                analysis_type="farmland_outflow_shard",
+                input_size=input_size,
+                ctx=None
+            )
+        workflow_details = json.loads(workflow_json).get("data") or {}
+        shard["dag_id"] = (workflow_details.get("dag_ids") or [shard["dag_id"]])[0]
+        shard["final_status"] = workflow_details.get("final_status", "unknown")
+        if shard["final_status"] == "completed":
+            # 成功的分片先写入缓存，部分失败时重新请求只需计算失败的村
+            path = await fetch_result_file(filename, "geojson")
+            if path is not None and await store_village_results(path, villages, signature, shard["dag_id"]):
+                shard["success"] = True
+                shard["path"] = str(path)
+                return shard
+            shard["final_status"] = "result_unavailable"
+        logger.warning(f"分片{index}第{attempt + 1}次执行未成功: {shard['final_status']}")
+    return shard
+
+
+async def run_sharded_outflow(
+    data_query_sql: str,
+    plan: dict,
+    script_kwargs: dict,
+    base_filename: str,
+    ctx: Context = None
+) -> dict:
+    """并行提交未缓存村的分片DAG，成功的分片按村写入缓存，全部成功后与已缓存的村合并为一个结果"""
+    shards = plan["shards"]
+    if ctx and shards:
+        await ctx.session.send_log_message("info", f"{len(plan['cached'])}个村使用缓存结果，其余村划分为{len(shards)}个分片并行计算")
+    semaphore = asyncio.Semaphore(SHARD_CONCURRENCY)
+    shard_results = await asyncio.gather(*[
+        _run_outflow_shard(i, villages, data_query_sql, script_kwargs, base_filename, semaphore,
+                           plan["signature"], plan.get("village_sizes"), plan.get("town_villages"))
+        for i, villages in enumerate(shards)
+    ])
+
+    sharded = {"shards": shard_results, "final_status": "failed"}
+    if not all(shard["success"] for shard in shard_results):
+        return sharded
+
+    cached = plan["cached"]
+    merged_path = RESULT_LOCAL_DIR / "merged" / f"{base_filename}.geojson"
+    merged_path.parent.mkdir(parents=True, exist_ok=True)
+    # 读取、合并、序列化和统计在进程池中完成，只传入文件路径、回传统计结果
+    summary = await run_cpu(
+        write_merged_outflow,
+        list(cached.values()) + [shard["path"] for shard in shard_results],
+        [{village} for village in cached] + [set(shard["villages"]) for shard in shard_results],
+        str(merged_path)
+    )
+    try:
+        entry = await run_blocking(register_vector_layer, layer_id_for(str(merged_path)), base_filename, merged_path)
+        await run_blocking(lambda: update_derived_boundaries(read_layer_collection(entry)))
+    except Exception as e:
+        logger.warning(f"合并结果登记为图层失败: {e}")
+
+    sharded.update({
+        "final_status": "completed",
+        "merged_path": str(merged_path),
+        "summary": summary
+    })
+    return sharded
+
+
 # @mcp.tool()
 async def run_big_query(
     # query: str,
@@ -1256,7 +2044,8 @@ async def run_big_query(
         api_result, execution_time = await call_api_with_timing(
             url=INTRANET_API_BASE_URL,
             json_data=api_payload,
-            use_intranet_token=True
+            use_intranet_token=True,
+            idempotent=True
         )
         
         if "error" in api_result:
@@ -1293,6 +2082,93 @@ async def run_big_query(
         return result.model_dump_json()
 
 
+# ============ 约束图层物化维护 ============
+
+# @mcp.tool()
+async def rebuild_constraint_layers(
+    tables: Optional[List[str]] = None,
+    slope_threshold: int = 4,
+    ctx: Context = None
+) -> str:
+    """
+    重建物化约束图层（维护用，不对大模型开放）
+
+    为坡度(pdjb > 4)、城镇开发边界、生态保护红线各提交一个维护DAG，生成已过滤、已重投影到EPSG:4527的
+    新版本图层，成功后登记为当前版本，之后生成的流出分析脚本直接读取物化图层（OGE_MATERIALIZED_LAYERS=0 时不读取）。
+
+    Parameters:
+    - tables: 需要重建的图层名列表，默认全部
+    - slope_threshold: 坡度等级阈值
+    """
+    operation = "重建物化约束图层"
+
+    async def build_one(layer):
+        version = next_materialized_version(layer)
+        asset = materialized_asset_name(layer, version)
+        workflow_result = await execute_dag_workflow(
+            code=build_materialize_script(layer, version),
+            task_name=asset,
+            filename=asset,
+            format="geojson",
+            wait_for_completion=True,
+            check_interval=30,
+            max_wait_time=3600,
+            ctx=None
+        )
+        workflow_data = json.loads(workflow_result)
+        workflow_details = workflow_data.get("data") or {}
+        dag_id = (workflow_details.get("dag_ids") or ["unknown"])[0]
+        success = workflow_data.get("success") and workflow_details.get("final_status") == "completed"
+        if success:
+            register_materialized_version(layer, version, dag_id)
+        return {
+            "table": layer.table,
+            "asset": asset,
+            "version": version,
+            "dag_id": dag_id,
+            "success": bool(success),
+            "final_status": workflow_details.get("final_status")
+        }
+
+    try:
+        if ctx:
+            await ctx.session.send_log_message("info", f"开始执行{operation}...")
+        logger.info(f"开始执行{operation} - 图层: {tables or '全部'}")
+
+        layers = materializable_layers(slope_threshold, tables)
+        builds = await asyncio.gather(*(build_one(layer) for layer in layers))
+        failed = [b for b in builds if not b["success"]]
+
+        data = {"builds": builds, "registry": get_materialized_registry()}
+        if failed:
+            result = Result.failed(
+                msg=f"{operation}部分失败: {', '.join(b['table'] for b in failed)}",
+                map_type="rebuild_constraint_layers",
+                operation=operation
+            )
+            result.data = data
+        else:
+            result = Result.succ(
+                data=data,
+                msg=f"{operation}成功，共{len(builds)}个图层",
+                map_type="rebuild_constraint_layers",
+                operation=operation,
+                api_endpoint="dag_workflow"
+            )
+
+        logger.info(f"{operation}执行完成 - 失败数: {len(failed)}")
+        return result.model_dump_json()
+
+    except Exception as e:
+        logger.error(f"{operation}执行失败: {str(e)}")
+        result = Result.failed(
+            msg=f"{operation}执行失败: {str(e)}",
+            map_type="rebuild_constraint_layers",
+            operation=operation
+        )
+        return result.model_dump_json()
+
+
 # ============ DAG批处理工具 ============
 
 # @mcp.tool()
@@ -1320,9 +2196,6 @@ async def execute_code_to_dag(
         
         logger.info(f"开始执行{operation}")
         
-        # 构建API URL
-        api_url = f"{DAG_API_BASE_URL}/executeCode"
-        
         # 构建请求数据
         request_data = {
             "code": code,
@@ -1342,18 +2215,29 @@ async def execute_code_to_dag(
                 "Authorization": auth_token
             }
         
-        logger.info(f"调用API: {api_url}")
         logger.info(f"请求数据: userId={user_id}, sampleName={sample_name}")
         
-        # 调用API
-        api_result, execution_time = await call_api_with_timing(
-            url=api_url,
-            method="POST",
-            json_data=request_data,
-            headers=final_headers,
-            timeout=300,     # 5分钟超时，DAG创建可能需要更长时间
-            use_intranet_token=not use_custom_token
-        )
+        # 按负载最低的健康集群依次尝试，集群故障时切换到下一个
+        cluster = None
+        for cluster in dag_router.submission_order():
+            api_url = f"{cluster.base_url}/executeCode"
+            logger.info(f"调用API: {api_url}")
+            api_result, execution_time = await call_api_with_timing(
+                url=api_url,
+                method="POST",
+                json_data=request_data,
+                headers=dict(final_headers) if final_headers else None,
+                timeout=300,     # 5分钟超时，DAG创建可能需要更长时间
+                use_intranet_token=not use_custom_token
+            )
+            # executeCode 非幂等：只在请求未发出时切换集群，否则可能在两个集群各生成一份DAG
+            if is_endpoint_failure(api_result, idempotent=False):
+                cluster.record_failure()
+                logger.warning(f"DAG集群故障，切换下一个集群 - {cluster.base_url}: {api_result.get('error')}")
+                continue
+            if not api_result.get("transport_error"):
+                cluster.record_success(execution_time)
+            break
         
         if "error" not in api_result:
             # 提取DAG信息
@@ -1368,6 +2252,10 @@ async def execute_code_to_dag(
                     dag_ids.append(key)
                 elif isinstance(value, str):
                     dag_ids.append(value)
+
+            # 记录DAG归属集群，后续提交与状态查询都发往该集群
+            for dag_id in dag_ids:
+                await dag_router.assign(dag_id, cluster)
             
             result_data = {
                 "dags": dags,
@@ -1375,7 +2263,8 @@ async def execute_code_to_dag(
                 "space_params": space_params,
                 "log": log_info,
                 "user_id": user_id,
-                "sample_name": sample_name
+                "sample_name": sample_name,
+                "cluster": cluster.base_url
             }
             
             result = Result.succ(
@@ -1421,6 +2310,7 @@ async def submit_batch_task(
     username: str = DEFAULT_USERNAME,
     script: str = "",
     auth_token: str = None,
+    resource_hints: Optional[dict] = None,
     ctx: Context = None
 ) -> str:
     """
@@ -1436,6 +2326,7 @@ async def submit_batch_task(
     - username: 用户名
     - script: 脚本代码
     - auth_token: 认证Token（可选，默认使用全局Token）
+    - resource_hints: Spark资源建议（可选，由 spark_resource_hints 按输入规模生成），不指定时使用集群默认配置
     """
     operation = "提交批处理任务"
     
@@ -1445,8 +2336,8 @@ async def submit_batch_task(
         
         logger.info(f"开始执行{operation} - DAG ID: {dag_id}")
         
-        # 构建API URL
-        api_url = f"{DAG_API_BASE_URL}/addTaskRecord"
+        # 构建API URL（发往DAG所属集群）
+        api_url = dag_router.url_for(dag_id, "/addTaskRecord")
         
         # 生成默认任务名和文件名（如果未提供）
         if not task_name:
@@ -1468,6 +2359,9 @@ async def submit_batch_task(
             "userName": username,
             "script": script
         }
+        if resource_hints:
+            # executor数、内存与分区数按输入规模决定
+            request_data["sparkConf"] = resource_hints["conf"]
         
         # 准备认证
         use_custom_token = bool(auth_token)
@@ -1482,7 +2376,9 @@ async def submit_batch_task(
             }
         
         logger.info(f"调用API: {api_url}")
-        logger.info(f"请求数据: taskName={task_name}, dagId={dag_id}")
+        logger.info(f"请求数据: taskName={task_name}, dagId={dag_id}"
+                    + (f", executors={resource_hints['executors']}, memory={resource_hints['executor_memory']}"
+                       f", partitions={resource_hints['partitions']}" if resource_hints else ""))
         
         # 调用API
         api_result, execution_time = await call_api_with_timing(
@@ -1512,6 +2408,7 @@ async def submit_batch_task(
                     "user_id": task_data.get("userId"),
                     "username": task_data.get("userName"),
                     "folder": task_data.get("folder"),
+                    "resources": resource_hints,
                     "api_response": api_result
                 }
                 
@@ -1792,6 +2689,61 @@ async def old_query_task_status(
         return result.model_dump_json()
 
 
+async def cancel_cluster_job(dag_id: str) -> None:
+    """取消已无人等待的集群任务：其他worker上仍有 /task_status 长轮询时不取消"""
+    store = get_task_store()
+    task = store.get(dag_id)
+    if task is None or task["status"] in FINAL_STATUSES:
+        return
+    if get_state_backend().get(f"{TASK_WATCH_KEY_PREFIX}{dag_id}") is not None:
+        logger.info(f"任务 {dag_id} 仍有前端在查看，不取消")
+        return
+
+    # 只有取消接口明确确认后才把任务标记为killed；找不到或调用失败时保持原状态，由状态查询继续跟踪
+    outcome = "unsupported"
+    batch_id = task.get("batch_session_id")
+    if batch_id is not None:
+        try:
+            async with httpx.AsyncClient(timeout=15) as client:
+                response = await client.delete(f"{LIVY_API_URL}/batches/{batch_id}")
+            if response.status_code == 200:
+                outcome = "cancelled"
+            elif response.status_code == 404:
+                # 批任务已结束被清理，或ID有误，都不能说明任务是被取消的
+                outcome = "not_found"
+            else:
+                outcome = f"livy_http_{response.status_code}"
+        except httpx.HTTPError as e:
+            outcome = "livy_error"
+            logger.warning(f"Livy批任务取消失败 {batch_id}: {e}")
+    if outcome != "cancelled" and DAG_CANCEL_PATH:
+        result, _ = await call_api_with_timing(
+            url=dag_router.url_for(dag_id, DAG_CANCEL_PATH),
+            method="GET",
+            params={"dagId": dag_id},
+            timeout=15,
+            use_intranet_token=True
+        )
+        if isinstance(result, dict) and result.get("code") == 200:
+            outcome = "cancelled"
+        elif isinstance(result, dict) and result.get("status_code") == 404:
+            outcome = "not_found"
+        else:
+            outcome = "dag_cancel_failed"
+
+    if outcome == "cancelled":
+        store.update_state(dag_id, "killed", "cancelled", detail={"cancel_reason": "调用方已断开或超过截止时间"})
+        await dag_router.release(dag_id)
+        logger.info(f"已取消被放弃的集群任务 {dag_id}")
+    else:
+        store.update_state(dag_id, task["state"], task["status"], detail={"cancel_attempt": outcome})
+        logger.warning(f"未能确认取消被放弃的集群任务 {dag_id}: {outcome}")
+
+
+# 集群任务等待者：工具协程被取消（客户端断开或超过截止时间）且无人接手时取消集群任务
+job_watchers = JobWatchers(on_orphan=cancel_cluster_job)
+
+
 # 逻辑简化版
 @mcp.tool()
 async def query_task_status(
@@ -1803,7 +2755,7 @@ async def query_task_status(
     查询批处理任务执行状态。除非用户指定使用，否则不去调用。
     """
     operation = "查询任务状态"
-    DAG_STATE_URL = f"{DAG_API_BASE_URL}/getState"
+    DAG_STATE_URL = dag_router.url_for(dag_id, "/getState")
     # CATALOG_URL   = "http://172.20.70.141/api/asset/batch-result/catalog"
 
     # 准备 headers & 模式
@@ -1815,10 +2767,10 @@ async def query_task_status(
         common_headers["Authorization"] = auth_token
 
     # 小工具：发起请求（可复用 httpx 或 call_api_with_timing）
-    async def fetch(url: str, params: dict):
+    async def fetch(url: str, params: dict, select: Optional[JsonSelect] = None):
         if use_custom:
             start = time.perf_counter()
-            async with httpx.AsyncClient(timeout=30) as client:
+            async with httpx.AsyncClient(timeout=clamp_timeout(30)) as client:
                 resp = await client.get(url, params=params, headers=common_headers)
             return resp, time.perf_counter() - start
         else:
@@ -1827,9 +2779,18 @@ async def query_task_status(
                 method="GET",
                 params=params,
                 timeout=30,
-                use_intranet_token=True
+                use_intranet_token=True,
+                select=select
             )
 
+    # 小工具：请求本身失败（网络异常、HTTP错误）时返回错误描述，否则返回None
+    def fetch_error(resp_or_obj) -> Optional[str]:
+        if isinstance(resp_or_obj, httpx.Response):
+            return f"HTTP {resp_or_obj.status_code}" if resp_or_obj.status_code >= 400 else None
+        if isinstance(resp_or_obj, dict) and "error" in resp_or_obj:
+            return str(resp_or_obj.get("error"))
+        return None
+
     # 小工具：解析 DAG 接口返回，统一成 (status_str, raw)
     def parse_status(resp_or_obj):
         # httpx.Response 分支
@@ -1851,7 +2812,7 @@ async def query_task_status(
 
     # 小工具：查询目录并提取 entry
     async def check_catalog():
-        cat_resp, _ = await fetch(CATALOG_URL, {"dagId": dag_id})
+        cat_resp, _ = await fetch(CATALOG_URL, {"dagId": dag_id}, select=JsonSelect("data.item", where={"dagId": dag_id}, limit=1))
         # 如果是 httpx.Response，需要先 .json()
         if isinstance(cat_resp, httpx.Response):
             if cat_resp.status_code != 200:
@@ -1873,11 +2834,40 @@ async def query_task_status(
                 return item
         return None
 
+    state = get_state_backend()
+    status_key = f"{DAG_STATUS_KEY_PREFIX}{dag_id}"
+    poll_lock = None
+
     try:
         # if ctx:
         #     await ctx.session.send_log_message("info", f"开始执行 {operation}...")
         logger.info(f"{operation} 开始 - DAG ID: {dag_id}")
 
+        # 多worker共享轮询结果：终态或刚查询过的状态直接复用，同一DAG同一时间只由一个worker查询上游
+        cached = None if use_custom else state.get(status_key)
+        if cached is None and not use_custom:
+            poll_lock = state.acquire_lock(f"poll:{dag_id}", ttl=30)
+            if poll_lock is None:
+                for _ in range(20):
+                    await asyncio.sleep(0.5)
+                    cached = state.get(status_key)
+                    if cached is not None:
+                        break
+        if cached is not None:
+            logger.info(f"{operation} 使用共享缓存 - DAG ID: {dag_id}")
+            result = Result.succ(
+                data=cached,
+                msg=(
+                    f"{operation}成功，DAG 状态: {cached.get('status')}；"
+                    f"最终结果状态: {cached.get('final_state')}"
+                ),
+                operation=operation,
+                map_type="query_task_status",
+                execution_time=0.0,
+                api_endpoint="dag"
+            )
+            return result.model_dump_json()
+
         result_data = {
             "dag_id": dag_id,
             "status": "",
@@ -1890,12 +2880,22 @@ async def query_task_status(
 
         # 先用 DAG API 判断是否还在跑
         raw_resp, elapsed = await fetch(DAG_STATE_URL, {"dagId": dag_id})
-        status_str, raw = parse_status(raw_resp)
+        state_error = fetch_error(raw_resp)
+        if state_error:
+            # 查询失败不代表任务失败，状态记为未知，下次再查
+            status_str = "unknown"
+            result_data["error"] = state_error
+            logger.warning(f"{operation} getState 请求失败 - DAG ID: {dag_id}: {state_error}")
+        else:
+            status_str, raw = parse_status(raw_resp)
         result_data["status"]     = status_str
         result_data["is_running"] = status_str in ["starting","running"]
+        result_data["final_state"] = None
         # result_data["raw_dag_response"] = raw
 
-        # 只有当 DAG 不再 running 时，才去查目录确认最终结果
+        # 只有当 DAG 不再 running 时，才去查目录确认最终结果。成功必须由目录确认（结果文件已登记）；
+        # getState 报告失败时即使目录没有记录也算结束，不再轮询到超时。
+        # 目录还没有记录且 getState 未报告失败（或查询失败）时保持未结束，之后继续查询
         if not result_data["is_running"]:
             entry = await check_catalog()
             if entry:
@@ -1904,14 +2904,30 @@ async def query_task_status(
                 result_data["catalog_entry"] = entry
                 result_data["is_completed"]  = (final_state == "success")
                 result_data["is_failed"]     = (final_state in ["failed", "error", "dead", "killed"])
-            else:
-                result_data["final_state"] = "unknown"
+            elif not state_error and str(status_str).lower() in ("failed", "error", "dead", "killed"):
+                result_data["final_state"] = str(status_str).lower()
                 result_data["is_failed"]   = True
-        else:
-            # 还在跑，不判失败
-            result_data["final_state"] = None
-            result_data["is_completed"] = False
-            result_data["is_failed"]    = False
+
+        is_final = result_data["is_completed"] or result_data["is_failed"]
+        if is_final:
+            await dag_router.release(dag_id)
+
+        if not use_custom:
+            state.set(status_key, result_data, ttl=DAG_STATUS_FINAL_TTL if is_final else DAG_STATUS_FRESH_TTL)
+            task_info = None
+            # 任务表只记录确定的状态：终态，或DAG接口报告的运行中
+            if is_final or result_data["is_running"]:
+                task_info = get_task_store().update_state(
+                    dag_id,
+                    state=result_data["final_state"] or status_str,
+                    status=normalize_status(status_str, result_data["is_completed"], result_data["is_failed"])
+                )
+            # 目录首次报告成功时在后台预取结果文件，用户第一次查看时直接读本地缓存
+            if result_data["is_completed"] and task_info and task_info.get("filename"):
+                result_prefetcher.enqueue(
+                    result_key(f"{task_info['filename']}.{task_info.get('format') or 'tif'}", task_info.get("user_id") or DEFAULT_USER_ID),
+                    priority=task_info.get("submitted_at")
+                )
 
         # 4. 构建并返回 Result
         result = Result.succ(
@@ -1937,6 +2953,79 @@ async def query_task_status(
             operation=operation
         )
         return result.model_dump_json()
+    finally:
+        if poll_lock is not None:
+            state.release_lock(f"poll:{dag_id}", poll_lock)
+
+
+def use_warm_session(warm_session: Optional[bool], input_size: Optional[dict]) -> bool:
+    """是否在Livy预热会话上执行：显式指定时按指定，否则地块数已知且不超过 WARM_SESSION_MAX_PARCELS 时使用"""
+    if not livy_pool.available:
+        return False
+    if warm_session is not None:
+        return warm_session
+    parcels = (input_size or {}).get("parcels")
+    return parcels is not None and parcels <= WARM_SESSION_MAX_PARCELS
+
+
+def record_workflow_run(workflow_results: dict, analysis_type: str, input_size: Optional[dict] = None,
+                        **extra_phases) -> None:
+    """把一次工作流运行（各阶段耗时、输入规模、集群与结果）写入运行记录"""
+    try:
+        times = workflow_results.get("execution_times") or {}
+        task_info = workflow_results.get("task_info") or {}
+        get_run_history().record({
+            **times,
+            **{k: v for k, v in extra_phases.items() if v is not None},
+            **(input_size or {}),
+            "started_at": workflow_results.get("started_at"),
+            "analysis": analysis_type,
+            "cluster": workflow_results.get("cluster"),
+            "executor": task_info.get("executor") or "batch",
+            "outcome": workflow_results.get("final_status") or "unknown"
+        })
+    except Exception as e:
+        logger.warning(f"写入运行记录失败: {e}")
+
+
+async def run_on_warm_session(code: str, *, task_name: Optional[str], filename: Optional[str], crs: str,
+                              scale: str, format: str, user_id: str, username: str, timeout: float) -> Optional[dict]:
+    """
+    在预热会话上执行OGE代码并登记到任务表，输出参数与批处理提交一致。
+    返回任务信息；会话池不可用、执行失败或结果文件没有写入结果存储时返回None，由调用方回退到批处理。
+    预热会话的任务不在OGE平台上，返回的 job_id 只用于本服务的任务表，不能作为 recordId/processId 使用
+    """
+    # 与 submit_batch_task 相同的默认文件名，执行后按它确认结果已写入
+    filename = filename or task_name or f"file_{time.strftime('%Y_%m_%d_%H_%M_%S')}"
+    output = {"filename": filename, "format": format, "crs": crs, "scale": scale,
+              "userId": user_id, "username": username}
+    try:
+        run = await livy_pool.run(code, output, timeout=clamp_timeout(timeout))
+        key = result_key(f"{filename}.{format or 'tif'}", user_id)
+        if not await result_object_exists(key):
+            raise LivyError(f"语句执行完成但结果存储中没有 {key}")
+    except (LivyError, httpx.HTTPError) as e:
+        livy_pool.stats["fallbacks"] += 1
+        logger.warning(f"预热会话执行失败，回退到批处理: {e}")
+        return None
+
+    job_id = f"livy_{user_id}_{int(time.time() * 1000)}_{run['session_id']}"
+    store = get_task_store()
+    store.register(job_id, task_name=task_name, filename=filename, format=format, user_id=user_id,
+                   username=username, batch_session_id=str(run["session_id"]), state="running",
+                   detail={"executor": "livy"})
+    store.update_state(job_id, state="success", status="completed", detail={"elapsed": round(run["elapsed"], 3)})
+    result_prefetcher.enqueue(key, priority=time.time())
+    logger.info(f"预热会话 {run['session_id']} 执行完成: {job_id}，耗时{run['elapsed']:.2f}秒")
+    return {
+        "job_id": job_id,
+        "task_name": task_name,
+        "filename": filename,
+        "executor": "livy",
+        "session_id": run["session_id"],
+        "state": "success",
+        "elapsed": run["elapsed"]
+    }
 
 
 # @mcp.tool()
@@ -1953,12 +3042,17 @@ async def execute_dag_workflow(
     auth_token: str = None,
     auto_submit: bool = True,
     wait_for_completion: bool = False,
-    check_interval: int = 10,     # 默认15秒检查一次
-    max_wait_time: int = 300,    # 默认5分钟超时
+    check_interval: Optional[int] = None,   # 不指定时按历史耗时预估
+    max_wait_time: Optional[int] = None,
+    warm_session: Optional[bool] = None,
+    analysis_type: str = "dag_workflow",
+    input_size: Optional[dict] = None,
+    record_run: bool = True,
     ctx: Context = None
 ) -> str:
     """
     执行完整的DAG批处理工作流：代码转DAG -> 提交任务 -> (可选)等待完成
+    等待完成的小任务优先在Livy预热会话上执行，会话池不可用或执行失败时回退到批处理
     
     Parameters:
     - code: OGE代码
@@ -1973,11 +3067,17 @@ async def execute_dag_workflow(
     - auth_token: 认证Token（可选）
     - auto_submit: 是否自动提交任务
     - wait_for_completion: 是否等待任务完成
-    - check_interval: 状态检查间隔（秒）
-    - max_wait_time: 最大等待时间（秒）
+    - check_interval: 状态检查间隔（秒），不指定时按预估耗时决定
+    - max_wait_time: 最大等待时间（秒），不指定时按预估耗时决定
+    - warm_session: 是否使用Livy预热会话，None 时按 input_size 中的地块数自动决定
+    - analysis_type: 分析类型，写入运行记录
+    - input_size: 输入规模（可选）：{"villages": 村数, "parcels": 地块数, "all_area": 面积}，
+      同时用于决定提交时的executor数、内存与分区数
+    - record_run: 是否写入运行记录；调用方还有后续阶段（如结果登记）时设为False，由调用方记录
     """
     operation = "DAG批处理工作流"
     workflow_start_time = time.perf_counter()
+    workflow_results = {"final_status": "unknown", "execution_times": {}}
     
     try:
         # if ctx:
@@ -1990,13 +3090,60 @@ async def execute_dag_workflow(
             "final_status": "unknown",
             "dag_ids": [],
             "task_info": None,
+            "started_at": time.time(),
+            "cluster": None,
             "execution_times": {}
         }
+        execution_times = workflow_results["execution_times"]
+
+        # 按历史运行记录预估耗时，决定首次查询时间、查询间隔与超时，预计完成时间随提交结果返回
+        estimator = get_runtime_estimator()
+        if estimator.stale:
+            await run_blocking(estimator.maybe_train)
+        schedule = estimator.schedule(analysis_type, input_size, check_interval, max_wait_time)
+        if auto_submit:
+            workflow_results["estimate"] = schedule
         
+        if auto_submit and wait_for_completion and use_warm_session(warm_session, input_size):
+            warm_result = await run_on_warm_session(
+                code, task_name=task_name, filename=filename, crs=crs, scale=scale, format=format,
+                user_id=user_id, username=username, timeout=schedule["timeout"]
+            )
+            if warm_result is not None:
+                workflow_results["dag_ids"] = [warm_result["job_id"]]
+                workflow_results["task_info"] = warm_result
+                workflow_results["steps"].append({
+                    "step": 1,
+                    "name": "预热会话执行",
+                    "success": True,
+                    "result": warm_result
+                })
+                workflow_results["final_status"] = "completed"
+                workflow_results["cluster"] = "livy"
+                execution_times["run"] = warm_result["elapsed"]
+                total_execution_time = time.perf_counter() - workflow_start_time
+                workflow_results["execution_times"]["total"] = total_execution_time
+                result = Result.succ(
+                    data=workflow_results,
+                    msg=f"{operation}成功，状态: completed（预热会话）",
+                    map_type="execute_dag_workflow",
+                    operation=operation,
+                    execution_time=total_execution_time,
+                    api_endpoint="livy"
+                )
+                return result.model_dump_json()
+
+        # 所有DAG集群都饱和时先等待空闲，避免提交后在集群中长时间排队
+        if auto_submit:
+            waited = await capacity_monitor.wait_for_capacity(ep.base_url for ep in dag_router.endpoints)
+            if waited:
+                execution_times["capacity_wait"] = waited
+
         # 步骤1: 代码转DAG
         # if ctx:
         #     await ctx.session.send_log_message("info", "步骤1: 代码转换为DAG...")
         
+        phase_start = time.perf_counter()
         dag_result_json = await execute_code_to_dag(
             code=code,
             user_id=user_id,
@@ -2004,6 +3151,7 @@ async def execute_dag_workflow(
             auth_token=auth_token,
             ctx=ctx
         )
+        execution_times["execute_code"] = time.perf_counter() - phase_start
         
         dag_result = json.loads(dag_result_json)
         workflow_results["steps"].append({
@@ -2047,6 +3195,9 @@ async def execute_dag_workflow(
             # if ctx:
             #     await ctx.session.send_log_message("info", f"步骤2: 提交批处理任务 (DAG: {primary_dag_id})...")
             
+            resource_hints = spark_resource_hints(input_size)
+            workflow_results["resources"] = resource_hints
+            phase_start = time.perf_counter()
             submit_result_json = await submit_batch_task(
                 dag_id=primary_dag_id,
                 task_name=task_name,
@@ -2057,8 +3208,12 @@ async def execute_dag_workflow(
                 username=username,
                 script=code,
                 auth_token=auth_token,
+                resource_hints=resource_hints,
                 ctx=ctx
             )
+            submitted_at = time.perf_counter()
+            execution_times["add_task_record"] = submitted_at - phase_start
+            workflow_results["cluster"] = dag_router.owner(primary_dag_id)
             
             # script字段内容太多了，是执行的脚本，不需要暴露出来。
             submit_result = json.loads(submit_result_json)
@@ -2097,52 +3252,78 @@ async def execute_dag_workflow(
             # 获取任务信息
             task_data = submit_result.get("data", {})
             workflow_results["task_info"] = task_data
+
+            # 登记到本地任务表，其他worker查询状态、历史或结果时可以直接找到
+            get_task_store().register(
+                primary_dag_id,
+                task_name=task_data.get("task_name") or task_name,
+                filename=task_data.get("filename") or filename,
+                format=format,
+                user_id=user_id,
+                username=username,
+                batch_session_id=task_data.get("batch_session_id"),
+                state=task_data.get("state"),
+                detail={"estimated_time": round(schedule["expected_seconds"]), "eta": schedule["eta"]}
+                if schedule["expected_seconds"] else None
+            )
             
             if wait_for_completion:
                 # 步骤3: 等待任务完成
                 # if ctx:
                 #     await ctx.session.send_log_message("info", f"步骤3: 等待任务完成...")
-                # 等待6s，等任务真的提交后再去查询
-                await asyncio.sleep(10)
-                
                 waited_time = 0
                 final_status = "unknown"
-                try:
-                    while waited_time < max_wait_time:
-                        status_result_json = await query_task_status(
-                            dag_id=primary_dag_id,
-                            # auth_token=auth_token,
-                            ctx=None  # 避免过多日志
-                        )
+                running_since = None   # 首次查到running的时间，之前为排队
+                # 本协程作为该任务的等待者；被取消（客户端断开或超过截止时间）且无其他等待者时，宽限期后取消集群任务
+                with job_watchers.watching(primary_dag_id):
+                    # 按预估耗时等待后再第一次查询（也等任务真的提交）
+                    await asyncio.sleep(schedule["first_poll"])
+
+                    try:
+                        while waited_time < schedule["timeout"]:
+                            poll_start = time.perf_counter()
+                            status_result_json = await query_task_status(
+                                dag_id=primary_dag_id,
+                                # auth_token=auth_token,
+                                ctx=None  # 避免过多日志
+                            )
+                            poll_end = time.perf_counter()
                         
-                        status_result = json.loads(status_result_json)
+                            status_result = json.loads(status_result_json)
                         
-                        if status_result.get("success"):
-                            status_data = status_result.get("data", {})
-                            current_status = status_data.get("status", "unknown")
+                            if status_result.get("success"):
+                                status_data = status_result.get("data", {})
+                                current_status = status_data.get("status", "unknown")
+                                if running_since is None and current_status == "running":
+                                    running_since = poll_end
+                                    execution_times["queue"] = running_since - submitted_at
+                                if status_data.get("is_completed") or status_data.get("is_failed"):
+                                    # DAG结束后的那次查询包含结果目录确认
+                                    execution_times["run"] = poll_start - (running_since or submitted_at)
+                                    execution_times["catalog_confirm"] = poll_end - poll_start
                             
-                            if status_data.get("is_completed"):
-                                final_status = "completed"
-                                workflow_results["final_status"] = "completed"
-                                logger.info(f"任务已完成: {current_status}")
-                                break
-                            elif status_data.get("is_failed"):
-                                final_status = "failed"
-                                workflow_results["final_status"] = "failed"
-                                logger.info(f"任务失败: {current_status}")
-                                break
-                            # else:
-                            #     # 任务仍在运行
-                            #     if ctx:
-                            #         await ctx.session.send_log_message("info", f"任务状态: {current_status}, 已等待 {waited_time}s")
+                                if status_data.get("is_completed"):
+                                    final_status = "completed"
+                                    workflow_results["final_status"] = "completed"
+                                    logger.info(f"任务已完成: {current_status}")
+                                    break
+                                elif status_data.get("is_failed"):
+                                    final_status = "failed"
+                                    workflow_results["final_status"] = "failed"
+                                    logger.info(f"任务失败: {current_status}")
+                                    break
+                                # else:
+                                #     # 任务仍在运行
+                                #     if ctx:
+                                #         await ctx.session.send_log_message("info", f"任务状态: {current_status}, 已等待 {waited_time}s")
                         
-                        await asyncio.sleep(check_interval)
-                        waited_time += check_interval
-                except Exception as e:
-                    tb = traceback.format_exc()
-                    logger.error(f"query_task_status 报错：{tb}", exc_info=True)
-                    print(tb)
-                if waited_time >= max_wait_time:
+                            await asyncio.sleep(estimator.next_interval(schedule, time.perf_counter() - submitted_at))
+                            waited_time = round(time.perf_counter() - submitted_at, 1)
+                    except Exception as e:
+                        tb = traceback.format_exc()
+                        logger.error(f"query_task_status 报错：{tb}", exc_info=True)
+                        print(tb)
+                if waited_time >= schedule["timeout"]:
                     workflow_results["final_status"] = "timeout"
                     final_status = "timeout"
                 
@@ -2186,6 +3367,7 @@ async def execute_dag_workflow(
         
     except Exception as e:
         logger.error(f"{operation}执行失败: {str(e)}")
+        workflow_results["final_status"] = "error"
         result = Result.failed(
             msg=f"{operation}执行失败: {str(e)}",
             map_type="execute_dag_workflow",
@@ -2193,6 +3375,91 @@ async def execute_dag_workflow(
         )
         result.data = workflow_results
         return result.model_dump_json()
+    finally:
+        workflow_results["execution_times"].setdefault("total", time.perf_counter() - workflow_start_time)
+        if record_run:
+            record_workflow_run(workflow_results, analysis_type, input_size)
+
+
+@mcp.tool()
+async def run_history_stats(
+    window: str = "24h",
+    group_by: Optional[str] = None,
+    analysis: Optional[str] = None,
+    cluster: Optional[str] = None,
+    outcome: Optional[str] = None,
+    ctx: Context = None
+) -> str:
+    """
+    工作流运行记录统计（维护用）
+
+    按时间窗口统计各阶段耗时与输入规模的分位数（p50/p90/p95/p99），可按分析类型、集群、执行方式或结果分组，
+    用于容量规划。
+
+    Parameters:
+    - window: 时间窗口，如 1h、24h、7d、30d，或秒数
+    - group_by: 分组列：analysis / cluster / executor / outcome
+    - analysis / cluster / outcome: 只统计指定分析类型、集群或结果的运行
+    """
+    operation = "运行记录统计"
+    try:
+        where = {k: v for k, v in {"analysis": analysis, "cluster": cluster, "outcome": outcome}.items() if v}
+        data = await run_blocking(get_run_history().stats_for, window, group_by, where)
+        runs = sum(group["runs"] for group in data["groups"].values())
+        result = Result.succ(
+            data=data,
+            msg=f"{operation}成功，{window}内共{runs}次运行",
+            map_type="run_history_stats",
+            operation=operation
+        )
+        return result.model_dump_json()
+    except Exception as e:
+        logger.error(f"{operation}执行失败: {str(e)}")
+        result = Result.failed(
+            msg=f"{operation}执行失败: {str(e)}",
+            map_type="run_history_stats",
+            operation=operation
+        )
+        return result.model_dump_json()
+
+@mcp.tool()
+async def cluster_capacity(
+    window: str = "15m",
+    cluster: Optional[str] = None,
+    refresh: bool = False,
+    ctx: Context = None
+) -> str:
+    """
+    集群容量（维护用）
+
+    返回各DAG集群最近一次采样的空闲核数、空闲内存、排队应用数与是否饱和，以及时间窗口内的最小空闲资源。
+
+    Parameters:
+    - window: 时间窗口，如 5m、15m、1h
+    - cluster: 只返回指定DAG集群
+    - refresh: 是否先立即采样一次
+    """
+    operation = "集群容量查询"
+    try:
+        if refresh:
+            await capacity_monitor.sample_once()
+        data = capacity_monitor.snapshot(window, cluster)
+        saturated = [name for name, item in data["clusters"].items() if item["saturated"]]
+        result = Result.succ(
+            data=data,
+            msg=f"{operation}成功，{len(data['clusters'])}个集群中{len(saturated)}个饱和",
+            map_type="cluster_capacity",
+            operation=operation
+        )
+        return result.model_dump_json()
+    except Exception as e:
+        logger.error(f"{operation}执行失败: {str(e)}")
+        result = Result.failed(
+            msg=f"{operation}执行失败: {str(e)}",
+            map_type="cluster_capacity",
+            operation=operation
+        )
+        return result.model_dump_json()
 
 # ============ 其他方法 ============
 
@@ -2206,21 +3473,33 @@ def update_process_id(data: dict, new_process_id: str):
 
 # ============ HTTP服务器设置 ============
 
-def create_starlette_app(mcp_server: Server, *, debug: bool = False) -> Starlette:
-    """创建支持SSE的Starlette应用"""
+def create_starlette_app(mcp_server: Server, *, debug: bool = False, shared_sessions: bool = False) -> Starlette:
+    """
+    创建支持SSE的Starlette应用
+
+    shared_sessions 为真时（多worker模式），SSE会话登记在共享状态后端，其他worker收到的
+    /messages/ 请求经共享状态转交给持有会话的worker（见 oge_sse_relay）
+    """
     sse = SseServerTransport("/messages/")
+    sse_relay = SseSessionRelay(sse, get_state_backend()) if shared_sessions else None
 
     async def handle_sse(request: Request) -> None:
-        async with sse.connect_sse(
-            request.scope,
-            request.receive,
-            request._send,
-        ) as (read_stream, write_stream):
-            await mcp_server.run(
-                read_stream,
-                write_stream,
-                mcp_server.create_initialization_options(),
-            )
+        session = {}
+        send = sse_relay.track(request._send, session) if sse_relay else request._send
+        try:
+            async with sse.connect_sse(
+                request.scope,
+                request.receive,
+                send,
+            ) as (read_stream, write_stream):
+                await mcp_server.run(
+                    read_stream,
+                    write_stream,
+                    mcp_server.create_initialization_options(),
+                )
+        finally:
+            if sse_relay:
+                await sse_relay.forget(session)
 
     async def handle_health(request: Request):
         return JSONResponse({
@@ -2258,6 +3537,10 @@ def create_starlette_app(mcp_server: Server, *, debug: bool = False) -> Starlett
                 "intranet_api": INTRANET_API_BASE_URL,
                 "dag_api": DAG_API_BASE_URL
             },
+            "endpoint_pools": {
+                "gateway": gateway_pool.snapshot(),
+                "dag": dag_router.snapshot()
+            },
             "available_tools": [
                 "refresh_token",
                 "check_token_status",
@@ -2280,13 +3563,534 @@ def create_starlette_app(mcp_server: Server, *, debug: bool = False) -> Starlett
             }
         })
 
+    def admin_denied(request: Request) -> Optional[Response]:
+        """维护接口鉴权，通过时返回None"""
+        if not ADMIN_TOKEN:
+            return JSONResponse({"success": False, "message": "维护接口未开放（未配置 OGE_ADMIN_TOKEN）"}, status_code=403)
+        header = request.headers.get("authorization", "")
+        token = header[len("Bearer "):] if header.startswith("Bearer ") else ""
+        if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            return JSONResponse({"success": False, "message": "维护接口认证失败"}, status_code=401,
+                                headers={"WWW-Authenticate": "Bearer"})
+        return None
+
+    def result_access_denied(request: Request, key: str) -> Optional[Response]:
+        """结果文件下载鉴权：有效的签名链接或维护令牌，通过时返回None"""
+        expires, signature = request.query_params.get("expires"), request.query_params.get("signature")
+        if RESULT_LINK_SECRET and expires and signature:
+            try:
+                expires_at = int(expires)
+            except ValueError:
+                expires_at = 0
+            if expires_at >= time.time() and hmac.compare_digest(
+                    signature.encode("utf-8"), result_link_signature(key, expires_at).encode("utf-8")):
+                return None
+        return admin_denied(request)
+
+    async def run_constraint_rebuild(job: dict, lock_token: str):
+        """后台执行重建，状态写入共享状态，各worker都能查询"""
+        state = get_state_backend()
+        key = f"{REBUILD_JOB_KEY_PREFIX}{job['id']}"
+        try:
+            result = json.loads(await rebuild_constraint_layers(tables=job["tables"]))
+            job.update(status="completed" if result.get("success") else "failed",
+                       message=result.get("msg"), result=result.get("data"))
+        except Exception as e:
+            logger.error(f"重建物化约束图层失败: {e}")
+            job.update(status="failed", message=str(e))
+        finally:
+            job["finished_at"] = time.time()
+            state.set(key, job, ttl=REBUILD_JOB_TTL)
+            state.release_lock(REBUILD_JOB_KEY_PREFIX + "lock", lock_token)
+
+    async def handle_constraint_layers(request: Request):
+        """查看物化约束图层登记表；POST 在后台触发重建（需要维护令牌），返回202和任务状态地址"""
+        if request.method == "POST":
+            denied = admin_denied(request)
+            if denied is not None:
+                return denied
+            try:
+                body = await request.json() if await request.body() else {}
+            except ValueError:
+                return JSONResponse({"success": False, "message": "请求体不是JSON"}, status_code=400)
+            # tables 缺省时重建全部图层，给出时必须是已知图层名的非空列表
+            tables = body.get("tables") if isinstance(body, dict) else None
+            known = materializable_tables()
+            if not isinstance(body, dict) or (tables is not None and (
+                    not isinstance(tables, list) or not tables
+                    or not all(isinstance(t, str) and t in known for t in tables))):
+                return JSONResponse({"success": False, "message": f"tables 需要为图层名列表，可选: {known}"},
+                                    status_code=400)
+            state = get_state_backend()
+            lock_token = state.acquire_lock(REBUILD_JOB_KEY_PREFIX + "lock", ttl=REBUILD_LOCK_TTL)
+            if lock_token is None:
+                return JSONResponse({"success": False, "message": "已有重建任务在运行"}, status_code=409)
+            job_id = uuid.uuid4().hex[:12]
+            status_url = f"/constraint_layers/rebuilds/{job_id}"
+            job = {"id": job_id, "status": "running", "tables": tables, "started_at": time.time(),
+                   "status_url": status_url}
+            state.set(f"{REBUILD_JOB_KEY_PREFIX}{job_id}", job, ttl=REBUILD_JOB_TTL)
+            spawn_background(run_constraint_rebuild(job, lock_token))
+            return JSONResponse({"success": True, "data": job, "message": "重建任务已开始"},
+                                status_code=202, headers={"Location": status_url})
+        return JSONResponse({
+            "success": True,
+            "data": get_materialized_registry(),
+            "message": "物化约束图层登记表"
+        })
+
+    async def handle_constraint_rebuild_status(request: Request):
+        """重建任务状态"""
+        denied = admin_denied(request)
+        if denied is not None:
+            return denied
+        job = get_state_backend().get(f"{REBUILD_JOB_KEY_PREFIX}{request.path_params['job_id']}")
+        if job is None:
+            return JSONResponse({"success": False, "message": "重建任务不存在"}, status_code=404)
+        return JSONResponse({"success": True, "data": job}, headers={"Cache-Control": "no-store"})
+
+    def conditional_headers(etag: str) -> dict:
+        return {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    def cached_json_response(request: Request, payload, etag: str) -> Response:
+        """带ETag的JSON响应，按 Accept-Encoding 压缩（br/gzip）"""
+        body, content_encoding = encode_body(json_body(payload), negotiate_encoding(request.headers.get("accept-encoding")))
+        headers = conditional_headers(etag)
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        return Response(body, media_type="application/json", headers=headers)
+
+    async def ensure_layer_file(entry: dict) -> Optional[dict]:
+        """矢量图层的本地文件已被结果缓存淘汰时重新下载，并更新登记（版本随之变化）"""
+        if Path(entry["path"]).exists():
+            return entry
+        path = await download_result(entry["key"]) if entry.get("key") else None
+        if path is None:
+            return None
+        return await run_blocking(
+            register_vector_layer, entry["id"], entry["name"], path, entry["key"], entry["category"]
+        )
+
+    async def handle_layers(request: Request):
+        """图层列表：约束图层 + 已完成的分析结果，内容未变化时返回304"""
+        layers = await run_blocking(list_layers)
+        etag = make_etag(layers)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=conditional_headers(etag))
+        return cached_json_response(request, {
+            "success": True,
+            "data": layers,
+            "message": "图层数据获取成功"
+        }, etag)
+
+    async def handle_layer_data(request: Request):
+        """按范围取矢量图层要素：参数 bbox=minLon,minLat,maxLon,maxLat、limit"""
+        layer_id = request.path_params["layer_id"]
+        entry = await run_blocking(get_layer, layer_id)
+        if entry is None:
+            return JSONResponse({"success": False, "message": f"图层不存在: {layer_id}"}, status_code=404)
+        if not entry.get("has_data"):
+            return JSONResponse({
+                "success": False,
+                "message": f"图层 {layer_id} 没有可按范围读取的矢量数据",
+                "url": entry.get("url")
+            }, status_code=400)
+        try:
+            bbox = parse_bbox(request.query_params.get("bbox"))
+            limit = int(request.query_params.get("limit", DEFAULT_FEATURE_LIMIT))
+            if limit < 1:
+                raise ValueError("limit 需要为正整数")
+            limit = min(limit, MAX_FEATURE_LIMIT)
+        except ValueError as e:
+            return JSONResponse({"success": False, "message": f"参数错误: {e}"}, status_code=400)
+
+        entry = await ensure_layer_file(entry)
+        if entry is None:
+            return JSONResponse({"success": False, "message": f"图层数据已不可用: {layer_id}"}, status_code=404)
+
+        etag = make_etag(entry["id"], entry["version"], bbox, limit)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=conditional_headers(etag))
+        collection = await run_blocking(query_layer_features, entry, bbox, limit)
+        # 大的要素集合在线程池中编码和压缩
+        return await run_blocking(cached_json_response, request, {
+            "success": True,
+            "data": collection,
+            "message": f"返回{len(collection['features'])}个要素"
+        }, etag)
+
+    async def handle_geocode(request: Request):
+        """地名正向查询：address 为地名或包含地名的地址，支持拼音、简称和容错"""
+        address = request.query_params.get("address", "")
+        try:
+            limit = int(request.query_params.get("limit", GEOCODE_DEFAULT_LIMIT))
+        except ValueError:
+            return JSONResponse({"success": False, "message": "limit 需要为整数"}, status_code=400)
+        limit = max(1, min(limit, GEOCODE_MAX_LIMIT))
+        matches = get_gazetteer().geocode(address, limit=limit)
+        if not matches:
+            return JSONResponse({"success": False, "data": [], "message": f"未找到地名: {address}"}, status_code=404)
+        return JSONResponse({"success": True, "data": matches, "message": f"找到{len(matches)}个地名"})
+
+    async def handle_reverse_geocode(request: Request):
+        """地名反向查询：返回包含该点的村/镇"""
+        try:
+            lng = float(request.query_params["lng"])
+            lat = float(request.query_params["lat"])
+        except (KeyError, ValueError):
+            return JSONResponse({"success": False, "message": "需要数值参数 lng、lat"}, status_code=400)
+        matches = get_gazetteer().reverse(lng, lat)
+        if not matches:
+            return JSONResponse({"success": False, "data": [], "message": "该位置不在已知的村镇范围内"}, status_code=404)
+        return JSONResponse({"success": True, "data": matches, "message": matches[0]["name"]})
+
+    async def handle_geo_stats(request: Request):
+        """
+        按范围统计流出地块数与面积（按流出原因、按村）。
+        请求体 {bounds, layerId?, tiles?}：缺省统计最近一次的流出结果，tiles 为真时附带各网格的预统计结果
+        """
+        try:
+            body = await request.json() if await request.body() else {}
+        except ValueError:
+            return JSONResponse({"success": False, "message": "请求体不是JSON"}, status_code=400)
+        if not isinstance(body, dict):
+            return JSONResponse({"success": False, "message": "请求体需要为JSON对象"}, status_code=400)
+        try:
+            bounds = parse_bounds(body.get("bounds"))
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            return JSONResponse({"success": False, "message": f"范围参数错误: {e}"}, status_code=400)
+        layer_id = body.get("layerId")
+        entry = await run_blocking(get_layer, layer_id) if layer_id else await run_blocking(latest_vector_layer)
+        if entry is None or not entry.get("has_data"):
+            return JSONResponse({"success": False, "message": "没有可统计的流出结果图层"}, status_code=404)
+        entry = await ensure_layer_file(entry)
+        if entry is None:
+            return JSONResponse({"success": False, "message": "流出结果图层数据已不可用"}, status_code=404)
+
+        started = time.time()
+        engine = await run_blocking(get_geo_stats_engine, entry, read_layer_collection)
+        stats = await run_blocking(engine.query, bounds)
+        if body.get("tiles"):
+            stats["tile_summaries"] = await run_blocking(engine.tile_summaries, bounds)
+        stats.update({
+            "layerId": entry["id"],
+            "layerName": entry["name"],
+            "bounds": list(bounds) if bounds else None,
+            "query_ms": round((time.time() - started) * 1000, 1)
+        })
+        return JSONResponse({"success": True, "data": stats, "message": "统计完成"})
+
+    async def handle_result_file(request: Request):
+        """
+        结果文件读取，支持Range：本地已缓存且与对象存储一致时直接从缓存输出，否则把请求透传到对象存储边收边发。
+        需要维护令牌或签名链接（见 task_response_view 的 downloadUrl）
+        """
+        user_id = request.path_params["user_id"]
+        filename = request.path_params["filename"]
+        try:
+            key = result_key(filename, user_id)
+        except InvalidKeyError as e:
+            return JSONResponse({"success": False, "message": str(e)}, status_code=400)
+        denied = result_access_denied(request, key)
+        if denied:
+            return denied
+        range_header = request.headers.get("range")
+
+        path = await revalidate_result(key)
+        if path is not None:
+            size = path.stat().st_size
+            meta = cached_result_meta(key) or {}
+            headers = {"Accept-Ranges": "bytes", "X-Result-Cache": "hit"}
+            # ETag沿用对象存储的ETag：本地文件的访问时间随LRU刷新，不能用来生成ETag
+            if meta.get("etag"):
+                headers["ETag"] = meta["etag"]
+                if request.headers.get("if-none-match") == meta["etag"]:
+                    return Response(status_code=304, headers=headers)
+            if meta.get("last_modified"):
+                headers["Last-Modified"] = meta["last_modified"]
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            start, end = byte_range or (0, size - 1)
+            headers["Content-Length"] = str(end - start + 1)
+            if byte_range:
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return StreamingResponse(
+                iter_file(path, start, end),
+                status_code=206 if byte_range else 200,
+                headers=headers,
+                media_type=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            )
+
+        client, upstream = await open_result_upstream(key, range_header)
+
+        async def close_upstream():
+            await upstream.aclose()
+            await client.aclose()
+
+        if upstream.status_code not in (200, 206):
+            status_code = upstream.status_code
+            await close_upstream()
+            return JSONResponse({"success": False, "message": f"结果文件不可用: {key}"}, status_code=status_code)
+        passthrough = ("content-length", "content-range", "content-type", "etag", "last-modified", "accept-ranges")
+        headers = {name: upstream.headers[name] for name in passthrough if name in upstream.headers}
+        headers["X-Result-Cache"] = "miss"
+        return StreamingResponse(
+            upstream.aiter_raw(),
+            status_code=upstream.status_code,
+            headers=headers,
+            background=BackgroundTask(close_upstream)
+        )
+
+    async def handle_raster_info(request: Request):
+        """栅格结果（COG）的范围、金字塔与XYZ瓦片地址模板"""
+        if not oge_raster_tiles.available():
+            return JSONResponse({"success": False, "message": "栅格瓦片服务不可用，需要安装 numpy 和 rasterio"}, status_code=501)
+        user_id = request.path_params["user_id"]
+        filename = request.path_params["filename"]
+        try:
+            key = result_key(filename, user_id)
+        except InvalidKeyError as e:
+            return JSONResponse({"success": False, "message": str(e)}, status_code=400)
+        cog = await ensure_result_cog(key)
+        if cog is None:
+            return JSONResponse({"success": False, "message": f"结果文件不存在: {filename}"}, status_code=404)
+        info = await result_raster_info(cog)
+        return JSONResponse({"success": True, "data": {
+            **info,
+            "tiles": f"/raster/{user_id}/{filename}/tiles/{{z}}/{{x}}/{{y}}.png",
+            "palettes": list(oge_raster_tiles.PALETTES)
+        }})
+
+    async def handle_raster_tile(request: Request):
+        """XYZ PNG瓦片，参数 palette/vmin/vmax 控制着色，缺省使用栅格值域"""
+        if not oge_raster_tiles.available():
+            return JSONResponse({"success": False, "message": "栅格瓦片服务不可用，需要安装 numpy 和 rasterio"}, status_code=501)
+        user_id = request.path_params["user_id"]
+        filename = request.path_params["filename"]
+        z, x, y = (request.path_params[name] for name in ("z", "x", "y"))
+        palette_name = request.query_params.get("palette", "aspect")
+        palette = oge_raster_tiles.PALETTES.get(palette_name)
+        if palette is None:
+            return JSONResponse({"success": False, "message": f"未知的配色: {palette_name}"}, status_code=400)
+
+        try:
+            key = result_key(filename, user_id)
+        except InvalidKeyError as e:
+            return JSONResponse({"success": False, "message": str(e)}, status_code=400)
+        cog = await ensure_result_cog(key)
+        if cog is None:
+            return JSONResponse({"success": False, "message": f"结果文件不存在: {filename}"}, status_code=404)
+        info = await result_raster_info(cog)
+        try:
+            vmin = float(request.query_params.get("vmin", info["min"] if info["min"] is not None else 0))
+            vmax = float(request.query_params.get("vmax", info["max"] if info["max"] is not None else 1))
+        except ValueError:
+            return JSONResponse({"success": False, "message": "vmin、vmax 需要为数值"}, status_code=400)
+        if not (math.isfinite(vmin) and math.isfinite(vmax)) or vmin > vmax:
+            return JSONResponse({"success": False, "message": "vmin、vmax 需要为有限数值且 vmin 不大于 vmax"},
+                                status_code=400)
+
+        cache_key = (str(cog), cog.stat().st_mtime, z, x, y, palette_name, vmin, vmax)
+        png = raster_tile_cache.get(cache_key)
+        if png is None:
+            png = await run_blocking(oge_raster_tiles.render_tile, cog, z, x, y, vmin, vmax, palette)
+            png = png or oge_raster_tiles.empty_tile()
+            raster_tile_cache.put(cache_key, png)
+        return Response(png, media_type="image/png", headers={"Cache-Control": "public, max-age=86400"})
+
+    async def handle_wvts_tile(request: Request):
+        """约束图层瓦片代理，按上游的内容类型和压缩格式原样返回"""
+        table = request.path_params["table"]
+        z, x, y = (request.path_params[name] for name in ("z", "x", "y"))
+        try:
+            tile, source = await tile_proxy.get(table, z, x, y)
+        except KeyError:
+            return JSONResponse({"success": False, "message": f"未代理的图层: {table}"}, status_code=404)
+        except Exception as e:
+            logger.warning(f"瓦片上游请求失败 {table}/{z}/{x}/{y}: {e}")
+            return JSONResponse({"success": False, "message": "瓦片上游服务不可用"}, status_code=502)
+        headers = {"Cache-Control": "public, max-age=86400", "X-Tile-Cache": source}
+        if tile["content_encoding"]:
+            headers["Content-Encoding"] = tile["content_encoding"]
+        return Response(tile["body"], status_code=tile["status"], media_type=tile["content_type"], headers=headers)
+
+    async def handle_tile_proxy(request: Request):
+        """瓦片代理状态；POST 按 {tables, center, zooms} 预热（需要维护令牌）"""
+        if request.method == "POST":
+            denied = admin_denied(request)
+            if denied is not None:
+                return denied
+            try:
+                body = await request.json() if await request.body() else {}
+            except ValueError:
+                return JSONResponse({"success": False, "message": "请求体不是JSON"}, status_code=400)
+            if not isinstance(body, dict):
+                return JSONResponse({"success": False, "message": "请求体需要为JSON对象"}, status_code=400)
+            kwargs = {k: body[k] for k in ("tables", "center", "zooms") if body.get(k)}
+            summary = await tile_proxy.seed(**kwargs)
+            return JSONResponse({"success": True, "data": summary, "message": "瓦片预热完成"})
+        return JSONResponse({"success": True, "data": tile_proxy.snapshot()})
+
+    def task_response_view(request: Request, task: dict) -> dict:
+        view = task_view(task, get_task_store().events(task["dag_id"]))
+        if view["status"] == "completed" and task.get("filename"):
+            filename = f"{task['filename']}.{task.get('format') or 'tif'}"
+            base_url = str(request.base_url).rstrip("/")
+            user_id = task.get("user_id") or DEFAULT_USER_ID
+            query = signed_result_query(result_key(filename, user_id))
+            view["result"]["downloadUrl"] = f"{base_url}/results/{user_id}/{filename}" + (f"?{query}" if query else "")
+        return view
+
+    async def handle_task_status(request: Request):
+        """任务状态长轮询：wait 为最长挂起秒数，since_version 为客户端已见版本，状态变化或终态时立即返回"""
+        task_id = request.path_params["task_id"]
+        try:
+            wait = min(max(float(request.query_params.get("wait", 0)), 0.0), LONG_POLL_MAX_WAIT)
+            since_version = int(request.query_params.get("since_version", -1))
+        except ValueError as e:
+            return JSONResponse({"success": False, "message": f"参数错误: {e}"}, status_code=400)
+
+        store = get_task_store()
+        task = store.get(task_id)
+        if task is None:
+            return JSONResponse({"success": False, "message": f"任务不存在: {task_id}"}, status_code=404)
+
+        deadline = time.monotonic() + wait
+        # 前端在查看的任务不会被当作无人等待而取消（跨worker通过共享状态标记）
+        job_watchers.attach(task_id)
+        try:
+            while True:
+                if task["status"] not in FINAL_STATUSES:
+                    get_state_backend().set(f"{TASK_WATCH_KEY_PREFIX}{task_id}", time.time(),
+                                            ttl=ORPHAN_GRACE_SECONDS + DAG_STATUS_FRESH_TTL)
+                # 未结束的任务按共享状态缓存的节奏查询上游，多个等待者共用同一次查询
+                if task["status"] not in FINAL_STATUSES and time.time() - (task.get("checked_at") or 0) >= DAG_STATUS_FRESH_TTL:
+                    await query_task_status(dag_id=task_id)
+                    task = store.get(task_id)
+                remaining = deadline - time.monotonic()
+                if task["version"] > since_version or task["status"] in FINAL_STATUSES or remaining <= 0:
+                    break
+                task = await store.wait_for_change(task_id, since_version, min(remaining, DAG_STATUS_FRESH_TTL))
+        finally:
+            job_watchers.detach(task_id)
+
+        return JSONResponse({"success": True, "data": task_response_view(request, task)},
+                            headers={"Cache-Control": "no-store"})
+
+    async def handle_task_history(request: Request):
+        """任务历史：按 user_id、status、since/until（秒级时间戳）筛选，提交时间倒序"""
+        params = request.query_params
+        try:
+            since = float(params["since"]) if params.get("since") else None
+            until = float(params["until"]) if params.get("until") else None
+            limit = int(params.get("limit", TASK_HISTORY_LIMIT))
+            offset = int(params.get("offset", 0))
+        except ValueError as e:
+            return JSONResponse({"success": False, "message": f"参数错误: {e}"}, status_code=400)
+        store = get_task_store()
+        tasks = await run_blocking(
+            store.history, params.get("user_id"), params.get("status"), since, until, limit, offset
+        )
+        return JSONResponse({
+            "success": True,
+            "data": [task_view(task) for task in tasks],
+            "counts": await run_blocking(store.counts, params.get("user_id")),
+            "message": f"返回{len(tasks)}个任务"
+        }, headers={"Cache-Control": "no-store"})
+
+    async def handle_run_history_stats(request: Request):
+        """运行记录分位数：window（如 24h、7d）、group_by（analysis/cluster/executor/outcome），可按分类列筛选"""
+        params = request.query_params
+        group_by = params.get("group_by") or None
+        where = {name: params[name] for name in CATEGORY_COLUMNS if params.get(name)}
+        try:
+            data = await run_blocking(get_run_history().stats_for, params.get("window", "24h"), group_by, where)
+        except ValueError as e:
+            return JSONResponse({"success": False, "message": f"参数错误: {e}"}, status_code=400)
+        return JSONResponse({"success": True, "data": data}, headers={"Cache-Control": "no-store"})
+
+    async def handle_metrics(request: Request):
+        """运行指标：默认Prometheus文本格式，format=json 时返回详细快照（含事件循环阻塞时的调用栈）"""
+        executor, watchdog = get_executor(), get_watchdog()
+        if request.query_params.get("format") == "json":
+            return JSONResponse({"success": True, "data": {
+                "executor": executor.snapshot(),
+                "event_loop": watchdog.snapshot(),
+                "job_watchers": job_watchers.snapshot(),
+                "runtime_estimator": get_runtime_estimator().snapshot(),
+                "tile_proxy": tile_proxy.snapshot(),
+                "livy_pool": livy_pool.snapshot(),
+                "report_queue": report_queue.snapshot(),
+                "cluster_capacity": capacity_monitor.snapshot(),
+                "run_history": get_run_history().snapshot(),
+                "sse_relay": sse_relay.snapshot() if sse_relay else None
+            }})
+        metrics = MetricsText()
+        executor.write_metrics(metrics)
+        watchdog.write_metrics(metrics)
+        livy_pool.write_metrics(metrics)
+        report_queue.write_metrics(metrics)
+        capacity_monitor.write_metrics(metrics)
+        metrics.add("oge_job_waiters", sum(job_watchers.snapshot()["waiting"].values()), help="等待中的集群任务等待者数")
+        return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    async def handle_result_cache(request: Request):
+        """本地结果缓存占用情况"""
+        files, total_bytes = result_cache_usage()
+        return JSONResponse({"success": True, "data": {
+            "files": files,
+            "bytes": total_bytes,
+            "prefetch": result_prefetcher.snapshot(),
+            "raster_tiles": raster_tile_cache.snapshot()
+        }})
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        # 事件循环看门狗随应用启动，Livy会话池在后台预热，结果登记队列继续发送上次未完成的登记，
+        # 集群容量监控开始采样，运行记录定时写出；退出时写出剩余运行记录，关闭会话、进程池和线程池
+        watchdog = get_watchdog()
+        watchdog.start()
+        livy_pool.start()
+        report_queue.start()
+        capacity_monitor.start()
+        get_run_history().start()
+        try:
+            yield
+        finally:
+            watchdog.stop()
+            get_run_history().stop()
+            await capacity_monitor.close()
+            await report_queue.stop()
+            await livy_pool.close()
+            get_executor().shutdown()
+
     return Starlette(
         debug=debug,
+        lifespan=lifespan,
         routes=[
             Route("/sse", endpoint=handle_sse),
             Route("/health", endpoint=handle_health),
             Route("/info", endpoint=handle_info),
-            Mount("/messages/", app=sse.handle_post_message),
+            Route("/constraint_layers", endpoint=handle_constraint_layers, methods=["GET", "POST"]),
+            Route("/constraint_layers/rebuilds/{job_id}", endpoint=handle_constraint_rebuild_status, methods=["GET"]),
+            Route("/layers", endpoint=handle_layers, methods=["GET"]),
+            Route("/layers/{layer_id}/data", endpoint=handle_layer_data, methods=["GET"]),
+            Route("/geo-stats", endpoint=handle_geo_stats, methods=["POST"]),
+            Route("/geocode", endpoint=handle_geocode, methods=["GET"]),
+            Route("/reverse-geocode", endpoint=handle_reverse_geocode, methods=["GET"]),
+            Route("/results/{user_id}/{filename:path}", endpoint=handle_result_file),
+            Route("/raster/{user_id}/{filename}/info", endpoint=handle_raster_info),
+            Route("/raster/{user_id}/{filename}/tiles/{z:int}/{x:int}/{y:int}.png", endpoint=handle_raster_tile),
+            Route("/result_cache", endpoint=handle_result_cache),
+            Route("/metrics", endpoint=handle_metrics, methods=["GET"]),
+            Route("/task_status/{task_id}", endpoint=handle_task_status, methods=["GET"]),
+            Route("/task_history", endpoint=handle_task_history, methods=["GET"]),
+            Route("/run_history/stats", endpoint=handle_run_history_stats, methods=["GET"]),
+            Route("/tiles/wvts/{table}/{z:int}/{x:int}/{y:int}", endpoint=handle_wvts_tile),
+            Route("/tile_proxy", endpoint=handle_tile_proxy, methods=["GET", "POST"]),
+            Mount("/messages/", app=sse_relay.handle_post_message if sse_relay else sse.handle_post_message),
         ],
     )
 
@@ -2300,6 +4104,9 @@ async def run_stdio_server():
         from mcp import stdio_server
         
         async with stdio_server() as streams:
+            report_queue.start()
+            capacity_monitor.start()
+            get_run_history().start()
             await mcp._mcp_server.run(
                 streams[0], streams[1], 
                 mcp._mcp_server.create_initialization_options()
@@ -2309,14 +4116,46 @@ async def run_stdio_server():
     except Exception as e:
         logger.error(f"服务器运行出错: {e}")
     finally:
+        get_run_history().stop()
+        await capacity_monitor.close()
+        await report_queue.stop()
         logger.info("MCP服务器已关闭")
 
-def run_http_server(host: str = "0.0.0.0", port: int = 8000):
-    """运行HTTP模式的服务器"""
-    logger.info(f"启动山东耕地流出分析MCP服务器 (HTTP模式) - {host}:{port}")
+def create_http_app() -> Starlette:
+    """生产模式的应用工厂，供uvicorn多worker进程各自创建应用"""
+    return create_starlette_app(mcp._mcp_server, debug=False, shared_sessions=True)
+
+def run_http_server(host: str = "0.0.0.0", port: int = 8000, workers: int = 1):
+    """
+    运行HTTP模式的服务器
+
+    workers > 1 时进入生产模式：由uvicorn启动多个worker进程，token、地区目录和结果缓存
+    通过共享状态后端（oge_shared_state）在进程间同步，任务登记写入本机任务表（oge_task_store）。向主进程发送SIGHUP可以
+    逐个平滑重启worker，SIGTERM时等待进行中的请求完成后再退出。
+
+    MCP的SSE会话仍只存在于建立连接的worker中：其他worker收到的 /messages/ 请求经共享状态转交（oge_sse_relay），
+    因此多台机器部署时共享状态后端须使用Redis；worker重启时其上的SSE连接会断开，客户端需要重新连接。
+    """
+    logger.info(f"启动山东耕地流出分析MCP服务器 (HTTP模式) - {host}:{port}, workers: {workers}")
+    logger.info(f"共享状态后端: {get_state_backend().describe()}")
+
+    if workers > 1:
+        module_name = Path(__file__).stem
+        if module_name.isidentifier():
+            sys.path.insert(0, str(Path(__file__).resolve().parent))
+            uvicorn.run(
+                f"{module_name}:create_http_app",
+                factory=True,
+                host=host,
+                port=port,
+                workers=workers,
+                timeout_graceful_shutdown=30
+            )
+            return
+        logger.warning(f"文件名 {Path(__file__).name} 不是合法的模块名，无法启动多worker，回退为单进程模式")
     
     mcp_server = mcp._mcp_server
-    starlette_app = create_starlette_app(mcp_server, debug=True)
+    starlette_app = create_starlette_app(mcp_server, debug=workers <= 1)
     
     uvicorn.run(starlette_app, host=host, port=port)
 
@@ -2341,7 +4180,7 @@ async def test_dag_status_api(
         logger.info(f"开始执行{operation} - DAG ID: {dag_id}")
         
         # 构建API URL
-        api_url = f"{DAG_API_BASE_URL}/getState"
+        api_url = dag_router.url_for(dag_id, "/getState")
         params = {"dagId": dag_id}
         
         logger.info(f"测试API调用: {api_url}?dagId={dag_id}")
@@ -2354,7 +4193,7 @@ async def test_dag_status_api(
                 params=params,
                 headers={
                     "Content-Type": "application/json",
-                    "Authorization": INTRANET_AUTH_TOKEN
+                    "Authorization": get_intranet_token()
                 }
             )
             
@@ -2415,14 +4254,18 @@ if __name__ == "__main__":
     parser.add_argument('--mode', choices=['stdio', 'http'], default='stdio', help='运行模式')
     parser.add_argument('--host', default='0.0.0.0', help='HTTP模式的绑定地址')
     parser.add_argument('--port', type=int, default=8000, help='HTTP模式的监听端口')
+    parser.add_argument('--workers', type=int, default=1, help='HTTP模式的worker进程数，大于1时进入生产模式')
+    parser.add_argument('--state-backend', default=None, help='共享状态后端，如 sqlite:///state/oge.db 或 redis://127.0.0.1:6379/0')
     
     args = parser.parse_args()
+    if args.state_backend:
+        configure_state_backend(args.state_backend)
     
     try:
         if args.mode == 'stdio':
             asyncio.run(run_stdio_server())
         else:
-            run_http_server(args.host, args.port)
+            run_http_server(args.host, args.port, args.workers)
     except KeyboardInterrupt:
         print("\n服务器已停止")
     except Exception as e:
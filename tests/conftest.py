@@ -0,0 +1,108 @@
+"""
+测试公共设置：状态文件写入临时目录；提供本地HTTP替身服务（Livy、S3等）
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = ROOT / "fixtures"
+sys.path.insert(0, str(ROOT))
+
+# 各模块在导入时读取这些路径，必须在导入前设置
+_STATE_DIR = Path(tempfile.mkdtemp(prefix="oge-tests-"))
+os.environ.setdefault("OGE_STATE_BACKEND", f"sqlite:///{_STATE_DIR / 'shared_state.db'}")
+os.environ.setdefault("OGE_TASK_STORE", str(_STATE_DIR / "tasks.db"))
+os.environ.setdefault("OGE_REPORT_QUEUE", str(_STATE_DIR / "reports.db"))
+os.environ.setdefault("OGE_RUN_HISTORY_DIR", str(_STATE_DIR / "run_history"))
+os.environ.setdefault("OGE_RESULT_CACHE_DIR", str(_STATE_DIR / "result_cache"))
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    """替身服务的请求处理基类"""
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj, code: int = 200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+
+@pytest.fixture
+def stand_in():
+    """启动本地替身服务：stand_in(handler类) -> base_url，测试结束后关闭"""
+    servers = []
+
+    def start(handler) -> str:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def s3_handler(objects: dict):
+    """S3兼容对象存储替身：objects 为 {"bucket/key": bytes}，支持 HEAD（含If-None-Match）、GET 与 Range；ETag为内容的MD5"""
+
+    class S3Handler(JsonHandler):
+        def _object(self):
+            return objects.get(unquote(self.path.lstrip("/").split("?")[0]))
+
+        def do_HEAD(self):
+            body = self._object()
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+
+        def do_GET(self):
+            body = self._object()
+            if body is None:
+                return self.send_json({"error": "NoSuchKey"}, 404)
+            start, end = 0, len(body) - 1
+            range_header = self.headers.get("Range")
+            if range_header:
+                first, _, last = range_header.split("=", 1)[1].partition("-")
+                start, end = int(first), min(int(last) if last else end, end)
+            chunk = body[start:end + 1]
+            self.send_response(206 if range_header else 200)
+            if range_header:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            self.send_header("Content-Length", str(len(chunk)))
+            self.send_header("ETag", f'"{hashlib.md5(body).hexdigest()}"')
+            self.end_headers()
+            self.wfile.write(chunk)
+
+    return S3Handler
@@ -0,0 +1,123 @@
+"""
+集群容量监控：用 fixtures/cluster_capacity 的采样回放验证饱和判定、提交排序与饱和时的提交等待
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from conftest import FIXTURES
+from oge_cluster_capacity import CapacityMonitor, is_saturated, parse_spark_master, parse_yarn_metrics
+from oge_endpoints import DagClusterRouter
+
+CAPACITY_FIXTURES = FIXTURES / "cluster_capacity"
+BUSY, IDLE = "http://dag-busy.test", "http://dag-idle.test"
+
+
+def _load(name):
+    return json.loads((CAPACITY_FIXTURES / name).read_text(encoding="utf-8"))
+
+
+def _free_spark_master():
+    doc = _load("spark_master.json")
+    for worker in doc["workers"]:
+        worker["coresused"], worker["memoryused"] = 4, 8192
+    doc["activeapps"] = [app for app in doc["activeapps"] if app["state"] == "RUNNING"]
+    return doc
+
+
+def test_parse_fixtures():
+    spark = parse_spark_master(_load("spark_master.json"))
+    # DEAD 的worker不计入容量
+    assert spark["nodes"] == 2 and spark["total_cores"] == 32
+    assert spark["free_cores"] == 0 and spark["queued_apps"] == 1 and spark["running_apps"] == 2
+    assert is_saturated(spark)
+
+    yarn = parse_yarn_metrics(_load("yarn_metrics.json"))
+    assert yarn["free_cores"] == 12 and yarn["free_memory_mb"] == 20480 and yarn["queued_apps"] == 1
+    assert not is_saturated(yarn)
+
+
+def test_saturation_needs_consecutive_samples_and_reorders_submission():
+    monitor = CapacityMonitor({BUSY: {"spark": "http://spark.test"}}, fixture_dir=str(CAPACITY_FIXTURES))
+    router = DagClusterRouter("dag-capacity", [BUSY, IDLE])
+    router.capacity = monitor
+
+    asyncio.run(monitor.sample_once())
+    assert monitor.latest(BUSY)["saturated"]
+    assert not monitor.saturated(BUSY)          # 单次采样不足以判定饱和
+    assert [ep.base_url for ep in router.submission_order()] == [BUSY, IDLE]
+
+    asyncio.run(monitor.sample_once())
+    assert monitor.saturated(BUSY)
+    assert not monitor.saturated(IDLE)          # 没有监控数据的集群不算饱和
+    assert [ep.base_url for ep in router.submission_order()] == [IDLE, BUSY]
+
+
+@pytest.fixture
+def replay_dir(tmp_path):
+    """采样回放：前三次饱和，之后空闲"""
+    saturated = _load("spark_master.json")
+    (tmp_path / "spark_master.json").write_text(
+        json.dumps([saturated, saturated, saturated, _free_spark_master()]), encoding="utf-8")
+    return tmp_path
+
+
+def test_wait_for_capacity_delays_until_a_cluster_frees_up(replay_dir):
+    monitor = CapacityMonitor({BUSY: {"spark": "http://spark.test"}}, interval=0.05, fixture_dir=str(replay_dir))
+
+    async def scenario():
+        await monitor.sample_once()
+        await monitor.sample_once()
+        assert monitor.all_saturated([BUSY])
+        monitor.start()
+        waited = await monitor.wait_for_capacity([BUSY], max_delay=5)
+        await monitor.close()
+        return waited
+
+    waited = asyncio.run(scenario())
+    assert 0 < waited < 5
+    assert not monitor.saturated(BUSY)
+    assert monitor.stats["delayed_submissions"] == 1
+
+
+def test_wait_for_capacity_is_bounded_by_max_delay():
+    monitor = CapacityMonitor({BUSY: {"spark": "http://spark.test"}}, interval=0.05,
+                              fixture_dir=str(CAPACITY_FIXTURES))
+
+    async def scenario():
+        await monitor.sample_once()
+        await monitor.sample_once()
+        monitor.start()
+        waited = await monitor.wait_for_capacity([BUSY], max_delay=0.3)
+        await monitor.close()
+        return waited
+
+    waited = asyncio.run(scenario())
+    assert 0.3 <= waited < 1.0
+    assert monitor.saturated(BUSY)
+
+
+def test_unsaturated_clusters_do_not_wait():
+    monitor = CapacityMonitor({BUSY: {"yarn": "http://yarn.test"}}, fixture_dir=str(CAPACITY_FIXTURES))
+    asyncio.run(monitor.sample_once())
+    asyncio.run(monitor.sample_once())
+    assert asyncio.run(monitor.wait_for_capacity([BUSY], max_delay=5)) == 0.0
+
+
+def test_capacity_tool_is_registered(monkeypatch):
+    import shandong_mcp_server_enhanced as srv
+
+    monitor = CapacityMonitor({BUSY: {"spark": "http://spark.test"}}, fixture_dir=str(CAPACITY_FIXTURES))
+    monkeypatch.setattr(srv, "capacity_monitor", monitor)
+
+    async def scenario():
+        names = {tool.name for tool in await srv.mcp.list_tools()}
+        assert "cluster_capacity" in names
+        return await srv.mcp.call_tool("cluster_capacity", {"refresh": True})
+
+    content = asyncio.run(scenario())
+    content = content[0] if isinstance(content, tuple) else content
+    data = json.loads(content[0].text)
+    assert data["success"] and data["data"]["clusters"][BUSY]["window"]["min_free_cores"] == 0
@@ -0,0 +1,49 @@
+"""
+入口故障转移判断（非幂等请求只在请求未发出时切换入口）与DAG集群活跃计数
+"""
+
+import asyncio
+
+import httpx
+
+from oge_endpoints import DagClusterRouter, is_endpoint_failure, transport_error_kind
+
+
+def test_transport_error_kind():
+    request = httpx.Request("POST", "http://gateway/executeCode")
+    assert transport_error_kind(httpx.ConnectError("refused", request=request)) == "connect"
+    assert transport_error_kind(httpx.ConnectTimeout("timeout", request=request)) == "connect"
+    assert transport_error_kind(httpx.ReadTimeout("timeout", request=request)) == "timeout"
+    assert transport_error_kind(httpx.RemoteProtocolError("closed", request=request)) == "io"
+    assert transport_error_kind(ValueError("bad json")) is None
+
+
+def test_non_idempotent_requests_only_fail_over_before_sending():
+    assert is_endpoint_failure({"error": "refused", "transport_error": "connect"}, idempotent=False)
+    assert not is_endpoint_failure({"error": "timeout", "transport_error": "timeout"}, idempotent=False)
+    assert not is_endpoint_failure({"error": "closed", "transport_error": "io"}, idempotent=False)
+    assert not is_endpoint_failure({"error": "bad gateway", "status_code": 502}, idempotent=False)
+
+
+def test_idempotent_requests_fail_over_on_server_errors_but_not_read_timeouts():
+    assert is_endpoint_failure({"error": "closed", "transport_error": "io"})
+    assert is_endpoint_failure({"error": "bad gateway", "status_code": 502})
+    assert not is_endpoint_failure({"error": "timeout", "transport_error": "timeout"})
+    assert not is_endpoint_failure({"error": "not found", "status_code": 404})
+    # 没有状态码也没有网络异常分类的错误（如解析异常）不是入口故障
+    assert not is_endpoint_failure({"error": "unexpected"})
+    assert not is_endpoint_failure({"error": "token", "code": 40003, "transport_error": "connect"})
+
+
+def test_concurrent_assignments_update_active_count():
+    router = DagClusterRouter("dag-test", ["http://dag-a.test", "http://dag-b.test"])
+    cluster = router.endpoints[0]
+
+    async def run():
+        await asyncio.gather(*(router.assign(f"dag-{i}", cluster) for i in range(20)))
+        assert router.active_count(cluster) == 20
+        await asyncio.gather(*(router.release(f"dag-{i}") for i in range(5)))
+        assert router.active_count(cluster) == 15
+        assert router.url_for("dag-7", "/getState") == "http://dag-a.test/getState"
+
+    asyncio.run(run())
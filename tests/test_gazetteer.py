@@ -0,0 +1,45 @@
+"""
+地名解析：精确与包含匹配直接替换，前缀与容错匹配有同级同分候选时不猜测、返回候选
+"""
+
+import pytest
+
+import oge_gazetteer
+
+
+@pytest.fixture
+def gazetteer(tmp_path, monkeypatch):
+    monkeypatch.setattr(oge_gazetteer, "BOUNDARY_FILE", tmp_path / "boundaries.geojson")
+    return oge_gazetteer.build_gazetteer()
+
+
+def test_unique_matches_resolve(gazetteer):
+    assert gazetteer.resolve("房干村") == "房干村"
+    assert gazetteer.resolve("房干") == "房干村"
+    assert gazetteer.resolve("雪野镇房干村") == "房干村"
+
+
+def test_ambiguous_prefix_returns_candidates(gazetteer):
+    # “西峪河”同时是西峪河北村、西峪河南村的前缀
+    name, candidates = gazetteer.resolve_candidates("西峪河")
+    assert name is None and sorted(candidates) == ["西峪河北村", "西峪河南村"]
+    assert gazetteer.resolve("西峪河") is None
+
+
+def test_ambiguous_fuzzy_match_is_not_guessed(gazetteer):
+    name, candidates = gazetteer.resolve_candidates("西峪村")
+    assert name is None and {"北峪村", "南峪村"} <= set(candidates)
+
+
+@pytest.mark.parametrize("module", ["shandong_mcp_server", "shandong_mcp_server_enhanced"])
+def test_geocode_route_validates_limit(module, gazetteer, monkeypatch):
+    import importlib
+    from starlette.testclient import TestClient
+
+    srv = importlib.import_module(module)
+    monkeypatch.setattr(srv, "get_gazetteer", lambda: gazetteer)
+    client = TestClient(srv.create_starlette_app(srv.mcp._mcp_server))
+
+    assert client.get("/geocode", params={"address": "峪村", "limit": "abc"}).status_code == 400
+    assert len(client.get("/geocode", params={"address": "峪村", "limit": "-3"}).json()["data"]) == 1
+    assert len(client.get("/geocode", params={"address": "峪村", "limit": "1000"}).json()["data"]) <= 20
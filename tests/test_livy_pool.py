@@ -0,0 +1,129 @@
+"""
+Livy预热会话池：用本地Livy替身验证会话复用、回收与回退，以及服务端在结果未写入时回退到批处理
+"""
+
+import asyncio
+import itertools
+
+import pytest
+
+import oge_livy_pool
+import oge_result_store
+from conftest import JsonHandler, s3_handler
+
+PRELOAD = "import oge\noge.initialize()\nservice = oge.Service.initialize()\noge_route_export(oge_batch_output)"
+
+
+def livy_handler(sessions: dict, executed: list = None):
+    """Livy REST替身：会话第二次查询时就绪，语句第一次查询时完成；代码中含 boom 的语句报错。
+    executed 按顺序记录执行过的 (会话ID, 代码)"""
+    ids = itertools.count()
+
+    class LivyHandler(JsonHandler):
+        def do_POST(self):
+            parts = self.path.strip("/").split("/")
+            body = self.read_json()
+            if parts == ["sessions"]:
+                sid = next(ids)
+                sessions[sid] = {"state": "starting", "polls": 0, "statements": []}
+                return self.send_json({"id": sid, "state": "starting"}, 201)
+            session = sessions[int(parts[1])]
+            if parts[-1] == "cancel":
+                return self.send_json({"msg": "canceled"})
+            code = body["code"]
+            if "boom" in code:
+                output = {"status": "error", "ename": "NameError", "evalue": "boom"}
+            elif "ru_maxrss" in code:
+                output = {"status": "ok", "data": {"text/plain": "1048576"}}
+            else:
+                output = {"status": "ok", "data": {"text/plain": "done"}}
+            session["statements"].append({"code": code, "output": output})
+            if executed is not None:
+                executed.append((int(parts[1]), code))
+            self.send_json({"id": len(session["statements"]) - 1, "state": "waiting"}, 201)
+
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            session = sessions.get(int(parts[1]))
+            if session is None:
+                return self.send_json({"msg": "not found"}, 404)
+            if len(parts) == 2:
+                session["polls"] += 1
+                if session["state"] == "starting" and session["polls"] >= 2:
+                    session["state"] = "idle"
+                return self.send_json({"state": session["state"]})
+            statement_id = int(parts[3])
+            return self.send_json({"id": statement_id, "state": "available",
+                                   "output": session["statements"][statement_id]["output"]})
+
+        def do_DELETE(self):
+            sessions.pop(int(self.path.strip("/").split("/")[1]), None)
+            self.send_json({"msg": "deleted"})
+
+    return LivyHandler
+
+
+async def _settle(pool):
+    # 归还与回收在后台进行
+    while pool._background:
+        await asyncio.sleep(0.01)
+
+
+def test_default_preload_disables_pool():
+    pool = oge_livy_pool.LivyPool("http://127.0.0.1:1", enabled=True,
+                                  preload="import oge\noge.initialize()")
+    assert not pool.enabled and not pool.available
+
+
+def test_sessions_are_reused_and_recycled(stand_in):
+    sessions, executed = {}, []
+    url = stand_in(livy_handler(sessions, executed))
+
+    async def scenario():
+        pool = oge_livy_pool.LivyPool(url, size=1, enabled=True, preload=PRELOAD, max_statements=2)
+        first = await pool.run("import oge\noge.initialize()\nresult.export('a')", {"filename": "f1"})
+        await _settle(pool)
+        second = await pool.run("result.export('b')", {"filename": "f2"})
+        await _settle(pool)
+        assert first["session_id"] == second["session_id"]
+        code = [code for _, code in executed if "export('a')" in code][0]
+        assert code.startswith("oge_batch_output = {'filename': 'f1'}")
+        assert "oge.initialize" not in code
+        # 达到 max_statements 后回收重建
+        assert first["session_id"] not in sessions
+        assert pool.stats["recycled"] == 1
+
+        with pytest.raises(oge_livy_pool.LivyError):
+            await pool.run("boom", {})
+        await _settle(pool)
+        assert pool.stats["statement_errors"] == 1
+        await pool.close()
+        assert not sessions
+
+    asyncio.run(scenario())
+
+
+def test_warm_run_requires_result_in_store(stand_in, monkeypatch):
+    import shandong_mcp_server_enhanced as srv
+
+    sessions, objects = {}, {}
+    pool = oge_livy_pool.LivyPool(stand_in(livy_handler(sessions)), size=1, enabled=True, preload=PRELOAD)
+    monkeypatch.setattr(srv, "livy_pool", pool)
+    monkeypatch.setattr(oge_result_store, "RESULT_STORE_URL", stand_in(s3_handler(objects)))
+    kwargs = dict(task_name="t", filename="warm_result", crs="EPSG:4326", scale="1000", format="geojson",
+                  user_id="u1", username="tester", timeout=60)
+
+    async def scenario():
+        # 语句成功但结果存储中没有结果文件：回退到批处理
+        assert await srv.run_on_warm_session("result.export('a')", **kwargs) is None
+        assert pool.stats["fallbacks"] == 1
+        await _settle(pool)
+
+        objects["oge-user/u1/result/warm_result.geojson"] = b'{"type": "FeatureCollection", "features": []}'
+        run = await srv.run_on_warm_session("result.export('a')", **kwargs)
+        assert run["executor"] == "livy" and run["state"] == "success"
+        assert srv.get_task_store().get(run["job_id"])["status"] == "completed"
+        await _settle(pool)
+        await pool.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,54 @@
+"""
+物化约束图层：默认启用（只使用已登记的版本），重建接口只接受已知图层名
+"""
+
+import pytest
+from starlette.testclient import TestClient
+
+import oge_materialized_layers
+
+
+def test_registered_assets_are_used_by_default(monkeypatch):
+    assert oge_materialized_layers.MATERIALIZED_LAYERS_ENABLED
+    monkeypatch.setattr(oge_materialized_layers, "get_registry", lambda: {
+        "podu": {"asset": "mv_shp_podu_pdjb_gt4_4527_v2", "version": 2},
+        "urban": {"version": 1},      # 未成功生成的版本没有 asset
+    })
+    assert oge_materialized_layers.current_assets() == {"podu": "mv_shp_podu_pdjb_gt4_4527_v2"}
+    monkeypatch.setattr(oge_materialized_layers, "MATERIALIZED_LAYERS_ENABLED", False)
+    assert oge_materialized_layers.current_assets() == {}
+
+
+@pytest.fixture
+def admin_client(monkeypatch):
+    import shandong_mcp_server_enhanced as srv
+
+    started = []
+
+    async def fake_rebuild(tables=None, slope_threshold=4, ctx=None):
+        started.append(tables)
+        return '{"success": true, "msg": "ok", "data": {}}'
+
+    monkeypatch.setattr(srv, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(srv, "rebuild_constraint_layers", fake_rebuild)
+    client = TestClient(srv.create_starlette_app(srv.mcp._mcp_server))
+    client.headers["Authorization"] = "Bearer admin-secret"
+    return client, started
+
+
+@pytest.mark.parametrize("body", [
+    {"tables": "shp_podu"}, {"tables": []}, {"tables": ["shp_podu", "pg_user"]}, {"tables": [1]}, [1, 2]
+])
+def test_rebuild_rejects_unknown_tables(admin_client, body):
+    client, started = admin_client
+    assert client.post("/constraint_layers", json=body).status_code == 400
+    assert not started
+
+
+def test_rebuild_accepts_known_tables(admin_client):
+    client, started = admin_client
+    response = client.post("/constraint_layers", json={"tables": ["shp_podu"]})
+    assert response.status_code == 202
+    assert response.json()["data"]["tables"] == ["shp_podu"]
+    status = client.get(response.headers["Location"]).json()
+    assert status["data"]["tables"] == ["shp_podu"]
@@ -0,0 +1,14 @@
+"""
+栅格结果瓦片：COG路径按完整对象名区分用户
+"""
+
+import oge_raster_tiles
+from oge_result_store import result_key
+
+
+def test_cog_paths_are_per_user():
+    first = oge_raster_tiles.cog_path_for(result_key("shandong_aspect_analysis.tif", "u1"))
+    second = oge_raster_tiles.cog_path_for(result_key("shandong_aspect_analysis.tif", "u2"))
+    assert first != second
+    assert first == oge_raster_tiles.COG_DIR / "u1" / "result" / "shandong_aspect_analysis.cog.tif"
+    assert second.is_relative_to(oge_raster_tiles.COG_DIR)
@@ -0,0 +1,61 @@
+"""
+结果登记队列：发送中的记录被重新登记时不重复发送，旧内容的发送结果不覆盖新内容
+"""
+
+import asyncio
+import json
+
+from oge_report_queue import ReportQueue
+
+
+def test_reenqueue_during_send_keeps_lease_and_new_payload(tmp_path):
+    queue = ReportQueue(str(tmp_path / "reports.db"))
+    queue.enqueue("http://catalog.test/register", {"v": 1}, key="dag-1")
+    claimed = queue._claim(10)
+    assert [json.loads(row["payload"]) for row in claimed] == [{"v": 1}]
+
+    queue.enqueue("http://catalog.test/register", {"v": 2}, key="dag-1")
+    assert queue._claim(10) == []                   # 租约仍在，其他发送方不能领取
+    queue._complete([(claimed[0], True, None)])     # 旧内容发送成功，不能把新内容标记为已发送
+
+    again = queue._claim(10)
+    assert [json.loads(row["payload"]) for row in again] == [{"v": 2}]
+    queue._complete([(again[0], True, None)])
+    assert queue._claim(10) == []
+
+
+def test_flush_sends_the_latest_payload(tmp_path):
+    sent = []
+
+    async def sender(url, payload):
+        sent.append(payload)
+        if payload == {"v": 1}:
+            queue.enqueue(url, {"v": 2}, key="dag-1")
+        return True, "ok"
+
+    queue = ReportQueue(str(tmp_path / "reports.db"), sender=sender)
+
+    async def scenario():
+        queue.enqueue("http://catalog.test/register", {"v": 1}, key="dag-1")
+        await queue.flush()
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert sent == [{"v": 1}, {"v": 2}]
+    row = queue._connection().execute("SELECT status, payload FROM reports WHERE key = 'dag-1'").fetchone()
+    assert row["status"] == "sent" and json.loads(row["payload"]) == {"v": 2}
+
+
+def test_existing_databases_gain_the_version_column(tmp_path):
+    import sqlite3
+    path = tmp_path / "reports.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE reports (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE, url TEXT NOT NULL,"
+                 " payload TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+                 " enqueued_at REAL NOT NULL, next_attempt_at REAL NOT NULL, lease_until REAL, last_error TEXT,"
+                 " sent_at REAL)")
+    conn.commit()
+    conn.close()
+    queue = ReportQueue(str(path))
+    queue.enqueue("http://catalog.test/register", {"v": 1}, key="dag-1")
+    assert queue._claim(10)[0]["version"] == 0
@@ -0,0 +1,185 @@
+"""
+结果存储：对S3替身的HEAD/GET与分段下载、本地缓存命中与淘汰、对象名校验
+"""
+
+import asyncio
+
+import pytest
+
+import oge_result_store
+from conftest import s3_handler
+from oge_result_store import InvalidKeyError
+
+
+@pytest.fixture
+def store(stand_in, tmp_path, monkeypatch):
+    """指向S3替身的结果存储，缓存目录放在临时目录；返回 (objects, requests)"""
+    objects, requests = {}, []
+
+    class RecordingS3(s3_handler(objects)):
+        def do_HEAD(self):
+            requests.append(("HEAD", self.path, dict(self.headers)))
+            super().do_HEAD()
+
+        def do_GET(self):
+            requests.append(("GET", self.path, dict(self.headers)))
+            super().do_GET()
+
+    monkeypatch.setattr(oge_result_store, "RESULT_STORE_URL", stand_in(RecordingS3))
+    monkeypatch.setattr(oge_result_store, "RESULT_CACHE_DIR", tmp_path / "cache")
+    return objects, requests
+
+
+def test_download_caches_objects(store):
+    objects, requests = store
+    key = oge_result_store.result_key("村级结果.geojson", "u1")
+    objects[f"oge-user/{key}"] = b'{"type": "FeatureCollection", "features": []}'
+
+    assert asyncio.run(oge_result_store.object_exists(key))
+    path = asyncio.run(oge_result_store.download(key))
+    assert path.read_bytes() == objects[f"oge-user/{key}"]
+    assert path.is_relative_to(oge_result_store.RESULT_CACHE_DIR.resolve())
+
+    # 第二次直接命中本地缓存，不再访问对象存储
+    count = len(requests)
+    assert asyncio.run(oge_result_store.download(key)) == path
+    assert len(requests) == count
+
+
+def test_large_objects_are_downloaded_in_ranges(store, monkeypatch):
+    objects, requests = store
+    monkeypatch.setattr(oge_result_store, "RANGE_CHUNK_SIZE", 1000)
+    body = bytes(range(256)) * 20
+    objects["oge-user/u1/result/big.tif"] = body
+
+    path = asyncio.run(oge_result_store.download("u1/result/big.tif"))
+    assert path.read_bytes() == body
+    ranges = sorted(headers["Range"] for method, _, headers in requests if method == "GET")
+    assert ranges == sorted(f"bytes={start}-{min(start + 1000, len(body)) - 1}" for start in range(0, len(body), 1000))
+    assert not list(path.parent.glob("*.part"))
+
+
+def test_missing_objects(store):
+    assert not asyncio.run(oge_result_store.object_exists("u1/result/none.geojson"))
+    assert asyncio.run(oge_result_store.download("u1/result/none.geojson")) is None
+
+
+def test_requests_are_signed_when_keys_are_configured(store, monkeypatch):
+    objects, requests = store
+    monkeypatch.setattr(oge_result_store, "RESULT_STORE_ACCESS_KEY", "AKIDEXAMPLE")
+    monkeypatch.setattr(oge_result_store, "RESULT_STORE_SECRET_KEY", "secret")
+    objects["oge-user/u1/result/a.geojson"] = b"{}"
+
+    asyncio.run(oge_result_store.download("u1/result/a.geojson"))
+    for _, _, headers in requests:
+        assert headers["Authorization"].startswith("AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/")
+        assert "x-amz-date" in {name.lower() for name in headers}
+
+
+def test_eviction_keeps_cache_under_limit(store, monkeypatch):
+    objects, _ = store
+    monkeypatch.setattr(oge_result_store, "RESULT_CACHE_MAX_BYTES", 2500)
+    for name in ("a", "b", "c"):
+        objects[f"oge-user/u1/result/{name}.tif"] = b"x" * 1000
+        asyncio.run(oge_result_store.download(f"u1/result/{name}.tif"))
+    files, total = oge_result_store.cache_usage()
+    assert files == 2 and total <= 2500
+    assert oge_result_store.cached_file("u1/result/c.tif") is not None
+
+
+@pytest.mark.parametrize("key", [
+    "../etc/passwd", "u1/../../secret", "/abs/path", "u1//result", "u1/./result", "u1\\result", "u1/res\x00ult", ""
+])
+def test_invalid_keys_are_rejected(key):
+    with pytest.raises(InvalidKeyError):
+        oge_result_store.cache_path(key)
+    with pytest.raises(InvalidKeyError):
+        oge_result_store.object_url(key)
+
+
+def test_result_key_rejects_bad_user_ids():
+    for user_id in ("", "u1/../u2", "a/b"):
+        with pytest.raises(InvalidKeyError):
+            oge_result_store.result_key("x.geojson", user_id)
+    with pytest.raises(InvalidKeyError):
+        oge_result_store.result_key("../x.geojson", "u1")
+
+
+def test_parse_range():
+    assert oge_result_store.parse_range("bytes=0-99", 1000) == (0, 99)
+    assert oge_result_store.parse_range("bytes=900-", 1000) == (900, 999)
+    assert oge_result_store.parse_range("bytes=-100", 1000) == (900, 999)
+    assert oge_result_store.parse_range("bytes=0-99,200-299", 1000) is None
+    with pytest.raises(ValueError):
+        oge_result_store.parse_range("bytes=1000-", 1000)
+
+
+def test_rerun_results_are_revalidated_by_etag(store, monkeypatch):
+    objects, requests = store
+    key = "u1/result/shandong_aspect_analysis.tif"
+    objects[f"oge-user/{key}"] = b"first run"
+    path = asyncio.run(oge_result_store.download(key))
+    etag = oge_result_store.cached_meta(key)["etag"]
+
+    # 确认间隔内不访问对象存储；超过间隔后未变化的对象只发一次条件HEAD
+    monkeypatch.setattr(oge_result_store, "RESULT_REVALIDATE_INTERVAL", 0)
+    count = len(requests)
+    assert asyncio.run(oge_result_store.download(key)) == path
+    assert [(method, headers.get("If-None-Match")) for method, _, headers in requests[count:]] == [("HEAD", etag)]
+
+    # 同名结果被重新计算覆盖：丢弃旧文件重新下载
+    objects[f"oge-user/{key}"] = b"second run!"
+    path = asyncio.run(oge_result_store.download(key))
+    assert path.read_bytes() == b"second run!"
+    assert oge_result_store.cached_meta(key)["etag"] != etag
+
+    # 对象被删除时缓存同样失效
+    del objects[f"oge-user/{key}"]
+    assert asyncio.run(oge_result_store.revalidate(key)) is None
+    assert oge_result_store.cached_file(key) is None
+
+
+def test_prefetch_refreshes_cached_results(store):
+    objects, _ = store
+    key = "u1/result/outflow.geojson"
+    objects[f"oge-user/{key}"] = b'{"v": 1}'
+    asyncio.run(oge_result_store.download(key))
+    objects[f"oge-user/{key}"] = b'{"v": 22}'
+
+    async def scenario():
+        prefetcher = oge_result_store.ResultPrefetcher()
+        assert prefetcher.enqueue(key)
+        for _ in range(100):
+            await asyncio.sleep(0.02)
+            if prefetcher.stats["completed"]:
+                break
+        return prefetcher.stats
+
+    assert asyncio.run(scenario())["completed"] == 1
+    assert oge_result_store.cached_file(key).read_bytes() == b'{"v": 22}'
+
+
+def test_results_route_requires_token_or_signed_link(store, monkeypatch):
+    from starlette.testclient import TestClient
+    import shandong_mcp_server_enhanced as srv
+
+    objects, _ = store
+    objects["oge-user/u1/result/a.geojson"] = b'{"type": "FeatureCollection", "features": []}'
+    monkeypatch.setattr(srv, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(srv, "RESULT_LINK_SECRET", "link-secret")
+    client = TestClient(srv.create_starlette_app(srv.mcp._mcp_server))
+
+    assert client.get("/results/u1/a.geojson").status_code == 401
+    assert client.get("/results/u1/a.geojson?expires=9999999999&signature=forged").status_code == 401
+    query = srv.signed_result_query("u1/result/a.geojson")
+    assert client.get(f"/results/u1/b.geojson?{query}").status_code == 401   # 签名只对对应的对象有效
+
+    miss = client.get(f"/results/u1/a.geojson?{query}")
+    assert miss.status_code == 200 and miss.headers["X-Result-Cache"] == "miss"
+    asyncio.run(oge_result_store.download("u1/result/a.geojson"))
+    hits = [client.get("/results/u1/a.geojson", headers={"Authorization": "Bearer admin-secret"}) for _ in range(2)]
+    assert all(r.headers["X-Result-Cache"] == "hit" for r in hits)
+    # 命中时的ETag来自对象存储，不随访问时间变化
+    assert hits[0].headers["ETag"] == hits[1].headers["ETag"] == miss.headers["ETag"]
+    not_modified = client.get(f"/results/u1/a.geojson?{query}", headers={"If-None-Match": miss.headers["ETag"]})
+    assert not_modified.status_code == 304
@@ -0,0 +1,58 @@
+"""
+HTTP路由的参数校验：请求体不是JSON、limit 非正数、vmin/vmax 非数值时返回400（两个服务器一致）
+"""
+
+import importlib
+import json
+
+import pytest
+from starlette.testclient import TestClient
+
+import oge_layer_registry
+
+SERVERS = ["shandong_mcp_server", "shandong_mcp_server_enhanced"]
+
+
+def _client(module):
+    srv = importlib.import_module(module)
+    return srv, TestClient(srv.create_starlette_app(srv.mcp._mcp_server))
+
+
+@pytest.mark.parametrize("module", SERVERS)
+def test_geo_stats_rejects_malformed_bodies(module):
+    _, client = _client(module)
+    for body in (b"{bounds:", b"[1, 2, 3]"):
+        response = client.post("/geo-stats", content=body, headers={"Content-Type": "application/json"})
+        assert response.status_code == 400
+
+
+@pytest.mark.parametrize("module", SERVERS)
+def test_layer_data_rejects_non_positive_limits(module, tmp_path):
+    path = tmp_path / "outflow.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {}, "geometry": {"type": "Point", "coordinates": [117.1, 36.3]}}
+    ]}), encoding="utf-8")
+    oge_layer_registry.register_vector_layer("route-test", "流出结果", path)
+    _, client = _client(module)
+
+    for limit in ("-1", "0", "abc"):
+        assert client.get("/layers/route-test/data", params={"limit": limit}).status_code == 400
+    assert client.get("/layers/route-test/data", params={"limit": "1"}).status_code == 200
+
+
+def test_raster_tile_rejects_bad_value_ranges(monkeypatch, tmp_path):
+    import oge_raster_tiles
+    srv, client = _client("shandong_mcp_server_enhanced")
+
+    async def fake_cog(key):
+        return tmp_path / "a.cog.tif"
+
+    async def fake_info(path):
+        return {"min": 0.0, "max": 360.0}
+
+    monkeypatch.setattr(oge_raster_tiles, "available", lambda: True)
+    monkeypatch.setattr(srv, "ensure_result_cog", fake_cog)
+    monkeypatch.setattr(srv, "result_raster_info", fake_info)
+    url = "/raster/u1/a.tif/tiles/10/850/400.png"
+    for params in ({"vmin": "abc"}, {"vmax": "nan"}, {"vmin": "inf"}, {"vmin": "10", "vmax": "5"}):
+        assert client.get(url, params=params).status_code == 400
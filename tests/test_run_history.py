@@ -0,0 +1,88 @@
+"""
+运行记录：定时写出未满批的行，合并已过去日期的小分段且查询不重复计数
+"""
+
+import asyncio
+import time
+
+import oge_run_history
+from oge_run_history import RunHistory
+
+
+def test_timer_flushes_partial_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(oge_run_history, "RUN_HISTORY_FLUSH_INTERVAL", 0.05)
+    history = RunHistory(str(tmp_path))
+
+    async def scenario():
+        history.start()
+        history.record({"analysis": "farmland_outflow", "total": 12.5, "outcome": "completed"})
+        assert not list(tmp_path.glob("runs-*.col"))
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            if list(tmp_path.glob("runs-*.col")):
+                break
+        history.stop()
+
+    asyncio.run(scenario())
+    assert len(list(tmp_path.glob("runs-*.col"))) == 1
+    assert history.snapshot()["buffered"] == 0
+
+
+def test_compaction_merges_closed_days_without_double_counting(tmp_path):
+    history = RunHistory(str(tmp_path))
+    yesterday = time.time() - 86400
+    for i in range(3):
+        history.record({"started_at": yesterday + i, "analysis": "farmland_outflow", "total": float(i),
+                        "cluster": f"dag-{i % 2}", "outcome": "completed"})
+        history.flush()
+    history.record({"analysis": "farmland_outflow", "total": 9.0, "outcome": "failed"})
+    history.flush()
+    day = oge_run_history._day(yesterday)
+    assert len(list(tmp_path.glob(f"runs-{day}-*.col"))) == 3
+
+    assert history.compact_closed_days() == 3
+    segments = list(tmp_path.glob(f"runs-{day}-*.col"))
+    assert len(segments) == 1
+    # 当天的分段不合并
+    assert len(list(tmp_path.glob("runs-*.col"))) == 2
+
+    data = history.scan(yesterday - 1, columns=["total", "cluster", "outcome"])
+    assert sorted(data["total"]) == [0.0, 1.0, 2.0, 9.0]
+    assert sorted(data["cluster"], key=str) == [None, "dag-0", "dag-0", "dag-1"]
+
+
+def test_scan_skips_segments_replaced_by_a_merge(tmp_path):
+    history = RunHistory(str(tmp_path))
+    yesterday = time.time() - 86400
+    for i in range(2):
+        history.record({"started_at": yesterday + i, "total": float(i)})
+        history.flush()
+    old = sorted(tmp_path.glob("runs-*.col"))
+    # 模拟合并后、删除旧分段前的状态：合并分段与旧分段同时存在
+    block_rows = []
+    for path in old:
+        block = history._read_segment(path, list(oge_run_history.COLUMNS))
+        block_rows.extend({name: block[name][i] for name in oge_run_history.COLUMNS}
+                          for i in range(block["header"]["rows"]))
+    history._write_segment(oge_run_history._day(yesterday), block_rows, replaces=[p.name for p in old])
+    assert sorted(history.scan(yesterday - 1, columns=["total"])["total"]) == [0.0, 1.0]
+
+
+def test_stats_tool_is_registered(tmp_path, monkeypatch):
+    import json
+    import shandong_mcp_server_enhanced as srv
+
+    history = RunHistory(str(tmp_path))
+    history.record({"started_at": time.time(), "total": 3.0, "analysis": "aspect"})
+    history.flush()
+    monkeypatch.setattr(oge_run_history, "_history", history)
+
+    async def scenario():
+        names = {tool.name for tool in await srv.mcp.list_tools()}
+        assert "run_history_stats" in names
+        return await srv.mcp.call_tool("run_history_stats", {"window": "1h", "group_by": "analysis"})
+
+    content = asyncio.run(scenario())
+    content = content[0] if isinstance(content, tuple) else content
+    data = json.loads(content[0].text)
+    assert data["success"] and data["data"]["groups"]["aspect"]["runs"] == 1
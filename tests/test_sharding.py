@@ -0,0 +1,103 @@
+"""
+分片光环：候选耕地只查询与本次计算的村相邻的村；结果按村缓存与合并只在进程间传递文件路径
+"""
+
+import json
+
+import pytest
+
+import oge_village_cache
+from oge_sharding import halo_villages, parse_villages, strip_villages, with_villages, write_merged_outflow
+
+BOUNDS = {
+    "东村": (121.00, 37.00, 121.01, 37.01),
+    "西村": (121.0105, 37.00, 121.02, 37.01),     # 与东村相距约50米
+    "南村": (121.00, 36.90, 121.01, 36.91),       # 相距约10公里
+}
+
+
+def test_halo_keeps_neighbours_and_drops_distant_villages():
+    halo = halo_villages(["东村"], ["东村", "西村", "南村", "北村"], BOUNDS, margin=0.002)
+    assert halo[0] == "东村"
+    assert "西村" in halo
+    assert "南村" not in halo
+    # 没有范围信息的村无法排除，保留在光环中
+    assert "北村" in halo
+
+
+def test_halo_requires_bounds_for_core_villages():
+    assert halo_villages(["北村"], ["东村", "北村"], BOUNDS) is None
+
+
+def test_halo_query_filters_by_village():
+    sql = "SELECT * FROM shp_guotubiangeng WHERE DLMC IN ('旱地') AND ZLDWMC IN ('东村')"
+    halo = halo_villages(["东村"], ["东村", "西村", "南村"], BOUNDS)
+    query = with_villages(sql, halo)
+    assert query == f"{strip_villages(sql)} AND ZLDWMC IN ('东村', '西村')"
+
+
+@pytest.mark.parametrize("sql, stripped", [
+    ("SELECT * FROM t WHERE DLMC IN ('旱地') AND ZLDWMC IN ('东村', '西村')",
+     "SELECT * FROM t WHERE DLMC IN ('旱地')"),
+    ("SELECT * FROM t WHERE ZLDWMC IN ('东村', '西村') AND DLMC IN ('旱地')",
+     "SELECT * FROM t WHERE DLMC IN ('旱地')"),
+    ("SELECT * FROM t WHERE DLMC IN ('旱地') AND ZLDWMC IN ('东村', '西村') AND YEAR = 2023",
+     "SELECT * FROM t WHERE DLMC IN ('旱地') AND YEAR = 2023"),
+    ("SELECT * FROM t WHERE ZLDWMC IN ('东村', '西村')", "SELECT * FROM t"),
+])
+def test_strip_villages_keeps_the_other_conditions(sql, stripped):
+    assert parse_villages(sql) == ["东村", "西村"]
+    assert strip_villages(sql) == stripped
+    assert with_villages(sql, ["南村"]) == f"{stripped} {'AND' if 'DLMC' in stripped else 'WHERE'} ZLDWMC IN ('南村')"
+
+
+def _feature(village, reason, area):
+    return {"type": "Feature", "properties": {"ZLDWMC": village, "reason": reason, "area": area}, "geometry": None}
+
+
+def test_village_cache_and_merge_work_from_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(oge_village_cache, "VILLAGE_CACHE_DIR", tmp_path / "village_cache")
+    result = tmp_path / "shard0.geojson"
+    result.write_text(json.dumps({"type": "FeatureCollection", "features": [
+        _feature("东村", "urban", 2), _feature("西村", "slope", 3), _feature("南村", "urban", 5)
+    ]}), encoding="utf-8")
+
+    parts = oge_village_cache.store_file(str(result), ["东村", "西村"], "sig-files")
+    assert {village: part["features"] for village, part in parts.items()} == {"东村": 1, "西村": 1}
+    oge_village_cache.register(parts, "sig-files", "dag-1")
+    cached, missing = oge_village_cache.lookup(["东村", "西村", "北村"], "sig-files")
+    assert set(cached) == {"东村", "西村"} and missing == ["北村"]
+
+    merged = tmp_path / "merged.geojson"
+    summary = write_merged_outflow([cached["东村"], str(result)], [{"东村"}, {"西村"}], str(merged))
+    assert summary == {"urban": {"count": 1, "area": 2.0}, "slope": {"count": 1, "area": 3.0}}
+    assert len(json.loads(merged.read_text(encoding="utf-8"))["features"]) == 2
+
+
+def _box(minx, miny, maxx, maxy):
+    return [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]
+
+
+def test_halo_uses_boundary_file_and_ignores_derived_hulls(tmp_path, monkeypatch):
+    import oge_gazetteer
+    import shandong_mcp_server_enhanced as srv
+
+    sql = "SELECT * FROM shp_guotubiangeng WHERE DLMC IN ('旱地') AND ZLDWMC IN ('东村')"
+    monkeypatch.setattr(oge_gazetteer, "BOUNDARY_FILE", tmp_path / "boundaries.geojson")
+    monkeypatch.setattr(oge_gazetteer, "_gazetteer", None)
+    # 只有结果地块凸包：凸包比村的实际范围小，不能用来排除邻村，光环退回全镇
+    state = oge_gazetteer.get_state_backend()
+    previous = state.get(oge_gazetteer.DERIVED_KEY)
+    state.set(oge_gazetteer.DERIVED_KEY, {name: _box(*box) for name, box in BOUNDS.items()})
+    try:
+        assert srv.halo_query_for(sql, ["东村"], ["东村", "西村", "南村"]) == strip_villages(sql)
+
+        (tmp_path / "boundaries.geojson").write_text(json.dumps({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {"name": name, "level": "village"},
+             "geometry": {"type": "Polygon", "coordinates": [_box(*box)]}} for name, box in BOUNDS.items()
+        ]}, ensure_ascii=False), encoding="utf-8")
+        monkeypatch.setattr(oge_gazetteer, "_gazetteer", None)
+        assert srv.halo_query_for(sql, ["东村"], ["东村", "西村", "南村"]) == \
+            f"{strip_villages(sql)} AND ZLDWMC IN ('东村', '西村')"
+    finally:
+        state.set(oge_gazetteer.DERIVED_KEY, previous or {})
@@ -0,0 +1,64 @@
+"""
+共享状态后端：过期行的清理、锁只由持有者释放、队列的追加与取出
+"""
+
+import time
+
+import oge_shared_state
+from oge_shared_state import RedisStateBackend, SQLiteStateBackend
+
+
+def _rows(backend, table):
+    return backend._connection().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_expired_rows_are_purged_on_write(tmp_path, monkeypatch):
+    backend = SQLiteStateBackend(str(tmp_path / "state.db"))
+    for i in range(5):
+        backend.set(f"dag_status:{i}", {"i": i}, ttl=0.01)
+    backend.push("mcp_sse:inbox:x", {"body": "{}"}, ttl=0.01)
+    backend.set("auth:intranet_token", "token")
+    time.sleep(0.02)
+    assert backend.get("dag_status:0") is None
+
+    monkeypatch.setattr(oge_shared_state, "EXPIRED_PURGE_INTERVAL", 0)
+    backend.set("catalog:regions", [1, 2])
+    assert _rows(backend, "kv") == 2
+    assert _rows(backend, "queue") == 0
+    assert backend.get("auth:intranet_token") == "token"
+
+
+def test_release_lock_only_deletes_own_token(tmp_path):
+    backend = SQLiteStateBackend(str(tmp_path / "state.db"))
+    first = backend.acquire_lock("token_refresh", ttl=0.01)
+    time.sleep(0.02)
+    second = backend.acquire_lock("token_refresh", ttl=30)
+    assert first and second and first != second
+
+    backend.release_lock("token_refresh", first)   # 过期的持有者释放时不能删掉新持有者的锁
+    assert backend.acquire_lock("token_refresh", ttl=30) is None
+    backend.release_lock("token_refresh", second)
+    assert backend.acquire_lock("token_refresh", ttl=30) is not None
+
+
+def test_queue_pops_in_order(tmp_path):
+    backend = SQLiteStateBackend(str(tmp_path / "state.db"))
+    for i in range(3):
+        backend.push("q", {"n": i}, ttl=30)
+    assert backend.pop_all("q") == [{"n": 0}, {"n": 1}, {"n": 2}]
+    assert backend.pop_all("q") == []
+
+
+def test_redis_release_lock_is_a_single_compare_and_delete():
+    commands = []
+
+    class RecordingRedis(RedisStateBackend):
+        def _execute(self, *args):
+            commands.append(args)
+            return 1
+
+    RecordingRedis("redis://127.0.0.1:6379/0").release_lock("token_refresh", "abc")
+    assert len(commands) == 1
+    command, script, numkeys, key, token = commands[0]
+    assert command == "EVAL" and numkeys == "1" and key == "lock:token_refresh" and token == '"abc"'
+    assert "GET" in script and "DEL" in script
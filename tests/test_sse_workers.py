@@ -0,0 +1,123 @@
+"""
+多worker模式的MCP SSE：会话建立在一个worker上，发往其他worker的 /messages/ 经共享状态转交
+"""
+
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+from conftest import ROOT
+
+INITIALIZE = {"jsonrpc": "2.0", "id": 0, "method": "initialize", "params": {
+    "protocolVersion": "2024-11-05", "capabilities": {}, "clientInfo": {"name": "test", "version": "1"}}}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _events(response, queue: asyncio.Queue):
+    """把SSE事件 (event, data) 放入队列"""
+    event = None
+    async for line in response.aiter_lines():
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            await queue.put((event, line[len("data:"):].strip()))
+
+
+def _messages(count: int) -> list:
+    """initialize、initialized通知，再加若干ping；带id的请求各有一个响应"""
+    return [INITIALIZE, {"jsonrpc": "2.0", "method": "notifications/initialized"}] + [
+        {"jsonrpc": "2.0", "id": i, "method": "ping"} for i in range(1, count)]
+
+
+async def _session(sse_url: str, message_bases: list, count: int):
+    """
+    在 sse_url 上建立会话，轮流向 message_bases POST（每条消息新建连接），返回各POST的状态码和SSE上收到的响应id
+    """
+    queue = asyncio.Queue()
+    async with httpx.AsyncClient(timeout=20) as client:
+        async with client.stream("GET", sse_url) as response:
+            reader = asyncio.create_task(_events(response, queue))
+            event, endpoint = await asyncio.wait_for(queue.get(), 10)
+            assert event == "endpoint"
+
+            statuses = []
+            for i, message in enumerate(_messages(count)):
+                base = message_bases[i % len(message_bases)]
+                async with httpx.AsyncClient(timeout=10) as poster:
+                    reply = await poster.post(base + endpoint, json=message, headers={"Connection": "close"})
+                statuses.append(reply.status_code)
+
+            received = set()
+            while len(received) < count:
+                event, data = await asyncio.wait_for(queue.get(), 10)
+                if event == "message":
+                    received.add(json.loads(data).get("id"))
+            reader.cancel()
+    return statuses, received
+
+
+def test_messages_posted_to_another_worker_reach_the_session():
+    """两个应用实例（两个worker）共用共享状态：在A上建立会话，消息发给B"""
+    import uvicorn
+    import shandong_mcp_server_enhanced as srv
+
+    ports = [_free_port(), _free_port()]
+
+    async def scenario():
+        servers = [uvicorn.Server(uvicorn.Config(
+            srv.create_starlette_app(srv.mcp._mcp_server, shared_sessions=True),
+            host="127.0.0.1", port=port, lifespan="off", log_level="warning")) for port in ports]
+        tasks = [asyncio.create_task(server.serve()) for server in servers]
+        while not all(server.started for server in servers):
+            await asyncio.sleep(0.05)
+        try:
+            return await _session(f"http://127.0.0.1:{ports[0]}/sse", [f"http://127.0.0.1:{ports[1]}"], 4)
+        finally:
+            for server in servers:
+                server.should_exit = True
+            await asyncio.gather(*tasks)
+
+    statuses, received = asyncio.run(scenario())
+    assert statuses == [202] * 5
+    assert received == {0, 1, 2, 3}
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uvicorn多worker依赖fork/spawn子进程与信号")
+def test_sse_session_with_multiple_workers(tmp_path):
+    """以 --workers 2 启动服务器，每条消息新建连接，无论落到哪个worker都要送达会话"""
+    port = _free_port()
+    env = dict(os.environ, OGE_STATE_BACKEND=f"sqlite:///{tmp_path / 'shared_state.db'}")
+    server = subprocess.Popen(
+        [sys.executable, str(ROOT / "shandong_mcp_server_enhanced.py"), "--mode", "http",
+         "--host", "127.0.0.1", "--port", str(port), "--workers", "2"],
+        cwd=tmp_path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                if httpx.get(f"{base}/health", timeout=1).status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            assert server.poll() is None and time.time() < deadline, "服务器未能启动"
+            time.sleep(0.2)
+
+        statuses, received = asyncio.run(_session(f"{base}/sse", [base], 12))
+        assert statuses == [202] * 13
+        assert received == set(range(12))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
@@ -0,0 +1,41 @@
+"""
+取消被放弃的集群任务：只有Livy确认取消后才标记为killed
+"""
+
+import asyncio
+
+from conftest import JsonHandler
+
+
+def livy_batches_handler(batches: dict, deleted: list):
+    """Livy批任务替身：DELETE 已知批任务返回200，未知批任务返回404"""
+
+    class BatchHandler(JsonHandler):
+        def do_DELETE(self):
+            batch_id = self.path.strip("/").split("/")[-1]
+            deleted.append(batch_id)
+            if batches.pop(batch_id, None) is None:
+                return self.send_json({"msg": f"Session '{batch_id}' not found."}, 404)
+            return self.send_json({"msg": "deleted"})
+
+    return BatchHandler
+
+
+def test_cancel_marks_killed_only_when_livy_confirms(stand_in, monkeypatch):
+    import shandong_mcp_server_enhanced as srv
+
+    batches, deleted = {"41": "running"}, []
+    monkeypatch.setattr(srv, "LIVY_API_URL", stand_in(livy_batches_handler(batches, deleted)))
+    monkeypatch.setattr(srv, "DAG_CANCEL_PATH", "")
+    store = srv.get_task_store()
+    store.register("dag-cancel-ok", batch_session_id="41", state="running")
+    store.register("dag-cancel-gone", batch_session_id="42", state="running")
+
+    asyncio.run(srv.cancel_cluster_job("dag-cancel-ok"))
+    asyncio.run(srv.cancel_cluster_job("dag-cancel-gone"))
+
+    assert deleted == ["41", "42"]
+    assert store.get("dag-cancel-ok")["status"] == "cancelled"
+    gone = store.get("dag-cancel-gone")
+    assert gone["status"] == "running"
+    assert gone["detail"]["cancel_attempt"] == "not_found"
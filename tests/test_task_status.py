@@ -0,0 +1,51 @@
+"""
+任务状态查询：成功须由结果目录确认，getState 报告失败时即使目录没有记录也立即结束
+"""
+
+import asyncio
+import json
+
+import pytest
+
+
+@pytest.fixture
+def dag_api(monkeypatch):
+    """替换 call_api_with_timing：getState 返回 states[dag_id]，目录返回 catalog 中的记录"""
+    import shandong_mcp_server_enhanced as srv
+
+    states, catalog = {}, []
+
+    async def fake_call(url, method="POST", params=None, **kwargs):
+        if url.endswith("/getState"):
+            return {"status": states[params["dagId"]]}, 0.01
+        return {"data": [item for item in catalog if item["dagId"] == params["dagId"]]}, 0.01
+
+    monkeypatch.setattr(srv, "call_api_with_timing", fake_call)
+    return srv, states, catalog
+
+
+def _status(srv, dag_id):
+    return json.loads(asyncio.run(srv.query_task_status(dag_id)))["data"]
+
+
+def test_failed_state_is_final_without_catalog_entry(dag_api):
+    srv, states, _ = dag_api
+    states["dag-status-dead"] = "dead"
+    srv.get_task_store().register("dag-status-dead", state="running")
+    data = _status(srv, "dag-status-dead")
+    assert data["is_failed"] and not data["is_completed"]
+    assert data["final_state"] == "dead"
+    assert srv.get_task_store().get("dag-status-dead")["status"] == "failed"
+
+
+def test_success_needs_catalog_confirmation(dag_api):
+    srv, states, catalog = dag_api
+    states["dag-status-ok"] = "success"
+    data = _status(srv, "dag-status-ok")
+    assert not data["is_completed"] and not data["is_failed"]
+
+    # 未结束的状态只短期缓存，过期后重新查询时目录已有记录
+    srv.get_state_backend().delete(f"{srv.DAG_STATUS_KEY_PREFIX}dag-status-ok")
+    catalog.append({"dagId": "dag-status-ok", "state": "success"})
+    data = _status(srv, "dag-status-ok")
+    assert data["is_completed"] and data["final_state"] == "success"
@@ -0,0 +1,108 @@
+"""
+本地地形引擎：坡向约定与集群一致（正北0度顺时针、平地-1），以及 terrain_engine_cross_check 的比较流程
+"""
+
+import asyncio
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import oge_terrain
+from conftest import FIXTURES
+
+
+def _plane(rows, cols, east=0.0, north=0.0):
+    """高程随东向、北向线性变化的平面，数组行自北向南"""
+    y, x = np.mgrid[0:rows, 0:cols]
+    return 100.0 + east * x - north * y
+
+
+@pytest.mark.parametrize("kernel", oge_terrain.KERNELS)
+@pytest.mark.parametrize("east, north, expected", [
+    (1.0, 0.0, 270.0),     # 东高西低，下坡朝西
+    (-1.0, 0.0, 90.0),
+    (0.0, 1.0, 180.0),     # 北高南低，下坡朝南
+    (0.0, -1.0, 0.0),
+])
+def test_aspect_convention(kernel, east, north, expected):
+    slope, aspect = oge_terrain.slope_aspect(_plane(8, 8, east, north), 1 / 3600, 37.5, kernel)
+    inner = aspect[1:-1, 1:-1]
+    assert np.allclose(inner, expected)
+    assert np.all(slope[1:-1, 1:-1] > 0)
+    assert np.isnan(aspect[0]).all()
+
+
+def test_flat_terrain_is_minus_one():
+    _, aspect = oge_terrain.slope_aspect(np.full((5, 5), 42.0), 1 / 3600, 37.5)
+    assert np.all(aspect[1:-1, 1:-1] == oge_terrain.FLAT_ASPECT)
+
+
+def test_compare_aspect_is_circular():
+    local = np.array([[359.0, 10.0], [oge_terrain.FLAT_ASPECT, np.nan]])
+    reference = np.array([[1.0, 10.5], [oge_terrain.FLAT_ASPECT, 5.0]])
+    comparison = oge_terrain.compare_aspect(local, reference, tolerance=1.0)
+    assert comparison["compared_pixels"] == 2
+    assert comparison["max_diff"] == 2.0
+    assert comparison["within_tolerance"] == 0.5
+    assert comparison["flat_mismatch"] == 0
+    with pytest.raises(ValueError):
+        oge_terrain.compare_aspect(local, reference[:1], 1.0)
+
+
+def _reference_fixture():
+    """集群坡向参考：DEM分幅与同一网格上的坡向输出（fixtures/terrain）"""
+    doc = json.loads((FIXTURES / "terrain" / "aspect_N37E121.json").read_text(encoding="utf-8"))
+    to_array = lambda rows: np.array([[np.nan if v is None else v for v in row] for row in rows], dtype=np.float64)
+    return doc, to_array(doc["dem"]), to_array(doc["aspect"]), to_array(doc["slope"])
+
+
+def test_engine_matches_reference_output():
+    doc, dem, aspect, slope = _reference_fixture()
+    local_slope, local_aspect = oge_terrain.slope_aspect(dem, doc["pixel_size"], doc["north"], "horn")
+    comparison = oge_terrain.compare_aspect(local_aspect, aspect, tolerance=0.01)
+    assert comparison["compared_pixels"] == 48 * 48
+    assert comparison["within_tolerance"] == 1.0 and comparison["flat_mismatch"] == 0
+    assert np.allclose(local_slope[1:-1, 1:-1], slope[1:-1, 1:-1], atol=1e-3)
+
+
+def test_cross_check_tool_compares_against_cluster_output(tmp_path, monkeypatch):
+    pytest.importorskip("rasterio")
+    import shandong_mcp_server_enhanced as srv
+
+    doc, dem, aspect, _ = _reference_fixture()
+    pixel = doc["pixel_size"]
+    monkeypatch.setattr(oge_terrain, "DEM_STORE_DIR", tmp_path / "dem")
+    oge_terrain.write_geotiff(oge_terrain.DEM_STORE_DIR / oge_terrain.dem_tile_name(121, 37),
+                              dem, doc["west"], doc["north"], pixel)
+    reference = oge_terrain.write_geotiff(tmp_path / "reference.tif", aspect, doc["west"], doc["north"], pixel)
+    submitted = []
+
+    async def fake_workflow(**kwargs):
+        submitted.append(kwargs)
+        return json.dumps({"success": True, "data": {"final_status": "completed"}})
+
+    async def fake_fetch(filename, ext, user_id=srv.DEFAULT_USER_ID):
+        return reference
+
+    monkeypatch.setattr(srv, "execute_dag_workflow", fake_workflow)
+    monkeypatch.setattr(srv, "fetch_result_file", fake_fetch)
+
+    result = json.loads(asyncio.run(srv.terrain_engine_cross_check([121.3, 37.3, 121.6, 37.6], tolerance=0.01)))
+    assert result["success"], result["msg"]
+    assert "Coverage.aspect" in submitted[0]["code"]
+    comparison = result["data"]["comparison"]
+    assert comparison["compared_pixels"] > 0
+    assert comparison["within_tolerance"] == 1.0
+
+
+def test_dem_window_masks_padding_outside_the_tile(tmp_path, monkeypatch):
+    pytest.importorskip("rasterio")
+    monkeypatch.setattr(oge_terrain, "DEM_STORE_DIR", tmp_path / "dem")
+    # 分幅只覆盖 121.0~121.9 度：窗口超出部分不能当作高程0
+    oge_terrain.write_geotiff(oge_terrain.DEM_STORE_DIR / oge_terrain.dem_tile_name(121, 37),
+                              np.full((50, 45), 500.0), 121.0, 38.0, 0.02)
+    dem, _, _ = oge_terrain.read_dem_window([121.8, 37.4, 121.98, 37.5], 0.02)
+    assert np.all(dem[:, :5] == 500.0)
+    assert np.isnan(dem[:, -4:]).all()
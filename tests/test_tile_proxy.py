@@ -0,0 +1,42 @@
+"""
+瓦片代理：磁盘缓存的元数据与内容在同一个文件中，预热接口需要维护令牌
+"""
+
+from starlette.testclient import TestClient
+
+from oge_tile_proxy import TileProxy
+
+
+def test_disk_cache_round_trip(tmp_path):
+    proxy = TileProxy(cache_dir=tmp_path)
+    key = ("ogeArable", 12, 3405, 1551)
+    tile = {"status": 200, "content_type": "application/x-protobuf", "content_encoding": "gzip",
+            "body": b"\x1f\x8b\n\x00binary\nbody"}
+    proxy._write_disk(key, tile)
+    assert proxy._read_disk(key) == tile
+    assert [p.name for p in (tmp_path / "ogeArable" / "12" / "3405").iterdir()] == ["1551.tile"]
+
+    proxy._write_disk(key, {**tile, "status": 204, "body": b""})
+    assert proxy._read_disk(key) == {**tile, "status": 204, "body": b""}
+
+
+def test_seeding_requires_admin_token(monkeypatch):
+    import shandong_mcp_server_enhanced as srv
+
+    seeded = []
+
+    async def fake_seed(**kwargs):
+        seeded.append(kwargs)
+        return {"tiles": 0}
+
+    monkeypatch.setattr(srv, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(srv.tile_proxy, "seed", fake_seed)
+    client = TestClient(srv.create_starlette_app(srv.mcp._mcp_server))
+
+    assert client.get("/tile_proxy").status_code == 200
+    assert client.post("/tile_proxy", json={"zooms": [14]}).status_code == 401
+    assert not seeded
+    headers = {"Authorization": "Bearer admin-secret"}
+    assert client.post("/tile_proxy", content=b"{", headers=headers).status_code == 400
+    assert client.post("/tile_proxy", json={"zooms": [14]}, headers=headers).status_code == 200
+    assert seeded == [{"zooms": [14]}]
@@ -0,0 +1,51 @@
+"""
+坡向分析的瓦片化：返回的拼接清单格式、瓦片结果缓存后平移只计算新增瓦片
+"""
+
+import asyncio
+import json
+
+import pytest
+
+
+@pytest.fixture
+def aspect_api(monkeypatch):
+    """替换 call_api_with_timing：记录每次提交的瓦片范围，返回带范围的假结果"""
+    import shandong_mcp_server_enhanced as srv
+
+    submitted = []
+
+    async def fake_call(url, json_data=None, **kwargs):
+        bbox = json_data["args"]["coverage"]["preParams"]["bbox"]
+        submitted.append(bbox)
+        return {"code": 200, "data": {"bbox": bbox}}, 0.01
+
+    monkeypatch.setattr(srv, "call_api_with_timing", fake_call)
+    return srv, submitted
+
+
+def _run(srv, bbox, **kwargs):
+    return json.loads(asyncio.run(srv.coverage_aspect_analysis(bbox, engine="cluster", **kwargs)))
+
+
+def test_manifest_shape(aspect_api):
+    srv, submitted = aspect_api
+    result = _run(srv, [117.05, 36.25, 117.15, 36.35], radius=3)
+    assert result["success"]
+    data = result["data"]
+    assert data["grid_shape"] == [2, 2] and data["computed_tiles"] == 4 and data["cached_tiles"] == 0
+    # 自北向南、自西向东，核心范围裁剪到请求窗口
+    assert [item["tile"] for item in data["tiles"]] == [[1170, 363], [1171, 363], [1170, 362], [1171, 362]]
+    assert data["tiles"][0]["window_bbox"] == pytest.approx([117.05, 36.3, 117.1, 36.35])
+    # 每个瓦片保留集群的原始返回，提交范围外扩了 radius 个像元
+    first = data["tiles"][0]
+    assert first["result"]["data"]["bbox"] == pytest.approx([117.0 - 3 / 3600, 36.3 - 3 / 3600, 117.1 + 3 / 3600, 36.4 + 3 / 3600])
+    assert len(submitted) == 4
+
+
+def test_panned_window_computes_only_new_tiles(aspect_api):
+    srv, submitted = aspect_api
+    _run(srv, [116.01, 35.01, 116.09, 35.09], radius=5)
+    data = _run(srv, [116.01, 35.01, 116.19, 35.09], radius=5)["data"]
+    assert data["cached_tiles"] == 1 and data["computed_tiles"] == 1
+    assert len(submitted) == 2